@@ -4,6 +4,7 @@ Only L-BFGS-B and Powell is supported in this class for versions of
 Scipy < 0.12. All optimizers are available for scipy >= 0.12.
 """
 import abc
+import copy
 from distutils.version import LooseVersion
 import numpy as np
 import scipy
@@ -393,6 +394,110 @@ def sparse_nnls(y, X,
         iteration += 1
 
 
+def batch_leastsq(fun, x0, bounds=None, x_scale=1., ftol=1e-10, xtol=1e-10,
+                  max_iter=100, lambda0=1e-3):
+    """Solve many independent non-linear least-squares problems at once
+
+    A Levenberg-Marquardt iteration is run simultaneously on every problem:
+    the normal equations of all problems are assembled and solved with
+    stacked linear algebra, and only the problems which have not converged
+    yet are updated. Steps leaving the bounds are projected back onto them.
+
+    Parameters
+    ----------
+    fun : callable
+        ``fun(x, index)`` returns the residuals, shape (k, m), and their
+        Jacobian with respect to the parameters, shape (k, m, p), of the
+        problems ``index`` (an integer array of length k) evaluated at the
+        parameters ``x``, shape (k, p).
+    x0 : array, shape (n, p)
+        Initial guess of each of the n problems.
+    bounds : 2-tuple of arrays of shape (p,), optional
+        Lower and upper bounds of the parameters. Default: unbounded.
+    x_scale : float or array of shape (p,), optional
+        Characteristic scale of each parameter. The iteration is carried out
+        on the parameters divided by ``x_scale``.
+    ftol : float, optional
+        A problem has converged when a step decreases its cost by less than
+        ``ftol`` times the cost.
+    xtol : float, optional
+        A problem has converged when the norm of a step of its scaled
+        parameters is less than ``xtol * (xtol + norm(scaled parameters))``.
+    max_iter : int, optional
+        Maximum number of iterations.
+    lambda0 : float, optional
+        Initial damping of the Levenberg-Marquardt iteration.
+
+    Returns
+    -------
+    x : array, shape (n, p)
+        The estimated parameters.
+    cost : array, shape (n,)
+        The sum of squared residuals of each problem at ``x``.
+    """
+    x = np.array(x0, dtype=float, copy=True)
+    n, p = x.shape
+    x_scale = np.broadcast_to(np.asarray(x_scale, dtype=float), (p,))
+    if bounds is None:
+        lower = np.full(p, -np.inf)
+        upper = np.full(p, np.inf)
+    else:
+        lower = np.broadcast_to(np.asarray(bounds[0], dtype=float), (p,))
+        upper = np.broadcast_to(np.asarray(bounds[1], dtype=float), (p,))
+
+    residuals, jac = fun(x, np.arange(n))
+    cost = np.sum(residuals ** 2, axis=-1)
+    # Problems which can not be evaluated at their initial guess are left
+    # untouched
+    active = np.flatnonzero(np.isfinite(cost))
+    residuals = residuals[active]
+    jac = jac[active]
+    lam = np.full(n, lambda0)
+    eye = np.eye(p)
+
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        jac_s = jac * x_scale
+        JtJ = np.einsum('kmi,kmj->kij', jac_s, jac_s)
+        grad = np.einsum('kmi,km->ki', jac_s, residuals)
+        diag = np.einsum('kii->ki', JtJ)
+        # The small identity term keeps the system invertible when a
+        # parameter does not influence the residuals
+        damping = (lam[active, None] * diag +
+                   1e-12 * diag.max(-1, keepdims=True) + 1e-300)
+        A = JtJ + damping[..., None] * eye
+        step = -np.linalg.solve(A, grad[..., None])[..., 0]
+        x_new = np.clip(x[active] + step * x_scale, lower, upper)
+        step = (x_new - x[active]) / x_scale
+
+        new_residuals, new_jac = fun(x_new, active)
+        new_cost = np.sum(new_residuals ** 2, axis=-1)
+        better = new_cost < cost[active]
+
+        x_norm = np.sqrt(np.sum((x[active] / x_scale) ** 2, axis=-1))
+        small_step = (np.sqrt(np.sum(step ** 2, axis=-1)) <=
+                      xtol * (xtol + x_norm))
+        small_decrease = cost[active] - new_cost <= ftol * cost[active]
+        converged = ((better & (small_decrease | small_step)) |
+                     (~better & (lam[active] > 1e16)))
+
+        improved = active[better]
+        x[improved] = x_new[better]
+        cost[improved] = new_cost[better]
+        lam[improved] /= 10.
+        lam[active[~better]] *= 10.
+        residuals = np.where(better[:, None], new_residuals, residuals)
+        jac = np.where(better[:, None, None], new_jac, jac)
+
+        keep = ~converged
+        active = active[keep]
+        residuals = residuals[keep]
+        jac = jac[keep]
+
+    return x, cost
+
+
 class SKLearnLinearSolver(with_metaclass(abc.ABCMeta, object)):
     """
     Provide a sklearn-like uniform interface to algorithms that solve problems
@@ -446,3 +551,158 @@ class NonNegativeLeastSquares(SKLearnLinearSolver):
         coef, rnorm = opt.nnls(X, y)
         self.coef_ = coef
         return self
+
+
+class NonNegativeElasticNet(SKLearnLinearSolver):
+    """
+    A non-negative elastic net solving many signals at once
+
+    Minimizes, for each column $y$ of the data and with $n$ the number of
+    samples:
+
+    .. math::
+
+        \\frac{1}{2n}\\|y - Xb\\|^2_2 + \\alpha \\rho \\|b\\|_1 +
+        \\frac{\\alpha(1 - \\rho)}{2}\\|b\\|^2_2, \\quad b \\geq 0
+
+    with $\\rho$ the `l1_ratio`, which is the objective of
+    `sklearn.linear_model.ElasticNet(positive=True)`. The problems are solved
+    with the alternating direction method of multipliers (ADMM) [Boyd2011]_.
+    The design matrix is factorized once (a thin SVD) and every iteration
+    updates all the signals with two matrix products, so fitting many signals
+    sharing one design matrix is much faster than one fit per signal. The
+    penalty parameter of the ADMM is adapted separately for every signal.
+
+    Parameters
+    ----------
+    alpha : float, optional
+        Weight of the penalty terms. Default: 0.001
+    l1_ratio : float, optional
+        Balance between the L1 and the L2 penalties. Default: 0.5
+    fit_intercept : bool, optional
+        Whether to fit an (unpenalized) intercept, as sklearn does by
+        default. The intercepts are stored in `intercept_`. Default: True
+    tol : float, optional
+        Relative tolerance on the primal and dual residuals of the ADMM.
+        Default: 1e-5
+    max_iter : int, optional
+        Maximum number of iterations. Default: 1000
+
+    References
+    ----------
+    .. [Boyd2011] Boyd S, Parikh N, Chu E, Peleato B, Eckstein J (2011).
+       Distributed optimization and statistical learning via the alternating
+       direction method of multipliers. Foundations and Trends in Machine
+       Learning 3(1): 1-122.
+    """
+    def __init__(self, alpha=0.001, l1_ratio=0.5, fit_intercept=True,
+                 tol=1e-5, max_iter=1000):
+        self.alpha = alpha
+        self.l1_ratio = l1_ratio
+        self.fit_intercept = fit_intercept
+        self.tol = tol
+        self.max_iter = max_iter
+        self._X = None
+
+    def __deepcopy__(self, memo):
+        """Copy the solver, sharing the (read-only) factorization of the
+        design matrix, if it was computed already"""
+        new = copy.copy(self)
+        for name, value in self.__dict__.items():
+            if name not in ('_X', '_svd'):
+                setattr(new, name, copy.deepcopy(value, memo))
+        return new
+
+    def _factorize(self, X):
+        """Thin SVD of the design matrix, computed once per design matrix"""
+        if X is not self._X:
+            X_mean = np.mean(X, 0) if self.fit_intercept else 0
+            U, s, Vt = np.linalg.svd(X - X_mean, full_matrices=False)
+            self._X = X
+            self._svd = (U, s ** 2 / X.shape[0], Vt, X_mean)
+        return self._svd
+
+    def fit(self, X, y):
+        """
+        Fit the non-negative elastic net to data
+
+        Parameters
+        ----------
+        X : array, shape (n_samples, n_features)
+            The design matrix.
+        y : array, shape (n_samples,) or (n_samples, n_targets)
+            The signals to fit.
+
+        Returns
+        -------
+        self : sets the attributes `coef_`, with shape (n_features,) or
+            (n_targets, n_features), and `intercept_`
+        """
+        X = np.asarray(X)
+        y = np.asarray(y, dtype=float)
+        U, w, Vt, X_mean = self._factorize(X)
+        n_samples, n_features = X.shape
+        l1 = self.alpha * self.l1_ratio
+        l2 = self.alpha * (1 - self.l1_ratio)
+        Y = y.reshape(n_samples, -1)
+        if self.fit_intercept:
+            y_mean = np.mean(Y, 0)
+            Y = Y - y_mean
+
+        # X^T y / n_samples, through the SVD of X
+        c = np.dot(Vt.T, np.sqrt(w[:, None] / n_samples) * np.dot(U.T, Y))
+        n_targets = c.shape[1]
+        rho = np.full(n_targets, max(np.mean(w) * n_samples / n_features,
+                                     l2, np.finfo(float).eps))
+        coef = np.zeros((n_targets, n_features))
+        z = np.zeros((n_features, n_targets))
+        u = np.zeros((n_features, n_targets))
+        sqrt_p = np.sqrt(n_features)
+        # Columns of the signals which have not converged yet. Converged
+        # columns are removed from the working arrays.
+        active = np.arange(n_targets)
+        for it in range(self.max_iter):
+            # b = (X^T X / n + (l2 + rho) I)^-1 (c + rho (z - u)), using
+            # (V W V^T + a I)^-1 = I / a + V ((W + a)^-1 - 1 / a) V^T
+            v = c + rho * (z - u)
+            a = l2 + rho
+            b = v / a + np.dot(Vt.T, (1. / (w[:, None] + a) - 1. / a) *
+                               np.dot(Vt, v))
+            # Over-relaxation speeds up the convergence [Boyd2011]_
+            b_relaxed = 1.8 * b - 0.8 * z
+            z_new = np.maximum(b_relaxed + u - l1 / rho, 0)
+            u = u + b_relaxed - z_new
+
+            primal = np.sqrt(np.sum((b - z_new) ** 2, 0))
+            dual = rho * np.sqrt(np.sum((z_new - z) ** 2, 0))
+            eps_primal = self.tol * (sqrt_p + np.maximum(
+                np.sqrt(np.sum(b ** 2, 0)), np.sqrt(np.sum(z_new ** 2, 0))))
+            eps_dual = self.tol * (sqrt_p + rho * np.sqrt(np.sum(u ** 2, 0)))
+            z = z_new
+            converged = (primal <= eps_primal) & (dual <= eps_dual)
+            if it == self.max_iter - 1:
+                converged[:] = True
+            coef[active[converged]] = z[:, converged].T
+
+            # Residual balancing: the scaled dual variable follows rho
+            scale = np.where(primal > 10 * dual, 2.,
+                             np.where(dual > 10 * primal, 0.5, 1.))
+            keep = ~converged
+            active = active[keep]
+            if active.size == 0:
+                break
+            c = c[:, keep]
+            z = z[:, keep]
+            rho = rho[keep] * scale[keep]
+            u = u[:, keep] / scale[keep]
+
+        if self.fit_intercept:
+            intercept = y_mean - np.dot(coef, X_mean)
+        else:
+            intercept = np.zeros(n_targets)
+        if y.ndim == 1:
+            coef = coef[0]
+            intercept = intercept[0]
+        self.coef_ = coef
+        self.intercept_ = intercept
+        return self
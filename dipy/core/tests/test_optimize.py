@@ -2,7 +2,8 @@ import numpy as np
 import scipy.sparse as sps
 
 import numpy.testing as npt
-from dipy.core.optimize import Optimizer, SCIPY_LESS_0_12, sparse_nnls, spdot
+from dipy.core.optimize import (Optimizer, SCIPY_LESS_0_12, sparse_nnls,
+                                 spdot, batch_leastsq, NonNegativeElasticNet)
 import dipy.core.optimize as opt
 
 
@@ -165,5 +166,55 @@ def test_sparse_nnls():
     npt.assert_array_almost_equal(beta, beta_hat_sparse, decimal=1)
 
 
+def test_batch_leastsq():
+    # Fit y = a * exp(-b * t) to a few curves at once
+    t = np.linspace(0, 2, 20)
+    params = np.array([[1., 2.], [3., 0.5], [0.5, 1.]])
+    y = params[:, :1] * np.exp(-params[:, 1:] * t)
+
+    def fun(x, index):
+        e = np.exp(-x[:, 1:] * t)
+        residuals = y[index] - x[:, :1] * e
+        jac = -np.stack([e, -x[:, :1] * t * e], axis=-1)
+        return residuals, jac
+
+    x, cost = batch_leastsq(fun, np.ones((3, 2)))
+    npt.assert_array_almost_equal(x, params)
+    npt.assert_array_almost_equal(cost, 0)
+
+    # The bounds are respected
+    x, cost = batch_leastsq(fun, np.ones((3, 2)),
+                            bounds=((0, 0), (np.inf, 1.5)))
+    npt.assert_(np.all(x[:, 1] <= 1.5))
+    npt.assert_array_almost_equal(x[1:], params[1:])
+
+
+def test_non_negative_elastic_net():
+    np.random.seed(2017)
+    X = np.abs(np.random.randn(30, 50))
+    beta = np.zeros((50, 4))
+    beta[np.random.randint(0, 50, 8), np.arange(8) % 4] = 1
+    y = np.dot(X, beta) + 0.01 * np.random.randn(30, 4)
+    alpha, l1_ratio = 0.01, 0.5
+    solver = NonNegativeElasticNet(alpha=alpha, l1_ratio=l1_ratio,
+                                   tol=1e-8, max_iter=10000)
+    coef = solver.fit(X, y).coef_
+    npt.assert_equal(coef.shape, (4, 50))
+    npt.assert_(np.all(coef >= 0))
+    # Optimality conditions of the centered problem: the gradient vanishes
+    # on the non-zero coefficients and is non-negative on the others
+    Xc = X - X.mean(0)
+    yc = y - y.mean(0)
+    grad = (np.dot(Xc.T, np.dot(Xc, coef.T) - yc) / X.shape[0] +
+            alpha * (1 - l1_ratio) * coef.T + alpha * l1_ratio)
+    npt.assert_array_almost_equal(grad[coef.T > 1e-6], 0, decimal=4)
+    npt.assert_(np.all(grad > -1e-4))
+    npt.assert_array_almost_equal(solver.predict(X) + solver.intercept_,
+                                  y, decimal=1)
+    # Each signal is fit independently
+    coef_1 = solver.fit(X, y[:, 1]).coef_
+    npt.assert_array_almost_equal(coef_1, coef[1], decimal=4)
+
+
 if __name__ == '__main__':
     npt.run_module_suite()
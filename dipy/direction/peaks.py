@@ -1,23 +1,23 @@
 from __future__ import division, print_function, absolute_import
 
 from multiprocessing import cpu_count, Pool
-from itertools import repeat
+from multiprocessing.sharedctypes import RawArray
+import os
 from os import path
+import tempfile
 from warnings import warn
 
 from dipy.utils.six.moves import xrange
 
-from nibabel.tmpdirs import InTemporaryDirectory
-
 import numpy as np
+from numpy.lib.format import open_memmap
 import scipy.optimize as opt
 
 from dipy.reconst.recspeed import (local_maxima, remove_similar_vertices,
-                                   search_descending)
+                                   search_descending, batch_peak_directions)
 from dipy.core.sphere import HemiSphere, Sphere
 from dipy.data import default_sphere
-from dipy.core.ndindex import ndindex
-from dipy.reconst.shm import sh_to_sf_matrix
+from dipy.reconst.shm import sh_to_sf_matrix, SphHarmModel
 from dipy.reconst.peak_direction_getter import PeaksAndMetricsDirectionGetter
 
 
@@ -224,7 +224,8 @@ class PeaksAndMetrics(PeaksAndMetricsDirectionGetter):
 def _peaks_from_model_parallel(model, data, sphere, relative_peak_threshold,
                                min_separation_angle, mask, return_odf,
                                return_sh, gfa_thr, normalize_peaks, sh_order,
-                               sh_basis_type, npeaks, B, invB, nbr_processes):
+                               sh_basis_type, npeaks, B, invB, nbr_processes,
+                               memmap_dir=None):
 
     if nbr_processes is None:
         try:
@@ -237,7 +238,7 @@ def _peaks_from_model_parallel(model, data, sphere, relative_peak_threshold,
                                     min_separation_angle, mask, return_odf,
                                     return_sh, gfa_thr, normalize_peaks,
                                     sh_order, sh_basis_type, npeaks,
-                                    parallel=False)
+                                    parallel=False, memmap_dir=memmap_dir)
     elif nbr_processes <= 0:
         warn("Invalid number of processes (%d). "
              "returns peaks_from_model(..., parallel=False)." % nbr_processes)
@@ -246,157 +247,257 @@ def _peaks_from_model_parallel(model, data, sphere, relative_peak_threshold,
                                 min_separation_angle, mask, return_odf,
                                 return_sh, gfa_thr, normalize_peaks,
                                 sh_order, sh_basis_type, npeaks,
-                                parallel=False)
+                                parallel=False, memmap_dir=memmap_dir)
 
-    shape = list(data.shape)
-    data = np.reshape(data, (-1, shape[-1]))
+    shape = data.shape[:-1]
+    data = np.reshape(data, (-1, data.shape[-1]))
     n = data.shape[0]
+    if mask is not None:
+        if mask.shape != shape:
+            raise ValueError("Mask is not the same shape as data.")
+        mask = mask.ravel()
     nbr_chunks = nbr_processes ** 2
     chunk_size = int(np.ceil(n / nbr_chunks))
     indices = list(zip(np.arange(0, n, chunk_size),
                        np.arange(0, n, chunk_size) + chunk_size))
 
-    with InTemporaryDirectory() as tmpdir:
+    # The workers write their results directly in the output arrays, which
+    # are either in shared memory or memory-mapped files of memmap_dir
+    specs = _pam_array_specs(shape, sphere, return_odf, return_sh, sh_order,
+                             npeaks)
+    out, handles = _empty_pam_arrays(shape, specs, memmap_dir, shared=True)
+
+    # The workers read the data and mask from shared memory, or from
+    # temporary files of memmap_dir, so that only their handles are sent to
+    # the workers, whatever the start method of the processes
+    inputs, temp_files = {}, []
+    for name, arr in [('data', data), ('mask', mask)]:
+        if arr is None:
+            continue
+        file_name = None
+        if memmap_dir is not None:
+            fd, file_name = tempfile.mkstemp(suffix='.npy', dir=memmap_dir)
+            os.close(fd)
+            temp_files.append(file_name)
+        shared, handle = _shared_array(arr.shape, arr.dtype, file_name)
+        shared[...] = arr
+        del shared
+        inputs[name] = (handle, arr.shape, arr.dtype)
+
+    try:
+        # The model and the handles of the arrays are sent once to each
+        # worker when it starts
+        pool = Pool(nbr_processes, initializer=_init_peaks_worker,
+                    initargs=(model, inputs, handles, specs,
+                              (sphere, relative_peak_threshold,
+                               min_separation_angle, gfa_thr,
+                               normalize_peaks, invB)))
+        try:
+            global_max = max([-np.inf] +
+                             pool.map(_peaks_from_model_parallel_sub,
+                                      indices))
+        finally:
+            pool.close()
+            # Make sure all worker processes have exited, needed on windows
+            # to release the memory-mapped files
+            pool.join()
+    finally:
+        for file_name in temp_files:
+            os.remove(file_name)
+
+    out['qa'] /= global_max
+    return _pam_from_attrs(PeaksAndMetrics,
+                           sphere,
+                           out['peak_indices'],
+                           out['peak_values'],
+                           out['peak_dirs'],
+                           out['gfa'],
+                           out['qa'],
+                           out['shm_coeff'] if return_sh else None,
+                           B if return_sh else None,
+                           out['odf'] if return_odf else None)
+
 
-        data_file_name = path.join(tmpdir, 'data.npy')
-        np.save(data_file_name, data)
-        if mask is not None:
-            mask = mask.flatten()
-            mask_file_name = path.join(tmpdir, 'mask.npy')
-            np.save(mask_file_name, mask)
-        else:
-            mask_file_name = None
-
-        pool = Pool(nbr_processes)
-
-        pam_res = pool.map(_peaks_from_model_parallel_sub,
-                           zip(repeat((data_file_name, mask_file_name)),
-                               indices,
-                               repeat(model),
-                               repeat(sphere),
-                               repeat(relative_peak_threshold),
-                               repeat(min_separation_angle),
-                               repeat(return_odf),
-                               repeat(return_sh),
-                               repeat(gfa_thr),
-                               repeat(normalize_peaks),
-                               repeat(sh_order),
-                               repeat(sh_basis_type),
-                               repeat(npeaks),
-                               repeat(B),
-                               repeat(invB)))
-        pool.close()
-
-        pam = PeaksAndMetrics()
-        pam.sphere = sphere
-        # use memmap to reduce the memory usage
-        pam.gfa = np.memmap(path.join(tmpdir, 'gfa.npy'),
-                            dtype=pam_res[0].gfa.dtype,
-                            mode='w+',
-                            shape=(data.shape[0]))
-
-        pam.peak_dirs = np.memmap(path.join(tmpdir, 'peak_dirs.npy'),
-                                  dtype=pam_res[0].peak_dirs.dtype,
-                                  mode='w+',
-                                  shape=(data.shape[0], npeaks, 3))
-        pam.peak_values = np.memmap(path.join(tmpdir, 'peak_values.npy'),
-                                    dtype=pam_res[0].peak_values.dtype,
-                                    mode='w+',
-                                    shape=(data.shape[0], npeaks))
-        pam.peak_indices = np.memmap(path.join(tmpdir, 'peak_indices.npy'),
-                                     dtype=pam_res[0].peak_indices.dtype,
-                                     mode='w+',
-                                     shape=(data.shape[0], npeaks))
-        pam.qa = np.memmap(path.join(tmpdir, 'qa.npy'),
-                           dtype=pam_res[0].qa.dtype,
-                           mode='w+',
-                           shape=(data.shape[0], npeaks))
-        if return_sh:
-            nbr_shm_coeff = (sh_order + 2) * (sh_order + 1) // 2
-            pam.shm_coeff = np.memmap(path.join(tmpdir, 'shm.npy'),
-                                      dtype=pam_res[0].shm_coeff.dtype,
-                                      mode='w+',
-                                      shape=(data.shape[0], nbr_shm_coeff))
-            pam.B = pam_res[0].B
-        else:
-            pam.shm_coeff = None
-            pam.invB = None
-        if return_odf:
-            pam.odf = np.memmap(path.join(tmpdir, 'odf.npy'),
-                                dtype=pam_res[0].odf.dtype,
-                                mode='w+',
-                                shape=(data.shape[0], len(sphere.vertices)))
+def _pam_array_specs(shape, sphere, return_odf, return_sh, sh_order, npeaks):
+    """dtype and trailing shape of each of the arrays of peaks and metrics"""
+    specs = dict(gfa=(np.float64, ()),
+                 qa=(np.float64, (npeaks,)),
+                 peak_dirs=(np.float64, (npeaks, 3)),
+                 peak_values=(np.float64, (npeaks,)),
+                 peak_indices=(np.int_, (npeaks,)))
+    if return_sh:
+        n_shm_coeff = (sh_order + 2) * (sh_order + 1) // 2
+        specs['shm_coeff'] = (np.float64, (n_shm_coeff,))
+    if return_odf:
+        specs['odf'] = (np.float64, (len(sphere.vertices),))
+    return specs
+
+
+def _empty_pam_arrays(shape, specs, memmap_dir=None, shared=False):
+    """Allocate the arrays of peaks and metrics
+
+    The arrays are memory-mapped ``.npy`` files of memmap_dir if it is
+    given, else they are in shared memory if `shared` is True, else in
+    memory. Returns the arrays and the handles of the workers to the shared
+    and memory-mapped arrays (see `_shared_array`).
+    """
+    arrays, handles = {}, {}
+    for name, (dtype, shape_end) in specs.items():
+        if memmap_dir is None and not shared:
+            arrays[name] = np.zeros(shape + shape_end, dtype=dtype)
+            continue
+        file_name = None
+        if memmap_dir is not None:
+            file_name = path.join(memmap_dir, name + '.npy')
+        arrays[name], handles[name] = _shared_array(shape + shape_end, dtype,
+                                                    file_name)
+    arrays['peak_indices'].fill(-1)
+    return arrays, handles
+
+
+def _shared_array(shape, dtype, file_name=None):
+    """Allocate an array shared with worker processes
+
+    Returns the array and the handle the workers use to access it with
+    `_attach_shared_array`: a shared memory buffer, or `file_name`, the
+    ``.npy`` file holding the array if it is given.
+    """
+    if file_name is not None:
+        arr = open_memmap(file_name, mode='w+', dtype=dtype, shape=shape)
+        return arr, file_name
+    handle = RawArray('b', max(int(np.prod(shape)) *
+                               np.dtype(dtype).itemsize, 1))
+    return _attach_shared_array(handle, shape, dtype), handle
+
+
+def _attach_shared_array(handle, shape, dtype, mode='r+'):
+    """The array of `shape` and `dtype` of a handle of `_shared_array`"""
+    if isinstance(handle, str):
+        return open_memmap(handle, mode=mode).reshape(shape)
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    arr = np.frombuffer(handle, dtype=np.uint8, count=nbytes)
+    return arr.view(dtype).reshape(shape)
+
+
+_peaks_worker = {}
+
+
+def _init_peaks_worker(model, inputs, handles, specs, params):
+    """Initializer of the worker processes of peaks_from_model"""
+    data = _attach_shared_array(*inputs['data'], mode='r')
+    mask = None
+    if 'mask' in inputs:
+        mask = _attach_shared_array(*inputs['mask'], mode='r')
+    n = data.shape[0]
+    out = {}
+    for name, handle in handles.items():
+        dtype, shape_end = specs[name]
+        # Flat views of the arrays, with one row per voxel
+        out[name] = _attach_shared_array(handle, (n,) + shape_end, dtype)
+    _peaks_worker.update(model=model, data=data, mask=mask, out=out,
+                         params=params)
+
+
+def _peaks_from_model_parallel_sub(bounds):
+    start_pos, end_pos = bounds
+    w = _peaks_worker
+    chunk = slice(start_pos, end_pos)
+    data = w['data'][chunk]
+    mask = w['mask'][chunk] if w['mask'] is not None else None
+    out = dict((name, arr[chunk]) for name, arr in w['out'].items())
+    global_max = _peaks_from_model_block(w['model'], data, mask, out,
+                                         *w['params'], num_threads=1)
+    for arr in w['out'].values():
+        if isinstance(arr, np.memmap):
+            arr.flush()
+    return global_max
+
+
+def _peaks_from_model_block(model, data, mask, out, sphere,
+                            relative_peak_threshold, min_separation_angle,
+                            gfa_thr, normalize_peaks, invB, chunk_size=10000,
+                            num_threads=None):
+    """Compute the peaks and metrics of a block of voxels
+
+    The ODFs of chunks of voxels are gathered to extract their peaks
+    together (see `dipy.reconst.recspeed.batch_peak_directions`); spherical
+    harmonic models also fit each chunk at once. The results are written in
+    the arrays of the dict ``out`` (see `_pam_array_specs`), whose leading
+    dimensions are those of ``data.shape[:-1]``. The quantitative anisotropy
+    written is not normalized.
+
+    Returns
+    -------
+    global_max : float
+        The maximum of the peak values of the ODFs of the block, used to
+        normalize the quantitative anisotropy.
+    """
+    if data.ndim == 1:
+        # Single voxel, work on views with a voxel dimension
+        data = data[None]
+        mask = None if mask is None else mask[None]
+        out = dict((name, arr[None]) for name, arr in out.items())
+    shape = data.shape[:-1]
+    if mask is None:
+        mask = np.ones(shape, dtype='bool')
+    npeaks = out['qa'].shape[-1]
+    vertices = np.ascontiguousarray(sphere.vertices, dtype=np.float64)
+    edges = np.asarray(sphere.edges, dtype=np.uint16)
+    voxels = np.array(np.nonzero(mask)).T
+    # Spherical harmonic models fit (and evaluate the ODFs of) a whole chunk
+    # of voxels at once
+    batch_fit = isinstance(model, SphHarmModel)
+
+    global_max = -np.inf
+    for start in range(0, len(voxels), chunk_size):
+        chunk = voxels[start:start + chunk_size]
+        idx = tuple(chunk.T)
+        if batch_fit:
+            odfs = model.fit(data[idx]).odf(sphere)
         else:
-            pam.odf = None
-
-        # copy subprocesses pam to a single pam (memmaps)
-        for i, (start_pos, end_pos) in enumerate(indices):
-            pam.gfa[start_pos: end_pos] = pam_res[i].gfa
-            pam.peak_dirs[start_pos: end_pos] = pam_res[i].peak_dirs
-            pam.peak_values[start_pos: end_pos] = pam_res[i].peak_values
-            pam.peak_indices[start_pos: end_pos] = pam_res[i].peak_indices
-            pam.qa[start_pos: end_pos] = pam_res[i].qa
-            if return_sh:
-                pam.shm_coeff[start_pos: end_pos] = pam_res[i].shm_coeff
-            if return_odf:
-                pam.odf[start_pos: end_pos] = pam_res[i].odf
-
-        pam_res = None
-
-        # load memmaps to arrays and reshape the metric
-        shape[-1] = -1
-        pam.gfa = np.reshape(np.array(pam.gfa), shape[:-1])
-        pam.peak_dirs = np.reshape(np.array(pam.peak_dirs), shape + [3])
-        pam.peak_values = np.reshape(np.array(pam.peak_values), shape)
-        pam.peak_indices = np.reshape(np.array(pam.peak_indices), shape)
-        pam.qa = np.reshape(np.array(pam.qa), shape)
-        if return_sh:
-            pam.shm_coeff = np.reshape(np.array(pam.shm_coeff), shape)
-        if return_odf:
-            pam.odf = np.reshape(np.array(pam.odf), shape)
-
-        # Make sure all worker processes have exited before leaving context
-        # manager in order to prevent temporary file deletion errors in windows
-        pool.join()
-
-    return pam
-
-
-def _peaks_from_model_parallel_sub(args):
-    (data_file_name, mask_file_name) = args[0]
-    (start_pos, end_pos) = args[1]
-    model = args[2]
-    sphere = args[3]
-    relative_peak_threshold = args[4]
-    min_separation_angle = args[5]
-    return_odf = args[6]
-    return_sh = args[7]
-    gfa_thr = args[8]
-    normalize_peaks = args[9]
-    sh_order = args[10]
-    sh_basis_type = args[11]
-    npeaks = args[12]
-    B = args[13]
-    invB = args[14]
-
-    data = np.load(data_file_name, mmap_mode='r')[start_pos:end_pos]
-    if mask_file_name is not None:
-        mask = np.load(mask_file_name, mmap_mode='r')[start_pos:end_pos]
-    else:
-        mask = None
-
-    return peaks_from_model(model, data, sphere, relative_peak_threshold,
-                            min_separation_angle, mask, return_odf,
-                            return_sh, gfa_thr, normalize_peaks,
-                            sh_order, sh_basis_type, npeaks, B, invB,
-                            parallel=False, nbr_processes=None)
+            odfs = np.array([model.fit(data[tuple(ijk)]).odf(sphere)
+                             for ijk in chunk])
+
+        if 'shm_coeff' in out:
+            out['shm_coeff'][idx] = np.dot(odfs, invB)
+        if 'odf' in out:
+            out['odf'][idx] = odfs
+
+        gfa_chunk = gfa(odfs)
+        out['gfa'][idx] = gfa_chunk
+        low = gfa_chunk < gfa_thr
+        if low.any():
+            global_max = max(global_max, odfs[low].max())
+        odfs = np.ascontiguousarray(odfs[~low], dtype=np.float64)
+        idx = tuple(chunk[~low].T)
+
+        # Get peaks of odfs
+        directions, pk, ind = batch_peak_directions(odfs, edges, vertices,
+                                                    relative_peak_threshold,
+                                                    min_separation_angle,
+                                                    npeaks, num_threads)
+        found = ind >= 0
+        if found[:, 0].any():
+            global_max = max(global_max, pk[found[:, 0], 0].max())
+
+        # Calculate peak metrics
+        out['qa'][idx] = np.where(found, pk - odfs.min(-1)[:, None], 0)
+        out['peak_indices'][idx] = ind
+        if normalize_peaks:
+            pk[found[:, 0]] /= pk[found[:, 0], :1]
+            directions *= pk[..., None]
+        out['peak_dirs'][idx] = directions
+        out['peak_values'][idx] = pk
+
+    return global_max
 
 
 def peaks_from_model(model, data, sphere, relative_peak_threshold,
                      min_separation_angle, mask=None, return_odf=False,
                      return_sh=True, gfa_thr=0, normalize_peaks=False,
                      sh_order=8, sh_basis_type=None, npeaks=5, B=None,
-                     invB=None, parallel=False, nbr_processes=None):
+                     invB=None, parallel=False, nbr_processes=None,
+                     memmap_dir=None):
     """Fits the model to data and computes peaks and metrics
 
     Parameters
@@ -440,12 +541,16 @@ def peaks_from_model(model, data, sphere, relative_peak_threshold,
         Inverse of B.
     parallel: bool
         If True, use multiprocessing to compute peaks and metric
-        (default False). Temporary files are saved in the default temporary
-        directory of the system. It can be changed using ``import tempfile``
-        and ``tempfile.tempdir = '/path/to/tempdir'``.
+        (default False). The worker processes write their results directly
+        in output arrays held in shared memory, or in the files of
+        `memmap_dir`.
     nbr_processes: int
         If `parallel` is True, the number of subprocesses to use
         (default multiprocessing.cpu_count()).
+    memmap_dir : str, optional
+        If given, the peaks and metrics are written in ``.npy`` files of this
+        existing directory (``gfa.npy``, ``peak_dirs.npy``, ...) and returned
+        as memory-mapped arrays, so that they do not need to fit in memory.
 
     Returns
     -------
@@ -476,80 +581,32 @@ def peaks_from_model(model, data, sphere, relative_peak_threshold,
                                           npeaks,
                                           B,
                                           invB,
-                                          nbr_processes)
+                                          nbr_processes,
+                                          memmap_dir)
 
     shape = data.shape[:-1]
-    if mask is None:
-        mask = np.ones(shape, dtype='bool')
-    else:
-        if mask.shape != shape:
-            raise ValueError("Mask is not the same shape as data.")
-
-    gfa_array = np.zeros(shape)
-    qa_array = np.zeros((shape + (npeaks,)))
-
-    peak_dirs = np.zeros((shape + (npeaks, 3)))
-    peak_values = np.zeros((shape + (npeaks,)))
-    peak_indices = np.zeros((shape + (npeaks,)), dtype='int')
-    peak_indices.fill(-1)
-
-    if return_sh:
-        n_shm_coeff = (sh_order + 2) * (sh_order + 1) // 2
-        shm_coeff = np.zeros((shape + (n_shm_coeff,)))
-
-    if return_odf:
-        odf_array = np.zeros((shape + (len(sphere.vertices),)))
-
-    global_max = -np.inf
-    for idx in ndindex(shape):
-        if not mask[idx]:
-            continue
-
-        odf = model.fit(data[idx]).odf(sphere)
-
-        if return_sh:
-            shm_coeff[idx] = np.dot(odf, invB)
-
-        if return_odf:
-            odf_array[idx] = odf
-
-        gfa_array[idx] = gfa(odf)
-        if gfa_array[idx] < gfa_thr:
-            global_max = max(global_max, odf.max())
-            continue
-
-        # Get peaks of odf
-        direction, pk, ind = peak_directions(odf, sphere,
-                                             relative_peak_threshold,
-                                             min_separation_angle)
-
-        # Calculate peak metrics
-        if pk.shape[0] != 0:
-            global_max = max(global_max, pk[0])
-
-            n = min(npeaks, pk.shape[0])
-            qa_array[idx][:n] = pk[:n] - odf.min()
-
-            peak_dirs[idx][:n] = direction[:n]
-            peak_indices[idx][:n] = ind[:n]
-            peak_values[idx][:n] = pk[:n]
-
-            if normalize_peaks:
-                peak_values[idx][:n] /= pk[0]
-                peak_dirs[idx] *= peak_values[idx][:, None]
-
-    qa_array /= global_max
+    if mask is not None and mask.shape != shape:
+        raise ValueError("Mask is not the same shape as data.")
+
+    specs = _pam_array_specs(shape, sphere, return_odf, return_sh, sh_order,
+                             npeaks)
+    out, _ = _empty_pam_arrays(shape, specs, memmap_dir)
+    global_max = _peaks_from_model_block(model, data, mask, out, sphere,
+                                         relative_peak_threshold,
+                                         min_separation_angle, gfa_thr,
+                                         normalize_peaks, invB)
+    out['qa'] /= global_max
 
     return _pam_from_attrs(PeaksAndMetrics,
                            sphere,
-                           peak_indices,
-                           peak_values,
-                           peak_dirs,
-                           gfa_array,
-                           qa_array,
-                           shm_coeff if return_sh else None,
+                           out['peak_indices'],
+                           out['peak_values'],
+                           out['peak_dirs'],
+                           out['gfa'],
+                           out['qa'],
+                           out['shm_coeff'] if return_sh else None,
                            B if return_sh else None,
-                           odf_array if return_odf else None)
+                           out['odf'] if return_odf else None)
 
 
 def gfa(samples):
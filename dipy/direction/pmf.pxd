@@ -0,0 +1,38 @@
+cimport numpy as cnp
+from cpython.pythread cimport PyThread_type_lock
+
+
+cdef class PmfGen:
+    cdef:
+        public cnp.npy_intp n_vertices
+
+    cpdef cnp.ndarray get_pmf(self, double[:] point)
+    cdef int get_pmf_c(self, double *point, double *out) nogil except -1
+
+
+cdef class SimplePmfGen(PmfGen):
+    cdef:
+        public object pmf_array
+        double[:, :, :, :] _pmf
+
+
+cdef class SHCoeffPmfGen(PmfGen):
+    cdef:
+        public object shcoeff
+        public object sphere
+        readonly object basis_type
+        readonly int cache_size
+        readonly object sf_dtype
+        int _mode
+        cnp.npy_intp _shape[3]
+        double[:, :, :, ::1] _coeff
+        double[:, ::1] _BT
+        cnp.npy_intp[::1] _cache_keys
+        double[:, ::1] _cache
+        PyThread_type_lock _locks[64]
+        float[:, :, :, ::1] _sf32
+        cnp.npy_uint16[:, :, :, ::1] _sf16
+
+    cdef void _project(self, double *coeff, double *sf) nogil
+    cdef void _add_voxel_sf(self, cnp.npy_intp i, cnp.npy_intp j,
+                            cnp.npy_intp k, double w, double *out) nogil
@@ -0,0 +1,401 @@
+"""Probability mass function (pmf) generators for probabilistic tracking
+
+A pmf generator gives, at any point of a volume, the probability of each
+direction of a sphere to be the next tracking direction. The ``get_pmf_c``
+methods write the pmf in a buffer without the GIL, and can be called from
+many threads at once.
+"""
+
+cimport cython
+
+import numpy as np
+cimport numpy as cnp
+
+from dipy.reconst.shm import order_from_ncoef, sph_harm_lookup
+
+from cpython.pythread cimport (PyThread_allocate_lock, PyThread_free_lock,
+                               PyThread_acquire_lock, PyThread_release_lock,
+                               WAIT_LOCK)
+from libc.math cimport floor
+from libc.stdlib cimport malloc, free
+
+cnp.import_array()
+
+# Number of voxels projected on the sphere at a time when precomputing
+_SF_BLOCK = 4096
+
+cdef enum:
+    # The ways SHCoeffPmfGen computes the sphere functions of the voxels
+    NO_CACHE = 0
+    CACHE = 1
+    SF32 = 2
+    SF16 = 3
+    # Number of locks of the cache of SHCoeffPmfGen, each guards the slots
+    # equal to its index modulo _N_LOCKS
+    _N_LOCKS = 64
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline int _trilinear_weights(double *point, cnp.npy_intp *shape,
+                                   cnp.npy_intp *index,
+                                   double *weight) nogil:
+    """Indices and weights of the 8 voxels around point, on each axis
+
+    Along axis ``d``, the two voxels are ``index[2 * d]`` and
+    ``index[2 * d + 1]``, as in ``_trilinear_interpolate_c_4d``. Returns -1
+    if point is outside the volume.
+    """
+    cdef:
+        int d
+        cnp.npy_intp flr
+        double rem
+
+    for d in range(3):
+        if point[d] < -.5 or point[d] >= shape[d] - .5:
+            return -1
+        flr = <cnp.npy_intp> floor(point[d])
+        rem = point[d] - flr
+        index[2 * d] = flr + (flr == -1)
+        index[2 * d + 1] = flr + (flr != shape[d] - 1)
+        weight[2 * d] = 1 - rem
+        weight[2 * d + 1] = rem
+    return 0
+
+
+# Values of the 2 ** 16 half precision floats, indexed by their bits
+cdef float _HALF_TO_FLOAT[65536]
+_HALF_TO_FLOAT[:] = np.arange(2 ** 16, dtype=np.uint16).view(np.float16)
+
+
+def _sphere_functions(shcoeff, B, dtype):
+    """Projects the SH coefficients of all voxels on the sphere"""
+    shape = shcoeff.shape[:-1]
+    coeff = np.reshape(shcoeff, (-1, shcoeff.shape[-1]))
+    sf = np.empty((coeff.shape[0], B.shape[0]), dtype=dtype)
+    for start in range(0, coeff.shape[0], _SF_BLOCK):
+        end = start + _SF_BLOCK
+        sf[start:end] = np.dot(coeff[start:end], B.T)
+    return sf.reshape(shape + (B.shape[0],))
+
+
+cdef class PmfGen:
+    """Base of the pmf generators
+
+    ``n_vertices`` is the number of values of the pmfs, or 0 if it is only
+    known from the arrays returned by ``get_pmf``.
+    """
+
+    cpdef cnp.ndarray get_pmf(self, double[:] point):
+        """The pmf at ``point``, an array of one value per sphere vertex"""
+        raise NotImplementedError()
+
+    cdef int get_pmf_c(self, double *point, double *out) nogil except -1:
+        """Writes the pmf at ``point`` in ``out``, without the GIL
+
+        ``out`` has ``n_vertices`` values. By default the GIL is acquired
+        to call ``get_pmf``.
+        """
+        cdef:
+            cnp.npy_intp v
+            double[:] pmf
+        with gil:
+            pmf = self.get_pmf(<double[:3]> point)
+            if pmf.shape[0] != self.n_vertices:
+                msg = ("The pmf has %d values, n_vertices is %d."
+                       % (pmf.shape[0], self.n_vertices))
+                raise ValueError(msg)
+            for v in range(pmf.shape[0]):
+                out[v] = pmf[v]
+        return 0
+
+
+cdef class SimplePmfGen(PmfGen):
+
+    def __init__(self, pmf_array):
+        if pmf_array.min() < 0:
+            raise ValueError("pmf should not have negative values")
+        self.pmf_array = pmf_array
+        self._pmf = pmf_array
+        self.n_vertices = self._pmf.shape[3]
+
+    def __reduce__(self):
+        return type(self), (self.pmf_array,)
+
+    cpdef cnp.ndarray get_pmf(self, double[:] point):
+        cdef:
+            double p[3]
+            double[::1] out_view
+
+        if point.shape[0] != 3:
+            raise ValueError("Point must be a 1d array with shape (3,).")
+        for d in range(3):
+            p[d] = point[d]
+        out = np.empty(self._pmf.shape[3])
+        out_view = out
+        self.get_pmf_c(p, &out_view[0])
+        return out
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.initializedcheck(False)
+    cdef int get_pmf_c(self, double *point, double *out) nogil except -1:
+        cdef:
+            cnp.npy_intp shape[3]
+            cnp.npy_intp index[6]
+            double weight[6]
+            cnp.npy_intp a, b, c, i, j, k, v
+            double w
+
+        for a in range(3):
+            shape[a] = self._pmf.shape[a]
+        if _trilinear_weights(point, shape, index, weight):
+            with gil:
+                raise IndexError("The point point is outside data")
+        for v in range(self._pmf.shape[3]):
+            out[v] = 0
+        for a in range(2):
+            for b in range(2):
+                for c in range(2):
+                    w = weight[a] * weight[2 + b] * weight[4 + c]
+                    if w == 0:
+                        continue
+                    i = index[a]
+                    j = index[2 + b]
+                    k = index[4 + c]
+                    for v in range(self._pmf.shape[3]):
+                        out[v] += w * self._pmf[i, j, k, v]
+        return 0
+
+
+cdef class SHCoeffPmfGen(PmfGen):
+    """Pmfs of spherical harmonics coefficients, interpolated trilinearly
+
+    The pmf at a point is the sphere function of the trilinearly interpolated
+    SH coefficients, with negative values set to 0. As the interpolation is
+    linear, it is also the interpolation of the sphere functions of the 8
+    neighboring voxels. These are kept in a cache, so that the steps through
+    a voxel project its coefficients on the sphere only once.
+
+    The cache is shared by the threads that track with the same generator,
+    its slots are guarded by a fixed number of locks.
+    """
+
+    def __cinit__(self):
+        for i in range(_N_LOCKS):
+            self._locks[i] = PyThread_allocate_lock()
+            if self._locks[i] == NULL:
+                raise MemoryError()
+
+    def __dealloc__(self):
+        for i in range(_N_LOCKS):
+            if self._locks[i] != NULL:
+                PyThread_free_lock(self._locks[i])
+
+    def __init__(self, shcoeff, sphere, basis_type, cache_size=4096,
+                 sf_dtype=None):
+        """Pmf generator of a volume of SH coefficients
+
+        Parameters
+        ----------
+        shcoeff : array (I, J, K, C)
+            The SH coefficients of each voxel.
+        sphere : Sphere
+            The directions of the pmf.
+        basis_type : name of basis
+            The basis that ``shcoeff`` are associated with.
+        cache_size : int, optional
+            Number of voxels whose sphere functions are cached, each takes
+            ``8 * len(sphere.vertices)`` bytes. With 0, the coefficients are
+            interpolated and projected on the sphere at each call.
+        sf_dtype : {None, 'float32', 'float16'}, optional
+            If given, the sphere functions of all voxels are computed once and
+            stored with this dtype instead of being cached. Uses
+            ``I * J * K * len(sphere.vertices)`` times 4 (float32) or 2
+            (float16) bytes, float16 keeps 3 significant digits.
+        """
+        self.shcoeff = shcoeff
+        self.sphere = sphere
+        self.basis_type = basis_type
+        sh_order = order_from_ncoef(shcoeff.shape[-1])
+        try:
+            basis = sph_harm_lookup[basis_type]
+        except KeyError:
+            raise ValueError("%s is not a known basis type." % basis_type)
+        B, m, n = basis(sh_order, sphere.theta, sphere.phi)
+        self.n_vertices = B.shape[0]
+        self._BT = np.ascontiguousarray(B.T, dtype=float)
+        if shcoeff.ndim != 4:
+            raise ValueError("shcoeff should be a 4d array.")
+        for d in range(3):
+            self._shape[d] = shcoeff.shape[d]
+        if cache_size < 0:
+            raise ValueError("cache_size should be a non negative integer, "
+                             "got %r" % (cache_size,))
+        self.cache_size = cache_size
+        self.sf_dtype = sf_dtype
+
+        if sf_dtype is None:
+            self._coeff = np.require(shcoeff, float, ['C', 'W'])
+            if cache_size == 0:
+                self._mode = NO_CACHE
+            else:
+                self._mode = CACHE
+                self._cache_keys = np.full(cache_size, -1, dtype=np.intp)
+                self._cache = np.empty((cache_size, B.shape[0]))
+        elif np.dtype(sf_dtype) == np.float32:
+            self._mode = SF32
+            self._sf32 = _sphere_functions(shcoeff, B, np.float32)
+        elif np.dtype(sf_dtype) == np.float16:
+            self._mode = SF16
+            sf = _sphere_functions(shcoeff, B, np.float16)
+            self._sf16 = sf.view(np.uint16)
+        else:
+            msg = "sf_dtype should be None, 'float32' or 'float16', got %r"
+            raise ValueError(msg % (sf_dtype,))
+
+    def __reduce__(self):
+        return type(self), (self.shcoeff, self.sphere, self.basis_type,
+                            self.cache_size, self.sf_dtype)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.initializedcheck(False)
+    cdef void _project(self, double *coeff, double *sf) nogil:
+        """Writes the sphere function of the SH coefficients ``coeff`` in
+        ``sf``"""
+        cdef:
+            cnp.npy_intp c, v, n_vertices = self._BT.shape[1]
+            cnp.npy_intp n_coef = self._BT.shape[0]
+            double x0, x1, x2, x3
+            double *r0
+            double *r1
+            double *r2
+            double *r3
+
+        for v in range(n_vertices):
+            sf[v] = 0
+        # One pass over the vertices per 4 coefficients, which vectorizes
+        for c in range(0, n_coef - 3, 4):
+            x0 = coeff[c]
+            x1 = coeff[c + 1]
+            x2 = coeff[c + 2]
+            x3 = coeff[c + 3]
+            r0 = &self._BT[c, 0]
+            r1 = &self._BT[c + 1, 0]
+            r2 = &self._BT[c + 2, 0]
+            r3 = &self._BT[c + 3, 0]
+            for v in range(n_vertices):
+                sf[v] += x0 * r0[v] + x1 * r1[v] + x2 * r2[v] + x3 * r3[v]
+        for c in range(n_coef - n_coef % 4, n_coef):
+            x0 = coeff[c]
+            r0 = &self._BT[c, 0]
+            for v in range(n_vertices):
+                sf[v] += x0 * r0[v]
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    @cython.initializedcheck(False)
+    cdef void _add_voxel_sf(self, cnp.npy_intp i, cnp.npy_intp j,
+                            cnp.npy_intp k, double w, double *out) nogil:
+        """Adds ``w`` times the sphere function of voxel (i, j, k), from the
+        cache, to ``out``
+
+        The cache is direct mapped: each voxel has one slot, given by its
+        linear index modulo the cache size, and replaces the voxel stored
+        there. Voxels close to each other along the last axes never share a
+        slot.
+        """
+        cdef:
+            cnp.npy_intp key, slot, v
+            cnp.npy_intp n_vertices = self._BT.shape[1]
+            double *sf
+
+        key = (i * self._shape[1] + j) * self._shape[2] + k
+        slot = key % self.cache_size
+        sf = &self._cache[slot, 0]
+        PyThread_acquire_lock(self._locks[slot % _N_LOCKS], WAIT_LOCK)
+        if self._cache_keys[slot] != key:
+            self._project(&self._coeff[i, j, k, 0], sf)
+            self._cache_keys[slot] = key
+        for v in range(n_vertices):
+            out[v] += w * sf[v]
+        PyThread_release_lock(self._locks[slot % _N_LOCKS])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.initializedcheck(False)
+    cdef int get_pmf_c(self, double *point, double *out) nogil except -1:
+        cdef:
+            cnp.npy_intp index[6]
+            double weight[6]
+            cnp.npy_intp a, b, c, i, j, k, v
+            cnp.npy_intp n_vertices = self._BT.shape[1]
+            cnp.npy_intp n_coef = self._BT.shape[0]
+            double w
+            double *coeff = NULL
+            double *sf
+            float *sf32
+            cnp.npy_uint16 *sf16
+
+        if _trilinear_weights(point, self._shape, index, weight):
+            with gil:
+                raise IndexError("The point point is outside data")
+
+        if self._mode == NO_CACHE:
+            coeff = <double *> malloc(n_coef * sizeof(double))
+            if coeff == NULL:
+                with gil:
+                    raise MemoryError()
+            for v in range(n_coef):
+                coeff[v] = 0
+        else:
+            for v in range(n_vertices):
+                out[v] = 0
+        for a in range(2):
+            for b in range(2):
+                for c in range(2):
+                    w = weight[a] * weight[2 + b] * weight[4 + c]
+                    if w == 0:
+                        continue
+                    i = index[a]
+                    j = index[2 + b]
+                    k = index[4 + c]
+                    if self._mode == NO_CACHE:
+                        sf = &self._coeff[i, j, k, 0]
+                        for v in range(n_coef):
+                            coeff[v] += w * sf[v]
+                    elif self._mode == CACHE:
+                        self._add_voxel_sf(i, j, k, w, out)
+                    elif self._mode == SF32:
+                        sf32 = &self._sf32[i, j, k, 0]
+                        for v in range(n_vertices):
+                            out[v] += w * sf32[v]
+                    else:
+                        sf16 = &self._sf16[i, j, k, 0]
+                        for v in range(n_vertices):
+                            out[v] += w * _HALF_TO_FLOAT[sf16[v]]
+        if self._mode == NO_CACHE:
+            self._project(coeff, out)
+            free(coeff)
+
+        for v in range(n_vertices):
+            if out[v] < 0:
+                out[v] = 0
+        return 0
+
+    cpdef cnp.ndarray get_pmf(self, double[:] point):
+        cdef:
+            double p[3]
+            double[::1] out_view
+
+        if point.shape[0] != 3:
+            raise ValueError("Point must be a 1d array with shape (3,).")
+        for d in range(3):
+            p[d] = point[d]
+        out = np.empty(self._BT.shape[1])
+        out_view = out
+        self.get_pmf_c(p, &out_view[0])
+        return out
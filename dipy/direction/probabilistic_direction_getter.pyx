@@ -0,0 +1,389 @@
+"""
+Implementation of a probabilistic direction getter based on sampling from
+discrete distribution (pmf) at each step of the tracking.
+
+The directions are chosen without the GIL, so that tracking can run in
+parallel. The random numbers come from a splitmix64 generator of each
+direction getter, which is seeded from ``np.random`` each time the initial
+directions of a seed are found: seeding ``np.random`` makes tracking
+reproducible in a single thread.
+"""
+cimport cython
+
+import numpy as np
+cimport numpy as cnp
+
+from dipy.direction.peaks import peak_directions, default_sphere
+from dipy.direction.pmf import SimplePmfGen, SHCoeffPmfGen
+from dipy.direction.pmf cimport PmfGen
+from dipy.tracking.local.direction_getter cimport DirectionGetter
+
+from libc.math cimport cos, fabs, M_PI
+from libc.stdlib cimport malloc, free
+
+cnp.import_array()
+
+
+cdef inline cnp.npy_uint64 _splitmix64(cnp.npy_uint64 *state) nogil:
+    """Next 64 random bits of the generator of state ``state``
+
+    Every state is valid, so a generator shared by threads is not corrupted
+    by concurrent updates, only its sequence changes.
+    """
+    cdef cnp.npy_uint64 z
+    state[0] += 0x9E3779B97F4A7C15ULL
+    z = state[0]
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL
+    return z ^ (z >> 31)
+
+
+cdef inline double _random(cnp.npy_uint64 *state) nogil:
+    """Uniform random number in [0, 1)"""
+    return (_splitmix64(state) >> 11) * (1. / 9007199254740992.)
+
+
+def _random_state():
+    """A state of the generator drawn from ``np.random``"""
+    return (int(np.random.randint(2 ** 31)) << 32 |
+            int(np.random.randint(2 ** 31)))
+
+
+cdef class PeakDirectionGetter(DirectionGetter):
+    """An abstract class for DirectionGetters that use the peak_directions
+    machinery."""
+
+    cdef:
+        public object sphere
+        public object _pf_kwargs
+
+    def __init__(self, sphere=None, **kwargs):
+        if sphere is None:
+            sphere = default_sphere
+        self.sphere = sphere
+        self._pf_kwargs = kwargs
+
+    def _peak_directions(self, blob):
+        """Gets directions using parameters provided at init.
+
+        Blob can be any function defined on ``self.sphere``, ie an ODF, PMF,
+        FOD.
+        """
+        return peak_directions(blob, self.sphere, **self._pf_kwargs)[0]
+
+
+cdef class ProbabilisticDirectionGetter(PeakDirectionGetter):
+    """Randomly samples direction of a sphere based on probability mass
+    function (pmf).
+
+    The main constructors for this class are current from_pmf and from_shcoeff.
+    The pmf gives the probability that each direction on the sphere should be
+    chosen as the next direction. To get the true pmf from the "raw pmf"
+    directions more than ``max_angle`` degrees from the incoming direction are
+    set to 0 and the result is normalized.
+
+    This is a cdef class: the tracking of ``LocalTracking`` and
+    ``local_tracker_batch`` calls its C methods directly, so overriding
+    ``get_direction`` or ``initial_direction`` in a Python subclass has no
+    effect on tracking.
+
+    """
+    cdef:
+        public PmfGen pmf_gen
+        public double pmf_threshold
+        readonly double max_angle
+        readonly object vertices
+        double _cos_similarity
+        double[:, ::1] _vertices
+        cnp.npy_uint64 _rng_state
+
+    @classmethod
+    def from_pmf(klass, pmf, max_angle, sphere, pmf_threshold=0.1, **kwargs):
+        """Constructor for making a DirectionGetter from an array of Pmfs
+
+        Parameters
+        ----------
+        pmf : array, 4d
+            The pmf to be used for tracking at each voxel.
+        max_angle : float, [0, 90]
+            The maximum allowed angle between incoming direction and new
+            direction.
+        sphere : Sphere
+            The set of directions to be used for tracking.
+        pmf_threshold : float [0., 1.]
+            Used to remove direction from the probability mass function for
+            selecting the tracking direction.
+        relative_peak_threshold : float in [0., 1.]
+            Used for extracting initial tracking directions. Passed to
+            peak_directions.
+        min_separation_angle : float in [0, 90]
+            Used for extracting initial tracking directions. Passed to
+            peak_directions.
+
+        See also
+        --------
+        dipy.direction.peaks.peak_directions
+
+
+        """
+        pmf = np.asarray(pmf, dtype=float)
+        if pmf.ndim != 4:
+            raise ValueError("pmf should be a 4d array.")
+        if pmf.shape[3] != len(sphere.theta):
+            msg = ("The last dimension of pmf should match the number of "
+                   "points in sphere.")
+            raise ValueError(msg)
+        pmf_gen = SimplePmfGen(pmf)
+        return klass(pmf_gen, max_angle, sphere, pmf_threshold, **kwargs)
+
+    @classmethod
+    def from_shcoeff(klass, shcoeff, max_angle, sphere, pmf_threshold=0.1,
+                     basis_type=None, cache_size=4096, sf_dtype=None,
+                     **kwargs):
+        """Probabilistic direction getter from a distribution of directions
+        on the sphere.
+
+        Parameters
+        ----------
+        shcoeff : array
+            The distribution of tracking directions at each voxel represented
+            as a function on the sphere using the real spherical harmonic
+            basis. For example the FOD of the Constrained Spherical
+            Deconvolution model can be used this way. This distribution will
+            be discretized using ``sphere`` and tracking directions will be
+            chosen from the vertices of ``sphere`` based on the distribution.
+        max_angle : float, [0, 90]
+            The maximum allowed angle between incoming direction and new
+            direction.
+        sphere : Sphere
+            The set of directions to be used for tracking.
+        pmf_threshold : float [0., 1.]
+            Used to remove direction from the probability mass function for
+            selecting the tracking direction.
+        basis_type : name of basis
+            The basis that ``shcoeff`` are associated with.
+            ``dipy.reconst.shm.real_sym_sh_basis`` is used by default.
+        cache_size : int, optional
+            Number of voxels whose pmfs are kept, so that the steps through a
+            voxel compute its pmf only once. See ``SHCoeffPmfGen``.
+        sf_dtype : {None, 'float32', 'float16'}, optional
+            If given, the pmfs of all voxels are computed once and stored
+            with this dtype instead. See ``SHCoeffPmfGen``.
+        relative_peak_threshold : float in [0., 1.]
+            Used for extracting initial tracking directions. Passed to
+            peak_directions.
+        min_separation_angle : float in [0, 90]
+            Used for extracting initial tracking directions. Passed to
+            peak_directions.
+
+        See also
+        --------
+        dipy.direction.peaks.peak_directions
+
+        """
+        pmf_gen = SHCoeffPmfGen(shcoeff, sphere, basis_type, cache_size,
+                                sf_dtype)
+        return klass(pmf_gen, max_angle, sphere, pmf_threshold, **kwargs)
+
+    def __init__(self, pmf_gen, max_angle, sphere=None, pmf_threshold=0.1,
+                 **kwargs):
+        """Direction getter from a pmf generator.
+
+        Parameters
+        ----------
+        pmf_gen : PmfGen
+            Used to get probability mass function for selecting tracking
+            directions.
+        max_angle : float, [0, 90]
+            The maximum allowed angle between incoming direction and new
+            direction.
+        sphere : Sphere
+            The set of directions to be used for tracking.
+        pmf_threshold : float [0., 1.]
+            Used to remove direction from the probability mass function for
+            selecting the tracking direction.
+        relative_peak_threshold : float in [0., 1.]
+            Used for extracting initial tracking directions. Passed to
+            peak_directions.
+        min_separation_angle : float in [0, 90]
+            Used for extracting initial tracking directions. Passed to
+            peak_directions.
+
+        See also
+        --------
+        dipy.direction.peaks.peak_directions
+
+        """
+        PeakDirectionGetter.__init__(self, sphere, **kwargs)
+        # The vertices need to be in a contiguous array
+        vertices = np.array(self.sphere.vertices, dtype=float, order='C')
+        if pmf_gen.n_vertices == 0:
+            # The size of the pmfs is only known from get_pmf
+            pmf_gen.n_vertices = len(vertices)
+        elif pmf_gen.n_vertices != len(vertices):
+            msg = ("The pmfs of pmf_gen have %d values, sphere has %d "
+                   "vertices." % (pmf_gen.n_vertices, len(vertices)))
+            raise ValueError(msg)
+        self.pmf_gen = pmf_gen
+        self.pmf_threshold = pmf_threshold
+        self.max_angle = max_angle
+        self.vertices = vertices
+        self._vertices = self.vertices
+        self._cos_similarity = cos(max_angle * M_PI / 180.)
+        self._rng_state = _random_state()
+
+    def __reduce__(self):
+        args = (self.pmf_gen, self.max_angle, self.sphere, self.pmf_threshold)
+        return type(self), args, self._pf_kwargs
+
+    def __setstate__(self, state):
+        self._pf_kwargs = state
+
+    cpdef cnp.ndarray[cnp.float_t, ndim=2] initial_direction(
+            self, double[::1] point):
+        """Returns best directions at seed location to start tracking.
+
+        Parameters
+        ----------
+        point : ndarray, shape (3,)
+            The point in an image at which to lookup tracking directions.
+
+        Returns
+        -------
+        directions : ndarray, shape (N, 3)
+            Possible tracking directions from point. ``N`` may be 0, all
+            directions should be unique.
+
+        """
+        self._rng_state = _random_state()
+        pmf = self.pmf_gen.get_pmf(point)
+        return self._peak_directions(pmf)
+
+    cpdef int get_direction(self, double[::1] point,
+                            double[::1] direction) except -1:
+        """Samples a pmf to updates ``direction`` array with a new direction.
+
+        Parameters
+        ----------
+        point : memory-view (or ndarray), shape (3,)
+            The point in an image at which to lookup tracking directions.
+        direction : memory-view (or ndarray), shape (3,)
+            Previous tracking direction.
+
+        Returns
+        -------
+        status : int
+            Returns 0 `direction` was updated with a new tracking direction, or
+            1 otherwise.
+
+        """
+        if point.shape[0] != 3 or direction.shape[0] != 3:
+            raise ValueError("point and direction should have shape (3,)")
+        return self.get_direction_c(&point[0], &direction[0])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.initializedcheck(False)
+    cdef int get_direction_c(self, double *point,
+                             double *direction) nogil except -1:
+        cdef:
+            cnp.npy_intp i, idx
+            double *pmf
+            double *newdir
+
+        # pmf_gen may have been replaced after __init__
+        if self.pmf_gen.n_vertices != self._vertices.shape[0]:
+            with gil:
+                msg = ("The pmfs of pmf_gen have %d values, sphere has %d "
+                       "vertices." % (self.pmf_gen.n_vertices,
+                                      self._vertices.shape[0]))
+                raise ValueError(msg)
+        pmf = <double *> malloc(self.pmf_gen.n_vertices * sizeof(double))
+        if pmf == NULL:
+            with gil:
+                raise MemoryError()
+        try:
+            self.pmf_gen.get_pmf_c(point, pmf)
+            idx = self._select_direction(pmf, direction)
+        finally:
+            free(pmf)
+        if idx < 0:
+            return 1
+
+        newdir = &self._vertices[idx, 0]
+        # Update direction and return 0 for error
+        if (newdir[0] * direction[0] + newdir[1] * direction[1] +
+                newdir[2] * direction[2]) > 0:
+            for i in range(3):
+                direction[i] = newdir[i]
+        else:
+            for i in range(3):
+                direction[i] = -newdir[i]
+        return 0
+
+    @cython.boundscheck(False)
+    @cython.initializedcheck(False)
+    cdef inline int _allowed(self, cnp.npy_intp i, double *direction) nogil:
+        """Whether vertex i is within ``max_angle`` of ``direction``"""
+        cdef double *v = &self._vertices[i, 0]
+        return fabs(v[0] * direction[0] + v[1] * direction[1] +
+                    v[2] * direction[2]) >= self._cos_similarity
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.initializedcheck(False)
+    @cython.cdivision(True)
+    cdef cnp.npy_intp _select_direction(self, double *pmf,
+                                        double *direction) nogil:
+        """Samples a vertex from the thresholded pmf of the vertices allowed
+        from ``direction``, returns -1 if they all have probability 0
+
+        The cumulative sum of the pmf is written in ``pmf``.
+        """
+        cdef:
+            cnp.npy_intp i, lo, hi, mid
+            cnp.npy_intp n = self._vertices.shape[0]
+            double total = 0
+            double sample
+
+        for i in range(n):
+            if pmf[i] >= self.pmf_threshold and self._allowed(i, direction):
+                total += pmf[i]
+            pmf[i] = total
+        if total == 0:
+            return -1
+
+        sample = _random(&self._rng_state) * total
+        while sample >= total:
+            sample = _random(&self._rng_state) * total
+        # The first vertex whose cumulative pmf is larger than the sample
+        lo = 0
+        hi = n - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if pmf[mid] > sample:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+
+cdef class DeterministicMaximumDirectionGetter(ProbabilisticDirectionGetter):
+    """Return direction of a sphere with the highest probability mass
+    function (pmf).
+    """
+
+    cdef cnp.npy_intp _select_direction(self, double *pmf,
+                                        double *direction) nogil:
+        """The vertex of largest pmf allowed from ``direction``, -1 if they
+        all have a pmf of 0 or below the threshold"""
+        cdef:
+            cnp.npy_intp i, idx = -1
+            double max_pmf = 0
+
+        for i in range(self._vertices.shape[0]):
+            if (pmf[i] >= self.pmf_threshold and pmf[i] > max_pmf and
+                    self._allowed(i, direction)):
+                idx = i
+                max_pmf = pmf[i]
+        return idx
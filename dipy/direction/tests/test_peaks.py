@@ -1,8 +1,11 @@
 import numpy as np
 
+import os
 import pickle
 from io import BytesIO
 
+from nibabel.tmpdirs import InTemporaryDirectory
+
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
                            assert_almost_equal, run_module_suite,
                            assert_equal, assert_)
@@ -578,6 +581,49 @@ def test_peaksFromModelParallel():
         assert_array_almost_equal(pam.odf, pam_single.odf)
 
 
+def test_peaksFromModelParallel_volume():
+    _, fbvals, fbvecs = get_data('small_64D')
+    gtab = gradient_table(np.load(fbvals), np.load(fbvecs))
+    mevals = np.array(([0.0015, 0.0003, 0.0003],
+                       [0.0015, 0.0003, 0.0003]))
+    data = np.zeros((3, 4, 2, len(gtab.bvals)))
+    for i, angle in enumerate(np.linspace(0, 90, 24)):
+        data.flat[i * data.shape[-1]:(i + 1) * data.shape[-1]] = \
+            multi_tensor(gtab, mevals, 100, angles=[(0, 0), (angle, 0)],
+                         fractions=[50, 50], snr=100)[0]
+    mask = np.ones(data.shape[:-1], dtype=bool)
+    mask[0, 0] = False
+
+    model = SimpleOdfModel(gtab)
+    pam_single = peaks_from_model(model, data, _sphere, .5, 45, mask=mask,
+                                  return_odf=True, return_sh=True)
+    with InTemporaryDirectory() as tmpdir:
+        pam_multi = peaks_from_model(model, data, _sphere, .5, 45, mask=mask,
+                                     return_odf=True, return_sh=True,
+                                     parallel=True, nbr_processes=2)
+        # The results written in memory-mapped files
+        pam_mmap = peaks_from_model(model, data, _sphere, .5, 45, mask=mask,
+                                    return_odf=True, return_sh=True,
+                                    parallel=True, nbr_processes=2,
+                                    memmap_dir=tmpdir)
+        assert_(isinstance(pam_mmap.gfa, np.memmap))
+        # The temporary files of the data and mask are removed
+        assert_equal(sorted(os.listdir(tmpdir)),
+                     ['gfa.npy', 'odf.npy', 'peak_dirs.npy',
+                      'peak_indices.npy', 'peak_values.npy', 'qa.npy',
+                      'shm_coeff.npy'])
+        assert_array_equal(np.load(os.path.join(tmpdir, 'gfa.npy')),
+                           pam_single.gfa)
+        for pam in [pam_multi, pam_mmap]:
+            for name in ['gfa', 'qa', 'peak_values', 'peak_indices',
+                         'peak_dirs', 'shm_coeff', 'odf']:
+                assert_equal(getattr(pam, name).dtype,
+                             getattr(pam_single, name).dtype)
+                assert_array_almost_equal(getattr(pam, name),
+                                          getattr(pam_single, name))
+        del pam_mmap
+
+
 def test_peaks_shm_coeff():
 
     SNR = 100
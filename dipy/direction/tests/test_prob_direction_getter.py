@@ -1,9 +1,15 @@
+import pickle
+
 import numpy as np
 import numpy.testing as npt
 
-from dipy.core.sphere import unit_octahedron
-from dipy.reconst.shm import SphHarmFit, SphHarmModel
-from dipy.direction import ProbabilisticDirectionGetter
+from dipy.core.sphere import HemiSphere, unit_octahedron
+from dipy.data import get_sphere
+from dipy.reconst.shm import SphHarmFit, SphHarmModel, real_sym_sh_basis
+from dipy.direction import (ProbabilisticDirectionGetter,
+                            DeterministicMaximumDirectionGetter)
+from dipy.direction.pmf import SHCoeffPmfGen, SimplePmfGen
+from dipy.tracking.local.interpolation import trilinear_interpolate4d
 
 
 def test_ProbabilisticDirectionGetter():
@@ -62,3 +68,123 @@ def test_ProbabilisticDirectionGetter():
                       fit.shm_coeff, 90, unit_octahedron,
                       pmf_threshold=0.1,
                       basis_type="not a basis")
+
+
+def test_SHCoeffPmfGen():
+    # The pmfs are the same with and without cache, and close to them when
+    # the sphere functions of the voxels are precomputed
+    sphere = get_sphere('symmetric362')
+    rng = np.random.RandomState(0)
+    shcoeff = rng.randn(5, 6, 7, 45)
+    B, m, n = real_sym_sh_basis(8, sphere.theta, sphere.phi)
+
+    pmf_gens = [(SHCoeffPmfGen(shcoeff, sphere, None, cache_size=0), 1e-12),
+                (SHCoeffPmfGen(shcoeff, sphere, None), 1e-12),
+                (SHCoeffPmfGen(shcoeff, sphere, None, cache_size=1), 1e-12),
+                (SHCoeffPmfGen(shcoeff, sphere, None, sf_dtype='float32'),
+                 1e-5),
+                (SHCoeffPmfGen(shcoeff, sphere, None, sf_dtype='float16'),
+                 1e-2)]
+    points = rng.uniform(-.5, 4.49, (50, 3))
+    points[:10] = np.round(points[:10])
+    for point in points:
+        expected = np.dot(B, trilinear_interpolate4d(shcoeff, point))
+        expected = expected.clip(0)
+        scale = abs(expected).max()
+        for pmf_gen, rtol in pmf_gens:
+            npt.assert_allclose(pmf_gen.get_pmf(point), expected,
+                                atol=rtol * scale)
+
+    for pmf_gen, rtol in pmf_gens:
+        npt.assert_raises(IndexError, pmf_gen.get_pmf,
+                          np.array([5.5, 0., 0.]))
+        npt.assert_raises(ValueError, pmf_gen.get_pmf, np.zeros(2))
+        other = pickle.loads(pickle.dumps(pmf_gen))
+        npt.assert_array_equal(other.get_pmf(points[0]),
+                               pmf_gen.get_pmf(points[0]))
+
+    npt.assert_raises(ValueError, SHCoeffPmfGen, shcoeff[0], sphere, None)
+    npt.assert_raises(ValueError, SHCoeffPmfGen, shcoeff, sphere, None,
+                      cache_size=-1)
+    npt.assert_raises(ValueError, SHCoeffPmfGen, shcoeff, sphere, None,
+                      sf_dtype='int8')
+
+
+def test_direction_sampling():
+    # The directions are drawn with the thresholded pmf of the vertices
+    # within max_angle of the previous direction
+    sphere = HemiSphere(xyz=np.eye(3))
+    pmf = np.zeros((2, 2, 2, 3))
+    pmf[...] = [.05, .3, .6]
+    point = np.array([.5, .5, .5])
+    prev = np.array([0., 0., 1.])
+
+    dg = ProbabilisticDirectionGetter.from_pmf(pmf, 90, sphere,
+                                               pmf_threshold=0.1)
+    dg.initial_direction(point)
+    counts = np.zeros(3)
+    for i in range(3000):
+        direction = prev.copy()
+        npt.assert_equal(dg.get_direction(point, direction), 0)
+        counts += abs(np.dot(sphere.vertices, direction)) > .5
+    npt.assert_equal(counts[0], 0)
+    npt.assert_allclose(counts / counts.sum(), [0, 1 / 3., 2 / 3.],
+                        atol=.03)
+
+    # Only the previous direction is within 80 degrees
+    dg = ProbabilisticDirectionGetter.from_pmf(pmf, 80, sphere)
+    direction = -prev
+    npt.assert_equal(dg.get_direction(point, direction), 0)
+    npt.assert_array_almost_equal(direction, -prev)
+    dg.pmf_threshold = 0.7
+    npt.assert_equal(dg.get_direction(point, direction), 1)
+
+    dg = DeterministicMaximumDirectionGetter.from_pmf(pmf, 90, sphere)
+    direction = prev.copy()
+    npt.assert_equal(dg.get_direction(point, direction), 0)
+    npt.assert_array_almost_equal(direction, prev)
+    direction = np.array([0., 1., 1.])
+    npt.assert_equal(dg.get_direction(point, direction), 0)
+    npt.assert_array_almost_equal(direction, prev)
+    dg = DeterministicMaximumDirectionGetter.from_pmf(pmf, 80, sphere,
+                                                      pmf_threshold=0.4)
+    direction = np.array([0., 1., 0.])
+    npt.assert_equal(dg.get_direction(point, direction), 1)
+
+    npt.assert_raises(IndexError, dg.get_direction, np.array([2., 0., 0.]),
+                      direction)
+
+    # The pmfs must have one value per vertex of the sphere
+    pmf_gen = SimplePmfGen(np.ones((2, 2, 2, 5)))
+    npt.assert_raises(ValueError, ProbabilisticDirectionGetter, pmf_gen, 90,
+                      sphere)
+    dg.pmf_gen = pmf_gen
+    npt.assert_raises(ValueError, dg.get_direction, point, direction)
+
+
+def test_direction_getter_random_state():
+    # Seeding np.random before finding the initial directions makes the
+    # sampled directions reproducible, also for copies of the getter
+    sphere = HemiSphere.from_sphere(unit_octahedron)
+    pmf = np.ones((2, 2, 2, 3))
+    point = np.zeros(3)
+    dg = ProbabilisticDirectionGetter.from_pmf(pmf, 90, sphere,
+                                               relative_peak_threshold=.5)
+
+    def sample(dg):
+        np.random.seed(1)
+        dg.initial_direction(point)
+        directions = []
+        for i in range(20):
+            direction = np.array([1., 0., 0.])
+            dg.get_direction(point, direction)
+            directions.append(direction)
+        return np.array(directions)
+
+    expected = sample(dg)
+    npt.assert_array_equal(sample(dg), expected)
+    other = pickle.loads(pickle.dumps(dg))
+    npt.assert_equal(other._pf_kwargs, {'relative_peak_threshold': .5})
+    npt.assert_equal(other.max_angle, 90)
+    npt.assert_array_equal(sample(other), expected)
+    npt.assert_(len(np.unique(expected, axis=0)) > 1)
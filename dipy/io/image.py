@@ -1,5 +1,6 @@
 from __future__ import division, print_function, absolute_import
 
+import numpy as np
 import nibabel as nib
 
 
@@ -21,3 +22,46 @@ def load_nifti(fname, return_img=False, return_voxsize=False):
 def save_nifti(fname, data, affine, hdr=None):
     result_img = nib.Nifti1Image(data, affine, header=hdr)
     result_img.to_filename(fname)
+
+
+def memmap_nifti(fname, shape, affine, dtype=np.float32, hdr=None):
+    """ Create an uncompressed NIfTI file and memory-map its data
+
+    The header is written to `fname` and the data block is allocated on disk
+    (filled with zeros). Values assigned to the returned memmap are written
+    directly to the file, so that an image can be filled block by block
+    without holding it in memory.
+
+    Parameters
+    ----------
+    fname : str
+        Name of the file to create. Must end with '.nii'.
+    shape : tuple
+        Shape of the image.
+    affine : array (4, 4)
+        Affine of the image.
+    dtype : data-type, optional
+        Data type stored in the file. Default: float32.
+    hdr : Nifti1Header, optional
+        Header whose fields are copied to the new file.
+
+    Returns
+    -------
+    data : memmap
+        The writable data of the image, in the Fortran order of NIfTI files.
+    """
+    if not fname.endswith('.nii'):
+        raise ValueError("Only uncompressed '.nii' files can be memory-mapped")
+    img = nib.Nifti1Image(np.empty((0,) * len(shape), dtype=dtype), affine,
+                          header=hdr)
+    header = img.header
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header['vox_offset'] = offset = 352
+    data_dtype = header.get_data_dtype()
+    with open(fname, 'wb') as f:
+        header.write_to(f)
+        f.write(b'\x00' * (offset - f.tell()))
+        f.truncate(offset + int(np.prod(shape)) * data_dtype.itemsize)
+    return np.memmap(fname, dtype=data_dtype, mode='r+', offset=offset,
+                     shape=shape, order='F')
@@ -0,0 +1,303 @@
+""" Benchmarks for the fits of the reconstruction models
+
+The classes of this module follow the conventions of airspeed velocity (asv):
+for each model and each volume size, ``time_fit`` measures the time to fit
+the volume, ``peakmem_fit`` the peak memory of the process during the fit
+and ``track_voxels_per_second`` the fit throughput.
+
+Run all benchmarks with::
+
+    import dipy.reconst as dire
+    dire.bench()
+
+Run this benchmark with:
+
+    nosetests -s --match '(?:^|[\\b_\\.//-])[Bb]ench' /path/to/bench_reconst.py
+"""
+from __future__ import division, print_function
+
+import time
+
+import numpy as np
+
+from dipy.core.gradients import gradient_table
+from dipy.data import get_3shell_gtab, get_data, get_sphere
+from dipy.sims.voxel import multi_tensor, multi_tensor_dki
+from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel
+from dipy.reconst.dki import DiffusionKurtosisModel
+from dipy.reconst.dsi import DiffusionSpectrumModel
+from dipy.reconst.dti import TensorModel
+from dipy.reconst.fwdti import FreeWaterTensorModel
+from dipy.reconst.gqi import GeneralizedQSamplingModel
+from dipy.reconst.ivim import IvimModel
+from dipy.reconst.mapmri import MapmriModel
+from dipy.reconst.sfm import SparseFascicleModel
+from dipy.reconst.shm import CsaOdfModel
+from dipy.reconst.shore import ShoreModel
+
+# Edge lengths of the cubic volumes fit by the benchmarks
+VOLUME_SIZES = [4, 8, 16]
+
+# Number of distinct voxels of the phantoms, tiled to fill the volumes
+N_CONFIGURATIONS = 64
+
+SNR = 30
+S0 = 100.
+EVALS = np.array([0.0017, 0.0003, 0.0003])
+
+
+def multi_shell_gtab():
+    """ 3 shells of 64 directions at b = 1000, 2000, 3500 s/mm^2 """
+    return get_3shell_gtab()
+
+
+def ivim_gtab():
+    """ 21 b-values between 0 and 1000 s/mm^2, densely sampling low b """
+    bvals = np.array([0., 10., 20., 30., 40., 60., 80., 100., 120., 140.,
+                      160., 180., 200., 300., 400., 500., 600., 700., 800.,
+                      900., 1000.])
+    rng = np.random.RandomState(0)
+    bvecs = rng.randn(len(bvals), 3)
+    bvecs /= np.sqrt((bvecs ** 2).sum(-1))[:, None]
+    return gradient_table(bvals, bvecs)
+
+
+def dsi_gtab():
+    """ The 515 q-space points of a DSI Cartesian grid """
+    return gradient_table(np.loadtxt(get_data('dsi515btable')))
+
+
+def phantom(gtab, size, kind='crossing', seed=0):
+    """ Synthetic volume of crossing fibers, free water or IVIM voxels
+
+    ``N_CONFIGURATIONS`` voxels are simulated with ``dipy.sims.voxel`` and
+    tiled to fill the volume, then Rician noise is added to every voxel.
+
+    Parameters
+    ----------
+    gtab : GradientTable
+        The acquisition scheme.
+    size : int
+        Edge length of the cubic volume.
+    kind : str, optional
+        'crossing' for two fibers crossing at random angles, 'kurtosis' for
+        the same configurations simulated with ``multi_tensor_dki``, 'water'
+        for a single fiber partial volumed with free water, 'ivim' for an
+        isotropic tissue and pseudo-diffusion compartment.
+    seed : int, optional
+        Seed of the random generator.
+
+    Returns
+    -------
+    data : ndarray (size, size, size, N)
+        The diffusion signals of the volume.
+    """
+    rng = np.random.RandomState(seed)
+    signals = np.empty((N_CONFIGURATIONS, len(gtab.bvals)))
+    for i in range(N_CONFIGURATIONS):
+        theta, phi = rng.uniform(0, 180, 2), rng.uniform(0, 360, 2)
+        angles = [(theta[0], phi[0]), (theta[1], phi[1])]
+        f = rng.uniform(30, 70)
+        if kind == 'crossing':
+            signals[i], _ = multi_tensor(gtab, np.array([EVALS, EVALS]),
+                                         S0=S0, angles=angles,
+                                         fractions=[f, 100 - f])
+        elif kind == 'kurtosis':
+            signals[i], _, _ = multi_tensor_dki(gtab,
+                                                np.array([EVALS, EVALS]),
+                                                S0=S0, angles=angles,
+                                                fractions=[f, 100 - f])
+        elif kind == 'water':
+            mevals = np.array([EVALS, [0.003, 0.003, 0.003]])
+            signals[i], _ = multi_tensor(gtab, mevals, S0=S0, angles=angles,
+                                         fractions=[f, 100 - f])
+        elif kind == 'ivim':
+            f = f / 500.
+            mevals = np.array([[0.009] * 3, [0.0009] * 3])
+            signals[i], _ = multi_tensor(gtab, mevals, S0=S0, angles=angles,
+                                         fractions=[100 * f, 100 * (1 - f)])
+        else:
+            raise ValueError("Unknown phantom kind %s" % kind)
+    n_voxels = size ** 3
+    data = np.resize(signals, (n_voxels, len(gtab.bvals)))
+    sigma = S0 / SNR
+    data = np.sqrt((data + sigma * rng.randn(*data.shape)) ** 2 +
+                   (sigma * rng.randn(*data.shape)) ** 2)
+    return data.reshape((size, size, size, -1))
+
+
+class _FitBenchmark(object):
+    """ Base of the fit benchmarks of a reconstruction model
+
+    Subclasses set ``gtab`` to one of the gradient table factories of this
+    module and ``kind`` to a phantom kind, and define
+    ``make_model(gtab, *params)``. The size of the volume is the last
+    benchmark parameter. ``make_model`` raises ``NotImplementedError`` for
+    combinations of parameters which are skipped.
+    """
+    params = [VOLUME_SIZES]
+    param_names = ['size']
+    timeout = 600
+    gtab = staticmethod(multi_shell_gtab)
+    kind = 'crossing'
+
+    def run(self):
+        """ Fit the volume, some fits compute their parameters lazily """
+        return self.model.fit(self.data)
+
+    def setup(self, *params):
+        gtab = self.gtab()
+        self.data = phantom(gtab, params[-1], self.kind)
+        self.model = self.make_model(gtab, *params[:-1])
+
+    def time_fit(self, *params):
+        self.run()
+
+    def peakmem_fit(self, *params):
+        self.run()
+
+    def track_voxels_per_second(self, *params):
+        start = time.time()
+        self.run()
+        return self.data[..., 0].size / (time.time() - start)
+
+    track_voxels_per_second.unit = 'voxels/s'
+
+
+class TensorFit(_FitBenchmark):
+    params = [['OLS', 'WLS', 'NLLS', 'RESTORE'], ['eigh', 'closed_form'],
+              VOLUME_SIZES]
+    param_names = ['fit_method', 'eig_backend', 'size']
+
+    def make_model(self, gtab, fit_method, eig_backend):
+        if fit_method in ('OLS', 'WLS'):
+            return TensorModel(gtab, fit_method, eig_backend=eig_backend)
+        if eig_backend != 'eigh':
+            # Only the linear fits have a choice of eigen-solver
+            raise NotImplementedError
+        if fit_method == 'RESTORE':
+            return TensorModel(gtab, fit_method, sigma=S0 / SNR)
+        return TensorModel(gtab, fit_method)
+
+
+class KurtosisFit(_FitBenchmark):
+    params = [['OLS', 'WLS'], VOLUME_SIZES]
+    param_names = ['fit_method', 'size']
+    kind = 'kurtosis'
+
+    def make_model(self, gtab, fit_method):
+        return DiffusionKurtosisModel(gtab, fit_method)
+
+
+class FreeWaterTensorFit(_FitBenchmark):
+    params = [['WLS', 'NLS'], VOLUME_SIZES]
+    param_names = ['fit_method', 'size']
+    kind = 'water'
+
+    def make_model(self, gtab, fit_method):
+        return FreeWaterTensorModel(gtab, fit_method)
+
+
+class IvimFit(_FitBenchmark):
+    params = [['voxelwise', 'batch'], VOLUME_SIZES]
+    param_names = ['fit_method', 'size']
+    gtab = staticmethod(ivim_gtab)
+    kind = 'ivim'
+
+    def make_model(self, gtab, fit_method):
+        return IvimModel(gtab, fit_method=fit_method)
+
+
+class CsaFit(_FitBenchmark):
+
+    def make_model(self, gtab):
+        return CsaOdfModel(gtab, 8)
+
+
+class CsdFit(_FitBenchmark):
+    params = [['voxelwise', 'batch'], VOLUME_SIZES]
+    param_names = ['fit_method', 'size']
+
+    def make_model(self, gtab, fit_method):
+        return ConstrainedSphericalDeconvModel(gtab, (EVALS, S0), sh_order=8,
+                                               fit_method=fit_method)
+
+
+class SparseFascicleFit(_FitBenchmark):
+    params = [['ElasticNet', 'BatchElasticNet'], VOLUME_SIZES]
+    param_names = ['solver', 'size']
+
+    def make_model(self, gtab, solver):
+        return SparseFascicleModel(gtab, sphere=get_sphere('symmetric362'),
+                                   response=EVALS, solver=solver)
+
+
+class MapmriFit(_FitBenchmark):
+    params = [['voxelwise', 'batch'], VOLUME_SIZES]
+    param_names = ['fit_method', 'size']
+
+    def make_model(self, gtab, fit_method):
+        return MapmriModel(gtab, radial_order=6,
+                           laplacian_regularization=True,
+                           laplacian_weighting='GCV',
+                           positivity_constraint=False,
+                           fit_method=fit_method)
+
+
+class ShoreFit(_FitBenchmark):
+
+    def make_model(self, gtab):
+        return ShoreModel(gtab, radial_order=6, zeta=700, lambdaN=1e-8,
+                          lambdaL=1e-8)
+
+
+class _OdfFitBenchmark(_FitBenchmark):
+    """ The ODFs of these models are computed when they are requested """
+
+    def setup(self, *params):
+        super(_OdfFitBenchmark, self).setup(*params)
+        self.sphere = get_sphere('symmetric724')
+
+    def run(self):
+        return self.model.fit(self.data).odf(self.sphere)
+
+
+class DsiFit(_OdfFitBenchmark):
+    gtab = staticmethod(dsi_gtab)
+
+    def make_model(self, gtab):
+        return DiffusionSpectrumModel(gtab)
+
+
+class GqiFit(_OdfFitBenchmark):
+
+    def make_model(self, gtab):
+        return GeneralizedQSamplingModel(gtab, sampling_length=3)
+
+
+def bench_reconst(size=VOLUME_SIZES[0]):
+    """ Print the fit throughput of all the benchmarked models """
+    suites = [TensorFit, KurtosisFit, FreeWaterTensorFit, IvimFit, CsaFit,
+              CsdFit, SparseFascicleFit, MapmriFit, ShoreFit, DsiFit, GqiFit]
+    print("== Benchmarking reconstruction fits on %d voxels ==" % size ** 3)
+    for suite in suites:
+        benchmark = suite()
+        for params in _param_combinations(suite.params[:-1]):
+            try:
+                benchmark.setup(*(params + (size,)))
+            except NotImplementedError:
+                continue
+            throughput = benchmark.track_voxels_per_second()
+            name = " ".join((suite.__name__,) + params)
+            print("%s :: %g voxels/s" % (name, throughput))
+
+
+def _param_combinations(params):
+    if not params:
+        return [()]
+    return [(p,) + rest for p in params[0]
+            for rest in _param_combinations(params[1:])]
+
+
+if __name__ == "__main__":
+    bench_reconst()
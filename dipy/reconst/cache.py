@@ -1,4 +1,15 @@
+import functools
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
 from dipy.core.onetime import auto_attr
+from dipy.core.gradients import GradientTable
+from dipy.core.sphere import Sphere
 
 
 class Cache(object):
@@ -23,6 +34,11 @@ class Cache(object):
                 M = self._compute_basis_matrix(sphere)
                 self.model.cache_set('odf_basis_matrix', key=sphere, value=M)
 
+    The values are kept by each instance for the lifetime of the instance.
+    Basis functions which only depend on their arguments can instead be
+    decorated with `cached_basis` to share their values between all
+    instances and worker processes through `basis_cache`.
+
     """
 
     # We use this method instead of __init__ to construct the cache, so
@@ -91,3 +107,264 @@ class Cache(object):
 
         """
         self._cache = {}
+
+
+def content_key(*args, **kwargs):
+    """Hash the content of the arguments of a basis computation
+
+    Arrays are hashed with their dtype, shape and values, gradient tables
+    with their b-values, b-vectors and diffusion times, and spheres with
+    their vertices, so that equal inputs built independently, e.g. in
+    different processes, give the same key.
+
+    Parameters
+    ----------
+    args, kwargs : objects
+        Numbers, strings, None, arrays, GradientTable and Sphere instances,
+        and tuples, lists and dicts of those.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal digest of the content of the arguments.
+
+    Raises
+    ------
+    TypeError
+        If an argument has another type.
+    """
+    h = hashlib.sha1()
+    _update_hash(h, (args, kwargs))
+    return h.hexdigest()
+
+
+def _update_hash(h, obj):
+    if isinstance(obj, (tuple, list)):
+        h.update(b'(')
+        for item in obj:
+            _update_hash(h, item)
+        h.update(b')')
+    elif isinstance(obj, dict):
+        h.update(b'{')
+        for name in sorted(obj):
+            _update_hash(h, name)
+            _update_hash(h, obj[name])
+        h.update(b'}')
+    elif isinstance(obj, GradientTable):
+        _update_hash(h, ('GradientTable', obj.bvals, obj.bvecs,
+                         obj.big_delta, obj.small_delta))
+    elif isinstance(obj, Sphere):
+        _update_hash(h, ('Sphere', obj.vertices))
+    elif obj is None or isinstance(obj, (bool, str, bytes)):
+        h.update(repr(obj).encode())
+    elif isinstance(obj, (int, np.integer)):
+        h.update(('int:%d' % obj).encode())
+    elif isinstance(obj, (float, np.floating)):
+        h.update(('float:%r' % float(obj)).encode())
+    elif isinstance(obj, np.ndarray) and obj.dtype != object:
+        arr = np.ascontiguousarray(obj)
+        h.update(('array:%s:%r' % (arr.dtype.str, arr.shape)).encode())
+        h.update(arr.view(np.uint8))
+    else:
+        raise TypeError("Can not compute a content key for %r"
+                        % type(obj).__name__)
+
+
+def _value_nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, tuple):
+        return sum(_value_nbytes(v) for v in value)
+    return 0
+
+
+def _copy(value):
+    """Copy the arrays of a cached value, so that callers can modify them"""
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, tuple):
+        return tuple(_copy(v) for v in value)
+    return value
+
+
+def _freeze(value):
+    """Make the arrays of a cached value read-only, as they are shared"""
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, tuple):
+        for v in value:
+            _freeze(v)
+    return value
+
+
+class BasisCache(object):
+    """Bounded cache of basis matrices shared by all models.
+
+    Values are looked up by content keys (see `content_key`) so that every
+    model instance computing the same basis reuses it. The least recently
+    used values are evicted when the arrays held exceed a memory budget.
+
+    If ``cache_dir`` is set, arrays are also stored as ``.npy`` files in this
+    directory, where worker processes and later runs find them.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Memory budget of the arrays held by the cache. Default: 256 MB.
+    cache_dir : str, optional
+        Directory of the on-disk store. Default: the value of the
+        ``DIPY_BASIS_CACHE_DIR`` environment variable, if set, else no
+        on-disk store.
+    """
+
+    def __init__(self, max_bytes=2 ** 28, cache_dir=None):
+        self.max_bytes = max_bytes
+        if cache_dir is None:
+            cache_dir = os.environ.get('DIPY_BASIS_CACHE_DIR')
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Retrieve the value stored for a key
+
+        Parameters
+        ----------
+        key : str
+            Content key of the value.
+        default : object
+            Value to be returned if no entry is found.
+
+        Returns
+        -------
+        v : object
+            The value stored for ``key``, from memory or else from the
+            on-disk store. Returns `default` if no entry is found.
+        """
+        with self._lock:
+            if key in self._entries:
+                # Mark as most recently used
+                value = self._entries.pop(key)
+                self._entries[key] = value
+                self.hits += 1
+                return value
+        value = self._load(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return default
+            self.disk_hits += 1
+            self._store(key, value)
+        return value
+
+    def set(self, key, value):
+        """Store a value
+
+        The arrays of the value are made read-only, as they are shared by
+        every user of the cache.
+
+        Parameters
+        ----------
+        key : str
+            Content key of the value.
+        value : array or tuple
+            The value to store. Only arrays are written to the on-disk
+            store.
+        """
+        _freeze(value)
+        with self._lock:
+            self._store(key, value)
+        if self.cache_dir is not None and isinstance(value, np.ndarray):
+            self._save(key, value)
+
+    def clear(self):
+        """Remove all values held in memory and reset the statistics"""
+        with self._lock:
+            self._entries = OrderedDict()
+            self.nbytes = 0
+            self.hits = self.misses = self.disk_hits = self.evictions = 0
+
+    def stats(self):
+        """Usage statistics of the cache
+
+        Returns
+        -------
+        stats : dict
+            The number of ``hits`` (in memory), ``disk_hits`` and ``misses``
+            of `get`, the number of ``evictions``, and the number of
+            ``entries`` and ``nbytes`` held in memory.
+        """
+        with self._lock:
+            return dict(hits=self.hits, disk_hits=self.disk_hits,
+                        misses=self.misses, evictions=self.evictions,
+                        entries=len(self._entries), nbytes=self.nbytes)
+
+    def _store(self, key, value):
+        nbytes = _value_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.nbytes -= _value_nbytes(self._entries.pop(key))
+        self._entries[key] = value
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= _value_nbytes(evicted)
+            self.evictions += 1
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            value = np.load(self._path(key))
+        except (IOError, OSError, ValueError):
+            return None
+        return _freeze(value)
+
+    def _save(self, key, value):
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # Write to a temporary file first so that concurrent readers
+            # never see a partial file
+            fd, tmp_name = tempfile.mkstemp(suffix='.npy', dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, value)
+            os.rename(tmp_name, self._path(key))
+        except (IOError, OSError):
+            pass
+
+
+basis_cache = BasisCache()
+
+
+def cached_basis(func):
+    """Decorator caching the values of a basis function in `basis_cache`
+
+    The values are looked up by the content of the arguments of the call
+    (see `content_key`). Calls with arguments that can not be hashed are
+    computed without the cache. Callers get copies of the cached arrays,
+    which they can modify.
+    """
+    name = func.__module__ + '.' + func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            key = content_key(name, args, kwargs)
+        except TypeError:
+            return func(*args, **kwargs)
+        value = basis_cache.get(key)
+        if value is None:
+            value = func(*args, **kwargs)
+            basis_cache.set(key, value)
+        return _copy(value)
+    return wrapper
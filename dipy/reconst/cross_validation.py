@@ -2,6 +2,8 @@
 Cross-validation analysis of diffusion models
 """
 from __future__ import division, print_function, absolute_import
+from multiprocessing import cpu_count, Pool
+
 from dipy.utils.six.moves import range
 
 import numpy as np
@@ -57,6 +59,44 @@ def coeff_of_determination(data, model, axis=-1):
     return 100 * (1 - (ss_err/ss_tot))
 
 
+def _xval_fold(model, folds, fold, data_0, data_b, S0, mask, model_args,
+               model_kwargs):
+    """Fit one fold and predict the measurements left out of it
+
+    Returns
+    -------
+    idx_to_assign : ndarray
+        Indices, in the full gradient table, of the left out measurements.
+    prediction : ndarray
+        Predicted signal for these measurements.
+    """
+    this_gtab, left_out_gtab, fold_mask, idx_to_assign = folds[fold]
+    this_data = np.concatenate([data_0, data_b[..., fold_mask]], -1)
+    this_model = model.__class__(this_gtab, *model_args, **model_kwargs)
+    this_fit = this_model.fit(this_data, mask=mask)
+    if not hasattr(this_fit, 'predict'):
+        err_str = "Models of type: %s " % this_model.__class__
+        err_str += "do not have an implementation of model prediction"
+        err_str += " and do not support cross-validation"
+        raise ValueError(err_str)
+    this_predict = S0[..., None] * this_fit.predict(left_out_gtab, S0=1)
+    return idx_to_assign, this_predict[..., data_0.shape[-1]:]
+
+
+# State of the worker processes of a parallel cross-validation, set once
+# when each worker starts
+_xval_worker = {}
+
+
+def _init_xval_worker(*args):
+    _xval_worker['args'] = args
+
+
+def _xval_fold_sub(fold):
+    model, folds = _xval_worker['args'][:2]
+    return _xval_fold(model, folds, fold, *_xval_worker['args'][2:])
+
+
 def kfold_xval(model, data, folds, *model_args, **model_kwargs):
     """
     Perform k-fold cross-validation to generate out-of-sample predictions for
@@ -81,7 +121,25 @@ def kfold_xval(model, data, folds, *model_args, **model_kwargs):
         Additional key-word arguments to the model initialization. If contains
         the kwarg `mask`, this will be used as a key-word argument to the `fit`
         method of the model object, rather than being used in the
-        initialization of the model object
+        initialization of the model object. The key-word arguments
+        `parallel`, `nbr_processes` and `out` are also used by this function
+        rather than by the model, see below.
+    parallel : bool, optional
+        If True, the folds are fitted in parallel, by a pool of worker
+        processes. Default: False
+    nbr_processes : int, optional
+        Number of worker processes, used if `parallel` is True. Default: the
+        number of CPUs (at most `folds`).
+    out : ndarray, optional
+        Array of the shape of `data`, e.g. a memory-mapped array, in which
+        the predictions of each fold are written as soon as they are
+        computed. Default: a new array.
+
+    Returns
+    -------
+    prediction : ndarray
+        The out-of-sample prediction of each measurement, of the shape of
+        `data`.
 
     Notes
     -----
@@ -94,12 +152,22 @@ def kfold_xval(model, data, folds, *model_args, **model_kwargs):
     It also assumes that the model object has `bval` and `bvec` attributes
     holding b-values and corresponding unit vectors.
 
+    With `parallel`, the data and the gradient tables of the folds are sent
+    once to each worker when it starts (with the 'fork' start method, they
+    are shared without any copy). The model is recreated in each worker, so
+    that its class and arguments must be picklable on platforms that spawn
+    processes.
+
     References
     ----------
     .. [1] Rokem, A., Chan, K.L. Yeatman, J.D., Pestilli, F., Mezer, A.,
        Wandell, B.A., 2014. Evaluating the accuracy of diffusion models at
        multiple b-values with cross-validation. ISMRM 2014.
     """
+    # Pop the arguments of this function out of the model arguments:
+    parallel = model_kwargs.pop('parallel', False)
+    nbr_processes = model_kwargs.pop('nbr_processes', None)
+    prediction = model_kwargs.pop('out', None)
     # This should always be there, if the model inherits from
     # dipy.reconst.base.ReconstModel:
     gtab = model.gtab
@@ -111,11 +179,14 @@ def kfold_xval(model, data, folds, *model_args, **model_kwargs):
         msg += "data equally, but "
         msg = "np.mod(%s, %s) is %s" % (data_b.shape[-1], folds, div_by_folds)
         raise ValueError(msg)
+    if prediction is None:
+        prediction = np.zeros(data.shape)
+    elif prediction.shape != data.shape:
+        raise ValueError("out must have the shape of the data")
 
     data_0 = data[..., gtab.b0s_mask]
     S0 = np.mean(data_0, -1)
     n_in_fold = data_b.shape[-1] / folds
-    prediction = np.zeros(data.shape)
     # We are going to leave out some randomly chosen samples in each iteration:
     order = np.random.permutation(data_b.shape[-1])
 
@@ -125,11 +196,14 @@ def kfold_xval(model, data, folds, *model_args, **model_kwargs):
     # Pop the mask, if there is one, out here for use in every fold:
     mask = model_kwargs.pop('mask', None)
     gtgt = gt.gradient_table  # Shorthand
+    # The gradient tables of all folds, and the measurements left out of
+    # each, as a mask of the diffusion-weighted measurements and as indices
+    # in the full gradient table:
+    fold_list = []
     for k in range(folds):
         fold_mask = np.ones(data_b.shape[-1], dtype=bool)
         fold_idx = order[int(k * n_in_fold): int((k + 1) * n_in_fold)]
         fold_mask[fold_idx] = False
-        this_data = np.concatenate([data_0, data_b[..., fold_mask]], -1)
 
         this_gtab = gtgt(np.hstack([gtab.bvals[gtab.b0s_mask],
                                     nz_bval[fold_mask]]),
@@ -139,18 +213,29 @@ def kfold_xval(model, data, folds, *model_args, **model_kwargs):
                                         nz_bval[~fold_mask]]),
                              np.concatenate([gtab.bvecs[gtab.b0s_mask],
                                              nz_bvec[~fold_mask]]))
-        this_model = model.__class__(this_gtab, *model_args, **model_kwargs)
-        this_fit = this_model.fit(this_data, mask=mask)
-        if not hasattr(this_fit, 'predict'):
-            err_str = "Models of type: %s " % this_model.__class__
-            err_str += "do not have an implementation of model prediction"
-            err_str += " and do not support cross-validation"
-            raise ValueError(err_str)
-        this_predict = S0[..., None] * this_fit.predict(left_out_gtab, S0=1)
-
         idx_to_assign = np.where(~gtab.b0s_mask)[0][~fold_mask]
-        prediction[..., idx_to_assign] =\
-            this_predict[..., np.sum(gtab.b0s_mask):]
+        fold_list.append((this_gtab, left_out_gtab, fold_mask,
+                          idx_to_assign))
+
+    args = (data_0, data_b, S0, mask, model_args, model_kwargs)
+    if parallel and folds > 1:
+        if nbr_processes is None:
+            nbr_processes = cpu_count()
+        pool = Pool(min(nbr_processes, folds), initializer=_init_xval_worker,
+                    initargs=(model, fold_list) + args)
+        try:
+            # Each fold is written in the output as soon as it is done
+            for idx_to_assign, this_predict in pool.imap_unordered(
+                    _xval_fold_sub, range(folds)):
+                prediction[..., idx_to_assign] = this_predict
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for k in range(folds):
+            idx_to_assign, this_predict = _xval_fold(model, fold_list, k,
+                                                     *args)
+            prediction[..., idx_to_assign] = this_predict
 
     # For the b0 measurements
     prediction[..., gtab.b0s_mask] = S0[..., None]
@@ -1,10 +1,13 @@
 from __future__ import division, print_function, absolute_import
 import warnings
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 from scipy.integrate import quad
 from scipy.special import lpn, gamma
 import scipy.linalg as la
+import scipy.sparse as sps
 import scipy.linalg.lapack as ll
 
 from dipy.data import small_sphere, get_sphere, default_sphere
@@ -21,8 +24,10 @@ from dipy.reconst.shm import (sph_harm_ind_list, real_sph_harm,
                               real_sym_sh_basis, sh_to_rh, forward_sdeconv_mat,
                               SphHarmModel)
 
-from dipy.direction.peaks import peaks_from_model
-from dipy.core.geometry import vec2vec_rotmat
+from dipy.reconst.recspeed import batch_peak_directions
+
+# Number of voxels whose ODFs are held at a time by recursive_response
+_ODF_CHUNK_SIZE = 10000
 
 
 class AxSymShResponse(object):
@@ -62,7 +67,7 @@ class AxSymShResponse(object):
 class ConstrainedSphericalDeconvModel(SphHarmModel):
 
     def __init__(self, gtab, response, reg_sphere=None, sh_order=8, lambda_=1,
-                 tau=0.1):
+                 tau=0.1, fit_method='voxelwise', block_size=1000):
         r""" Constrained Spherical Deconvolution (CSD) [1]_.
 
         Spherical deconvolution computes a fiber orientation distribution
@@ -100,6 +105,13 @@ class ConstrainedSphericalDeconvModel(SphHarmModel):
             zero. However, to improve the stability of the algorithm, tau is
             set to tau*100 % of the mean fODF amplitude (here, 10% by default)
             (see [1]_). Default: 0.1
+        fit_method : str (optional)
+            'voxelwise' deconvolves one voxel at a time. 'batch' deconvolves
+            blocks of `block_size` voxels at once with ``csdeconv_batch`` and
+            returns a single SphHarmFit. Default: 'voxelwise'
+        block_size : int (optional)
+            Number of voxels deconvolved together by the 'batch' fit method.
+            Default: 1000
 
         References
         ----------
@@ -122,6 +134,13 @@ class ConstrainedSphericalDeconvModel(SphHarmModel):
         self._where_b0s = lazy_index(gtab.b0s_mask)
         self._where_dwi = lazy_index(~gtab.b0s_mask)
 
+        if fit_method not in ('voxelwise', 'batch'):
+            msg = "fit_method must be 'voxelwise' or 'batch', "
+            msg += "got %r" % (fit_method,)
+            raise ValueError(msg)
+        self.fit_method = fit_method
+        self.block_size = block_size
+
         no_params = ((sh_order + 1) * (sh_order + 2)) / 2
 
         if no_params > np.sum(~gtab.b0s_mask):
@@ -177,13 +196,72 @@ class ConstrainedSphericalDeconvModel(SphHarmModel):
         self._X = X = self.R.diagonal() * self.B_dwi
         self._P = np.dot(X.T, X)
 
+    def fit(self, data, mask=None, **kwargs):
+        """ Fit the model to the signal of one voxel or of many voxels.
+
+        Parameters
+        ----------
+        data : array
+            The measured signal, with the measurements along the last
+            dimension.
+        mask : array (optional)
+            A boolean array with the shape data.shape[:-1] selecting the
+            voxels to fit.
+        kwargs : dict
+            With the 'voxelwise' fit method, passed to the multi voxel
+            decorator, e.g. to select a parallel ``engine``. With the 'batch'
+            fit method, ``n_jobs`` sets the number of threads deconvolving
+            blocks of voxels (default: 1, None uses all the cpus).
+
+        Returns
+        -------
+        SphHarmFit or MultiVoxelFit
+        """
+        if self.fit_method == 'batch':
+            return self._fit_batch(data, mask, **kwargs)
+        return self._fit_voxel(data, mask, **kwargs)
+
     @multi_voxel_fit
-    def fit(self, data):
+    def _fit_voxel(self, data):
         dwi_data = data[self._where_dwi]
         shm_coeff, _ = csdeconv(dwi_data, self._X, self.B_reg, self.tau,
                                 P=self._P)
         return SphHarmFit(self, shm_coeff, None)
 
+    def _fit_batch(self, data, mask=None, n_jobs=1):
+        if mask is None:
+            mask = np.ones(data.shape[:-1], dtype=bool)
+        elif mask.shape != data.shape[:-1]:
+            raise ValueError("mask and data shape do not match")
+        else:
+            mask = np.asarray(mask, dtype=bool)
+
+        dwi_data = np.reshape(data[mask], (-1, data.shape[-1]))
+        dwi_data = dwi_data[:, self._where_dwi]
+        blocks = [dwi_data[i:i + self.block_size]
+                  for i in range(0, dwi_data.shape[0], self.block_size)]
+        # The threads share the read-only X, P and B_reg matrices
+        def deconv(block):
+            return csdeconv_batch(block, self._X, self.B_reg, self.tau,
+                                  P=self._P)[0]
+
+        if n_jobs == 1 or len(blocks) < 2:
+            block_coeff = [deconv(block) for block in blocks]
+        else:
+            pool = ThreadPool(n_jobs or cpu_count())
+            try:
+                block_coeff = pool.map(deconv, blocks)
+            finally:
+                pool.close()
+                pool.join()
+
+        shm_coeff = np.zeros(data.shape[:-1] + (self._X.shape[1],))
+        if len(blocks):
+            shm_coeff[mask] = np.concatenate(block_coeff)
+        if data.ndim == 1:
+            return SphHarmFit(self, shm_coeff, None)
+        return SphHarmFit(self, shm_coeff, mask)
+
     def predict(self, sh_coeff, gtab=None, S0=1.):
         """Compute a signal prediction given spherical harmonic coefficients
         for the provided GradientTable class instance.
@@ -587,6 +665,114 @@ def csdeconv(dwsignal, X, B_reg, tau=0.1, convergence=50, P=None):
     return fodf_sh, num_it
 
 
+def csdeconv_batch(dwsignal, X, B_reg, tau=0.1, convergence=50, P=None):
+    r""" Constrained-regularized spherical deconvolution of many voxels
+
+    Computes the same deconvolution as ``csdeconv`` for every row of
+    `dwsignal`, with the linear algebra of all the voxels done together.
+
+    Parameters
+    ----------
+    dwsignal : array (n_voxels, n_dwi)
+        Diffusion weighted signals to be deconvolved.
+    X : array
+        Prediction matrix which estimates diffusion weighted signals from FOD
+        coefficients.
+    B_reg : array (N, B)
+        SH basis matrix which maps FOD coefficients to FOD values on the
+        surface of the sphere. B_reg should be scaled to account for lambda.
+    tau : float
+        Threshold controlling the amplitude below which the corresponding fODF
+        is assumed to be zero, see ``csdeconv``.
+    convergence : int
+        Maximum number of iterations to allow the deconvolution to converge.
+    P : ndarray
+        ``dot(X.T, X)``, if already computed.
+
+    Returns
+    -------
+    fodf_sh : ndarray (n_voxels, ``(sh_order + 1)*(sh_order + 2)/2``)
+         Spherical harmonics coefficients of the constrained-regularized fiber
+         ODFs.
+    num_it : ndarray (n_voxels,)
+         Number of iterations in the constrained-regularization used for
+         convergence in every voxel.
+
+    Notes
+    -----
+    The initial solution of all the voxels uses a single Cholesky
+    factorization of $P$. The matrices $Q = P + H_{n-1}^T H_{n-1}$ of all the
+    voxels are formed at once, as the product of the indicators of the
+    negative directions with the outer products of the rows of `B_reg`, and
+    are then updated with the directions which enter or leave the negative
+    set at each iteration. The systems of the voxels which have not converged
+    yet are solved together with stacked linear algebra.
+    """
+    mu = 1e-5
+    dwsignal = np.atleast_2d(dwsignal)
+    n_voxels = dwsignal.shape[0]
+    n_coef = B_reg.shape[1]
+    if P is None:
+        P = np.dot(X.T, X)
+    z = np.dot(dwsignal, X)
+
+    try:
+        P_factor = la.cho_factor(P)
+    except la.LinAlgError:
+        P = P + mu * np.eye(P.shape[0])
+        P_factor = la.cho_factor(P)
+    fodf_sh = la.cho_solve(P_factor, z.T).T
+    num_it = np.zeros(n_voxels, dtype=int)
+
+    # For the first iteration we use a smooth FOD that only uses SH orders up
+    # to 4 (the first 15 coefficients).
+    fodf = np.dot(fodf_sh[:, :15], B_reg[:, :15].T)
+    threshold = B_reg[0, 0] * fodf_sh[:, :1] * tau
+    fodf_small = fodf < threshold
+    # If the low-order fodf does not have any values less than threshold, the
+    # full-order fodf is used.
+    smooth = ~np.any(fodf_small, -1)
+    if np.any(smooth):
+        fodf = np.dot(fodf_sh[smooth], B_reg.T)
+        fodf_small[smooth] = fodf < threshold[smooth]
+    # Voxels whose fodf still has no values less than threshold are done.
+    active = np.flatnonzero(np.any(fodf_small, -1))
+    fodf_small = fodf_small[active]
+
+    # Outer products of the rows of B_reg, so that H^T H is a matrix product
+    B_outer = (B_reg[:, :, None] * B_reg[:, None, :]).reshape(-1, n_coef ** 2)
+    Q = P.ravel() + np.dot(fodf_small.astype(float), B_outer)
+    for it in range(1, convergence + 1):
+        if active.size == 0:
+            break
+        fodf_sh_active = np.linalg.solve(Q.reshape(-1, n_coef, n_coef),
+                                         z[active, :, None])[..., 0]
+        fodf_sh[active] = fodf_sh_active
+        num_it[active] = it
+
+        # Sample the FODs using the regularization sphere.
+        fodf = np.dot(fodf_sh_active, B_reg.T)
+        fodf_small_last = fodf_small
+        fodf_small = fodf < threshold[active]
+
+        changed = fodf_small != fodf_small_last
+        converged = ~np.any(changed, -1)
+        active = active[~converged]
+        fodf_small = fodf_small[~converged]
+        # Q is updated with the directions which enter or leave the negative
+        # set of each voxel, fewer than the directions of the set
+        update = sps.csr_matrix(np.where(fodf_small, 1., -1.) *
+                                changed[~converged])
+        Q = Q[~converged] + update.dot(B_outer)
+    else:
+        if active.size:
+            msg = 'maximum number of iterations exceeded - failed to converge'
+            msg += ' in %d voxels' % active.size
+            warnings.warn(msg)
+
+    return fodf_sh, num_it
+
+
 def odf_deconv(odf_sh, R, B_reg, lambda_=1., tau=0.1, r2_term=False):
     r""" ODF constrained-regularized spherical deconvolution using
     the Sharpening Deconvolution Transform (SDT) [1]_, [2]_.
@@ -935,10 +1121,10 @@ def recursive_response(gtab, data, mask=None, sh_order=8, peak_thr=0.01,
         convergence criterion, maximum relative change of SH
         coefficients. Default: 0.001.
     parallel : bool, optional
-        Whether to use parallelization in peak-finding during the calibration
-        procedure. Default: True
+        Whether to use parallelization in the deconvolution during the
+        calibration procedure. Default: True
     nbr_processes: int
-        If `parallel` is True, the number of subprocesses to use
+        If `parallel` is True, the number of threads to use
         (default multiprocessing.cpu_count()).
     sphere : Sphere, optional.
         The sphere used for peak finding. Default: default_sphere.
@@ -957,6 +1143,10 @@ def recursive_response(gtab, data, mask=None, sh_order=8, peak_thr=0.01,
     which has low accuracy at high b-value. This function recursively
     calibrates the response function, for more information see [1].
 
+    At each iteration, the voxels are deconvolved in blocks, the peaks of
+    all their fODFs are found together and the response is fitted to all the
+    single fiber voxels at once.
+
     References
     ----------
     .. [1] Tax, C.M.W., et al. NeuroImage 2014. Recursive calibration of
@@ -975,38 +1165,53 @@ def recursive_response(gtab, data, mask=None, sh_order=8, peak_thr=0.01,
     n = np.arange(0, sh_order + 1, 2)
     where_dwi = lazy_index(~gtab.b0s_mask)
     response_p = np.ones(len(n))
+    n_jobs = None if parallel else 1
+    if parallel and nbr_processes is not None:
+        n_jobs = nbr_processes
+
+    # The SH basis sampling the ODFs on the sphere is the same at every
+    # iteration
+    m_sh, n_sh = sph_harm_ind_list(sh_order)
+    r, theta, phi = cart2sphere(sphere.x, sphere.y, sphere.z)
+    B_sphere = real_sph_harm(m_sh, n_sh, theta[:, None], phi[:, None])
+    vertices = np.ascontiguousarray(sphere.vertices, dtype=np.float64)
+    edges = np.asarray(sphere.edges, dtype=np.uint16)
+
+    # Unit diffusion-weighted gradients
+    gradients = gtab.gradients[where_dwi]
+    gradients = gradients / np.sqrt((gradients ** 2).sum(-1))[:, None]
 
     for num_it in range(iter):
-        r_sh_all = np.zeros(len(n))
         csd_model = ConstrainedSphericalDeconvModel(gtab, res_obj,
-                                                    sh_order=sh_order)
-
-        csd_peaks = peaks_from_model(model=csd_model,
-                                     data=data,
-                                     sphere=sphere,
-                                     relative_peak_threshold=peak_thr,
-                                     min_separation_angle=25,
-                                     parallel=parallel,
-                                     nbr_processes=nbr_processes)
-
-        dirs = csd_peaks.peak_dirs
-        vals = csd_peaks.peak_values
-        single_peak_mask = (vals[:, 1] / vals[:, 0]) < peak_thr
+                                                    sh_order=sh_order,
+                                                    fit_method='batch')
+        csd_fit = csd_model.fit(data, n_jobs=n_jobs)
+        # The ODFs are evaluated and their peaks found in chunks of voxels,
+        # so that the ODFs of all voxels are never held at once
+        shm_coeff = csd_fit.shm_coeff
+        dirs = np.empty((len(shm_coeff), 2, 3))
+        vals = np.empty((len(shm_coeff), 2))
+        for start in range(0, len(shm_coeff), _ODF_CHUNK_SIZE):
+            chunk = slice(start, start + _ODF_CHUNK_SIZE)
+            odfs = np.dot(shm_coeff[chunk], B_sphere.T)
+            dirs[chunk], vals[chunk], _ = batch_peak_directions(
+                odfs, edges, vertices, peak_thr, 25, 2)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            single_peak_mask = (vals[:, 1] / vals[:, 0]) < peak_thr
         data = data[single_peak_mask]
-        dirs = dirs[single_peak_mask]
-
-        for num_vox in range(data.shape[0]):
-            rotmat = vec2vec_rotmat(dirs[num_vox, 0], np.array([0, 0, 1]))
-
-            rot_gradients = np.dot(rotmat, gtab.gradients.T).T
-
-            x, y, z = rot_gradients[where_dwi].T
-            r, theta, phi = cart2sphere(x, y, z)
-            # for the gradient sphere
-            B_dwi = real_sph_harm(0, n, theta[:, None], phi[:, None])
-            r_sh_all += np.linalg.lstsq(B_dwi, data[num_vox, where_dwi])[0]
-
-        response = r_sh_all / data.shape[0]
+        dirs = dirs[single_peak_mask, 0]
+
+        # Rotating the gradients of a voxel so that its peak is along z, the
+        # polar angle of each gradient becomes its angle to the peak, which
+        # is all the axially symmetric (m=0) basis depends on
+        cos_theta = np.clip(np.dot(dirs, gradients.T), -1, 1)
+        B_dwi = real_sph_harm(0, n, np.arccos(cos_theta)[..., None], 0)
+        # Least-squares fit of all voxels at once, B_dwi is (voxels, dwi, n)
+        r_sh = np.linalg.pinv(B_dwi)
+        r_sh = (r_sh * data[:, None, where_dwi]).sum(-1)
+
+        response = r_sh.sum(0) / data.shape[0]
         res_obj = AxSymShResponse(data[:, gtab.b0s_mask].mean(), response)
 
         change = abs((response_p - response) / response_p)
@@ -2,6 +2,8 @@
 """ Classes and functions for fitting the diffusion kurtosis model """
 from __future__ import division, print_function, absolute_import
 
+from multiprocessing import cpu_count, Pool
+
 import numpy as np
 import scipy.optimize as opt
 import dipy.core.sphere as dps
@@ -614,20 +616,18 @@ def apparent_kurtosis_coef(dki_params, sphere, min_diffusivity=0,
     kt = kt[rel_i]
     evecs = evecs[rel_i]
     evals = evals[rel_i]
-    akci = akc[rel_i]
 
     # Compute MD and DT
     md = mean_diffusivity(evals)
     dt = lower_triangular(vec_val_vect(evecs, evals))
 
-    # loop over all relevant voxels
-    for vox in range(len(kt)):
-        akci[vox] = directional_kurtosis(dt[vox], md[vox], kt[vox], V,
-                                         min_diffusivity=min_diffusivity,
-                                         min_kurtosis=min_kurtosis)
+    # Compute the AKC of all relevant voxels at once
+    dt_basis, kt_basis = _directional_basis(V)
+    akc[rel_i] = _batch_directional_kurtosis(dt, md, kt, dt_basis, kt_basis,
+                                             min_diffusivity=min_diffusivity,
+                                             min_kurtosis=min_kurtosis)
 
     # reshape data according to input data
-    akc[rel_i] = akci
 
     return akc.reshape((outshape + (len(V),)))
 
@@ -1129,8 +1129,259 @@ def _voxel_kurtosis_maximum(dt, md, kt, sphere, gtol=1e-2):
     return max_value, max_direction
 
 
+def _directional_basis(V):
+    """ Bases of the directional diffusion and diffusion variance
+
+    Parameters
+    ----------
+    V : array (g, 3)
+        g directions of a Sphere in Cartesian coordinates
+
+    Returns
+    -------
+    dt_basis : array (g, 6)
+        ``np.dot(dt, dt_basis.T)`` is the apparent diffusion coefficient of
+        the diffusion tensors ``dt`` (..., 6) along the directions of V, see
+        `directional_diffusion`.
+    kt_basis : array (g, 15)
+        ``np.dot(kt, kt_basis.T)`` is the apparent diffusion variance of the
+        kurtosis tensors ``kt`` (..., 15) along the directions of V, see
+        `directional_diffusion_variance`.
+    """
+    dt_basis = np.array([directional_diffusion(e, V, min_diffusivity=None)
+                         for e in np.eye(6)]).T
+    kt_basis = np.array([directional_diffusion_variance(e, V)
+                         for e in np.eye(15)]).T
+    return dt_basis, kt_basis
+
+
+def _batch_directional_kurtosis(dt, md, kt, dt_basis, kt_basis,
+                                min_diffusivity=0, min_kurtosis=-3/7):
+    """ Apparent kurtosis coefficients of many voxels along the directions of
+    the bases given by `_directional_basis`
+
+    Parameters
+    ----------
+    dt : array (n, 6)
+        elements of the diffusion tensor of the voxels.
+    md : array (n,)
+        mean diffusivity of the voxels
+    kt : array (n, 15)
+        elements of the kurtosis tensor of the voxels.
+    dt_basis, kt_basis : arrays (g, 6) and (g, 15)
+        See `_directional_basis`
+    min_diffusivity, min_kurtosis : float (optional)
+        See `directional_kurtosis`
+
+    Returns
+    -------
+    akc : array (n, g)
+        Apparent kurtosis coefficient of the voxels along the g directions.
+    """
+    adc = np.dot(dt, dt_basis.T)
+    if min_diffusivity is not None:
+        adc = adc.clip(min=min_diffusivity)
+    akc = np.dot(kt, kt_basis.T) * (md[:, None] / adc) ** 2
+    if min_kurtosis is not None:
+        akc = akc.clip(min=min_kurtosis)
+    return akc
+
+
+def _sphere_neighbors(sphere):
+    """ Neighbors of the vertices of a sphere as an array (g, m) padded with
+    the index of the vertex itself"""
+    n_vertices = len(sphere.vertices)
+    edges = np.concatenate([sphere.edges, sphere.edges[:, ::-1]])
+    edges = edges[np.argsort(edges[:, 0], kind='mergesort')]
+    degree = np.bincount(edges[:, 0], minlength=n_vertices)
+    neighbors = np.repeat(np.arange(n_vertices)[:, None], max(degree.max(), 1),
+                          axis=1)
+    rank = np.arange(len(edges)) - np.repeat(np.cumsum(degree) - degree,
+                                             degree)
+    neighbors[edges[:, 0], rank] = edges[:, 1]
+    return neighbors
+
+
+def _refine_kurtosis_maximum(dt, md, kt, n, gtol=1e-2, max_iter=100):
+    """ Refines local maxima of the directional kurtosis of many voxels
+
+    A Newton iteration on the sphere is run for all the starting directions
+    together. Its steps are taken in the plane tangent to the sphere, and the
+    Hessian is shifted whenever it is not negative definite, so that every
+    accepted step increases the directional kurtosis.
+
+    Parameters
+    ----------
+    dt : array (n, 6)
+        elements of the diffusion tensor of the voxels.
+    md : array (n,)
+        mean diffusivity of the voxels
+    kt : array (n, 15)
+        elements of the kurtosis tensor of the voxels.
+    n : array (n, 3)
+        Starting direction in each voxel.
+    gtol : float, optional
+        The iteration stops when the norm of the gradient of the directional
+        kurtosis on the sphere is less than gtol.
+    max_iter : int, optional
+        Maximum number of Newton steps.
+
+    Returns
+    -------
+    n : array (n, 3)
+        The refined directions.
+    akc : array (n,)
+        The directional kurtosis along the refined directions.
+    """
+    n = n / np.sqrt(np.sum(n ** 2, -1))[:, None]
+    D = from_lower_triangular(dt)
+    W = kt[:, _kt_full_index]
+    md2 = md ** 2
+
+    def value_and_derivatives(n, i, derivatives=True):
+        Dn = np.einsum('kij,kj->ki', D[i], n)
+        d = np.sum(Dn * n, -1)
+        Wn2 = np.einsum('kijlm,kl,km->kij', W[i], n, n)
+        Wn3 = np.einsum('kij,kj->ki', Wn2, n)
+        w = np.sum(Wn3 * n, -1)
+        f = md2[i] * w / d ** 2
+        if not derivatives:
+            return f
+        c = (md2[i] / d ** 2)[:, None]
+        grad = c * (4 * Wn3 - 4 * (w / d)[:, None] * Dn)
+        outer = Wn3[:, :, None] * Dn[:, None, :]
+        hess = c[..., None] * (
+            12 * Wn2 - (8 / d)[:, None, None] * (outer + outer.swapaxes(1, 2))
+            - (4 * w / d)[:, None, None] * D[i] +
+            (24 * w / d ** 2)[:, None, None] * Dn[:, :, None] * Dn[:, None, :])
+        return f, grad, hess
+
+    # Orthonormal bases of the tangent planes
+    def tangent_basis(n):
+        a = np.eye(3)[np.argmin(np.abs(n), -1)]
+        u = np.cross(n, a)
+        u /= np.sqrt(np.sum(u ** 2, -1))[:, None]
+        return u, np.cross(n, u)
+
+    active = np.arange(len(n))
+    radius = np.full(len(n), 0.5)
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        x = n[active]
+        f, grad, hess = value_and_derivatives(x, active)
+        u, v = tangent_basis(x)
+        # The directional kurtosis is homogeneous of degree 0, its gradient
+        # is tangent to the sphere and its Hessian on the sphere is the
+        # projection of the Euclidean Hessian on the tangent plane
+        g = np.stack([np.sum(grad * u, -1), np.sum(grad * v, -1)], -1)
+        Hu = np.einsum('kij,kj->ki', hess, u)
+        Hv = np.einsum('kij,kj->ki', hess, v)
+        h11 = np.sum(u * Hu, -1)
+        h12 = np.sum(v * Hu, -1)
+        h22 = np.sum(v * Hv, -1)
+        converged = np.sqrt(np.sum(g ** 2, -1)) < gtol
+        # Shift the Hessian to make it negative definite
+        l_max = (h11 + h22) / 2 + np.sqrt(((h11 - h22) / 2) ** 2 + h12 ** 2)
+        eps = 1e-3 * (np.abs(h11) + np.abs(h22) + np.abs(f)) + 1e-12
+        shift = np.maximum(l_max + eps, 0)
+        a11 = h11 - shift
+        a22 = h22 - shift
+        det = a11 * a22 - h12 ** 2
+        step = -np.stack([a22 * g[:, 0] - h12 * g[:, 1],
+                          a11 * g[:, 1] - h12 * g[:, 0]], -1) / det[:, None]
+        norm = np.sqrt(np.sum(step ** 2, -1))
+        step *= (np.minimum(norm, radius[active]) /
+                 np.maximum(norm, 1e-300))[:, None]
+        x_new = x + step[:, :1] * u + step[:, 1:] * v
+        x_new /= np.sqrt(np.sum(x_new ** 2, -1))[:, None]
+        f_new = value_and_derivatives(x_new, active, derivatives=False)
+        better = f_new >= f
+        n[active[better]] = x_new[better]
+        radius[active[~better]] /= 4
+        small = radius[active] < 1e-10
+        active = active[~(converged | small)]
+    akc = value_and_derivatives(n, slice(None), derivatives=False)
+    return n, akc.clip(min=-3/7)
+
+
+def _batch_kurtosis_maximum(dt, md, kt, sphere, gtol=1e-2):
+    """ Computes the maximum value of the kurtosis tensor of many voxels
+
+    The directional kurtosis of all voxels is sampled on the sphere with one
+    matrix product, and the local maxima found on the sphere are refined
+    together (see `_refine_kurtosis_maximum`).
+
+    Parameters
+    ----------
+    dt : array (n, 6)
+        elements of the diffusion tensor of the voxels.
+    md : array (n,)
+        mean diffusivity of the voxels
+    kt : array (n, 15)
+        elements of the kurtosis tensor of the voxels.
+    sphere : Sphere class instance
+        The sphere providing sample directions for the initial search of the
+        maximum value of kurtosis.
+    gtol : float, optional
+        This input is to refine kurtosis maximum under the precision of the
+        directions sampled on the sphere class instance. If gtol is None,
+        fiber direction is directly taken from the initial sampled directions
+        of the given sphere object
+
+    Returns
+    -------
+    max_value : array (n,)
+        kurtosis tensor maximum values
+    max_dir : array (n, 3)
+        Cartesian coordinates of the direction of the maximal kurtosis values
+
+    See also
+    --------
+    dipy.reconst.dki._voxel_kurtosis_maximum
+    """
+    dt_basis, kt_basis = _directional_basis(sphere.vertices)
+    akc = _batch_directional_kurtosis(dt, md, kt, dt_basis, kt_basis)
+
+    # A vertex is a local maximum if it is > at least one neighbor and >= all
+    # neighbors, as in dipy.reconst.recspeed.local_maxima
+    neighbors = akc[:, _sphere_neighbors(sphere)]
+    is_max = ((akc >= neighbors.max(-1)) & (akc > neighbors.min(-1)))
+    has_max = is_max.any(-1)
+
+    # Voxels without any maximum (spherical or null kurtosis tensors)
+    max_value = akc.mean(-1)
+    max_dir = np.zeros((len(akc), 3))
+    best = np.argmax(np.where(is_max, akc, -np.inf), -1)[has_max]
+    max_value[has_max] = akc[has_max, best]
+    max_dir[has_max] = sphere.vertices[best]
+
+    if gtol is not None:
+        vox, ind = np.nonzero(is_max)
+        k_dir, k_val = _refine_kurtosis_maximum(dt[vox], md[vox], kt[vox],
+                                                sphere.vertices[ind],
+                                                gtol=gtol)
+        # Keep the best refined maximum of each voxel
+        order = np.lexsort((k_val, vox))
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = vox[order][1:] != vox[order][:-1]
+        vox, k_dir, k_val = vox[order][last], k_dir[order][last], \
+            k_val[order][last]
+        better = k_val > max_value[vox]
+        max_value[vox[better]] = k_val[better]
+        max_dir[vox[better]] = k_dir[better]
+
+    return max_value, max_dir
+
+
+def _kurtosis_maximum_chunk(args):
+    """ Helper function used by `kurtosis_maximum` to process a chunk of
+    voxels in a worker process"""
+    return _batch_kurtosis_maximum(*args)[0]
+
+
 def kurtosis_maximum(dki_params, sphere='repulsion100', gtol=1e-2,
-                     mask=None):
+                     mask=None, n_jobs=1, chunk_size=10000):
     """ Computes kurtosis maximum value
 
     Parameters
@@ -1154,13 +1405,17 @@ def kurtosis_maximum(dki_params, sphere='repulsion100', gtol=1e-2,
     mask : ndarray
         A boolean array used to mark the coordinates in the data that should be
         analyzed that has the shape dki_params.shape[:-1]
+    n_jobs : int, optional
+        Number of worker processes processing chunks of voxels. If None, the
+        number of cpus is used. Default: 1, all voxels are processed in the
+        calling process.
+    chunk_size : int, optional
+        Number of voxels processed together. Default: 10000
 
     Returns
     --------
     max_value : float
         kurtosis tensor maximum value
-    max_dir : array (3,)
-        Cartesian coordinates of the direction of the maximal kurtosis value
     """
     shape = dki_params.shape[:-1]
 
@@ -1182,14 +1437,25 @@ def kurtosis_maximum(dki_params, sphere='repulsion100', gtol=1e-2,
     mask = np.logical_and(mask, pos_evals)
 
     kt_max = np.zeros(mask.shape)
-    dt = lower_triangular(vec_val_vect(evecs, evals))
+    evals = evals[mask]
+    kt = kt[mask]
+    dt = lower_triangular(vec_val_vect(evecs[mask], evals))
     md = mean_diffusivity(evals)
 
-    for idx in ndindex(shape):
-        if not mask[idx]:
-            continue
-        kt_max[idx], da = _voxel_kurtosis_maximum(dt[idx], md[idx], kt[idx],
-                                                  sphere, gtol=gtol)
+    chunks = [(dt[i:i + chunk_size], md[i:i + chunk_size],
+               kt[i:i + chunk_size], sphere, gtol)
+              for i in range(0, len(kt), chunk_size)]
+    if n_jobs == 1 or len(chunks) < 2:
+        kt_max_masked = [_kurtosis_maximum_chunk(c) for c in chunks]
+    else:
+        pool = Pool(n_jobs or cpu_count())
+        try:
+            kt_max_masked = pool.map(_kurtosis_maximum_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    if chunks:
+        kt_max[mask] = np.concatenate(kt_max_masked)
 
     return kt_max
 
@@ -1603,7 +1869,8 @@ class DiffusionKurtosisFit(TensorFit):
         """
         return radial_kurtosis(self.model_params, min_kurtosis, max_kurtosis)
 
-    def kmax(self, sphere='repulsion100', gtol=1e-5, mask=None):
+    def kmax(self, sphere='repulsion100', gtol=1e-5, mask=None, n_jobs=1,
+             chunk_size=10000):
         r""" Computes the maximum value of a single voxel kurtosis tensor
 
         Parameters
@@ -1617,13 +1884,18 @@ class DiffusionKurtosisFit(TensorFit):
             the convergence procedure must be less than gtol before successful
             termination. If gtol is None, fiber direction is directly taken
             from the initial sampled directions of the given sphere object
+        n_jobs : int, optional
+            Number of worker processes, see `kurtosis_maximum`. Default: 1
+        chunk_size : int, optional
+            Number of voxels processed together. Default: 10000
 
         Returns
         --------
         max_value : float
             kurtosis tensor maximum value
         """
-        return kurtosis_maximum(self.model_params, sphere, gtol, mask)
+        return kurtosis_maximum(self.model_params, sphere, gtol, mask,
+                                n_jobs=n_jobs, chunk_size=chunk_size)
 
     def predict(self, gtab, S0=1.):
         r""" Given a DKI model fit, predict the signal on the vertices of a
@@ -1953,6 +2225,12 @@ def Wrotate(kt, Basis):
 ind_ele = {1: 0, 16: 1, 81: 2, 2: 3, 3: 4, 8: 5, 24: 6, 27: 7, 54: 8, 4: 9,
            9: 10, 36: 11, 6: 12, 12: 13, 18: 14}
 
+# Index of the elements of the full 4D kurtosis tensor in the 15 independent
+# elements, see `Wcons`
+_kt_full_index = np.array([[[[ind_ele[(i + 1) * (j + 1) * (k + 1) * (l + 1)]
+                              for l in range(3)] for k in range(3)]
+                            for j in range(3)] for i in range(3)])
+
 
 def Wrotate_element(kt, indi, indj, indk, indl, B):
     r""" Computes the the specified index element of a kurtosis tensor rotated
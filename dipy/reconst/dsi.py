@@ -1,10 +1,24 @@
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
+import scipy.sparse as sps
 from scipy.ndimage import map_coordinates
 from scipy.fftpack import fftn, fftshift, ifftshift
+try:  # faster, scipy >= 1.4
+    from scipy.fft import rfftn, irfftn
+except ImportError:
+    from numpy.fft import rfftn, irfftn
 from dipy.reconst.odf import OdfModel, OdfFit
-from dipy.reconst.cache import Cache
+from dipy.reconst.cache import Cache, cached_basis
 from dipy.reconst.multi_voxel import multi_voxel_fit
 
+# Number of q-space grid cells, summed over the voxels, which are Fourier
+# transformed at once by the methods of a multi voxel fit.
+_GRID_BLOCK = 2 ** 18
+
+_FFT_AXES = (-3, -2, -1)
+
 
 class DiffusionSpectrumModel(OdfModel, Cache):
 
@@ -132,14 +146,19 @@ class DiffusionSpectrumModel(OdfModel, Cache):
 
 class DiffusionSpectrumFit(OdfFit):
 
+    # Parameters gathered in arrays by ``multi_voxel_fit``
+    _fit_params = ('data',)
+
     def __init__(self, model, data):
-        """ Calculates PDF and ODF and other properties for a single voxel
+        """ Calculates PDF and ODF and other properties for a single voxel,
+        or for many voxels at once when the data has leading voxel
+        dimensions.
 
         Parameters
         ----------
         model : object,
             DiffusionSpectrumModel
-        data : 1d ndarray,
+        data : ndarray (..., N),
             signal values
         """
         self.model = model
@@ -154,23 +173,31 @@ class DiffusionSpectrumFit(OdfFit):
     def pdf(self, normalized=True):
         """ Applies the 3D FFT in the q-space grid to generate
         the diffusion propagator
+
+        Returns
+        -------
+        Pr : array (..., qgrid_size, qgrid_size, qgrid_size)
+            The propagator of every voxel.
         """
-        values = self.data * self.model.filter
-        # create the signal volume
-        Sq = np.zeros((self.qgrid_sz, self.qgrid_sz, self.qgrid_sz))
-        # fill q-space
-
-        for i in range(len(values)):
-            qx, qy, qz = self.model.qgrid[i]
-            Sq[qx, qy, qz] += values[i]
+        return self._pdf(self.data, normalized)
+
+    def _pdf(self, data, normalized=True):
+        """ The propagators of the signals ``data`` (..., N), all computed
+        with a single FFT over the stacked q-space grids.
+        """
+        values = data * self.model.filter
+        # create the signal volumes
+        Sq = qspace_signal(values, self.model.qgrid, self.qgrid_sz)
         # apply fourier transform
-        Pr = fftshift(np.real(fftn(ifftshift(Sq), 3 * (self.qgrid_sz, ))))
+        Pr = fftshift(np.real(fftn(ifftshift(Sq, axes=_FFT_AXES),
+                                   axes=_FFT_AXES)), axes=_FFT_AXES)
         # clipping negative values to 0 (ringing artefact)
-        Pr = np.clip(Pr, 0, Pr.max())
+        Pr_max = Pr.max(axis=_FFT_AXES, keepdims=True)
+        Pr = np.minimum(np.maximum(Pr, 0), Pr_max)
 
         # normalize the propagator to obtain a pdf
         if normalized:
-            Pr /= Pr.sum()
+            Pr /= Pr.sum(axis=_FFT_AXES, keepdims=True)
 
         return Pr
 
@@ -194,7 +221,7 @@ class DiffusionSpectrumFit(OdfFit):
         else:
             values = self.data
 
-        rtop = values.sum()
+        rtop = values.sum(-1)
 
         return rtop
 
@@ -233,7 +260,7 @@ class DiffusionSpectrumFit(OdfFit):
 
         center = self.qgrid_sz // 2
 
-        rtop = Pr[center, center, center]
+        rtop = Pr[..., center, center, center]
         return rtop
 
     def msd_discrete(self, normalized=True):
@@ -277,10 +304,10 @@ class DiffusionSpectrumFit(OdfFit):
         z = np.tile(a.reshape(gridsize, 1, 1), (1, gridsize, gridsize))
         r2 = x ** 2 + y ** 2 + z ** 2
 
-        msd = np.sum(Pr * r2) / float((gridsize ** 3))
+        msd = np.sum(Pr * r2, axis=_FFT_AXES) / float((gridsize ** 3))
         return msd
 
-    def odf(self, sphere):
+    def odf(self, sphere, n_jobs=1):
         r""" Calculates the real discrete odf for a given discrete sphere
 
         ..math::
@@ -291,19 +318,78 @@ class DiffusionSpectrumFit(OdfFit):
 
         where $\hat{\mathbf{u}}$ is the unit vector which corresponds to a
         sphere point.
+
+        The propagators of many voxels are computed by blocks, with one FFT
+        per block, and are integrated along the radii with a single sparse
+        matrix product.
+
+        Parameters
+        ----------
+        sphere : Sphere
+            The points on which to sample the odf.
+        n_jobs : int, optional
+            Number of threads processing blocks of voxels. None uses all the
+            cpus. Default: 1
         """
-        interp_coords = self.model.cache_get('interp_coords',
-                                             key=sphere)
-        if interp_coords is None:
+        odf_matrix = self.model.cache_get('odf_matrix', key=sphere)
+        if odf_matrix is None:
             interp_coords = pdf_interp_coords(sphere,
                                               self.model.qradius,
                                               self.model.origin)
-            self.model.cache_set('interp_coords', sphere, interp_coords)
+            odf_matrix = pdf_odf_matrix(self.model.qradius, interp_coords,
+                                        3 * (self.qgrid_sz, ))
+            self.model.cache_set('odf_matrix', sphere, odf_matrix)
+
+        data = np.reshape(self.data, (-1, self.data.shape[-1]))
+        block_size = max(1, _GRID_BLOCK // self.qgrid_sz ** 3)
+        blocks = [data[i:i + block_size]
+                  for i in range(0, data.shape[0], block_size)]
+
+        def block_odf(block):
+            Pr = self._pdf(block)
+            # calculate the orientation distribution function
+            return odf_matrix.dot(Pr.reshape(Pr.shape[0], -1).T).T
+
+        if n_jobs == 1 or len(blocks) < 2:
+            odfs = [block_odf(block) for block in blocks]
+        else:
+            pool = ThreadPool(n_jobs or cpu_count())
+            try:
+                odfs = pool.map(block_odf, blocks)
+            finally:
+                pool.close()
+                pool.join()
+        return np.concatenate(odfs).reshape(self.data.shape[:-1] + (-1,))
+
 
-        Pr = self.pdf()
+def qspace_signal(values, qgrid, qgrid_size):
+    """ Fill the q-space grids of many voxels with their signal values
 
-        # calculate the orientation distribution function
-        return pdf_odf(Pr, self.model.qradius, interp_coords)
+    Parameters
+    ----------
+    values : array (..., N)
+        signal values of every voxel
+    qgrid : array (N, 3)
+        grid coordinates of the measurements, see ``create_qspace``
+    qgrid_size : int
+        size of the grid along each axis
+
+    Returns
+    -------
+    Sq : array (..., qgrid_size, qgrid_size, qgrid_size)
+        the signal volumes, where the values of measurements which fall in
+        the same cell are summed
+    """
+    values = np.asarray(values, dtype=float)
+    shape = 3 * (qgrid_size, )
+    cells = np.ravel_multi_index(tuple(np.asarray(qgrid).T), shape)
+    n_meas = len(cells)
+    # Sparse matrix summing the measurements into the cells of the grid
+    scatter = sps.csr_matrix((np.ones(n_meas), (cells, np.arange(n_meas))),
+                             shape=(qgrid_size ** 3, n_meas))
+    flat = np.reshape(values, (-1, n_meas))
+    Sq = scatter.dot(flat.T).T
+    return Sq.reshape(values.shape[:-1] + shape)
 
 
 def create_qspace(gtab, origin):
@@ -386,6 +472,7 @@ def hanning_filter(gtab, filter_width, origin):
     return .5 * np.cos(2 * np.pi * r / filter_width)
 
 
+@cached_basis
 def pdf_interp_coords(sphere, rradius, origin):
     """ Precompute coordinates for ODF calculation from the PDF
 
@@ -422,6 +509,62 @@ def pdf_odf(Pr, rradius, interp_coords):
     return odf
 
 
+def pdf_odf_matrix(rradius, interp_coords, pdf_shape):
+    r""" Sparse matrix calculating the real ODF from the flattened PDF
+
+    The trilinear interpolation of the PDF at the coordinates
+    `interp_coords` and the weighted sum along the radius of ``pdf_odf``
+    are linear in the PDF, and are gathered in a single sparse matrix, so
+    that the ODFs of many voxels are a single matrix product.
+
+    Parameters
+    ----------
+    rradius : array, shape (N,)
+        interpolation range on the radius
+    interp_coords : array, shape (3, M, N)
+        coordinates in the pdf for interpolating the odf
+    pdf_shape : tuple
+        shape (X, Y, Z) of the pdf
+
+    Returns
+    -------
+    odf_matrix : sparse matrix, shape (M, X * Y * Z)
+        ``odf_matrix.dot(Pr.ravel())`` equals ``pdf_odf(Pr, rradius,
+        interp_coords)``
+    """
+    coords = np.reshape(interp_coords, (3, -1))
+    n_points = coords.shape[1]
+    rows = np.repeat(np.arange(interp_coords.shape[1]),
+                     interp_coords.shape[2])
+    radial_weights = np.tile(np.asarray(rradius, dtype=float) ** 2,
+                             interp_coords.shape[1])
+    # Points outside of the pdf are interpolated to 0, as with the constant
+    # mode of ``map_coordinates``
+    inside = np.ones(n_points, dtype=bool)
+    for axis in range(3):
+        inside &= (coords[axis] >= 0) & (coords[axis] <= pdf_shape[axis] - 1)
+    lower = np.floor(coords).astype(int)
+    for axis in range(3):
+        lower[axis] = np.clip(lower[axis], 0, max(pdf_shape[axis] - 2, 0))
+    frac = coords - lower
+
+    all_rows, all_cols, all_weights = [], [], []
+    for corner in np.ndindex(2, 2, 2):
+        weights = radial_weights * inside
+        index = []
+        for axis, c in enumerate(corner):
+            weights = weights * (frac[axis] if c else 1 - frac[axis])
+            index.append(np.minimum(lower[axis] + c, pdf_shape[axis] - 1))
+        all_rows.append(rows)
+        all_cols.append(np.ravel_multi_index(index, pdf_shape))
+        all_weights.append(weights)
+    return sps.csr_matrix((np.concatenate(all_weights),
+                           (np.concatenate(all_rows),
+                            np.concatenate(all_cols))),
+                          shape=(interp_coords.shape[1],
+                                 int(np.prod(pdf_shape))))
+
+
 def half_to_full_qspace(data, gtab):
     """ Half to full Cartesian grid mapping
 
@@ -562,13 +705,12 @@ class DiffusionSpectrumDeconvFit(DiffusionSpectrumFit):
         hard threshold and then deconvolve the propagator with the
         Lucy-Richardson deconvolution algorithm
         """
-        values = self.data
-        # create the signal volume
-        Sq = np.zeros((self.qgrid_sz, self.qgrid_sz, self.qgrid_sz))
-        # fill q-space
-        for i in range(len(values)):
-            qx, qy, qz = self.model.qgrid[i]
-            Sq[qx, qy, qz] += values[i]
+        return self._pdf(self.data)
+
+    def _pdf(self, data, normalized=True):
+        values = data
+        # create the signal volumes
+        Sq = qspace_signal(values, self.model.qgrid, self.qgrid_sz)
         # get deconvolution PSF
         DSID_PSF = self.model.cache_get('deconv_psf', key=self.model.gtab)
         if DSID_PSF is None:
@@ -576,8 +718,8 @@ class DiffusionSpectrumDeconvFit(DiffusionSpectrumFit):
                                self.qgrid_sz, self.qgrid_sz)
         self.model.cache_set('deconv_psf', self.model.gtab, DSID_PSF)
         # apply fourier transform
-        Pr = fftshift(np.abs(np.real(fftn(ifftshift(Sq),
-                                          3 * (self.qgrid_sz, )))))
+        Pr = fftshift(np.abs(np.real(fftn(ifftshift(Sq, axes=_FFT_AXES),
+                                          axes=_FFT_AXES))), axes=_FFT_AXES)
         # threshold propagator
         Pr = threshold_propagator(Pr)
         # apply LR deconvolution
@@ -588,12 +730,14 @@ class DiffusionSpectrumDeconvFit(DiffusionSpectrumFit):
 def threshold_propagator(P, estimated_snr=15.):
     """
     Applies hard threshold on the propagator to remove background noise for the
-    deconvolution.
+    deconvolution. The propagators of many voxels can be stacked along leading
+    dimensions.
     """
     P_thresholded = P.copy()
-    threshold = P_thresholded.max() / float(estimated_snr)
+    threshold = (P_thresholded.max(axis=_FFT_AXES, keepdims=True) /
+                 float(estimated_snr))
     P_thresholded[P_thresholded < threshold] = 0
-    return P_thresholded / P_thresholded.sum()
+    return P_thresholded / P_thresholded.sum(axis=_FFT_AXES, keepdims=True)
 
 
 def gen_PSF(qgrid_sampling, siz_x, siz_y, siz_z):
@@ -615,8 +759,9 @@ def LR_deconv(prop, psf, numit=5, acc_factor=1):
 
     Parameters
     ----------
-    prop : 3-D ndarray of dtype float
-        The 3D volume to be deconvolve
+    prop : ndarray (..., X, Y, Z) of dtype float
+        The 3D volume to be deconvolve. Many volumes can be stacked along
+        leading dimensions, they are deconvolved together.
     psf : 3-D ndarray of dtype float
         The filter that will be used for the deconvolution.
     numit : int
@@ -633,28 +778,36 @@ def LR_deconv(prop, psf, numit=5, acc_factor=1):
     """
 
     eps = 1e-16
-    # Create the otf of the same size as prop
-    otf = np.zeros_like(prop)
+    # Create the otf of the same size as the volumes of prop
+    otf = np.zeros(prop.shape[-3:])
     # prop.ndim==3
     otf[otf.shape[0] // 2 - psf.shape[0] // 2:otf.shape[0] // 2 +
         psf.shape[0] // 2 + 1, otf.shape[1] // 2 - psf.shape[1] // 2:
         otf.shape[1] // 2 + psf.shape[1] // 2 + 1, otf.shape[2] // 2 -
         psf.shape[2] // 2:otf.shape[2] // 2 + psf.shape[2] // 2 + 1] = psf
     otf = np.real(np.fft.fftn(np.fft.ifftshift(otf)))
+    # The otf is real and even, so the blurring of real volumes only needs
+    # the half spectrum of their real transform.
+    otf = otf[..., :otf.shape[-1] // 2 + 1]
+    shape = prop.shape[-3:]
+
+    def blur(volume):
+        return irfftn(otf * rfftn(volume, axes=_FFT_AXES), shape,
+                      axes=_FFT_AXES)
+
     # Enforce Positivity
     prop = np.clip(prop, 0, np.inf)
     prop_deconv = prop.copy()
     for it in range(numit):
         # Blur the estimate
-        reBlurred = np.real(np.fft.ifftn(otf * np.fft.fftn(prop_deconv)))
+        reBlurred = blur(prop_deconv)
         reBlurred[reBlurred < eps] = eps
         # Update the estimate
         prop_deconv = prop_deconv * (
-            np.real(np.fft.ifftn(
-                otf * np.fft.fftn((prop / reBlurred) + eps)))) ** acc_factor
+            blur((prop / reBlurred) + eps)) ** acc_factor
         # Enforce positivity
         prop_deconv = np.clip(prop_deconv, 0, np.inf)
-    return prop_deconv / prop_deconv.sum()
+    return prop_deconv / prop_deconv.sum(axis=_FFT_AXES, keepdims=True)
 
 
 if __name__ == '__main__':
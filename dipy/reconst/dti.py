@@ -8,7 +8,6 @@ import functools
 
 import numpy as np
 
-import scipy.optimize as opt
 
 from dipy.utils.six.moves import range
 from dipy.utils.arrfuncs import pinv, eigh
@@ -16,7 +15,9 @@ from dipy.data import get_sphere
 from ..core.gradients import gradient_table
 from ..core.geometry import vector_norm
 from .vec_val_sum import vec_val_vect
+from .tensor_eig import eigh_3x3, tensor_metrics_3x3
 from ..core.onetime import auto_attr
+from ..core.optimize import batch_leastsq
 from .base import ReconstModel
 
 
@@ -720,6 +721,11 @@ class TensorModel(ReconstModel):
         Example : In :func:`iter_fit_tensor` we have a default step value of
         1e4
 
+        The 'WLS' and 'OLS' fit methods also accept an `eig_backend`
+        key-word argument. With ``eig_backend='closed_form'`` the tensors are
+        decomposed with a dedicated, parallel 3x3 eigen-solver (see
+        :func:`decompose_tensor`).
+
         References
         ----------
         .. [1] Basser, P.J., Mattiello, J., LeBihan, D., 1994. Estimation of
@@ -753,7 +759,7 @@ class TensorModel(ReconstModel):
             e_s += " positive."
             raise ValueError(e_s)
 
-    def fit(self, data, mask=None):
+    def fit(self, data, mask=None, out=None, scalars=None, block_size=100000):
         """ Fit method of the DTI model class
 
         Parameters
@@ -765,7 +771,29 @@ class TensorModel(ReconstModel):
             A boolean array used to mark the coordinates in the data that
             should be analyzed that has the shape data.shape[:-1]
 
+        out : array, optional
+            A writable array of shape data.shape[:-1] + (12,), for example a
+            memmap (see :func:`dipy.io.image.memmap_nifti`), receiving the
+            tensor parameters. The returned TensorFit holds `out`.
+
+        scalars : dict, optional
+            Maps names of TensorFit attributes (e.g. 'fa', 'md') to writable
+            arrays of shape data.shape[:-1] (plus the trailing dimensions of
+            the attribute, e.g. 3 for 'color_fa') receiving these maps.
+
+        block_size : int, optional
+            When `out` or `scalars` are given, or `data` is not an ndarray
+            (e.g. the `dataobj` of a nibabel image or a memmap), the data is
+            read, fit and written in blocks of whole slices along the first
+            axis holding about `block_size` voxels, so that the memory used
+            depends on the block size rather than on the image size.
+            Default: 100000
+
         """
+        if (out is not None or scalars or
+                type(data) is not np.ndarray and data.ndim > 1):
+            return self._fit_blocks(data, mask, out, scalars, block_size)
+
         S0_params = None
 
         if mask is not None:
@@ -801,10 +829,49 @@ class TensorModel(ReconstModel):
             dti_params[mask, :] = params_in_mask
             if self.return_S0_hat:
                 S0_params = np.zeros(data.shape[:-1] + (1,))
-                S0_params[mask] = model_S0
+                S0_params[mask] = model_S0.reshape(-1, 1)
 
         return TensorFit(self, dti_params, model_S0=S0_params)
 
+    def _fit_blocks(self, data, mask, out, scalars, block_size):
+        """Fit the data in blocks of slices along the first axis, writing the
+        results of each block to `out` and `scalars`"""
+        shape = data.shape[:-1]
+        if mask is not None and mask.shape != shape:
+            raise ValueError("Mask is not the same shape as data.")
+        if out is None:
+            out = np.empty(shape + (12,))
+        elif out.shape != shape + (12,):
+            raise ValueError("out should have the shape data.shape[:-1] + "
+                             "(12,)")
+        scalars = scalars or {}
+        for name in scalars:
+            if not hasattr(TensorFit, name):
+                raise ValueError('"%s" is not an attribute of TensorFit' %
+                                 name)
+        # The S0 maps have the shapes of the in-memory fit
+        S0_shape = shape if mask is None else shape + (1,)
+        S0_params = None
+        if self.return_S0_hat:
+            S0_params = np.empty(S0_shape)
+
+        n_slices = max(1, int(block_size // max(1, np.prod(shape[1:]))))
+        for i in range(0, shape[0], n_slices):
+            block = slice(i, i + n_slices)
+            block_mask = None if mask is None else np.asarray(mask[block])
+            if block_mask is not None and not np.any(block_mask):
+                block_fit = TensorFit(
+                    self, np.zeros(block_mask.shape + (12,)),
+                    model_S0=np.zeros(block_mask.shape + (1,)))
+            else:
+                block_fit = self.fit(np.asarray(data[block]), block_mask)
+            out[block] = block_fit.model_params
+            if self.return_S0_hat:
+                S0_params[block] = block_fit.model_S0
+            for name, scalar_map in scalars.items():
+                scalar_map[block] = getattr(block_fit, name)
+        return TensorFit(self, out, model_S0=S0_params)
+
     def predict(self, dti_params, S0=1.):
         """
         Predict a signal for this TensorModel class instance given parameters.
@@ -1304,7 +1371,8 @@ def iter_fit_tensor(step=1e4):
 
 
 @iter_fit_tensor()
-def wls_fit_tensor(design_matrix, data, return_S0_hat=False):
+def wls_fit_tensor(design_matrix, data, return_S0_hat=False,
+                   eig_backend='eigh'):
     r"""
     Computes weighted least squares (WLS) fit to calculate self-diffusion
     tensor using a linear regression model [1]_.
@@ -1319,6 +1387,9 @@ def wls_fit_tensor(design_matrix, data, return_S0_hat=False):
         dimension should contain the data. It makes no copies of data.
     return_S0_hat : bool
         Boolean to return (True) or not (False) the S0 values for the fit.
+    eig_backend : str, optional
+        The eigen-decomposition backend, 'eigh' or 'closed_form' (see
+        `decompose_tensor`). Default: 'eigh'
 
     Returns
     -------
@@ -1374,15 +1445,18 @@ def wls_fit_tensor(design_matrix, data, return_S0_hat=False):
                            w * log_s)
     if return_S0_hat:
         return (eig_from_lo_tri(fit_result,
-                                min_diffusivity=tol / -design_matrix.min()),
+                                min_diffusivity=tol / -design_matrix.min(),
+                                backend=eig_backend),
                 np.exp(-fit_result[:, -1]))
     else:
         return eig_from_lo_tri(fit_result,
-                               min_diffusivity=tol / -design_matrix.min())
+                               min_diffusivity=tol / -design_matrix.min(),
+                               backend=eig_backend)
 
 
 @iter_fit_tensor()
-def ols_fit_tensor(design_matrix, data, return_S0_hat=False):
+def ols_fit_tensor(design_matrix, data, return_S0_hat=False,
+                   eig_backend='eigh'):
     r"""
     Computes ordinary least squares (OLS) fit to calculate self-diffusion
     tensor using a linear regression model [1]_.
@@ -1397,6 +1471,9 @@ def ols_fit_tensor(design_matrix, data, return_S0_hat=False):
         dimension should contain the data. It makes no copies of data.
     return_S0_hat : bool
         Boolean to return (True) or not (False) the S0 values for the fit.
+    eig_backend : str, optional
+        The eigen-decomposition backend, 'eigh' or 'closed_form' (see
+        `decompose_tensor`). Default: 'eigh'
 
     Returns
     -------
@@ -1433,11 +1510,13 @@ def ols_fit_tensor(design_matrix, data, return_S0_hat=False):
                            np.log(data))
     if return_S0_hat:
         return (eig_from_lo_tri(fit_result,
-                                min_diffusivity=tol / -design_matrix.min()),
+                                min_diffusivity=tol / -design_matrix.min(),
+                                backend=eig_backend),
                 np.exp(-fit_result[:, -1]))
     else:
         return eig_from_lo_tri(fit_result,
-                               min_diffusivity=tol / -design_matrix.min())
+                               min_diffusivity=tol / -design_matrix.min(),
+                               backend=eig_backend)
 
 
 def _ols_fit_matrix(design_matrix):
@@ -1460,113 +1539,6 @@ def _ols_fit_matrix(design_matrix):
     return np.dot(U, U.T)
 
 
-def _nlls_err_func(tensor, design_matrix, data, weighting=None,
-                   sigma=None):
-    """
-    Error function for the non-linear least-squares fit of the tensor.
-
-    Parameters
-    ----------
-    tensor : array (3,3)
-        The 3-by-3 tensor matrix
-
-    design_matrix : array
-        The design matrix
-
-    data : array
-        The voxel signal in all gradient directions
-
-    weighting : str (optional).
-         Whether to use the Geman McClure weighting criterion (see [1]_
-         for details)
-
-    sigma : float or float array (optional)
-        If 'sigma' weighting is used, we will weight the error function
-        according to the background noise estimated either in aggregate over
-        all directions (when a float is provided), or to an estimate of the
-        noise in each diffusion-weighting direction (if an array is
-        provided). If 'gmm', the Geman-Mclure M-estimator is used for
-        weighting (see Notes).
-
-    Notes
-    -----
-    The GemanMcClure M-estimator is described as follows [1]_ (page 1089): "The
-    scale factor C affects the shape of the GMM [Geman-McClure M-estimator]
-    weighting function and represents the expected spread of the residuals
-    (i.e., the SD of the residuals) due to Gaussian distributed noise. The
-    scale factor C can be estimated by many robust scale estimators. We used
-    the median absolute deviation (MAD) estimator because it is very robust to
-    outliers having a 50% breakdown point (6,7). The explicit formula for C
-    using the MAD estimator is:
-
-    .. math ::
-
-            C = 1.4826 x MAD = 1.4826 x median{|r1-\hat{r}|,... |r_n-\hat{r}|}
-
-    where $\hat{r} = median{r_1, r_2, ..., r_3}$ and n is the number of data
-    points. The multiplicative constant 1.4826 makes this an approximately
-    unbiased estimate of scale when the error model is Gaussian."
-
-
-    References
-    ----------
-    [1] Chang, L-C, Jones, DK and Pierpaoli, C (2005). RESTORE: robust
-    estimation of tensors by outlier rejection. MRM, 53: 1088-95.
-    """
-    # This is the predicted signal given the params:
-    y = np.exp(np.dot(design_matrix, tensor))
-
-    # Compute the residuals
-    residuals = data - y
-
-    # If we don't want to weight the residuals, we are basically done:
-    if weighting is None:
-        # And we return the SSE:
-        return residuals
-    se = residuals ** 2
-    # If the user provided a sigma (e.g 1.5267 * std(background_noise), as
-    # suggested by Chang et al.) we will use it:
-    if weighting == 'sigma':
-        if sigma is None:
-            e_s = "Must provide sigma value as input to use this weighting"
-            e_s += " method"
-            raise ValueError(e_s)
-        w = 1 / (sigma**2)
-
-    elif weighting == 'gmm':
-        # We use the Geman McClure M-estimator to compute the weights on the
-        # residuals:
-        C = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            w = 1 / (se + C**2)
-            # The weights are normalized to the mean weight (see p. 1089):
-            w = w / np.mean(w)
-
-    # Return the weighted residuals:
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        return np.sqrt(w * se)
-
-
-def _nlls_jacobian_func(tensor, design_matrix, data, *arg, **kwargs):
-    """The Jacobian is the first derivative of the error function [1]_.
-
-    Notes
-    -----
-    This is an implementation of equation 14 in [1]_.
-
-    References
-    ----------
-    [1] Koay, CG, Chang, L-C, Carew, JD, Pierpaoli, C, Basser PJ (2006).
-        A unifying theoretical and algorithmic framework for least squares
-        methods of estimation in diffusion tensor imaging. MRM 182, 115-25.
-
-    """
-    pred = np.exp(np.dot(design_matrix, tensor))
-    return -pred[:, None] * design_matrix
-
-
 def _decompose_tensor_nan(tensor, tensor_alternative, min_diffusivity=0):
     """ Helper function that expands the function decompose_tensor to deal
     with tensor with nan elements.
@@ -1612,11 +1584,160 @@ def _decompose_tensor_nan(tensor, tensor_alternative, min_diffusivity=0):
     return evals, evecs
 
 
+def _nlls_fit_batch(design_matrix, data, start_params, weights=None,
+                    step=10000):
+    """
+    Non-linear least-squares fit of the tensors of many voxels at once.
+
+    All the voxels are updated together by a Levenberg-Marquardt iteration
+    solving the 7x7 normal equations of every voxel with stacked linear
+    algebra (see :func:`dipy.core.optimize.batch_leastsq`).
+
+    Parameters
+    ----------
+    design_matrix : array (g, 7)
+        Design matrix holding the covariants used to solve for the regression
+        coefficients.
+    data : array (n, g)
+        The signal of n voxels.
+    start_params : array (n, 7)
+        Initial estimate of the tensor parameters of every voxel.
+    weights : float or array of shape (g,) or (n, g) (optional)
+        The residuals are multiplied by these weights, i.e. the square root
+        of the weights of the squared residuals. A weight of 0 removes a
+        measurement from the fit of a voxel.
+    step : int (optional)
+        The number of voxels fit together, which bounds the memory used by
+        the Jacobians.
+
+    Returns
+    -------
+    params : array (n, 7)
+        The tensor parameters. Voxels where the fit produced non-finite
+        values keep their start parameters.
+    """
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+
+    def residuals_and_jacobian(params, chunk, index):
+        pred = np.exp(np.dot(params, design_matrix.T))
+        residuals = data[chunk][index] - pred
+        jac = -pred[..., None] * design_matrix
+        if weights is not None:
+            w = weights[chunk][index] if weights.ndim == 2 else weights
+            residuals = residuals * w
+            jac = jac * w[..., None]
+        return residuals, jac
+
+    params = np.empty_like(start_params)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for i in range(0, data.shape[0], step):
+            chunk = slice(i, i + step)
+            params[chunk], _ = batch_leastsq(
+                lambda x, index: residuals_and_jacobian(x, chunk, index),
+                start_params[chunk], ftol=1.49012e-08, xtol=1.49012e-08,
+                max_iter=200)
+    failed = ~np.all(np.isfinite(params), axis=-1)
+    params[failed] = start_params[failed]
+    return params
+
+
+def _nlls_fit_gmm(design_matrix, data, start_params, gmm_iterations=5):
+    r"""
+    Non-linear least-squares fit of many voxels with Geman-McClure weights.
+
+    The squared residuals are weighted with the Geman-McClure M-estimator
+    [1]_ (page 1089):
+
+    .. math ::
+
+            w_i = \frac{1}{r_i^2 + C^2}
+
+    normalized to their mean weight. The scale factor C is estimated with the
+    median absolute deviation (MAD) of the residuals, which is very robust to
+    outliers having a 50% breakdown point:
+
+    .. math ::
+
+            C = 1.4826 x MAD = 1.4826 x median{|r1-\hat{r}|,... |r_n-\hat{r}|}
+
+    where $\hat{r} = median{r_1, r_2, ..., r_3}$. The multiplicative
+    constant 1.4826 makes this an approximately unbiased estimate of scale
+    when the error model is Gaussian.
+
+    The fit is iteratively reweighted: C and the weights are computed from
+    the residuals of the current parameters, and the weighted fit of all
+    voxels is repeated `gmm_iterations` times.
+
+    Parameters
+    ----------
+    design_matrix : array (g, 7)
+        Design matrix holding the covariants used to solve for the regression
+        coefficients.
+    data : array (n, g)
+        The signal of n voxels.
+    start_params : array (n, 7)
+        Initial estimate of the tensor parameters of every voxel.
+    gmm_iterations : int (optional)
+        The number of reweighted fits.
+
+    Returns
+    -------
+    params : array (n, 7)
+        The tensor parameters.
+
+    References
+    ----------
+    .. [1] Chang, L-C, Jones, DK and Pierpaoli, C (2005). RESTORE: robust
+       estimation of tensors by outlier rejection. MRM, 53: 1088-95.
+    """
+    params = start_params
+    for _ in range(gmm_iterations):
+        residuals = data - np.exp(np.dot(params, design_matrix.T))
+        C = 1.4826 * np.median(
+            np.abs(residuals - np.median(residuals, -1)[:, None]), -1)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            w = 1. / (residuals ** 2 + C[:, None] ** 2)
+            w = np.sqrt(w / np.mean(w, -1)[:, None])
+        w[~np.all(np.isfinite(w), -1)] = 1.
+        params = _nlls_fit_batch(design_matrix, data, params, weights=w)
+    return params
+
+
+def _nlls_start_params(design_matrix, data):
+    """Flatten the data and compute the OLS starting point of the NLLS
+    fits"""
+    flat_data = data.reshape((-1, data.shape[-1]))
+    if np.any(np.all(flat_data == 0, -1)):
+        raise ValueError("The data in this voxel contains only zeros")
+    inv_design = np.linalg.pinv(design_matrix)
+    log_s = np.log(flat_data)
+    ols_params = np.dot(inv_design, log_s.T).T
+    return flat_data, ols_params
+
+
+def _nlls_output(data, params, return_S0_hat):
+    """Decompose the fitted tensors into the 12 dti parameters"""
+    evals, evecs = decompose_tensor(from_lower_triangular(params[:, :6]))
+    dti_params = np.concatenate([evals, evecs.reshape(-1, 9)], axis=-1)
+    dti_params.shape = data.shape[:-1] + (12,)
+    if return_S0_hat:
+        model_S0 = np.exp(-params[:, 6:])
+        model_S0.shape = data.shape[:-1] + (1,)
+        return (dti_params, model_S0)
+    else:
+        return dti_params
+
+
 def nlls_fit_tensor(design_matrix, data, weighting=None,
                     sigma=None, jac=True, return_S0_hat=False):
     """
     Fit the tensor params using non-linear least-squares.
 
+    All the voxels of a chunk are fit together (see `_nlls_fit_batch`).
+
     Parameters
     ----------
     design_matrix : array (g, 7)
@@ -1639,7 +1760,8 @@ def nlls_fit_tensor(design_matrix, data, weighting=None,
         from some part of the image known to contain no signal (only noise).
 
     jac : bool
-        Use the Jacobian? Default: True
+        Ignored, kept for compatibility: the analytical Jacobian is always
+        used.
 
     return_S0_hat : bool
         Boolean to return (True) or not (False) the S0 values for the fit.
@@ -1649,64 +1771,25 @@ def nlls_fit_tensor(design_matrix, data, weighting=None,
     nlls_params: the eigen-values and eigen-vectors of the tensor in each
         voxel.
 
+    Notes
+    -----
+    With the 'gmm' weighting, the fit is iteratively reweighted with the
+    Geman-McClure M-estimator of the residuals (see `_nlls_fit_gmm`).
     """
-    # Flatten for the iteration over voxels:
-    flat_data = data.reshape((-1, data.shape[-1]))
-    # Use the OLS method parameters as the starting point for the optimization:
-    inv_design = np.linalg.pinv(design_matrix)
-    log_s = np.log(flat_data)
-    D = np.dot(inv_design, log_s.T).T
-
-    # Flatten for the iteration over voxels:
-    ols_params = np.reshape(D, (-1, D.shape[-1]))
-    # 12 parameters per voxel (evals + evecs):
-    dti_params = np.empty((flat_data.shape[0], 12))
-    if return_S0_hat:
-        model_S0 = np.empty((flat_data.shape[0], 1))
-    for vox in range(flat_data.shape[0]):
-        if np.all(flat_data[vox] == 0):
-            raise ValueError("The data in this voxel contains only zeros")
-
-        start_params = ols_params[vox]
-        # Do the optimization in this voxel:
-        if jac:
-            this_tensor, status = opt.leastsq(_nlls_err_func, start_params,
-                                              args=(design_matrix,
-                                                    flat_data[vox],
-                                                    weighting,
-                                                    sigma),
-                                              Dfun=_nlls_jacobian_func)
-        else:
-            this_tensor, status = opt.leastsq(_nlls_err_func, start_params,
-                                              args=(design_matrix,
-                                                    flat_data[vox],
-                                                    weighting,
-                                                    sigma))
-
-        # The parameters are the evals and the evecs:
-        try:
-            evals, evecs = decompose_tensor(
-                from_lower_triangular(this_tensor[:6]))
-            dti_params[vox, :3] = evals
-            dti_params[vox, 3:] = evecs.ravel()
-            if return_S0_hat:
-                model_S0[vox] = np.exp(-this_tensor[6])
-        # If leastsq failed to converge and produced nans, we'll resort to the
-        # OLS solution in this voxel:
-        except np.linalg.LinAlgError:
-            evals, evecs = decompose_tensor(
-                from_lower_triangular(start_params[:6]))
-            dti_params[vox, :3] = evals
-            dti_params[vox, 3:] = evecs.ravel()
-            if return_S0_hat:
-                model_S0[vox] = np.exp(-start_params[6])
-
-    dti_params.shape = data.shape[:-1] + (12,)
-    if return_S0_hat:
-        model_S0.shape = data.shape[:-1] + (1,)
-        return (dti_params, model_S0)
-    else:
-        return dti_params
+    flat_data, ols_params = _nlls_start_params(design_matrix, data)
+    weights = None
+    if weighting == 'sigma':
+        if sigma is None:
+            e_s = "Must provide sigma value as input to use this weighting"
+            e_s += " method"
+            raise ValueError(e_s)
+        weights = 1. / np.asarray(sigma, dtype=float)
+    elif weighting == 'gmm':
+        params = _nlls_fit_gmm(design_matrix, flat_data, ols_params)
+        return _nlls_output(data, params, return_S0_hat)
+    params = _nlls_fit_batch(design_matrix, flat_data, ols_params,
+                             weights=weights)
+    return _nlls_output(data, params, return_S0_hat)
 
 
 def restore_fit_tensor(design_matrix, data, sigma=None, jac=True,
@@ -1714,6 +1797,10 @@ def restore_fit_tensor(design_matrix, data, sigma=None, jac=True,
     """
     Use the RESTORE algorithm [Chang2005]_ to calculate a robust tensor fit
 
+    The voxels of a chunk are fit together. Each step of the outlier
+    rejection is applied to the voxels which still have outliers, with a mask
+    of the outlier measurements of every voxel.
+
     Parameters
     ----------
 
@@ -1731,14 +1818,12 @@ def restore_fit_tensor(design_matrix, data, sigma=None, jac=True,
         from some part of the image known to contain no signal (only noise).
 
     jac : bool, optional
-        Whether to use the Jacobian of the tensor to speed the non-linear
-        optimization procedure used to fit the tensor paramters (see also
-        :func:`nlls_fit_tensor`). Default: True
+        Ignored, kept for compatibility: the analytical Jacobian is always
+        used (see also :func:`nlls_fit_tensor`).
 
     return_S0_hat : bool
         Boolean to return (True) or not (False) the S0 values for the fit.
 
-
     Returns
     -------
     restore_params : an estimate of the tensor parameters in each voxel.
@@ -1749,103 +1834,33 @@ def restore_fit_tensor(design_matrix, data, sigma=None, jac=True,
     of tensors by outlier rejection. MRM, 53: 1088-95.
 
     """
-    # Flatten for the iteration over voxels:
-    flat_data = data.reshape((-1, data.shape[-1]))
-    # Use the OLS method parameters as the starting point for the optimization:
-    inv_design = np.linalg.pinv(design_matrix)
-    log_s = np.log(flat_data)
-    D = np.dot(inv_design, log_s.T).T
-    ols_params = np.reshape(D, (-1, D.shape[-1]))
-    # 12 parameters per voxel (evals + evecs):
-    dti_params = np.empty((flat_data.shape[0], 12))
-    if return_S0_hat:
-        model_S0 = np.empty((flat_data.shape[0], 1))
-    for vox in range(flat_data.shape[0]):
-        if np.all(flat_data[vox] == 0):
-            raise ValueError("The data in this voxel contains only zeros")
-
-        start_params = ols_params[vox]
-        # Do nlls using sigma weighting in this voxel:
-        if jac:
-            this_tensor, status = opt.leastsq(_nlls_err_func, start_params,
-                                              args=(design_matrix,
-                                                    flat_data[vox],
-                                                    'sigma',
-                                                    sigma),
-                                              Dfun=_nlls_jacobian_func)
-        else:
-            this_tensor, status = opt.leastsq(_nlls_err_func, start_params,
-                                              args=(design_matrix,
-                                                    flat_data[vox],
-                                                    'sigma',
-                                                    sigma))
-
-        # Get the residuals:
-        pred_sig = np.exp(np.dot(design_matrix, this_tensor))
-        residuals = flat_data[vox] - pred_sig
-        # If any of the residuals are outliers (using 3 sigma as a criterion
-        # following Chang et al., e.g page 1089):
-        if np.any(np.abs(residuals) > 3 * sigma):
-            # Do nlls with GMM-weighting:
-            if jac:
-                this_tensor, status = opt.leastsq(_nlls_err_func,
-                                                  start_params,
-                                                  args=(design_matrix,
-                                                        flat_data[vox],
-                                                        'gmm'),
-                                                  Dfun=_nlls_jacobian_func)
-            else:
-                this_tensor, status = opt.leastsq(_nlls_err_func,
-                                                  start_params,
-                                                  args=(design_matrix,
-                                                        flat_data[vox],
-                                                        'gmm'))
-
-            # How are you doin' on those residuals?
-            pred_sig = np.exp(np.dot(design_matrix, this_tensor))
-            residuals = flat_data[vox] - pred_sig
-            if np.any(np.abs(residuals) > 3 * sigma):
-                # If you still have outliers, refit without those outliers:
-                non_outlier_idx = np.where(np.abs(residuals) <= 3 * sigma)
-                clean_design = design_matrix[non_outlier_idx]
-                clean_sig = flat_data[vox][non_outlier_idx]
-                if np.iterable(sigma):
-                    this_sigma = sigma[non_outlier_idx]
-                else:
-                    this_sigma = sigma
-
-                if jac:
-                    this_tensor, status = opt.leastsq(_nlls_err_func,
-                                                      start_params,
-                                                      args=(clean_design,
-                                                            clean_sig,
-                                                            'sigma',
-                                                            this_sigma),
-                                                      Dfun=_nlls_jacobian_func)
-                else:
-                    this_tensor, status = opt.leastsq(_nlls_err_func,
-                                                      start_params,
-                                                      args=(clean_design,
-                                                            clean_sig,
-                                                            'sigma',
-                                                            this_sigma))
-
-        # The parameters are the evals and the evecs:
-        evals, evecs = _decompose_tensor_nan(
-            from_lower_triangular(this_tensor[:6]),
-            from_lower_triangular(start_params[:6]))
-        dti_params[vox, :3] = evals
-        dti_params[vox, 3:] = evecs.ravel()
-        if return_S0_hat:
-            model_S0[vox] = np.exp(-this_tensor[6])
-
-    dti_params.shape = data.shape[:-1] + (12,)
-    restore_params = dti_params
-    if return_S0_hat:
-        model_S0.shape = data.shape[:-1] + (1,)
-        return (restore_params, model_S0)
-    else:
-        return restore_params
+    flat_data, ols_params = _nlls_start_params(design_matrix, data)
+    weights = 1. / np.asarray(sigma, dtype=float)
+    # Do nlls using sigma weighting in all voxels:
+    params = _nlls_fit_batch(design_matrix, flat_data, ols_params,
+                             weights=weights)
+
+    def outliers(params, index):
+        pred_sig = np.exp(np.dot(params[index], design_matrix.T))
+        # Outliers use 3 sigma as a criterion following Chang et al., e.g.
+        # page 1089:
+        return np.abs(flat_data[index] - pred_sig) > 3 * sigma
+
+    # In the voxels with outliers, do nlls with GMM-weighting:
+    redo = np.flatnonzero(np.any(outliers(params, slice(None)), -1))
+    if redo.size:
+        params[redo] = _nlls_fit_gmm(design_matrix, flat_data[redo],
+                                     ols_params[redo])
+        # If there are still outliers, refit without those outliers:
+        outlier_mask = outliers(params, redo)
+        still = np.any(outlier_mask, -1)
+        redo = redo[still]
+        if redo.size:
+            clean_weights = ~outlier_mask[still] * weights
+            params[redo] = _nlls_fit_batch(
+                design_matrix, flat_data[redo], ols_params[redo],
+                weights=clean_weights)
+    return _nlls_output(data, params, return_S0_hat)
 
 
 _lt_indices = np.array([[0, 1, 3],
@@ -1906,7 +1921,7 @@ def lower_triangular(tensor, b0=None):
         return D
 
 
-def decompose_tensor(tensor, min_diffusivity=0):
+def decompose_tensor(tensor, min_diffusivity=0, backend='eigh'):
     """ Returns eigenvalues and eigenvectors given a diffusion tensor
 
     Computes tensor eigen decomposition to calculate eigenvalues and
@@ -1921,6 +1936,11 @@ def decompose_tensor(tensor, min_diffusivity=0):
         much smaller than the diffusion weighting, cause quite a lot of noise
         in metrics such as fa, diffusivity values smaller than
         `min_diffusivity` are replaced with `min_diffusivity`.
+    backend : str, optional
+        'eigh' uses ``np.linalg.eigh`` (LAPACK). 'closed_form' uses the
+        analytic eigenvalues of 3x3 symmetric matrices and computes all the
+        tensors in parallel (see `dipy.reconst.tensor_eig.eigh_3x3`), which
+        is much faster on large volumes. Default: 'eigh'
 
     Returns
     -------
@@ -1933,6 +1953,13 @@ def decompose_tensor(tensor, min_diffusivity=0):
         eigvals[..., j])
 
     """
+    if backend == 'closed_form':
+        return _eigh_closed_form(lower_triangular(tensor), min_diffusivity)
+    elif backend != 'eigh':
+        e_s = "backend must be 'eigh' or 'closed_form', "
+        e_s += "got %r" % (backend,)
+        raise ValueError(e_s)
+
     # outputs multiplicity as well so need to unique
     eigenvals, eigenvecs = eigh(tensor)
 
@@ -1961,6 +1988,48 @@ def decompose_tensor(tensor, min_diffusivity=0):
     return eigenvals, eigenvecs
 
 
+def _eigh_closed_form(tensor_elements, min_diffusivity=0):
+    """ decompose_tensor for the lower triangular elements of tensors,
+    using the closed-form 3x3 eigen-solver"""
+    shape = tensor_elements.shape[:-1]
+    elements = np.ascontiguousarray(tensor_elements[..., :6],
+                                    dtype=np.float64).reshape(-1, 6)
+    eigenvals, eigenvecs = eigh_3x3(elements)
+    eigenvals = eigenvals.clip(min=min_diffusivity)
+    return eigenvals.reshape(shape + (3,)), eigenvecs.reshape(shape + (3, 3))
+
+
+def tensor_metrics(tensor_elements, min_diffusivity=0, num_threads=None):
+    """ FA, MD, AD, RD and mode of diffusion tensors, in one pass
+
+    The metrics are computed together from the eigenvalues of each tensor,
+    in parallel and without any intermediate array the size of the volume.
+
+    Parameters
+    ----------
+    tensor_elements : array (..., 6)
+        The six unique elements of the tensors, in lower triangular order
+        (see `lower_triangular`).
+    min_diffusivity : float, optional
+        See `decompose_tensor`. Default: 0
+    num_threads : int, optional
+        Number of threads. If None (default), the value of the
+        OMP_NUM_THREADS environment variable, or else all cores, are used.
+
+    Returns
+    -------
+    fa, md, ad, rd, mode : arrays (...)
+        The fractional anisotropy, mean, axial and radial diffusivities and
+        mode of the tensors. The mode of isotropic tensors is NaN.
+    """
+    tensor_elements = np.asarray(tensor_elements)
+    shape = tensor_elements.shape[:-1]
+    elements = np.ascontiguousarray(tensor_elements[..., :6],
+                                    dtype=np.float64).reshape(-1, 6)
+    metrics = tensor_metrics_3x3(elements, min_diffusivity, num_threads)
+    return tuple(metrics[:, i].reshape(shape) for i in range(5))
+
+
 def design_matrix(gtab, dtype=None):
     """  Constructs design matrix for DTI weighted least squares or
     least squares fitting. (Basser et al., 1994a)
@@ -2014,7 +2083,7 @@ def quantize_evecs(evecs, odf_vertices=None):
     return IN
 
 
-def eig_from_lo_tri(data, min_diffusivity=0):
+def eig_from_lo_tri(data, min_diffusivity=0, backend='eigh'):
     """
     Calculates tensor eigenvalues/eigenvectors from an array containing the
     lower diagonal form of the six unique tensor elements.
@@ -2025,6 +2094,8 @@ def eig_from_lo_tri(data, min_diffusivity=0):
         diffusion tensors elements stored in lower triangular order
     min_diffusivity : float
         See decompose_tensor()
+    backend : str, optional
+        See decompose_tensor(). Default: 'eigh'
 
     Returns
     -------
@@ -2032,8 +2103,12 @@ def eig_from_lo_tri(data, min_diffusivity=0):
         Eigen-values and eigen-vectors of the same array.
     """
     data = np.asarray(data)
-    evals, evecs = decompose_tensor(from_lower_triangular(data),
-                                    min_diffusivity=min_diffusivity)
+    if backend == 'closed_form':
+        evals, evecs = _eigh_closed_form(data, min_diffusivity)
+    else:
+        evals, evecs = decompose_tensor(from_lower_triangular(data),
+                                        min_diffusivity=min_diffusivity,
+                                        backend=backend)
     dti_params = np.concatenate((evals[..., None, :], evecs), axis=-2)
     return dti_params.reshape(data.shape[:-1] + (12, ))
 
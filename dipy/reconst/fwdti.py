@@ -17,6 +17,7 @@ from dipy.reconst.dki import _positive_evals
 
 from dipy.reconst.vec_val_sum import vec_val_vect
 from dipy.core.ndindex import ndindex
+from dipy.core.optimize import batch_leastsq
 from dipy.reconst.multi_voxel import multi_voxel_fit
 
 
@@ -136,18 +137,44 @@ class FreeWaterTensorModel(ReconstModel):
             mes = "fwdti fit requires data for at least 2 non zero b-values"
             raise ValueError(mes)
 
-    @multi_voxel_fit
     def fit(self, data, mask=None):
         """ Fit method of the free water elimination DTI model class
 
+        With the 'WLS' and 'NLS' fit methods, all the voxels are fitted
+        together (see `wls_fit_tensor` and `nls_fit_tensor`). Other fit
+        methods are applied to one voxel at a time.
+
         Parameters
         ----------
         data : array
-            The measured signal from one voxel.
+            The measured signal, with the measurements along the last
+            dimension.
         mask : array
             A boolean array used to mark the coordinates in the data that
             should be analyzed that has the shape data.shape[:-1]
         """
+        batch_fit = _batch_fit_methods.get(self.fit_method)
+        if batch_fit is None:
+            return self._fit_voxel(data, mask=mask)
+
+        data = np.asarray(data)
+        if mask is None:
+            mask = np.ones(data.shape[:-1], dtype=bool)
+        else:
+            if mask.shape != data.shape[:-1]:
+                raise ValueError("Mask is not the same shape as data.")
+            mask = np.array(mask, dtype=bool, copy=False)
+
+        fwdti_params = np.zeros(data.shape[:-1] + (13,))
+        data_in_mask = np.reshape(data[mask], (-1, data.shape[-1]))
+        S0 = np.mean(data_in_mask[:, self.gtab.b0s_mask], axis=-1)
+        fwdti_params[mask] = batch_fit(self.design_matrix, data_in_mask, S0,
+                                       *self.args, **self.kwargs)
+
+        return FreeWaterTensorFit(self, fwdti_params)
+
+    @multi_voxel_fit
+    def _fit_voxel(self, data):
         S0 = np.mean(data[self.gtab.b0s_mask])
         fwdti_params = self.fit_method(self.design_matrix, data, S0,
                                        *self.args, **self.kwargs)
@@ -324,6 +351,101 @@ def wls_iter(design_matrix, sig, S0, Diso=3e-3, mdreg=2.7e-3,
     return fw_params
 
 
+def _wls_fit_batch(design_matrix, data, S0, Diso=3e-3, mdreg=2.7e-3,
+                   min_signal=1.0e-6, piterations=3, step=2000):
+    """ Weighted linear least squares fit of the free water elimination model
+    to many voxels at once.
+
+    This is `wls_iter` applied to the signal of each voxel: the WLS
+    solutions of all the voxels of a block of `step` voxels, for all the
+    sampled values of the free water volume fraction, are computed with
+    stacked matrix products.
+
+    Parameters
+    ----------
+    design_matrix : array (g, 7)
+        Design matrix holding the covariants used to solve for the regression
+        coefficients.
+    data : array (n, g)
+        Diffusion-weighted signal of n voxels.
+    S0 : array (n, )
+        Non diffusion weighted signal of each voxel.
+    Diso, mdreg, min_signal, piterations : see `wls_iter`
+    step : int, optional
+        Number of voxels fitted together.
+
+    Returns
+    -------
+    fw_params : array (n, 13)
+        The free water model parameters of each voxel (see `wls_iter`).
+    """
+    W = design_matrix
+    data = np.asarray(data, dtype=float)
+    S0 = np.asarray(S0, dtype=float)
+    fw_params = np.zeros((data.shape[0], 13))
+    # General free-water signal contribution
+    fwsig = np.exp(np.dot(W, np.array([Diso, 0, Diso, 0, 0, Diso, 0])))
+
+    for start in range(0, data.shape[0], step):
+        sig = data[start:start + step]
+        s0 = S0[start:start + step]
+        log_s = np.log(np.maximum(sig, min_signal))
+
+        # DTI weighted linear least square solution of every voxel
+        WTS2 = W.T * (sig ** 2)[:, None, :]
+        inv_WT_S2_W = np.linalg.pinv(np.einsum('nij,jk->nik', WTS2, W))
+        invWTS2W_WTS2 = np.einsum('nij,njk->nik', inv_WT_S2_W, WTS2)
+        params = np.einsum('nij,nj->ni', invWTS2W_WTS2, log_s)
+
+        md = (params[:, 0] + params[:, 2] + params[:, 5]) / 3
+        fw_params[start:start + step, 12][md > mdreg] = 1.0
+        # Process voxels with significant signal from tissue
+        tissue = (md < mdreg) & (np.mean(sig, -1) > min_signal) & \
+            (s0 > min_signal)
+        if not np.any(tissue):
+            continue
+        sig = sig[tissue, :, None]
+        s0 = s0[tissue, None, None]
+        invWTS2W_WTS2 = invWTS2W_WTS2[tissue]
+        n = sig.shape[0]
+
+        df = 1  # initialize precision
+        flow = np.zeros(n)  # lower f evaluated
+        fhig = np.ones(n)  # higher f evaluated
+        ns = 9  # initial number of samples per iteration
+        for p in range(piterations):
+            df = df * 0.1
+            # sampling f, (n, ns), as np.linspace(flow + df, fhig - df, ns)
+            fs = (flow + df)[:, None] + np.arange(ns) * \
+                ((fhig - flow - 2 * df) / (ns - 1))[:, None]
+            fs[:, -1] = fhig - df
+            FS = fs[:, None, :]
+            SA = sig - FS * s0 * fwsig[:, None]
+            # Negative SA, for inapropriate large volume fractions, are
+            # replaced by data's min positive signal (see wls_iter)
+            SA[SA <= 0] = min_signal
+            y = np.log(SA / (1 - FS))
+            all_new_params = np.einsum('nij,njk->nik', invWTS2W_WTS2, y)
+            # Select params for lower F2
+            SIpred = (1 - FS) * np.exp(np.einsum('ij,njk->nik', W,
+                                                 all_new_params)) + \
+                FS * s0 * fwsig[:, None]
+            F2 = np.sum(np.square(sig - SIpred), axis=1)
+            Mind = np.argmin(F2, axis=-1)
+            params = all_new_params[np.arange(n), :, Mind]
+            f = fs[np.arange(n), Mind]  # Updated f
+            flow = f - df  # refining precision
+            fhig = f + df
+            ns = 19
+
+        evals, evecs = decompose_tensor(from_lower_triangular(params))
+        block = fw_params[start:start + step]
+        block[tissue] = np.concatenate((evals, evecs.reshape(-1, 9),
+                                        f[:, None]), axis=-1)
+
+    return fw_params
+
+
 def wls_fit_tensor(gtab, data, Diso=3e-3, mask=None, min_signal=1.0e-6,
                    piterations=3, mdreg=2.7e-3):
     r""" Computes weighted least squares (WLS) fit to calculate self-diffusion
@@ -385,15 +507,12 @@ def wls_fit_tensor(gtab, data, Diso=3e-3, mask=None, min_signal=1.0e-6,
             raise ValueError("Mask is not the same shape as data.")
         mask = np.array(mask, dtype=bool, copy=False)
 
-    # Prepare S0
-    S0 = np.mean(data[:, :, :, gtab.b0s_mask], axis=-1)
-
-    index = ndindex(mask.shape)
-    for v in index:
-        if mask[v]:
-            params = wls_iter(W, data[v], S0[v], min_signal=min_signal,
-                              Diso=3e-3, piterations=piterations, mdreg=mdreg)
-            fw_params[v] = params
+    # All the voxels of the mask are fitted together
+    data_in_mask = np.reshape(data[mask], (-1, data.shape[-1]))
+    S0 = np.mean(data_in_mask[:, gtab.b0s_mask], axis=-1)
+    fw_params[mask] = _wls_fit_batch(W, data_in_mask, S0, Diso=Diso,
+                                     mdreg=mdreg, min_signal=min_signal,
+                                     piterations=piterations)
 
     return fw_params
 
@@ -645,6 +764,155 @@ def nls_iter(design_matrix, sig, S0, Diso=3e-3, mdreg=2.7e-3,
     return params
 
 
+def _nls_fit_batch(design_matrix, data, S0, Diso=3e-3, mdreg=2.7e-3,
+                   min_signal=1.0e-6, cholesky=False, f_transform=True,
+                   jac=False, weighting=None, sigma=None, step=10000,
+                   gmm_iterations=5):
+    """ Non linear least squares fit of the free water elimination model to
+    many voxels at once.
+
+    This is `nls_iter` applied to the signal of each voxel. The starting
+    points are given by `_wls_fit_batch`, and all the voxels of a block of
+    `step` voxels are then refined together by a Levenberg-Marquardt
+    iteration with the analytical Jacobian of the model (see
+    :func:`dipy.core.optimize.batch_leastsq`), so `jac` is ignored. The
+    'gmm' weighting is applied by iteratively reweighted least squares:
+    the Geman-McClure weights of the residuals are updated
+    `gmm_iterations` times.
+
+    Parameters
+    ----------
+    design_matrix : array (g, 7)
+        Design matrix holding the covariants used to solve for the regression
+        coefficients.
+    data : array (n, g)
+        Diffusion-weighted signal of n voxels.
+    S0 : array (n, )
+        Non diffusion weighted signal of each voxel.
+    Diso, mdreg, min_signal, cholesky, f_transform, jac, weighting, sigma :
+        see `nls_iter`
+    step : int, optional
+        Number of voxels fitted together.
+    gmm_iterations : int, optional
+        Number of reweightings of the 'gmm' weighting.
+
+    Returns
+    -------
+    fw_params : array (n, 13)
+        The free water model parameters of each voxel (see `nls_iter`).
+    """
+    W = design_matrix
+    data = np.asarray(data, dtype=float)
+    S0 = np.asarray(S0, dtype=float)
+    if weighting == 'sigma':
+        if sigma is None:
+            e_s = "Must provide sigma value as input to use this weighting"
+            e_s += " method"
+            raise ValueError(e_s)
+        weights = 1. / np.asarray(sigma, dtype=float)
+    else:
+        weights = None
+
+    # Initial guess
+    fw_params = _wls_fit_batch(W, data, S0, min_signal=min_signal, Diso=Diso,
+                               mdreg=mdreg)
+
+    # Process voxels with significant signal from tissue
+    tissue = np.flatnonzero((fw_params[:, 12] < 0.99) &
+                            (np.mean(data, -1) > min_signal) &
+                            (S0 > min_signal))
+    if tissue.size == 0:
+        return fw_params
+
+    # converting evals and evecs to diffusion tensor elements
+    evals = fw_params[tissue, :3]
+    evecs = fw_params[tissue, 3:12].reshape((-1, 3, 3))
+    dt = lower_triangular(vec_val_vect(evecs, evals))
+    if cholesky:
+        dt = lower_triangular_to_cholesky(dt)
+    f = fw_params[tissue, 12]
+    if f_transform:
+        f = np.arcsin(2*f - 1) + np.pi/2
+    start_params = np.concatenate((dt, -np.log(S0[tissue])[:, None],
+                                   f[:, None]), axis=-1)
+
+    # The free water signal only depends on -log(S0)
+    fw_design = np.dot(W[:, :6], [Diso, 0, Diso, 0, 0, Diso])
+
+    def residuals_and_jacobian(params, sig, w):
+        if cholesky:
+            tensor = cholesky_to_lower_triangular(params[:, :6])
+        else:
+            tensor = params[:, :6]
+        if f_transform:
+            f = 0.5 * (1 + np.sin(params[:, 7] - np.pi/2))
+            df_dp = 0.5 * np.cos(params[:, 7] - np.pi/2)
+        else:
+            f = params[:, 7]
+            df_dp = 1.
+        t = np.exp(np.dot(tensor, W[:, :6].T) +
+                   params[:, 6, None] * W[:, 6])
+        s = np.exp(fw_design + params[:, 6, None] * W[:, 6])
+        residuals = sig - ((1 - f[:, None]) * t + f[:, None] * s)
+        jac = np.empty(residuals.shape + (8,))
+        jac[..., :6] = (f[:, None, None] - 1) * t[..., None] * W[:, :6]
+        if cholesky:
+            jac[..., :6] = np.einsum('kgi,kij->kgj', jac[..., :6],
+                                     _cholesky_jacobian(params[:, :6]))
+        jac[..., 6] = -((1 - f[:, None]) * t + f[:, None] * s) * W[:, 6]
+        jac[..., 7] = (t - s) * np.reshape(df_dp, (-1, 1))
+        if w is not None:
+            residuals = residuals * w
+            jac = jac * w[..., None]
+        return residuals, jac
+
+    params = np.empty_like(start_params)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for i in range(0, tissue.size, step):
+            chunk = slice(i, i + step)
+            sig = data[tissue[chunk]]
+            x = start_params[chunk]
+            n_fits = gmm_iterations if weighting == 'gmm' else 1
+            w = weights
+            for _ in range(n_fits):
+                if weighting == 'gmm':
+                    # Geman-McClure weights of the current residuals,
+                    # normalized to their mean weight (see _nls_err_func)
+                    r = residuals_and_jacobian(x, sig, None)[0]
+                    C = 1.4826 * np.median(
+                        np.abs(r - np.median(r, -1)[:, None]), -1)
+                    w = 1. / (r ** 2 + C[:, None] ** 2)
+                    w = np.sqrt(w / np.mean(w, -1)[:, None])
+                    w[~np.all(np.isfinite(w), -1)] = 1.
+
+                def fun(x, index, sig=sig, w=w):
+                    this_w = w[index] if w is not None and w.ndim == 2 else w
+                    return residuals_and_jacobian(x, sig[index], this_w)
+                x, _ = batch_leastsq(fun, x, ftol=1.49012e-08,
+                                     xtol=1.49012e-08, max_iter=200)
+            params[chunk] = x
+
+    # Process tissue diffusion tensor
+    if cholesky:
+        params[:, :6] = cholesky_to_lower_triangular(params[:, :6])
+        start_params[:, :6] = dt = lower_triangular(vec_val_vect(evecs,
+                                                                 evals))
+    # Voxels where the fit failed keep their initial guess
+    failed = ~np.all(np.isfinite(params), axis=-1)
+    params[failed] = start_params[failed]
+    evals, evecs = decompose_tensor(from_lower_triangular(params[:, :6]))
+
+    # Process water volume fraction f
+    f = params[:, 7]
+    if f_transform:
+        f = 0.5 * (1 + np.sin(f - np.pi/2))
+
+    fw_params[tissue] = np.concatenate((evals, evecs.reshape(-1, 9),
+                                        f[:, None]), axis=-1)
+    return fw_params
+
+
 def nls_fit_tensor(gtab, data, mask=None, Diso=3e-3, mdreg=2.7e-3,
                    min_signal=1.0e-6, f_transform=True, cholesky=False,
                    jac=False, weighting=None, sigma=None):
@@ -717,17 +985,14 @@ def nls_fit_tensor(gtab, data, mask=None, Diso=3e-3, mdreg=2.7e-3,
             raise ValueError("Mask is not the same shape as data.")
         mask = np.array(mask, dtype=bool, copy=False)
 
-    # Prepare S0
-    S0 = np.mean(data[:, :, :, gtab.b0s_mask], axis=-1)
-
-    index = ndindex(mask.shape)
-    for v in index:
-        if mask[v]:
-            params = nls_iter(W, data[v], S0[v], Diso=Diso, mdreg=mdreg,
-                              min_signal=min_signal, f_transform=f_transform,
-                              cholesky=cholesky, jac=jac, weighting=weighting,
-                              sigma=sigma)
-            fw_params[v] = params
+    # All the voxels of the mask are fitted together
+    data_in_mask = np.reshape(data[mask], (-1, data.shape[-1]))
+    S0 = np.mean(data_in_mask[:, gtab.b0s_mask], axis=-1)
+    fw_params[mask] = _nls_fit_batch(W, data_in_mask, S0, Diso=Diso,
+                                     mdreg=mdreg, min_signal=min_signal,
+                                     f_transform=f_transform,
+                                     cholesky=cholesky, jac=jac,
+                                     weighting=weighting, sigma=sigma)
 
     return fw_params
 
@@ -737,13 +1002,13 @@ def lower_triangular_to_cholesky(tensor_elements):
 
     Parameters
     ----------
-    tensor_elements : array (6,)
+    tensor_elements : array (..., 6)
         Array containing the six elements of diffusion tensor's lower
         triangular.
 
     Returns
     -------
-    cholesky_elements : array (6,)
+    cholesky_elements : array (..., 6)
         Array containing the six Cholesky's decomposition elements
         (R0, R1, R2, R3, R4, R5) [1]_.
 
@@ -754,14 +1019,15 @@ def lower_triangular_to_cholesky(tensor_elements):
            tensor-derived quantities in diffusion tensor imaging. Magnetic
            Resonance in Medicine, 55(4), 930-936. doi:10.1002/mrm.20832
     """
-    R0 = np.sqrt(tensor_elements[0])
-    R3 = tensor_elements[1] / R0
-    R1 = np.sqrt(tensor_elements[2] - R3**2)
-    R5 = tensor_elements[3] / R0
-    R4 = (tensor_elements[4] - R3*R5) / R1
-    R2 = np.sqrt(tensor_elements[5] - R4**2 - R5**2)
+    tensor_elements = np.asarray(tensor_elements)
+    R0 = np.sqrt(tensor_elements[..., 0])
+    R3 = tensor_elements[..., 1] / R0
+    R1 = np.sqrt(tensor_elements[..., 2] - R3**2)
+    R5 = tensor_elements[..., 3] / R0
+    R4 = (tensor_elements[..., 4] - R3*R5) / R1
+    R2 = np.sqrt(tensor_elements[..., 5] - R4**2 - R5**2)
 
-    return np.array([R0, R1, R2, R3, R4, R5])
+    return np.stack([R0, R1, R2, R3, R4, R5], axis=-1)
 
 
 def cholesky_to_lower_triangular(R):
@@ -769,13 +1035,13 @@ def cholesky_to_lower_triangular(R):
 
     Parameters
     ----------
-    R : array (6,)
+    R : array (..., 6)
         Array containing the six Cholesky's decomposition elements
         (R0, R1, R2, R3, R4, R5) [1]_.
 
     Returns
     -------
-    tensor_elements : array (6,)
+    tensor_elements : array (..., 6)
         Array containing the six elements of diffusion tensor's lower
         triangular.
 
@@ -786,13 +1052,49 @@ def cholesky_to_lower_triangular(R):
            tensor-derived quantities in diffusion tensor imaging. Magnetic
            Resonance in Medicine, 55(4), 930-936. doi:10.1002/mrm.20832
     """
-    Dxx = R[0]**2
-    Dxy = R[0]*R[3]
-    Dyy = R[1]**2 + R[3]**2
-    Dxz = R[0]*R[5]
-    Dyz = R[1]*R[4] + R[3]*R[5]
-    Dzz = R[2]**2 + R[4]**2 + R[5]**2
-    return np.array([Dxx, Dxy, Dyy, Dxz, Dyz, Dzz])
+    R = np.asarray(R)
+    R0, R1, R2, R3, R4, R5 = [R[..., i] for i in range(6)]
+    Dxx = R0**2
+    Dxy = R0*R3
+    Dyy = R1**2 + R3**2
+    Dxz = R0*R5
+    Dyz = R1*R4 + R3*R5
+    Dzz = R2**2 + R4**2 + R5**2
+    return np.stack([Dxx, Dxy, Dyy, Dxz, Dyz, Dzz], axis=-1)
+
+
+def _cholesky_jacobian(R):
+    """ Derivatives of the diffusion tensor elements with respect to the
+    Cholesky's decomposition elements (see `cholesky_to_lower_triangular`)
+
+    Parameters
+    ----------
+    R : array (..., 6)
+        Cholesky's decomposition elements (R0, R1, R2, R3, R4, R5).
+
+    Returns
+    -------
+    jac : array (..., 6, 6)
+        jac[..., i, j] is the derivative of the i-th tensor element with
+        respect to Rj.
+    """
+    R0, R1, R2, R3, R4, R5 = [R[..., i] for i in range(6)]
+    jac = np.zeros(R.shape + (6,))
+    jac[..., 0, 0] = 2 * R0
+    jac[..., 1, 0] = R3
+    jac[..., 1, 3] = R0
+    jac[..., 2, 1] = 2 * R1
+    jac[..., 2, 3] = 2 * R3
+    jac[..., 3, 0] = R5
+    jac[..., 3, 5] = R0
+    jac[..., 4, 1] = R4
+    jac[..., 4, 3] = R5
+    jac[..., 4, 4] = R1
+    jac[..., 4, 5] = R3
+    jac[..., 5, 2] = 2 * R2
+    jac[..., 5, 4] = 2 * R4
+    jac[..., 5, 5] = 2 * R5
+    return jac
 
 
 common_fit_methods = {'WLLS': wls_iter,
@@ -800,3 +1102,7 @@ common_fit_methods = {'WLLS': wls_iter,
                       'NLLS': nls_iter,
                       'NLS': nls_iter,
                       }
+
+# Fit methods applied to all the voxels at once by FreeWaterTensorModel.fit
+_batch_fit_methods = {wls_iter: _wls_fit_batch,
+                      nls_iter: _nls_fit_batch}
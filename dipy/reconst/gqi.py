@@ -1,7 +1,7 @@
 """ Classes and functions for generalized q-sampling """
 import numpy as np
 from .odf import OdfModel, OdfFit, gfa
-from .cache import Cache
+from .cache import Cache, cached_basis
 import warnings
 from .multi_voxel import multi_voxel_fit
 from .recspeed import local_maxima, remove_similar_vertices
@@ -85,15 +85,20 @@ class GeneralizedQSamplingModel(OdfModel, Cache):
 
 class GeneralizedQSamplingFit(OdfFit):
 
+    # Parameters gathered in arrays by ``multi_voxel_fit``, the ODF is linear
+    # in the signal so that the ODFs of all voxels are one matrix product
+    _fit_params = ('data',)
+
     def __init__(self, model, data):
-        """ Calculates PDF and ODF for a single voxel
+        """ Calculates PDF and ODF for a single voxel, or for many voxels
+        at once
 
         Parameters
         ----------
         model : object,
             DiffusionSpectrumModel
-        data : 1d ndarray,
-            signal values
+        data : ndarray (..., N),
+            signal values, the leading dimensions run over voxels
 
         """
         OdfFit.__init__(self, model, data)
@@ -108,21 +113,44 @@ class GeneralizedQSamplingFit(OdfFit):
         """
         self.gqi_vector = self.model.cache_get('gqi_vector', key=sphere)
         if self.gqi_vector is None:
-            if self.model.method == 'gqi2':
-                H = squared_radial_component
-                # print self.gqi_vector.shape
-                self.gqi_vector = np.real(H(np.dot(
-                    self.model.b_vector, sphere.vertices.T) *
-                    self.model.Lambda))
-            if self.model.method == 'standard':
-                self.gqi_vector = np.real(np.sinc(np.dot(
-                    self.model.b_vector, sphere.vertices.T) *
-                    self.model.Lambda / np.pi))
+            self.gqi_vector = gqi_odf_matrix(self.model.b_vector,
+                                             sphere.vertices,
+                                             self.model.Lambda,
+                                             self.model.method)
             self.model.cache_set('gqi_vector', sphere, self.gqi_vector)
 
         return np.dot(self.data, self.gqi_vector)
 
 
+@cached_basis
+def gqi_odf_matrix(b_vector, vertices, Lambda, method='gqi2'):
+    """ Matrix projecting the signal on the GQI ODF
+
+    Parameters
+    ----------
+    b_vector : array, shape (N, 3)
+        b-vectors scaled by the square root of the b-values.
+    vertices : array, shape (M, 3)
+        Directions of the ODF.
+    Lambda : float
+        Diffusion sampling length (lambda in eq. 2.14 and 2.16 of [2]_ in
+        `GeneralizedQSamplingModel`).
+    method : str,
+        'standard' or 'gqi2'
+
+    Returns
+    -------
+    gqi_vector : array, shape (N, M)
+        The ODF of a signal ``data`` is ``np.dot(data, gqi_vector)``.
+    """
+    if method == 'gqi2':
+        H = squared_radial_component
+        return np.real(H(np.dot(b_vector, vertices.T) * Lambda))
+    if method == 'standard':
+        return np.real(np.sinc(np.dot(b_vector, vertices.T) * Lambda /
+                               np.pi))
+
+
 def normalize_qa(qa, max_qa=None):
     """ Normalize quantitative anisotropy.
 
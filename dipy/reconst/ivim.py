@@ -8,6 +8,7 @@ import scipy
 import warnings
 from dipy.reconst.base import ReconstModel
 from dipy.reconst.multi_voxel import multi_voxel_fit
+from dipy.core.optimize import batch_leastsq
 
 SCIPY_LESS_0_17 = (LooseVersion(scipy.version.short_version) <
                    LooseVersion('0.17'))
@@ -134,7 +135,8 @@ class IvimModel(ReconstModel):
                  two_stage=True, tol=1e-15,
                  x_scale=[1000., 0.1, 0.001, 0.0001],
                  options={'gtol': 1e-15, 'ftol': 1e-15,
-                          'eps': 1e-15, 'maxiter': 1000}):
+                          'eps': 1e-15, 'maxiter': 1000},
+                 fit_method='voxelwise', block_size=10000):
         """
         Initialize an IVIM model.
 
@@ -201,6 +203,21 @@ class IvimModel(ReconstModel):
             default : options={'gtol': 1e-15, 'ftol': 1e-15, 'eps': 1e-15,
                       'maxiter': 1000}
 
+        fit_method : str, optional
+            'voxelwise' fits every voxel separately with scipy's least squares
+            solvers. 'batch' fits blocks of voxels together: the linear stages
+            are solved as one matrix product for all the voxels of a block
+            and the non-linear stages as a bounded Levenberg-Marquardt
+            iteration vectorized across the voxels of a block (see
+            `dipy.core.optimize.batch_leastsq`). The rules falling back to the
+            linear fit when the initial guess is infeasible or the bounds are
+            violated are the same for both methods.
+            default : 'voxelwise'
+
+        block_size : int, optional
+            Number of voxels fit together when `fit_method` is 'batch'.
+            default : 10000
+
         References
         ----------
         .. [1] Le Bihan, Denis, et al. "Separation of diffusion and perfusion
@@ -224,6 +241,13 @@ class IvimModel(ReconstModel):
         self.options = options
         self.x_scale = x_scale
 
+        if fit_method not in ('voxelwise', 'batch'):
+            e_s = "fit_method must be 'voxelwise' or 'batch', "
+            e_s += "got %r" % (fit_method,)
+            raise ValueError(e_s)
+        self.fit_method = fit_method
+        self.block_size = block_size
+
         if SCIPY_LESS_0_17 and self.bounds is not None:
             e_s = "Scipy versions less than 0.17 do not support "
             e_s += "bounds. Please update to Scipy 0.17 to use bounds"
@@ -233,8 +257,7 @@ class IvimModel(ReconstModel):
         else:
             self.bounds = bounds
 
-    @multi_voxel_fit
-    def fit(self, data, mask=None):
+    def fit(self, data, mask=None, **kwargs):
         """ Fit method of the Ivim model class.
 
         The fitting takes place in the following steps: Linear fitting for D
@@ -253,18 +276,29 @@ class IvimModel(ReconstModel):
         Parameters
         ----------
         data : array
-            The measured signal from one voxel. A multi voxel decorator
-            will be applied to this fit method to scale it and apply it
-            to multiple voxels.
+            The measured signal from one voxel or from many voxels, with the
+            measurements along the last dimension.
 
         mask : array
             A boolean array used to mark the coordinates in the data that
             should be analyzed that has the shape data.shape[:-1]
 
+        kwargs : dict
+            Passed to the multi voxel decorator when `fit_method` is
+            'voxelwise', e.g. to select a parallel ``engine``.
+
         Returns
         -------
         IvimFit object
         """
+        if self.fit_method == 'batch':
+            return self._fit_batch(data, mask)
+        return self._fit_voxel(data, mask, **kwargs)
+
+    @multi_voxel_fit
+    def _fit_voxel(self, data):
+        """ Fit the Ivim model to the signal of a single voxel.
+        """
         # Get S0_prime and D - paramters assuming a single exponential decay
         # for signals for bvals greater than `split_b_D`
         S0_prime, D = self.estimate_linear_fit(
@@ -498,6 +532,144 @@ class IvimModel(ReconstModel):
                 warnings.warn(warningMsg, UserWarning)
                 return x0
 
+    def _fit_batch(self, data, mask=None):
+        """Fit the Ivim model to blocks of voxels at once.
+
+        Parameters
+        ----------
+        data : array
+            The measured signal, with the measurements along the last
+            dimension.
+
+        mask : array, optional
+            A boolean array with the shape data.shape[:-1] selecting the
+            voxels to fit.
+
+        Returns
+        -------
+        IvimFit object
+        """
+        if mask is None:
+            mask = np.ones(data.shape[:-1], dtype=bool)
+        elif mask.shape != data.shape[:-1]:
+            raise ValueError("mask and data shape do not match")
+        else:
+            mask = np.asarray(mask, dtype=bool)
+
+        data_in_mask = np.reshape(data[mask], (-1, data.shape[-1]))
+        params_in_mask = np.empty((data_in_mask.shape[0], 4))
+        for start in range(0, data_in_mask.shape[0], self.block_size):
+            block = slice(start, start + self.block_size)
+            params_in_mask[block] = self._batch_params(data_in_mask[block])
+
+        ivim_params = np.zeros(data.shape[:-1] + (4,))
+        ivim_params[mask] = params_in_mask
+        return IvimFit(self, ivim_params)
+
+    def _batch_linear_fit(self, signal, split_b, less_than=True):
+        """Vectorized version of `estimate_linear_fit` for a block of
+        voxels, shape (n_voxels, n_bvals). All voxels share one
+        pseudo-inverse of the design matrix.
+        """
+        bvals = self.gtab.bvals
+        if less_than:
+            sel = bvals <= split_b
+        else:
+            sel = bvals >= split_b
+        design = np.column_stack([bvals[sel], np.ones(np.sum(sel))])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            D, neg_log_S0 = np.dot(np.linalg.pinv(design),
+                                   -np.log(signal[:, sel]).T)
+        S0 = np.exp(-neg_log_S0)
+        return S0, D
+
+    def _batch_params(self, signal):
+        """Estimate the Ivim parameters of a block of voxels.
+
+        The steps and the fallback rules are those of the voxelwise fit.
+        """
+        bvals = self.gtab.bvals
+        ftol = self.options["ftol"]
+        xtol = self.tol
+        max_iter = self.options["maxiter"]
+        x_scale = np.asarray(self.x_scale, dtype=float)
+
+        S0_prime, D = self._batch_linear_fit(signal, self.split_b_D,
+                                             less_than=False)
+        S0, D_star_prime = self._batch_linear_fit(signal, self.split_b_S0,
+                                                  less_than=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f_guess = 1 - S0_prime / S0
+
+        # Fit f and D_star keeping S0 and D from the linear fits
+        def f_D_star_residuals(x, index):
+            f, D_star = x[:, 0, None], x[:, 1, None]
+            S0_i, D_i = S0[index, None], D[index, None]
+            e_star = np.exp(-bvals * D_star)
+            e = np.exp(-bvals * D_i)
+            residuals = signal[index] - S0_i * (f * e_star + (1 - f) * e)
+            jac = -np.stack([S0_i * (e_star - e),
+                             -S0_i * f * bvals * e_star], axis=-1)
+            return residuals, jac
+
+        x0 = np.column_stack([f_guess, D_star_prime])
+        bounds_f_D_star = ((0., 0.), (self.bounds[1][1], self.bounds[1][2]))
+        f_D_star = self._batch_bounded_leastsq(
+            f_D_star_residuals, x0, bounds_f_D_star, x_scale[1:3], ftol,
+            xtol, max_iter, "f and D_star")
+        params_linear = np.column_stack([S0, f_D_star, D])
+        if not self.two_stage:
+            return params_linear
+
+        def ivim_residuals(x, index):
+            S0_i, f, D_star, D_i = [x[:, i, None] for i in range(4)]
+            e_star = np.exp(-bvals * D_star)
+            e = np.exp(-bvals * D_i)
+            mix = f * e_star + (1 - f) * e
+            residuals = signal[index] - S0_i * mix
+            jac = -np.stack([mix,
+                             S0_i * (e_star - e),
+                             -S0_i * f * bvals * e_star,
+                             -S0_i * (1 - f) * bvals * e], axis=-1)
+            return residuals, jac
+
+        params_two_stage = self._batch_bounded_leastsq(
+            ivim_residuals, params_linear, self.bounds, x_scale, ftol, xtol,
+            max_iter, "all the parameters")
+        all_nan = np.all(np.isnan(params_two_stage), axis=-1)
+        params_two_stage[all_nan] = -1
+        bounds_violated = ~(np.all(params_two_stage >= self.bounds[0], -1) &
+                            np.all(params_two_stage <= self.bounds[1], -1))
+        if np.any(bounds_violated):
+            warningMsg = "Bounds are violated for leastsq fitting in "
+            warningMsg += "%d voxels. " % np.sum(bounds_violated)
+            warningMsg += "Returning parameters from linear fit"
+            warnings.warn(warningMsg, UserWarning)
+            params_two_stage[bounds_violated] = params_linear[bounds_violated]
+        return params_two_stage
+
+    def _batch_bounded_leastsq(self, fun, x0, bounds, x_scale, ftol, xtol,
+                               max_iter, name):
+        """Run `batch_leastsq` on the voxels whose initial guess is
+        feasible, the other voxels keep their initial guess.
+        """
+        feasible = (np.all(x0 >= bounds[0], -1) &
+                    np.all(x0 <= bounds[1], -1))
+        x = x0.copy()
+        if not np.all(feasible):
+            warningMsg = "x0 obtained from linear fitting is not feasibile"
+            warningMsg += " as initial guess for leastsq while estimating "
+            warningMsg += "%s in %d voxels. " % (name, np.sum(~feasible))
+            warningMsg += "Using parameters from the linear fit."
+            warnings.warn(warningMsg, UserWarning)
+        index = np.flatnonzero(feasible)
+        if index.size:
+            x[index] = batch_leastsq(
+                lambda x, i: fun(x, index[i]), x0[index], bounds=bounds,
+                x_scale=x_scale, ftol=ftol, xtol=xtol,
+                max_iter=max_iter)[0]
+        return x
+
 
 class IvimFit(object):
 
@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-from dipy.reconst.multi_voxel import multi_voxel_fit
+from dipy.reconst.multi_voxel import multi_voxel_fit, MultiVoxelArrayFit
 from dipy.reconst.base import ReconstModel, ReconstFit
-from dipy.reconst.cache import Cache
+from dipy.reconst.cache import Cache, cached_basis
 from scipy.special import hermite, gamma, genlaguerre
 try:  # preferred scipy >= 0.14, required scipy >= 1.0
     from scipy.special import factorial, factorial2
@@ -18,6 +18,15 @@ from dipy.core.optimize import Optimizer
 
 cvxopt, have_cvxopt, _ = optional_package("cvxopt")
 
+# Number of voxels for which voxel specific design matrices are evaluated at
+# once by the methods of a multi voxel ``MapmriFit``.
+_VOXEL_BLOCK = 128
+
+# Regularization weights at which the generalized cross-validation is
+# evaluated by the 'batch' fit method, spanning the bounds of the optimizer of
+# ``generalized_crossvalidation``.
+_GCV_WEIGHTS = np.logspace(-5, 1, 121)
+
 
 class MapmriModel(ReconstModel, Cache):
 
@@ -80,7 +89,10 @@ class MapmriModel(ReconstModel, Cache):
                  eigenvalue_threshold=1e-04,
                  bval_threshold=np.inf,
                  dti_scale_estimation=True,
-                 static_diffusivity=0.7e-3):
+                 static_diffusivity=0.7e-3,
+                 fit_method='voxelwise',
+                 mu_resolution=0,
+                 block_size=10000):
         r""" Analytical and continuous modeling of the diffusion signal with
         respect to the MAPMRI basis [1]_.
 
@@ -159,6 +171,23 @@ class MapmriModel(ReconstModel, Cache):
             the tissue diffusivity that is used when dti_scale_estimation is
             set to False. The default is that of typical white matter
             D=0.7e-3 _[5].
+        fit_method : string,
+            'voxelwise' fits one voxel at a time. 'batch' fits blocks of
+            `block_size` voxels at once: the tensors, the generalized
+            cross-validation over a grid of weights and the regularized least
+            squares of all the voxels of a block are computed together with
+            stacked linear algebra. Fits with the positivity constraint are
+            always done voxel by voxel. Default: 'voxelwise'
+        mu_resolution : float,
+            Relative resolution to which the isotropic scale factors are
+            rounded by the 'batch' fit method, so that the voxels with the
+            same rounded scale factor share their design matrix. This trades
+            some accuracy for speed, mostly for fits without regularization
+            which are sensitive to the scale factor. 0 keeps the exact scale
+            factor of every voxel. Default: 0
+        block_size : int,
+            Number of voxels fit together by the 'batch' fit method.
+            Default: 10000
 
         References
         ----------
@@ -211,6 +240,13 @@ class MapmriModel(ReconstModel, Cache):
         if radial_order < 0 or radial_order % 2:
             msg = "radial_order must be a positive, even number."
             raise ValueError(msg)
+        if fit_method not in ('voxelwise', 'batch'):
+            msg = "fit_method must be 'voxelwise' or 'batch', "
+            msg += "got %r" % (fit_method,)
+            raise ValueError(msg)
+        self.fit_method = fit_method
+        self.mu_resolution = mu_resolution
+        self.block_size = block_size
         self.radial_order = radial_order
         self.bval_threshold = bval_threshold
         self.dti_scale_estimation = dti_scale_estimation
@@ -283,7 +319,8 @@ class MapmriModel(ReconstModel, Cache):
                 D = static_diffusivity
                 mumean = np.sqrt(2 * D * self.tau)
                 self.mu = np.array([mumean, mumean, mumean])
-                self.M = mapmri_isotropic_phi_matrix(radial_order, mumean, q)
+                self.M = _shared_isotropic_phi_matrix(radial_order, mumean,
+                                                      q)
                 if (self.laplacian_regularization and
                    isinstance(laplacian_weighting, float) and
                    not positivity_constraint):
@@ -292,8 +329,31 @@ class MapmriModel(ReconstModel, Cache):
                            self.laplacian_matrix)
                     self.MMt_inv_Mt = np.dot(np.linalg.pinv(MMt), self.M.T)
 
+    def fit(self, data, mask=None, **kwargs):
+        """ Fit the model to the signal of one voxel or of many voxels.
+
+        Parameters
+        ----------
+        data : array
+            The measured signal, with the measurements along the last
+            dimension.
+        mask : array (optional)
+            A boolean array with the shape data.shape[:-1] selecting the
+            voxels to fit.
+        kwargs : dict
+            With the 'voxelwise' fit method, passed to the multi voxel
+            decorator, e.g. to select a parallel ``engine``.
+
+        Returns
+        -------
+        MapmriFit or MultiVoxelArrayFit
+        """
+        if self.fit_method == 'batch' and not self.positivity_constraint:
+            return self._fit_batch(data, mask)
+        return self._fit_voxel(data, mask, **kwargs)
+
     @multi_voxel_fit
-    def fit(self, data):
+    def _fit_voxel(self, data):
         errorcode = 0
         tenfit = self.tenmodel.fit(data[self.cutoff])
         evals = tenfit.evals
@@ -426,25 +486,146 @@ class MapmriModel(ReconstModel, Cache):
 
         return MapmriFit(self, coef, mu, R, lopt, errorcode)
 
+    def _fit_batch(self, data, mask=None):
+        if mask is None:
+            mask = np.ones(data.shape[:-1], dtype=bool)
+        elif mask.shape != data.shape[:-1]:
+            raise ValueError("mask and data shape do not match")
+        else:
+            mask = np.asarray(mask, dtype=bool)
+
+        signal = np.reshape(data[mask], (-1, data.shape[-1]))
+        n_voxels = signal.shape[0]
+        coef = np.zeros((n_voxels, self.ind_mat.shape[0]))
+        mu = np.zeros((n_voxels, 3))
+        R = np.zeros((n_voxels, 3, 3))
+        lopt = np.zeros(n_voxels)
+        errorcode = np.zeros(n_voxels, dtype=int)
+        for start in range(0, n_voxels, self.block_size):
+            block = slice(start, start + self.block_size)
+            (coef[block], mu[block], R[block], lopt[block],
+             errorcode[block]) = self._fit_block(signal[block])
+
+        if data.ndim == 1:
+            return MapmriFit(self, coef[0], mu[0], R[0], lopt[0],
+                             errorcode[0])
+        return MultiVoxelArrayFit(
+            self, MapmriFit(self, coef, mu, R, lopt, errorcode), mask)
+
+    def _fit_block(self, data):
+        """Unconstrained fit of the voxels of ``data`` (n_voxels, N)
+
+        The voxels are split in groups sharing their design matrix: voxels
+        with the same rounded isotropic scale factor, or blocks of voxels
+        whose voxel specific (anisotropic) matrices are stacked.
+        """
+        n_voxels = data.shape[0]
+        tenfit = self.tenmodel.fit(data[:, self.cutoff])
+        evals = tenfit.evals
+        R = tenfit.evecs
+        evals = np.clip(evals, self.eigenvalue_threshold,
+                        evals.max(-1)[:, None])
+        qvals = np.sqrt(self.gtab.bvals / self.tau) / (2 * np.pi)
+
+        blocks = [np.arange(start, min(start + _VOXEL_BLOCK, n_voxels))
+                  for start in range(0, n_voxels, _VOXEL_BLOCK)]
+        shared = False
+        if self.anisotropic_scaling:
+            mu = np.sqrt(evals * 2 * self.tau)
+            groups = blocks
+        else:
+            if hasattr(self, 'mu'):
+                u0 = np.repeat(self.mu[0], n_voxels)
+                shared = True
+            else:
+                u0 = isotropic_scale_factor(evals * 2 * self.tau)
+                if self.mu_resolution > 0:
+                    step = np.log1p(self.mu_resolution)
+                    u0 = np.exp(np.round(np.log(u0) / step) * step)
+                    shared = True
+            mu = np.repeat(u0[:, None], 3, -1)
+            groups = blocks
+            if shared:
+                _, inverse = np.unique(u0, return_inverse=True)
+                order = np.argsort(inverse, kind='mergesort')
+                groups = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+
+        coef = np.zeros((n_voxels, self.ind_mat.shape[0]))
+        lopt = np.zeros(n_voxels)
+        errorcode = np.zeros(n_voxels, dtype=int)
+        for idx in groups:
+            if self.anisotropic_scaling:
+                q = np.dot(self.gtab.bvecs, R[idx]).transpose(1, 0, 2)
+                q = q * qvals[:, None]
+                M = mapmri_phi_matrix(self.radial_order, mu[idx, None, :], q)
+                if self.laplacian_regularization:
+                    laplacian_matrix = mapmri_laplacian_reg_matrix(
+                        self.ind_mat, mu[idx], self.S_mat, self.T_mat,
+                        self.U_mat)
+            elif shared:
+                if hasattr(self, 'MMt_inv_Mt'):
+                    coef[idx] = np.dot(data[idx], self.MMt_inv_Mt.T)
+                    lopt[idx] = self.laplacian_weighting
+                    continue
+                if hasattr(self, 'M'):
+                    M = self.M
+                else:
+                    # Cached by `basis_cache`, the matrices of the rounded
+                    # scale factors are shared between blocks and fits.
+                    q = self.gtab.bvecs * qvals[:, None]
+                    M = _shared_isotropic_phi_matrix(self.radial_order,
+                                                     u0[idx[0]], q)
+                laplacian_matrix = self.laplacian_matrix * u0[idx[0]]
+            else:
+                M = self.M_mu_independent * mapmri_isotropic_M_mu_dependent(
+                    self.radial_order, u0[idx, None], qvals)
+                laplacian_matrix = (self.laplacian_matrix *
+                                    u0[idx, None, None])
+
+            if not self.laplacian_regularization:
+                laplacian_matrix = np.zeros(M.shape[-1:] * 2)
+            elif isinstance(self.laplacian_weighting, str):
+                gcv = generalized_crossvalidation_batch(
+                    data[idx], M, laplacian_matrix, _GCV_WEIGHTS)
+                lopt[idx] = _gcv_optimum(gcv, _GCV_WEIGHTS, refine=True)
+            elif np.isscalar(self.laplacian_weighting):
+                lopt[idx] = self.laplacian_weighting
+            else:
+                weights = np.asarray(self.laplacian_weighting)
+                gcv = generalized_crossvalidation_batch(
+                    data[idx], M, laplacian_matrix, weights)
+                lopt[idx] = _gcv_optimum(gcv, weights)
+
+            coef[idx], errorcode[idx] = _regularized_lstsq_batch(
+                data[idx], M, laplacian_matrix, lopt[idx])
+
+        ok = errorcode == 0
+        coef[ok] /= np.dot(coef[ok], self.Bm)[:, None]
+        return coef, mu, R, lopt, errorcode
+
 
 class MapmriFit(ReconstFit):
 
+    # Parameters gathered in arrays by ``multi_voxel_fit``
+    _fit_params = ('_mapmri_coef', 'mu', 'R', 'lopt', 'errorcode')
+
     def __init__(self, model, mapmri_coef, mu, R, lopt, errorcode=0):
-        """ Calculates diffusion properties for a single voxel
+        """ Calculates diffusion properties for a single voxel, or for many
+        voxels at once when the parameters have leading voxel dimensions.
 
         Parameters
         ----------
         model : object,
             AnalyticalModel
-        mapmri_coef : 1d ndarray,
+        mapmri_coef : ndarray, shape (..., N)
             mapmri coefficients
-        mu : array, shape (3,)
+        mu : array, shape (..., 3)
             scale parameters vector for x, y and z
-        R : array, shape (3,3)
+        R : array, shape (..., 3, 3)
             rotation matrix
-        lopt : float,
+        lopt : float or array, shape (...)
             regularization weight used for laplacian regularization
-        errorcode : int
+        errorcode : int or array, shape (...)
             provides information on whether errors occurred in the fitting
             of each voxel. 0 means no problem, 1 means a LinAlgError
             occurred when trying to invert the design matrix. 2 means the
@@ -480,6 +661,14 @@ class MapmriFit(ReconstFit):
         """
         return self._mapmri_coef
 
+    def _voxel_blocks(self):
+        """Yields index blocks of the flattened voxels, used to evaluate
+        voxel specific design matrices a bounded number of voxels at a time.
+        """
+        n_voxels = int(np.prod(self._mapmri_coef.shape[:-1]))
+        for start in range(0, n_voxels, _VOXEL_BLOCK):
+            yield slice(start, start + _VOXEL_BLOCK)
+
     def odf(self, sphere, s=2):
         r""" Calculates the analytical Orientation Distribution Function (ODF)
         from the signal [1]_ Eq. (32).
@@ -498,9 +687,15 @@ class MapmriFit(ReconstFit):
 
         if self.model.anisotropic_scaling:
             v_ = sphere.vertices
-            v = np.dot(v_, self.R)
-            I_s = mapmri_odf_matrix(self.radial_order, self.mu, s, v)
-            odf = np.dot(I_s, self._mapmri_coef)
+            coef = self._mapmri_coef.reshape(-1, self._mapmri_coef.shape[-1])
+            mu = np.reshape(self.mu, (-1, 1, 3))
+            R = np.reshape(self.R, (-1, 3, 3))
+            odf = np.empty((coef.shape[0], v_.shape[0]))
+            for block in self._voxel_blocks():
+                v = np.matmul(v_, R[block])
+                I_s = mapmri_odf_matrix(self.radial_order, mu[block], s, v)
+                odf[block] = np.einsum('ijk,ik->ij', I_s, coef[block])
+            odf = odf.reshape(self._mapmri_coef.shape[:-1] + (v_.shape[0],))
         else:
             I = self.model.cache_get('ODF_matrix', key=(sphere, s))
             if I is None:
@@ -508,7 +703,8 @@ class MapmriFit(ReconstFit):
                                                 s, sphere.vertices)
                 self.model.cache_set('ODF_matrix', (sphere, s), I)
 
-            odf = self.mu[0] ** s * np.dot(I, self._mapmri_coef)
+            odf = (self.mu[..., 0, None] ** s *
+                   np.dot(self._mapmri_coef, I.T))
 
         return odf
 
@@ -539,7 +735,7 @@ class MapmriFit(ReconstFit):
             I = mapmri_isotropic_odf_sh_matrix(self.radial_order, 1, s)
             self.model.cache_set('ODF_sh_matrix', (self.radial_order, s), I)
 
-        odf = self.mu[0] ** s * np.dot(I, self._mapmri_coef)
+        odf = self.mu[..., 0, None] ** s * np.dot(self._mapmri_coef, I.T)
 
         return odf
 
@@ -562,10 +758,10 @@ class MapmriFit(ReconstFit):
         ind_mat = self.model.ind_mat
         if self.model.anisotropic_scaling:
             sel = Bm > 0.  # select only relevant coefficients
-            const = 1 / (np.sqrt(2 * np.pi) * self.mu[0])
+            const = 1 / (np.sqrt(2 * np.pi) * self.mu[..., 0])
             ind_sum = (-1.0) ** (ind_mat[sel, 0] / 2.0)
-            rtpp_vec = const * Bm[sel] * ind_sum * self._mapmri_coef[sel]
-            rtpp = rtpp_vec.sum()
+            rtpp = const * np.dot(self._mapmri_coef[..., sel],
+                                  Bm[sel] * ind_sum)
             return rtpp
 
         else:
@@ -585,15 +781,15 @@ class MapmriFit(ReconstFit):
                             rtpp_vec[count] = const * matsum
                             count += 1
 
-            direction = np.array(self.R[:, 0], ndmin=2)
-            r, theta, phi = cart2sphere(direction[:, 0], direction[:, 1],
-                                        direction[:, 2])
+            direction = np.asarray(self.R)[..., :, 0]
+            r, theta, phi = cart2sphere(direction[..., 0], direction[..., 1],
+                                        direction[..., 2])
 
-            rtpp = self._mapmri_coef * (1 / self.mu[0]) *\
+            rtpp = self._mapmri_coef * (1 / self.mu[..., 0, None]) *\
                 rtpp_vec * real_sph_harm(ind_mat[:, 2], ind_mat[:, 1],
-                                         theta, phi)
+                                         theta[..., None], phi[..., None])
 
-            return rtpp.sum()
+            return rtpp.sum(-1)
 
     def rtap(self):
         r""" Calculates the analytical return to the axis probability (RTAP)
@@ -614,10 +810,10 @@ class MapmriFit(ReconstFit):
         ind_mat = self.model.ind_mat
         if self.model.anisotropic_scaling:
             sel = Bm > 0.  # select only relevant coefficients
-            const = 1 / (2 * np.pi * np.prod(self.mu[1:]))
+            const = 1 / (2 * np.pi * np.prod(self.mu[..., 1:], axis=-1))
             ind_sum = (-1.0) ** ((np.sum(ind_mat[sel, 1:], axis=1) / 2.0))
-            rtap_vec = const * Bm[sel] * ind_sum * self._mapmri_coef[sel]
-            rtap = np.sum(rtap_vec)
+            rtap = const * np.dot(self._mapmri_coef[..., sel],
+                                  Bm[sel] * ind_sum)
         else:
             rtap_vec = np.zeros((ind_mat.shape[0]))
             count = 0
@@ -637,13 +833,13 @@ class MapmriFit(ReconstFit):
                         count += 1
             rtap_vec *= 2
 
-            direction = np.array(self.R[:, 0], ndmin=2)
-            r, theta, phi = cart2sphere(direction[:, 0],
-                                        direction[:, 1], direction[:, 2])
-            rtap_vec = self._mapmri_coef * (1 / self.mu[0] ** 2) *\
+            direction = np.asarray(self.R)[..., :, 0]
+            r, theta, phi = cart2sphere(direction[..., 0],
+                                        direction[..., 1], direction[..., 2])
+            rtap_vec = self._mapmri_coef * (1 / self.mu[..., 0, None] ** 2) *\
                 rtap_vec * real_sph_harm(ind_mat[:, 2], ind_mat[:, 1],
-                                         theta, phi)
-            rtap = rtap_vec.sum()
+                                         theta[..., None], phi[..., None])
+            rtap = rtap_vec.sum(-1)
         return rtap
 
     def rtop(self):
@@ -664,15 +860,15 @@ class MapmriFit(ReconstFit):
         Bm = self.model.Bm
 
         if self.model.anisotropic_scaling:
-            const = 1 / (np.sqrt(8 * np.pi ** 3) * np.prod(self.mu))
+            const = 1 / (np.sqrt(8 * np.pi ** 3) *
+                         np.prod(self.mu, axis=-1))
             ind_sum = (-1.0) ** (np.sum(self.model.ind_mat, axis=1) / 2)
-            rtop_vec = const * ind_sum * Bm * self._mapmri_coef
-            rtop = rtop_vec.sum()
+            rtop = const * np.dot(self._mapmri_coef, ind_sum * Bm)
         else:
             const = 1 / (2 * np.sqrt(2.0) * np.pi ** (3 / 2.0))
             rtop_vec = const * (-1.0) ** (self.model.ind_mat[:, 0] - 1) * Bm
-            rtop = (1 / self.mu[0] ** 3) * rtop_vec * self._mapmri_coef
-            rtop = rtop.sum()
+            rtop = ((1 / self.mu[..., 0] ** 3) *
+                    np.dot(self._mapmri_coef, rtop_vec))
         return rtop
 
     def msd(self):
@@ -691,30 +887,29 @@ class MapmriFit(ReconstFit):
         NeuroImage (2016).
         """
 
-        mu = self.mu
+        mu = self.mu[..., None, :]
         ind_mat = self.model.ind_mat
         Bm = self.model.Bm
         sel = self.model.Bm > 0.  # select only relevant coefficients
-        mapmri_coef = self._mapmri_coef[sel]
+        mapmri_coef = self._mapmri_coef[..., sel]
         if self.model.anisotropic_scaling:
             ind_sum = np.sum(ind_mat[sel], axis=1)
             nx, ny, nz = ind_mat[sel].T
 
             numerator = (-1) ** (0.5 * (-ind_sum)) * np.pi ** (3 / 2.0) *\
-                ((1 + 2 * nx) * mu[0] ** 2 + (1 + 2 * ny) *
-                 mu[1] ** 2 + (1 + 2 * nz) * mu[2] ** 2)
+                ((1 + 2 * nx) * mu[..., 0] ** 2 + (1 + 2 * ny) *
+                 mu[..., 1] ** 2 + (1 + 2 * nz) * mu[..., 2] ** 2)
 
             denominator = np.sqrt(2. ** (-ind_sum) * factorial(nx) *
                                   factorial(ny) * factorial(nz)) *\
                 gamma(0.5 - 0.5 * nx) * gamma(0.5 - 0.5 * ny) *\
                 gamma(0.5 - 0.5 * nz)
 
-            msd_vec = self._mapmri_coef[sel] * (numerator / denominator)
-            msd = msd_vec.sum()
+            msd_vec = mapmri_coef * (numerator / denominator)
+            msd = msd_vec.sum(-1)
         else:
             msd_vec = (4 * ind_mat[sel, 0] - 1) * Bm[sel]
-            msd = self.mu[0] ** 2 * msd_vec * mapmri_coef
-            msd = msd.sum()
+            msd = self.mu[..., 0] ** 2 * np.dot(mapmri_coef, msd_vec)
         return msd
 
     def qiv(self):
@@ -734,7 +929,8 @@ class MapmriFit(ReconstFit):
         using Laplacian-regularized MAP-MRI and its application to HCP data."
         NeuroImage (2016).
         """
-        ux, uy, uz = self.mu
+        mu = self.mu[..., None, :]
+        ux, uy, uz = mu[..., 0], mu[..., 1], mu[..., 2]
         ind_mat = self.model.ind_mat
         if self.model.anisotropic_scaling:
             sel = self.model.Bm > 0  # select only relevant coefficients
@@ -749,16 +945,16 @@ class MapmriFit(ReconstFit):
                 ((1 + 2 * nx) * uy ** 2 * uz ** 2 + ux ** 2 *
                  ((1 + 2 * nz) * uy ** 2 + (1 + 2 * ny) * uz ** 2))
 
-            qiv_vec = self._mapmri_coef[sel] * (numerator / denominator)
-            qiv = qiv_vec.sum()
+            qiv_vec = self._mapmri_coef[..., sel] * (numerator / denominator)
+            qiv = qiv_vec.sum(-1)
         else:
             sel = self.model.Bm > 0.  # select only relevant coefficients
             j = ind_mat[sel, 0]
             qiv_vec = ((8 * (-1.0) ** (1 - j) *
                         np.sqrt(2) * np.pi ** (7 / 2.)) / ((4.0 * j - 1) *
                                                            self.model.Bm[sel]))
-            qiv = ux ** 5 * qiv_vec * self._mapmri_coef[sel]
-            qiv = qiv.sum()
+            qiv = self.mu[..., 0] ** 5 * np.dot(self._mapmri_coef[..., sel],
+                                                qiv_vec)
         return qiv
 
     def ng(self):
@@ -787,7 +983,7 @@ class MapmriFit(ReconstFit):
             raise ValueError(msg)
 
         coef = self._mapmri_coef
-        return np.sqrt(1 - coef[0] ** 2 / np.sum(coef ** 2))
+        return np.sqrt(1 - coef[..., 0] ** 2 / np.sum(coef ** 2, axis=-1))
 
     def ng_parallel(self):
         r""" Calculates the analytical parallel non-Gaussiannity (NG) [1]_.
@@ -816,18 +1012,21 @@ class MapmriFit(ReconstFit):
 
         ind_mat = self.model.ind_mat
         coef = self._mapmri_coef
-        a_par = np.zeros_like(coef)
-        a0 = np.zeros_like(coef)
+        w_par = np.zeros(coef.shape[-1])
+        w0 = np.zeros(coef.shape[-1])
 
-        for i in range(coef.shape[0]):
+        for i in range(coef.shape[-1]):
             n1, n2, n3 = ind_mat[i]
             if (n2 % 2 + n3 % 2) == 0:
-                a_par[i] = coef[i] * (-1) ** ((n2 + n3) / 2) *\
+                w_par[i] = (-1) ** ((n2 + n3) / 2) *\
                     np.sqrt(factorial(n2) * factorial(n3)) /\
                     (factorial2(n2) * factorial2(n3))
                 if n1 == 0:
-                    a0[i] = a_par[i]
-        return np.sqrt(1 - np.sum(a0 ** 2) / np.sum(a_par ** 2))
+                    w0[i] = w_par[i]
+        a_par = coef * w_par
+        a0 = coef * w0
+        return np.sqrt(1 - np.sum(a0 ** 2, axis=-1) /
+                       np.sum(a_par ** 2, axis=-1))
 
     def ng_perpendicular(self):
         r""" Calculates the analytical perpendicular non-Gaussiannity (NG)
@@ -856,18 +1055,21 @@ class MapmriFit(ReconstFit):
 
         ind_mat = self.model.ind_mat
         coef = self._mapmri_coef
-        a_perp = np.zeros_like(coef)
-        a00 = np.zeros_like(coef)
+        w_perp = np.zeros(coef.shape[-1])
+        w00 = np.zeros(coef.shape[-1])
 
-        for i in range(coef.shape[0]):
+        for i in range(coef.shape[-1]):
             n1, n2, n3 = ind_mat[i]
             if n1 % 2 == 0:
                 if n2 % 2 == 0 and n3 % 2 == 0:
-                    a_perp[i] = coef[i] * (-1) ** (n1 / 2) *\
+                    w_perp[i] = (-1) ** (n1 / 2) *\
                         np.sqrt(factorial(n1)) / factorial2(n1)
                     if n2 == 0 and n3 == 0:
-                        a00[i] = a_perp[i]
-        return np.sqrt(1 - np.sum(a00 ** 2) / np.sum(a_perp ** 2))
+                        w00[i] = w_perp[i]
+        a_perp = coef * w_perp
+        a00 = coef * w00
+        return np.sqrt(1 - np.sum(a00 ** 2, axis=-1) /
+                       np.sum(a_perp ** 2, axis=-1))
 
     def norm_of_laplacian_signal(self):
         """ Calculates the norm of the laplacian of the fitted signal [1]_.
@@ -883,15 +1085,23 @@ class MapmriFit(ReconstFit):
         using Laplacian-regularized MAP-MRI and its application to HCP data."
         NeuroImage (2016).
         """
+        coef = self._mapmri_coef
         if self.model.anisotropic_scaling:
-            laplacian_matrix = mapmri_laplacian_reg_matrix(
-                    self.model.ind_mat, self.mu,
-                    self.model.S_mat, self.model.T_mat, self.model.U_mat)
-        else:
-            laplacian_matrix = self.mu[0] * self.model.laplacian_matrix
-
-        norm_of_laplacian = np.dot(np.dot(self._mapmri_coef, laplacian_matrix),
-                                   self._mapmri_coef)
+            coef = coef.reshape(-1, coef.shape[-1])
+            mu = np.reshape(self.mu, (-1, 3))
+            norm_of_laplacian = np.empty(coef.shape[0])
+            for block in self._voxel_blocks():
+                laplacian_matrix = mapmri_laplacian_reg_matrix(
+                        self.model.ind_mat, mu[block],
+                        self.model.S_mat, self.model.T_mat, self.model.U_mat)
+                norm_of_laplacian[block] = np.einsum(
+                    'ij,ijk,ik->i', coef[block], laplacian_matrix,
+                    coef[block])
+            return norm_of_laplacian.reshape(self._mapmri_coef.shape[:-1])
+
+        laplacian_matrix = self.model.laplacian_matrix
+        norm_of_laplacian = self.mu[..., 0] * np.sum(
+            np.dot(coef, laplacian_matrix) * coef, axis=-1)
         return norm_of_laplacian
 
     def fitted_signal(self, gtab=None):
@@ -917,42 +1127,60 @@ class MapmriFit(ReconstFit):
             qvals = np.sqrt(gtab.bvals / self.model.tau) / (2 * np.pi)
             q = qvals[:, None] * gtab.bvecs
 
+        coef = self._mapmri_coef.reshape(-1, self._mapmri_coef.shape[-1])
+        E = np.empty((coef.shape[0], q.shape[0]))
         if self.model.anisotropic_scaling:
-            q_rot = np.dot(q, self.R)
-            M = mapmri_phi_matrix(self.radial_order, self.mu, q_rot)
+            mu = np.reshape(self.mu, (-1, 1, 3))
+            R = np.reshape(self.R, (-1, 3, 3))
+            for block in self._voxel_blocks():
+                q_rot = np.matmul(q, R[block])
+                M = mapmri_phi_matrix(self.radial_order, mu[block], q_rot)
+                E[block] = np.einsum('ijk,ik->ij', M, coef[block])
         else:
-            M = mapmri_isotropic_phi_matrix(self.radial_order, self.mu[0], q)
-
-        E = S0 * np.dot(M, self._mapmri_coef)
-        return E
+            mu = np.reshape(self.mu, (-1, 3))[:, 0, None]
+            M_mu_independent = mapmri_isotropic_M_mu_independent(
+                self.radial_order, q)
+            for block in self._voxel_blocks():
+                M = M_mu_independent * mapmri_isotropic_M_mu_dependent(
+                    self.radial_order, mu[block], qvals)
+                E[block] = np.einsum('ijk,ik->ij', M, coef[block])
+        E = E.reshape(self._mapmri_coef.shape[:-1] + (q.shape[0],))
+        return S0 * E
 
     def pdf(self, r_points):
         """ Diffusion propagator on a given set of real points.
         if the array r_points is non writeable, then intermediate
         results are cached for faster recalculation
         """
+        coef = self._mapmri_coef.reshape(-1, self._mapmri_coef.shape[-1])
+        EAP = np.empty((coef.shape[0], r_points.shape[0]))
         if self.model.anisotropic_scaling:
-            r_point_rotated = np.dot(r_points, self.R)
-            K = mapmri_psi_matrix(self.radial_order, self.mu, r_point_rotated)
-            EAP = np.dot(K, self._mapmri_coef)
+            mu = np.reshape(self.mu, (-1, 1, 3))
+            R = np.reshape(self.R, (-1, 3, 3))
+            for block in self._voxel_blocks():
+                r_point_rotated = np.matmul(r_points, R[block])
+                K = mapmri_psi_matrix(self.radial_order, mu[block],
+                                      r_point_rotated)
+                EAP[block] = np.einsum('ijk,ik->ij', K, coef[block])
         else:
+            K_independent = None
             if not r_points.flags.writeable:
                 K_independent = self.model.cache_get(
                     'mapmri_matrix_pdf_independent', key=hash(r_points.data))
-                if K_independent is None:
-                    K_independent = mapmri_isotropic_K_mu_independent(
-                        self.radial_order, r_points)
+            if K_independent is None:
+                K_independent = mapmri_isotropic_K_mu_independent(
+                    self.radial_order, r_points)
+                if not r_points.flags.writeable:
                     self.model.cache_set('mapmri_matrix_pdf_independent',
                                          hash(r_points.data), K_independent)
-                K_dependent = mapmri_isotropic_K_mu_dependent(
-                    self.radial_order, self.mu[0], r_points)
-                K = K_dependent * K_independent
-            else:
-                K = mapmri_isotropic_psi_matrix(
-                    self.radial_order, self.mu[0], r_points)
-            EAP = np.dot(K, self._mapmri_coef)
+            mu = np.reshape(self.mu, (-1, 3))[:, 0, None]
+            for block in self._voxel_blocks():
+                K = K_independent * mapmri_isotropic_K_mu_dependent(
+                    self.radial_order, mu[block], r_points)
+                EAP[block] = np.einsum('ijk,ik->ij', K, coef[block])
 
-        return EAP
+        return EAP.reshape(self._mapmri_coef.shape[:-1] +
+                           (r_points.shape[0],))
 
 
 def isotropic_scale_factor(mu_squared):
@@ -960,12 +1188,12 @@ def isotropic_scale_factor(mu_squared):
 
     Parameters
     ----------
-    mu_squared : array, shape (N,3)
+    mu_squared : array, shape (..., 3)
         squared scale factors of mapmri basis in x, y, z
 
     Returns
     -------
-    u0 : float
+    u0 : float or array, shape (...)
         closest isotropic scale factor for the isotropic basis
 
     References
@@ -974,11 +1202,18 @@ def isotropic_scale_factor(mu_squared):
     diffusion imaging method for mapping tissue microstructure",
     NeuroImage, 2013.
     """
-    X, Y, Z = mu_squared
-    coef_array = np.array([-3, -(X + Y + Z), (X * Y + X * Z + Y * Z),
-                           3 * X * Y * Z])
+    X, Y, Z = np.rollaxis(np.asarray(mu_squared, dtype=float), -1)
+    # The roots of the polynomial -3 u^3 - (X + Y + Z) u^2 +
+    # (X Y + X Z + Y Z) u + 3 X Y Z are the eigenvalues of its companion
+    # matrix, as in ``np.roots``, computed here for all the voxels at once.
+    companion = np.zeros(X.shape + (3, 3))
+    companion[..., 0, 0] = -(X + Y + Z) / 3.
+    companion[..., 0, 1] = (X * Y + X * Z + Y * Z) / 3.
+    companion[..., 0, 2] = X * Y * Z
+    companion[..., 1, 0] = 1
+    companion[..., 2, 1] = 1
     # take the real, positive root of the problem.
-    u0 = np.sqrt(np.real(np.roots(coef_array).max()))
+    u0 = np.sqrt(np.real(np.linalg.eigvals(companion)).max(-1))
     return u0
 
 
@@ -1107,10 +1342,12 @@ def mapmri_phi_matrix(radial_order, mu, q_gradients):
     ----------
     radial_order : unsigned int,
         an even integer that represent the order of the basis
-    mu : array, shape (3,)
+    mu : array, shape (..., 3)
         scale factors of the basis for x, y, z
-    q_gradients : array, shape (N,3)
-        points in the q-space in which evaluate the basis
+    q_gradients : array, shape (..., N, 3)
+        points in the q-space in which evaluate the basis. Leading
+        dimensions of ``mu`` and ``q_gradients`` are broadcast against each
+        other to evaluate the matrices of many voxels at once.
 
     References
     ----------
@@ -1121,28 +1358,26 @@ def mapmri_phi_matrix(radial_order, mu, q_gradients):
 
     ind_mat = mapmri_index_matrix(radial_order)
     n_elem = ind_mat.shape[0]
-    n_qgrad = q_gradients.shape[0]
 
-    qx, qy, qz = q_gradients.T
-    mux, muy, muz = mu
+    qx, qy, qz = np.rollaxis(np.asarray(q_gradients), -1)
+    mux, muy, muz = np.rollaxis(np.asarray(mu), -1)
+    shape = np.broadcast(qx, mux).shape
 
-    Mx_storage = np.array(np.zeros((n_qgrad, radial_order + 1)),
-                          dtype=complex)
-    My_storage = np.array(np.zeros((n_qgrad, radial_order + 1)),
-                          dtype=complex)
-    Mz_storage = np.array(np.zeros((n_qgrad, radial_order + 1)),
-                          dtype=complex)
-    M = np.zeros((n_qgrad, n_elem))
+    Mx_storage = np.zeros(shape + (radial_order + 1,), dtype=complex)
+    My_storage = np.zeros(shape + (radial_order + 1,), dtype=complex)
+    Mz_storage = np.zeros(shape + (radial_order + 1,), dtype=complex)
+    M = np.zeros(shape + (n_elem,))
 
     for n in range(radial_order + 1):
-        Mx_storage[:, n] = mapmri_phi_1d(n, qx, mux)
-        My_storage[:, n] = mapmri_phi_1d(n, qy, muy)
-        Mz_storage[:, n] = mapmri_phi_1d(n, qz, muz)
+        Mx_storage[..., n] = mapmri_phi_1d(n, qx, mux)
+        My_storage[..., n] = mapmri_phi_1d(n, qy, muy)
+        Mz_storage[..., n] = mapmri_phi_1d(n, qz, muz)
 
     counter = 0
     for nx, ny, nz in ind_mat:
-        M[:, counter] = (
-            np.real(Mx_storage[:, nx] * My_storage[:, ny] * Mz_storage[:, nz])
+        M[..., counter] = (
+            np.real(Mx_storage[..., nx] * My_storage[..., ny] *
+                    Mz_storage[..., nz])
             )
         counter += 1
 
@@ -1183,10 +1418,11 @@ def mapmri_psi_matrix(radial_order, mu, rgrad):
     ----------
     radial_order : unsigned int,
         an even integer that represent the order of the basis
-    mu : array, shape (3,)
+    mu : array, shape (..., 3)
         scale factors of the basis for x, y, z
-    rgrad : array, shape (N,3)
-        points in the r-space in which evaluate the EAP
+    rgrad : array, shape (..., N, 3)
+        points in the r-space in which evaluate the EAP. Leading dimensions
+        of ``mu`` and ``rgrad`` are broadcast against each other.
 
     References
     ----------
@@ -1197,24 +1433,24 @@ def mapmri_psi_matrix(radial_order, mu, rgrad):
 
     ind_mat = mapmri_index_matrix(radial_order)
     n_elem = ind_mat.shape[0]
-    n_qgrad = rgrad.shape[0]
-    rx, ry, rz = rgrad.T
-    mux, muy, muz = mu
+    rx, ry, rz = np.rollaxis(np.asarray(rgrad), -1)
+    mux, muy, muz = np.rollaxis(np.asarray(mu), -1)
+    shape = np.broadcast(rx, mux).shape
 
-    Kx_storage = np.zeros((n_qgrad, radial_order + 1))
-    Ky_storage = np.zeros((n_qgrad, radial_order + 1))
-    Kz_storage = np.zeros((n_qgrad, radial_order + 1))
-    K = np.zeros((n_qgrad, n_elem))
+    Kx_storage = np.zeros(shape + (radial_order + 1,))
+    Ky_storage = np.zeros(shape + (radial_order + 1,))
+    Kz_storage = np.zeros(shape + (radial_order + 1,))
+    K = np.zeros(shape + (n_elem,))
 
     for n in range(radial_order + 1):
-        Kx_storage[:, n] = mapmri_psi_1d(n, rx, mux)
-        Ky_storage[:, n] = mapmri_psi_1d(n, ry, muy)
-        Kz_storage[:, n] = mapmri_psi_1d(n, rz, muz)
+        Kx_storage[..., n] = mapmri_psi_1d(n, rx, mux)
+        Ky_storage[..., n] = mapmri_psi_1d(n, ry, muy)
+        Kz_storage[..., n] = mapmri_psi_1d(n, rz, muz)
 
     counter = 0
     for nx, ny, nz in ind_mat:
-        K[:, counter] = (
-            Kx_storage[:, nx] * Ky_storage[:, ny] * Kz_storage[:, nz]
+        K[..., counter] = (
+            Kx_storage[..., nx] * Ky_storage[..., ny] * Kz_storage[..., nz]
             )
         counter += 1
 
@@ -1228,12 +1464,14 @@ def mapmri_odf_matrix(radial_order, mu, s, vertices):
     ----------
     radial_order : unsigned int,
         an even integer that represent the order of the basis
-    mu : array, shape (3,)
+    mu : array, shape (..., 3)
         scale factors of the basis for x, y, z
     s : unsigned int
         radial moment of the ODF
-    vertices : array, shape (N,3)
-        points of the sphere shell in the r-space in which evaluate the ODF
+    vertices : array, shape (..., N, 3)
+        points of the sphere shell in the r-space in which evaluate the ODF.
+        Leading dimensions of ``mu`` and ``vertices`` are broadcast against
+        each other.
 
 
     References
@@ -1244,26 +1482,26 @@ def mapmri_odf_matrix(radial_order, mu, s, vertices):
     """
 
     ind_mat = mapmri_index_matrix(radial_order)
-    n_vert = vertices.shape[0]
     n_elem = ind_mat.shape[0]
-    odf_mat = np.zeros((n_vert, n_elem))
-    mux, muy, muz = mu
+    mux, muy, muz = np.rollaxis(np.asarray(mu), -1)
+    vx, vy, vz = np.rollaxis(np.asarray(vertices), -1)
     # Eq, 35a
-    rho = 1.0 / np.sqrt((vertices[:, 0] / mux) ** 2 +
-                        (vertices[:, 1] / muy) ** 2 +
-                        (vertices[:, 2] / muz) ** 2)
+    rho = 1.0 / np.sqrt((vx / mux) ** 2 +
+                        (vy / muy) ** 2 +
+                        (vz / muz) ** 2)
     # Eq, 35b
-    alpha = 2 * rho * (vertices[:, 0] / mux)
+    alpha = 2 * rho * (vx / mux)
     # Eq, 35c
-    beta = 2 * rho * (vertices[:, 1] / muy)
+    beta = 2 * rho * (vy / muy)
     # Eq, 35d
-    gamma = 2 * rho * (vertices[:, 2] / muz)
+    gamma = 2 * rho * (vz / muz)
     const = rho ** (3 + s) / np.sqrt(2 ** (2 - s) * np.pi **
                                      3 * (mux ** 2 * muy ** 2 * muz ** 2))
+    odf_mat = np.zeros(rho.shape + (n_elem,))
     for j in range(n_elem):
         n1, n2, n3 = ind_mat[j]
         f = np.sqrt(factorial(n1) * factorial(n2) * factorial(n3))
-        odf_mat[:, j] = const * f * \
+        odf_mat[..., j] = const * f * \
             _odf_cfunc(n1, n2, n3, alpha, beta, gamma, s)
 
     return odf_mat
@@ -1339,6 +1577,11 @@ def mapmri_isotropic_phi_matrix(radial_order, mu, q):
     return M
 
 
+# The matrices of the scale factors shared by many voxels, the static or
+# rounded ones, are cached. The matrices of per voxel scale factors are not.
+_shared_isotropic_phi_matrix = cached_basis(mapmri_isotropic_phi_matrix)
+
+
 def mapmri_isotropic_radial_signal_basis(j, l, mu, qval):
     r"""Radial part of the isotropic 1D-SHORE signal basis [1]_ eq. (61).
 
@@ -1395,13 +1638,14 @@ def mapmri_isotropic_M_mu_independent(radial_order, q):
 
 def mapmri_isotropic_M_mu_dependent(radial_order, mu, qval):
     '''Computed the mu dependent part of the signal design matrix.
+    ``mu`` may be an array of shape (..., 1) to compute the matrices of many
+    voxels at once.
     '''
     ind_mat = mapmri_isotropic_index_matrix(radial_order)
 
     n_elem = ind_mat.shape[0]
-    n_qgrad = qval.shape[0]
-    Q_u0_dependent = np.zeros((n_qgrad, n_elem))
     pi2q2mu2 = 2 * np.pi ** 2 * mu ** 2 * qval ** 2
+    Q_u0_dependent = np.zeros(pi2q2mu2.shape + (n_elem,))
 
     counter = 0
     for n in range(0, radial_order + 1, 2):
@@ -1410,7 +1654,7 @@ def mapmri_isotropic_M_mu_dependent(radial_order, mu, qval):
             const = mu ** l * np.exp(-pi2q2mu2) *\
                 genlaguerre(j - 1, l + 0.5)(2 * pi2q2mu2)
             for m in range(-l, l + 1):
-                Q_u0_dependent[:, counter] = const
+                Q_u0_dependent[..., counter] = const
                 counter += 1
 
     return Q_u0_dependent
@@ -1513,15 +1757,16 @@ def mapmri_isotropic_K_mu_independent(radial_order, rgrad):
 
 def mapmri_isotropic_K_mu_dependent(radial_order, mu, rgrad):
     '''Computes mu dependent part of M. Same trick as with M.
+    ``mu`` may be an array of shape (..., 1) to compute the matrices of many
+    voxels at once.
     '''
     r, theta, phi = cart2sphere(rgrad[:, 0], rgrad[:, 1],
                                 rgrad[:, 2])
     theta[np.isnan(theta)] = 0
     ind_mat = mapmri_isotropic_index_matrix(radial_order)
     n_elem = ind_mat.shape[0]
-    n_rgrad = rgrad.shape[0]
-    K = np.zeros((n_rgrad, n_elem))
     r2mu2 = r ** 2 / (2 * mu ** 2)
+    K = np.zeros(r2mu2.shape + (n_elem,))
 
     counter = 0
     for n in range(0, radial_order + 1, 2):
@@ -1530,7 +1775,7 @@ def mapmri_isotropic_K_mu_dependent(radial_order, mu, rgrad):
             const = (mu ** 3) ** (-1) * mu ** (-l) *\
                 np.exp(-r2mu2) * genlaguerre(j - 1, l + 0.5)(2 * r2mu2)
             for m in range(-l, l + 1):
-                K[:, counter] = const
+                K[..., counter] = const
                 counter += 1
     return K
 
@@ -1902,14 +2147,14 @@ def mapmri_laplacian_reg_matrix(ind_mat, mu, S_mat, T_mat, U_mat):
     ----------
     ind_mat : matrix (N_coef, 3),
         Basis order matrix
-    mu : array, shape (3,)
+    mu : array, shape (..., 3)
         scale factors of the basis for x, y, z
     S, T, U : matrices, shape (N_coef,N_coef)
         Regularization submatrices
 
     Returns
     -------
-    LR : matrix (N_coef, N_coef),
+    LR : matrix (..., N_coef, N_coef),
         Voxel-specific Laplacian regularization matrix
 
     References
@@ -1918,33 +2163,32 @@ def mapmri_laplacian_reg_matrix(ind_mat, mu, S_mat, T_mat, U_mat):
     using Laplacian-regularized MAP-MRI and its application to HCP data."
     NeuroImage (2016).
     """
-    ux, uy, uz = mu
+    ux, uy, uz = np.rollaxis(np.asarray(mu, dtype=float), -1)
     x, y, z = ind_mat.T
-    n_elem = ind_mat.shape[0]
-    LR = np.zeros((n_elem, n_elem))
-
-    for i in range(n_elem):
-        for j in range(i, n_elem):
-            if (
-               (x[i] - x[j]) % 2 == 0 and
-               (y[i] - y[j]) % 2 == 0 and
-               (z[i] - z[j]) % 2 == 0
-               ):
-                LR[i, j] = LR[j, i] = \
-                  (ux ** 3 / (uy * uz)) *\
-                  S_mat[x[i], x[j]] * U_mat[y[i], y[j]] * U_mat[z[i], z[j]] +\
-                  (uy ** 3 / (ux * uz)) *\
-                  S_mat[y[i], y[j]] * U_mat[z[i], z[j]] * U_mat[x[i], x[j]] +\
-                  (uz ** 3 / (ux * uy)) *\
-                  S_mat[z[i], z[j]] * U_mat[x[i], x[j]] * U_mat[y[i], y[j]] +\
-                  2 * ((ux * uy) / uz) *\
-                  T_mat[x[i], x[j]] * T_mat[y[i], y[j]] * U_mat[z[i], z[j]] +\
-                  2 * ((ux * uz) / uy) *\
-                  T_mat[x[i], x[j]] * T_mat[z[i], z[j]] * U_mat[y[i], y[j]] +\
-                  2 * ((uz * uy) / ux) *\
-                  T_mat[z[i], z[j]] * T_mat[y[i], y[j]] * U_mat[x[i], x[j]]
-
-    return LR
+    xi, xj = x[:, None], x[None, :]
+    yi, yj = y[:, None], y[None, :]
+    zi, zj = z[:, None], z[None, :]
+    parity = (((xi - xj) % 2 == 0) & ((yi - yj) % 2 == 0) &
+              ((zi - zj) % 2 == 0))
+    # The six mu independent terms of the matrix, combined below with the
+    # voxel specific scale factors
+    terms = np.array([
+        S_mat[xi, xj] * U_mat[yi, yj] * U_mat[zi, zj],
+        S_mat[yi, yj] * U_mat[zi, zj] * U_mat[xi, xj],
+        S_mat[zi, zj] * U_mat[xi, xj] * U_mat[yi, yj],
+        2 * T_mat[xi, xj] * T_mat[yi, yj] * U_mat[zi, zj],
+        2 * T_mat[xi, xj] * T_mat[zi, zj] * U_mat[yi, yj],
+        2 * T_mat[zi, zj] * T_mat[yi, yj] * U_mat[xi, xj]]) * parity
+    factors = np.stack([ux ** 3 / (uy * uz),
+                        uy ** 3 / (ux * uz),
+                        uz ** 3 / (ux * uy),
+                        (ux * uy) / uz,
+                        (ux * uz) / uy,
+                        (uz * uy) / ux], axis=-1)
+    LR = np.tensordot(factors, terms, axes=1)
+    # The matrix is built from its upper triangle
+    upper = np.triu(np.ones(parity.shape, dtype=bool))
+    return np.where(upper, LR, np.swapaxes(LR, -1, -2))
 
 
 def generalized_crossvalidation_array(data, M, LR, weights_array=None):
@@ -2032,3 +2276,162 @@ def gcv_cost_function(weight, args):
     normyytilde = np.linalg.norm(data - np.dot(S, data), 2)
     gcv_value = normyytilde / (K - trS)
     return gcv_value
+
+
+def generalized_crossvalidation_batch(data, M, LR, weights_array):
+    """Generalized Cross Validation Function [1]_ eq. (15) of many voxels.
+
+    Evaluates the cost function of the generalized cross-validation of all
+    the voxels at every weight of `weights_array`. $M^T M$ and the
+    regularization matrix are diagonalized simultaneously, once per voxel,
+    after which the trace of the smoothing matrix and the norm of the
+    residuals at every weight only take a few vector operations.
+
+    Parameters
+    ----------
+    data : array (n_voxels, N),
+        data array
+    M : matrix, shape (N, Ncoef) or (n_voxels, N, Ncoef)
+        mapmri observation matrix, shared by the voxels or voxel specific
+    LR : matrix, shape (N_coef, N_coef) or (n_voxels, N_coef, N_coef)
+        regularization matrix, shared by the voxels or voxel specific
+    weights_array : array (N_of_weights)
+        array of regularization weights
+
+    Returns
+    -------
+    gcv : array (n_voxels, N_of_weights)
+        value of the cost function of every voxel at every weight
+
+    References
+    ----------
+    .. [1]_ Craven et al. "Smoothing Noisy Data with Spline Functions."
+        NUMER MATH 31.4 (1978): 377-403.
+    """
+    K = data.shape[-1]
+    weights_array = np.asarray(weights_array, dtype=float)
+    Mt = np.swapaxes(M, -1, -2)
+    MMt = np.matmul(Mt, M)
+    try:
+        L = np.linalg.cholesky(MMt)
+    except np.linalg.LinAlgError:
+        return _generalized_crossvalidation_pinv(data, M, LR, weights_array)
+
+    # With M^T M = L L^T and L^-1 LR L^-T = V diag(s) V^T, the smoothing
+    # matrix is S = U diag(1 / (1 + weight s)) U^T, where U = M L^-T V has
+    # orthonormal columns.
+    Linv = np.linalg.inv(L)
+    s, V = np.linalg.eigh(np.matmul(np.matmul(Linv, LR),
+                                    np.swapaxes(Linv, -1, -2)))
+    W = np.matmul(np.swapaxes(Linv, -1, -2), V)
+    U = np.matmul(M, W)
+    if U.ndim == 2:
+        z = np.dot(data, U)
+        projected = np.dot(z, U.T)
+    else:
+        z = np.matmul(data[:, None, :], U)[:, 0]
+        projected = np.matmul(U, z[..., None])[..., 0]
+    # The residuals are the sum of the (orthogonal) residuals of the
+    # projection on the columns of U and of the shrinkage of z
+    norm_projection = np.sum((data - projected) ** 2, -1)
+    shrink = 1. / (1. + weights_array[:, None] * s[..., None, :])
+    trS = np.sum(shrink, -1)
+    normyytilde = np.sqrt(norm_projection[:, None] +
+                          np.sum(((1 - shrink) * z[:, None, :]) ** 2, -1))
+    return normyytilde / (K - trS)
+
+
+def _generalized_crossvalidation_pinv(data, M, LR, weights_array):
+    """``generalized_crossvalidation_batch`` for singular $M^T M$, with the
+    pseudo-inverse of the regularized matrix at every weight."""
+    K = data.shape[-1]
+    Mt = np.swapaxes(M, -1, -2)
+    MMt = np.matmul(Mt, M)
+    if M.ndim == 2:
+        Mty = np.dot(data, M)
+    else:
+        Mty = np.matmul(Mt, data[..., None])[..., 0]
+    gcv = np.empty((data.shape[0], len(weights_array)))
+    for i, weight in enumerate(weights_array):
+        pinv = np.linalg.pinv(MMt + weight * LR)
+        # trace(M pinv M^T) = trace(pinv M^T M), with M^T M symmetric
+        trS = np.sum(pinv * MMt, axis=(-2, -1))
+        coef = np.matmul(Mty[..., None, :], np.swapaxes(pinv, -1, -2))
+        if M.ndim == 2:
+            fitted = np.dot(coef[..., 0, :], Mt)
+        else:
+            fitted = np.matmul(coef, Mt)[..., 0, :]
+        normyytilde = np.sqrt(np.sum((data - fitted) ** 2, -1))
+        gcv[:, i] = normyytilde / (K - trS)
+    return gcv
+
+
+def _gcv_optimum(gcv, weights_array, refine=False):
+    """Optimal weights of the costs of ``generalized_crossvalidation_batch``
+
+    Without `refine`, the weights are chosen as in
+    ``generalized_crossvalidation_array``, at the first local minimum of the
+    cost along `weights_array`. With `refine`, the weights are those of the
+    global minimum, refined by parabolic interpolation of the cost as a
+    function of the logarithm of the weights, which must then be evenly
+    spaced in log scale.
+    """
+    n_weights = gcv.shape[-1]
+    if not refine:
+        increase = np.diff(gcv, axis=-1) > 0
+        # generalized_crossvalidation_array evaluates the cost up to the
+        # second to last weight only
+        increase[:, n_weights - 3] = True
+        return weights_array[np.argmax(increase, -1)]
+
+    best = np.argmin(gcv, -1)
+    log_weights = np.log(weights_array)
+    log_opt = log_weights[best]
+    inner = (best > 0) & (best < n_weights - 1)
+    rows = np.flatnonzero(inner)
+    g0 = gcv[rows, best[rows] - 1]
+    g1 = gcv[rows, best[rows]]
+    g2 = gcv[rows, best[rows] + 1]
+    curvature = g0 - 2 * g1 + g2
+    step = log_weights[1] - log_weights[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = 0.5 * step * (g0 - g2) / curvature
+    offset[~(curvature > 0)] = 0
+    log_opt[rows] += np.clip(offset, -step, step)
+    return np.exp(log_opt)
+
+
+def _regularized_lstsq_batch(data, M, LR, weights):
+    """Laplacian regularized least squares of many voxels
+
+    Solves ``(M^T M + weight LR) coef = M^T data`` for all the voxels at once.
+    The systems of voxels for which they are singular are solved one at a
+    time, and their coefficients are set to zero with an errorcode of 1 if
+    they can not be inverted, as in ``MapmriModel.fit``.
+    """
+    Mt = np.swapaxes(M, -1, -2)
+    MMt = np.matmul(Mt, M)
+    if M.ndim == 2:
+        Mty = np.dot(data, M)
+    else:
+        Mty = np.matmul(Mt, data[..., None])[..., 0]
+    errorcode = np.zeros(data.shape[0], dtype=int)
+    weights = np.asarray(weights, dtype=float)
+    shared = MMt.ndim == 2 and np.ndim(LR) == 2
+    if shared and np.all(weights == weights[0]):
+        try:
+            return np.linalg.solve(MMt + weights[0] * LR, Mty.T).T, errorcode
+        except np.linalg.LinAlgError:
+            pass
+    A = MMt + weights[:, None, None] * LR
+    try:
+        return np.linalg.solve(A, Mty[..., None])[..., 0], errorcode
+    except np.linalg.LinAlgError:
+        pass
+    coef = np.zeros(Mty.shape)
+    for i in range(data.shape[0]):
+        try:
+            coef[i] = np.linalg.solve(A[i], Mty[i])
+        except np.linalg.LinAlgError:
+            errorcode[i] = 1
+    return coef, errorcode
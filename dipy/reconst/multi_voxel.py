@@ -1,8 +1,19 @@
 """Tools to easily make multi voxel models"""
+from __future__ import division
+
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
+from itertools import chain
+from os import path
+
 import numpy as np
+from numpy.lib.format import open_memmap
 from numpy.lib.stride_tricks import as_strided
 
+from nibabel.tmpdirs import TemporaryDirectory
+
 from ..core.ndindex import ndindex
+from ..core.onetime import auto_attr
 from .quick_squash import quick_squash as _squash
 from .base import ReconstFit
 
@@ -10,9 +21,42 @@ from .base import ReconstFit
 def multi_voxel_fit(single_voxel_fit):
     """Method decorator to turn a single voxel model fit
     definition into a multi voxel model fit definition
+
+    The decorated fit method accepts the additional keyword arguments
+    ``engine``, ``n_jobs`` and ``chunk_size`` which select how the voxels
+    in the mask are distributed. See ``_parallel_fit`` for details.
+
+    If the single voxel fit class defines ``_fit_params``, the names of the
+    attributes holding its parameters in the order of its constructor
+    arguments, the parameters of all voxels are gathered in dense arrays and
+    a ``MultiVoxelArrayFit`` is returned. The methods of such a fit class
+    must accept parameters with a leading voxel dimension. Otherwise the
+    single voxel fits are kept in the object array of a ``MultiVoxelFit``.
     """
-    def new_fit(self, data, mask=None):
-        """Fit method for every voxel in data"""
+    def new_fit(self, data, mask=None, engine='serial', n_jobs=None,
+                chunk_size=None):
+        """Fit method for every voxel in data
+
+        Parameters
+        ----------
+        data : array
+            The measured signal, with the last dimension holding the
+            measurements of each voxel.
+        mask : array, optional
+            A boolean array with the shape of ``data.shape[:-1]``. Only voxels
+            where the mask is True are fit.
+        engine : {'serial', 'thread', 'process'}, optional
+            'serial' (default) fits every voxel in the calling thread.
+            'thread' fits chunks of voxels in a pool of threads sharing
+            ``data``. 'process' fits chunks of voxels in a pool of worker
+            processes that read the masked signal from a memory-mapped
+            temporary file.
+        n_jobs : int, optional
+            Number of workers of the pool. Default: the number of cpus.
+        chunk_size : int, optional
+            Number of voxels sent to a worker at a time. Default: the number
+            of voxels in the mask split in ``4 * n_jobs`` chunks.
+        """
         # If only one voxel just return a normal fit
         if data.ndim == 1:
             return single_voxel_fit(self, data)
@@ -26,15 +70,176 @@ def multi_voxel_fit(single_voxel_fit):
         elif mask.shape != data.shape[:-1]:
             raise ValueError("mask and data shape do not match")
 
-        # Fit data where mask is True
-        fit_array = np.empty(data.shape[:-1], dtype=object)
-        for ijk in ndindex(data.shape[:-1]):
-            if mask[ijk]:
-                fit_array[ijk] = single_voxel_fit(self, data[ijk])
-        return MultiVoxelFit(self, fit_array, mask)
+        if engine == 'serial':
+            voxel_fits = (single_voxel_fit(self, data[ijk])
+                          for ijk in ndindex(data.shape[:-1]) if mask[ijk])
+        else:
+            voxel_fits = _parallel_fit(self, single_voxel_fit, data, mask,
+                                       engine, n_jobs, chunk_size)
+        return _gather_fits(self, voxel_fits, mask)
     return new_fit
 
 
+# State of the worker processes of the 'process' engine, set once per worker
+# by ``_init_fit_worker`` so that the model is not sent with every chunk.
+_worker_state = {}
+
+
+def _init_fit_worker(model, fit_name, data_file_name):
+    _worker_state['model'] = model
+    _worker_state['fit'] = getattr(model, fit_name)
+    _worker_state['data'] = np.load(data_file_name, mmap_mode='r')
+
+
+def _fit_chunk(bounds):
+    start, end = bounds
+    fit = _worker_state['fit']
+    data = _worker_state['data']
+    # A 1D signal makes the decorated method return the single voxel fit
+    return [fit(np.asarray(data[i])) for i in range(start, end)]
+
+
+def _parallel_fit(model, single_voxel_fit, data, mask, engine='process',
+                  n_jobs=None, chunk_size=None):
+    """Fit the voxels of ``data`` where ``mask`` is True in a worker pool
+
+    The voxels of the mask are split in chunks of consecutive voxels (in C
+    order) which are fit independently by the workers. The fits are yielded
+    in the order of the voxels, so the result does not depend on the number
+    of workers.
+
+    With the 'thread' engine the workers index ``data`` directly. With the
+    'process' engine the masked voxels are written once to a memory-mapped
+    temporary file which every worker maps read-only, so neither the data
+    nor the model are pickled for each chunk. Only the single voxel fits are
+    sent back to the parent process.
+
+    Parameters
+    ----------
+    model : object
+        The model instance being fit.
+    single_voxel_fit : callable
+        The undecorated fit method, ``single_voxel_fit(model, signal)``.
+    data : array (..., N)
+        The measured signal.
+    mask : boolean array, shape ``data.shape[:-1]``
+        Voxels to fit.
+    engine : {'thread', 'process'}
+        Kind of worker pool.
+    n_jobs : int, optional
+        Number of workers. Default: the number of cpus.
+    chunk_size : int, optional
+        Number of voxels fit by a worker at a time.
+
+    Returns
+    -------
+    voxel_fits : generator
+        The single voxel fits of the voxels in the mask, in C order.
+    """
+    if engine not in ('thread', 'process'):
+        raise ValueError("engine should be one of 'serial', 'thread' or "
+                         "'process', got %r" % (engine,))
+    if n_jobs is None:
+        n_jobs = cpu_count()
+    elif n_jobs < 1:
+        raise ValueError("n_jobs should be a positive integer, got %r"
+                         % (n_jobs,))
+    if chunk_size is not None and chunk_size < 1:
+        raise ValueError("chunk_size should be a positive integer, got %r"
+                         % (chunk_size,))
+    return _parallel_fit_gen(model, single_voxel_fit, data, mask, engine,
+                             n_jobs, chunk_size)
+
+
+def _parallel_fit_gen(model, single_voxel_fit, data, mask, engine, n_jobs,
+                      chunk_size):
+    voxels = np.array(np.nonzero(mask)).T
+    n = len(voxels)
+    if n == 0:
+        return
+    if chunk_size is None:
+        chunk_size = int(np.ceil(n / (4. * n_jobs)))
+    bounds = [(start, min(start + chunk_size, n))
+              for start in range(0, n, chunk_size)]
+
+    if engine == 'thread':
+        def fit_chunk(bounds):
+            start, end = bounds
+            return [single_voxel_fit(model, data[tuple(ijk)])
+                    for ijk in voxels[start:end]]
+
+        pool = ThreadPool(n_jobs)
+        try:
+            for fits in pool.imap(fit_chunk, bounds):
+                for fit in fits:
+                    yield fit
+        finally:
+            pool.close()
+            pool.join()
+        return
+
+    with TemporaryDirectory() as tmpdir:
+        data_file_name = path.join(tmpdir, 'data.npy')
+        masked = open_memmap(data_file_name, mode='w+', dtype=data.dtype,
+                             shape=(n, data.shape[-1]))
+        # Copy chunk by chunk so that ``data`` may itself be a memmap
+        for start, end in bounds:
+            masked[start:end] = data[tuple(voxels[start:end].T)]
+        masked.flush()
+        del masked
+
+        pool = Pool(n_jobs, initializer=_init_fit_worker,
+                    initargs=(model, single_voxel_fit.__name__,
+                              data_file_name))
+        try:
+            for fits in pool.imap(_fit_chunk, bounds):
+                for fit in fits:
+                    # Fits come back with their own unpickled copy of the
+                    # model, point them to the model of this process.
+                    if getattr(fit, 'model', None) is not None:
+                        try:
+                            fit.model = model
+                        except AttributeError:
+                            pass
+                    yield fit
+        finally:
+            pool.close()
+            # Make sure all worker processes have exited before removing the
+            # temporary directory, needed on windows
+            pool.join()
+
+
+def _gather_fits(model, voxel_fits, mask):
+    """Collect the single voxel fits of the voxels in ``mask``
+
+    Fit classes defining ``_fit_params`` are gathered in the dense parameter
+    arrays of a ``MultiVoxelArrayFit``, so that the single voxel fit objects
+    are discarded as soon as their parameters are copied. Other fits are
+    kept in the object array of a ``MultiVoxelFit``.
+    """
+    voxel_fits = iter(voxel_fits)
+    first = next(voxel_fits, None)
+    param_names = getattr(first, '_fit_params', None)
+    if param_names is None:
+        fit_array = np.empty(mask.shape, dtype=object)
+        if first is not None:
+            voxels = zip(*np.nonzero(mask))
+            fit_array[next(voxels)] = first
+            for ijk, fit in zip(voxels, voxel_fits):
+                fit_array[ijk] = fit
+        return MultiVoxelFit(model, fit_array, mask)
+
+    n = np.count_nonzero(mask)
+    params = []
+    for name in param_names:
+        value = np.asarray(getattr(first, name))
+        params.append(np.empty((n,) + value.shape, dtype=value.dtype))
+    for i, fit in enumerate(chain([first], voxel_fits)):
+        for name, param in zip(param_names, params):
+            param[i] = getattr(fit, name)
+    return MultiVoxelArrayFit(model, type(first)(model, *params), mask)
+
+
 class MultiVoxelFit(ReconstFit):
     """Holds an array of fits and allows access to their attributes and
     methods"""
@@ -99,6 +304,92 @@ class MultiVoxelFit(ReconstFit):
         return result
 
 
+class MultiVoxelArrayFit(ReconstFit):
+    """Holds the parameters of many single voxel fits in dense arrays
+
+    ``voxel_fit`` is an instance of the single voxel fit class whose
+    parameters have a leading dimension running over the voxels of ``mask``
+    (in C order). Attributes and methods of the voxel fit are evaluated once
+    for all voxels, and their per voxel results are put back in an array
+    with the shape of the mask, zero outside of it.
+    """
+    def __init__(self, model, voxel_fit, mask):
+        self.model = model
+        self.voxel_fit = voxel_fit
+        self.mask = mask
+
+    @property
+    def shape(self):
+        return self.mask.shape
+
+    @auto_attr
+    def fit_array(self):
+        """The single voxel fits in an object array with the shape of the
+        fit, as in ``MultiVoxelFit``, None outside of the mask"""
+        voxel_fit = self.voxel_fit
+        params = [getattr(voxel_fit, name) for name in voxel_fit._fit_params]
+        fit_array = np.empty(self.mask.shape, dtype=object)
+        for i, ijk in enumerate(zip(*np.nonzero(self.mask))):
+            fit_array[ijk] = type(voxel_fit)(self.model,
+                                             *[p[i] for p in params])
+        return fit_array
+
+    def _unmask(self, value):
+        n = np.count_nonzero(self.mask)
+        if not isinstance(value, np.ndarray) or value.shape[:1] != (n,):
+            return value
+        result = np.zeros(self.mask.shape + value.shape[1:],
+                          dtype=value.dtype)
+        result[self.mask] = value
+        return result
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') or attr == 'voxel_fit':
+            raise AttributeError(attr)
+        value = getattr(self.voxel_fit, attr)
+        if not callable(value):
+            return self._unmask(value)
+
+        def method(*args, **kwargs):
+            return self._unmask(value(*args, **kwargs))
+        return method
+
+    def __getitem__(self, index):
+        position = np.full(self.mask.shape, -1, dtype=np.intp)
+        position[self.mask] = np.arange(np.count_nonzero(self.mask))
+        position = position[index]
+        voxel_fit = self.voxel_fit
+        params = [getattr(voxel_fit, name) for name in voxel_fit._fit_params]
+        if np.ndim(position) == 0:
+            if position < 0:
+                return None
+            return type(voxel_fit)(self.model,
+                                   *[p[position] for p in params])
+        mask = position >= 0
+        position = position[mask]
+        return MultiVoxelArrayFit(self.model,
+                                  type(voxel_fit)(self.model,
+                                                  *[p[position]
+                                                    for p in params]),
+                                  mask)
+
+    def predict(self, *args, **kwargs):
+        """
+        Predict the signal of all voxels at once, with S0 provided as a
+        scalar or as an array whose leading dimensions have the shape of the
+        fit.
+        """
+        if not hasattr(self.voxel_fit, 'predict'):
+            msg = "This model does not have prediction implemented yet"
+            raise NotImplementedError(msg)
+        S0 = kwargs.get('S0')
+        if (isinstance(S0, np.ndarray) and
+                S0.shape[:self.mask.ndim] == self.mask.shape):
+            S0 = S0[self.mask]
+            kwargs['S0'] = S0[:, None] if S0.ndim == 1 else S0
+        return self._unmask(self.voxel_fit.predict(*args, **kwargs))
+
+
 class CallableArray(np.ndarray):
     """An array which can be called like a function"""
     def __call__(self, *args, **kwargs):
@@ -88,9 +88,6 @@ cdef class PeaksAndMetricsDirectionGetter(DirectionGetter):
         return res
 
 
-    @cython.initializedcheck(False)
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
     cpdef int get_direction(self,
                             double[::1] point,
                             double[::1] direction) except -1:
@@ -102,18 +99,28 @@ cdef class PeaksAndMetricsDirectionGetter(DirectionGetter):
         """
         if not self.initialized:
             self._initialize()
+        return self.get_direction_c(&point[0], &direction[0])
 
+    @cython.initializedcheck(False)
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int get_direction_c(self, double *point,
+                             double *direction) nogil except -1:
         cdef:
             np.npy_intp s
             double newdirection[3]
             np.npy_intp qa_shape[4]
             np.npy_intp qa_strides[4]
 
+        if not self.initialized:
+            with gil:
+                self._initialize()
+
         for i in range(4):
             qa_shape[i] = self._qa.shape[i]
             qa_strides[i] = self._qa.strides[i]
 
-        s = _propagation_direction(&point[0], &direction[0],
+        s = _propagation_direction(point, direction,
                                    &self._qa[0, 0, 0, 0],
                                    &self._ind[0, 0, 0, 0],
                                    &self._odf_vertices[0, 0], self.qa_thr,
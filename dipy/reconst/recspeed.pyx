@@ -10,8 +10,11 @@ cimport cython
 import numpy as np
 cimport numpy as cnp
 
+from cython.parallel import parallel, prange
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
 from libc.stdlib cimport malloc, free
-from libc.string cimport memcpy
+from libc.string cimport memcpy, memset
 
 cdef extern from "dpy_math.h" nogil:
     double floor(double x)
@@ -317,8 +320,14 @@ def local_maxima(cnp.ndarray odf, cnp.ndarray edges):
 @cython.boundscheck(False)
 cdef void _cosort(double[::1] A, cnp.npy_intp[::1] B) nogil:
     """Sorts `A` in-place and applies the same reordering to `B`"""
+    if A.shape[0] > 0:
+        _cosort_ptr(&A[0], &B[0], A.shape[0])
+
+
+cdef void _cosort_ptr(double *A, cnp.npy_intp *B, size_t n) nogil:
+    """Sorts the `n` values of `A` in-place and applies the same reordering
+    to `B`"""
     cdef:
-        size_t n = A.shape[0]
         size_t hole
         double insert_A
         long insert_B
@@ -335,6 +344,142 @@ cdef void _cosort(double[::1] A, cnp.npy_intp[::1] B) nogil:
         B[hole] = insert_B
 
 
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def batch_peak_directions(double[:, ::1] odfs, cnp.uint16_t[:, :] edges,
+                          double[:, ::1] vertices,
+                          double relative_peak_threshold,
+                          double min_separation_angle, int npeaks,
+                          num_threads=None):
+    """Peak directions of many ODFs evaluated on the same sphere
+
+    Finds in every row of `odfs` the same peaks as
+    ``dipy.direction.peaks.peak_directions``, keeping at most `npeaks` of
+    them. The ODFs are processed in parallel, without the GIL.
+
+    Parameters
+    ----------
+    odfs : array (N, M), dtype=double
+        The ODFs of N voxels evaluated on the M vertices of a sphere.
+    edges : array (E, 2), dtype=uint16
+        The neighbor relations between the vertices of the sphere.
+    vertices : array (M, 3), dtype=double
+        The vertices of the sphere.
+    relative_peak_threshold : float
+        Only peaks greater than ``min + relative_peak_threshold *
+        (max - min)`` are kept, where ``min`` is the minimum of the ODF (or 0
+        if it is negative) and ``max`` its largest peak.
+    min_separation_angle : float in [0, 90]
+        The minimum angle between peaks, in degrees. Of two peaks too close,
+        only the larger one is kept.
+    npeaks : int
+        Maximum number of peaks returned for each ODF.
+    num_threads : int, optional
+        Number of threads. If None (default), the value of the
+        OMP_NUM_THREADS environment variable, or else all cores, are used.
+
+    Returns
+    -------
+    directions : array (N, npeaks, 3)
+        The directions of the peaks of each ODF, padded with zeros.
+    values : array (N, npeaks)
+        The values of the peaks, in descending order, padded with zeros.
+    indices : array (N, npeaks)
+        The indices of the vertices of the peaks, padded with -1.
+    """
+    cdef:
+        cnp.npy_intp n_odfs = odfs.shape[0]
+        cnp.npy_intp n_vertices = odfs.shape[1]
+        cnp.npy_intp i, j, k, count, n, n_unique
+        double odf_min, threshold, sim
+        double cos_similarity = cos(DPY_PI / 180 * min_separation_angle)
+        double *values_buf
+        cnp.npy_intp *wpeak_buf
+        double[:, :, ::1] directions
+        double[:, ::1] values
+        cnp.npy_intp[:, ::1] indices
+        char[::1] failed
+
+    if vertices.shape[0] != n_vertices:
+        raise ValueError("odfs should have one column per vertex")
+    if edges.shape[0] and np.asarray(edges).max() >= n_vertices:
+        raise IndexError("Values in edges must be < len(odf)")
+    directions_arr = np.zeros((n_odfs, npeaks, 3))
+    values_arr = np.zeros((n_odfs, npeaks))
+    indices_arr = np.empty((n_odfs, npeaks), dtype=np.intp)
+    indices_arr.fill(-1)
+    failed_arr = np.zeros(n_odfs, dtype=np.int8)
+    directions = directions_arr
+    values = values_arr
+    indices = indices_arr
+    failed = failed_arr
+    if n_odfs == 0 or n_vertices == 0:
+        return directions_arr, values_arr, indices_arr
+
+    set_num_threads(num_threads)
+    with nogil, parallel():
+        values_buf = <double *> malloc(n_vertices * sizeof(double))
+        wpeak_buf = <cnp.npy_intp *> malloc(n_vertices *
+                                            sizeof(cnp.npy_intp))
+        for i in prange(n_odfs, schedule='guided'):
+            # Local maxima, sorted in descending order
+            memset(wpeak_buf, 0, n_vertices * sizeof(cnp.npy_intp))
+            count = _compare_neighbors(odfs[i], edges, wpeak_buf)
+            if count < 0:
+                failed[i] = 1
+                continue
+            for j in range(count):
+                values_buf[j] = odfs[i, wpeak_buf[j]]
+            _cosort_ptr(values_buf, wpeak_buf, count)
+            if count == 0 or values_buf[0] < 0.:
+                continue
+
+            # Remove small peaks
+            n = count
+            if count > 1:
+                odf_min = odfs[i, 0]
+                for j in range(1, n_vertices):
+                    if odfs[i, j] < odf_min:
+                        odf_min = odfs[i, j]
+                if odf_min < 0.:
+                    odf_min = 0.
+                threshold = relative_peak_threshold * (values_buf[0] -
+                                                       odf_min)
+                n = 0
+                while n < count and values_buf[n] - odf_min >= threshold:
+                    n = n + 1
+
+            # Remove peaks too close to a larger one
+            n_unique = 0
+            for j in range(n):
+                if n_unique == npeaks:
+                    break
+                for k in range(n_unique):
+                    sim = fabs(vertices[wpeak_buf[j], 0] *
+                               directions[i, k, 0] +
+                               vertices[wpeak_buf[j], 1] *
+                               directions[i, k, 1] +
+                               vertices[wpeak_buf[j], 2] *
+                               directions[i, k, 2])
+                    if sim > cos_similarity:
+                        break
+                else:
+                    directions[i, n_unique, 0] = vertices[wpeak_buf[j], 0]
+                    directions[i, n_unique, 1] = vertices[wpeak_buf[j], 1]
+                    directions[i, n_unique, 2] = vertices[wpeak_buf[j], 2]
+                    values[i, n_unique] = values_buf[j]
+                    indices[i, n_unique] = wpeak_buf[j]
+                    n_unique = n_unique + 1
+        free(values_buf)
+        free(wpeak_buf)
+    if num_threads is not None:
+        restore_default_num_threads()
+
+    if failed_arr.any():
+        raise ValueError("odf can not have nans")
+    return directions_arr, values_arr, indices_arr
+
+
 @cython.wraparound(False)
 @cython.boundscheck(False)
 cdef long _compare_neighbors(double[:] odf, cnp.uint16_t[:, :] edges,
@@ -16,6 +16,9 @@ This is an implementation of the sparse fascicle model described in
    models at multiple b-values with cross-validation. ISMRM 2014.
 """
 import warnings
+import copy
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
@@ -310,9 +313,12 @@ class SparseFascicleModel(ReconstModel, Cache):
         solver : string, dipy.core.optimize.SKLearnLinearSolver object, or sklearn.linear_model.base.LinearModel object, optional.
             This will determine the algorithm used to solve the set of linear
             equations underlying this model. If it is a string it needs to be
-            one of the following: {'ElasticNet', 'NNLS'}. Otherwise, it can be
-            an object that inherits from `dipy.optimize.SKLearnLinearSolver`.
-            Default: 'ElasticNet'.
+            one of the following: {'ElasticNet', 'BatchElasticNet', 'NNLS'}.
+            'BatchElasticNet' solves the same non-negative elastic net as
+            'ElasticNet' for many voxels at once (see
+            `dipy.core.optimize.NonNegativeElasticNet`) and does not require
+            sklearn. Otherwise, it can be an object that inherits from
+            `dipy.optimize.SKLearnLinearSolver`. Default: 'ElasticNet'.
         l1_ratio : float, optional
             Sets the balance betwee L1 and L2 regularization in ElasticNet
             [Zou2005]_. Default: 0.5
@@ -352,6 +358,9 @@ class SparseFascicleModel(ReconstModel, Cache):
         if solver == 'ElasticNet':
             self.solver = lm.ElasticNet(l1_ratio=l1_ratio, alpha=alpha,
                                         positive=True, warm_start=True)
+        elif solver == 'BatchElasticNet':
+            self.solver = opt.NonNegativeElasticNet(l1_ratio=l1_ratio,
+                                                    alpha=alpha)
         elif solver == 'NNLS' or solver == 'nnls':
             self.solver = opt.NonNegativeLeastSquares()
 
@@ -361,7 +370,7 @@ class SparseFascicleModel(ReconstModel, Cache):
 
         else:
             e_s = "The `solver` key-word argument needs to be: "
-            e_s += "'ElasticNet', 'NNLS', or a "
+            e_s += "'ElasticNet', 'BatchElasticNet', 'NNLS', or a "
             e_s += "`dipy.optimize.SKLearnLinearSolver` object"
             raise ValueError(e_s)
 
@@ -379,7 +388,7 @@ class SparseFascicleModel(ReconstModel, Cache):
         return sfm_design_matrix(self.gtab, self.sphere, self.response,
                                  'signal')
 
-    def fit(self, data, mask=None):
+    def fit(self, data, mask=None, n_jobs=1, chunk_size=1000):
         """
         Fit the SparseFascicleModel object to data.
 
@@ -393,6 +402,14 @@ class SparseFascicleModel(ReconstModel, Cache):
             should be analyzed. Has the shape `data.shape[:-1]`. Default: None,
             which implies that all points should be analyzed.
 
+        n_jobs : int, optional
+            Number of threads fitting chunks of voxels in parallel. None uses
+            all the cpus. Default: 1
+
+        chunk_size : int, optional
+            Number of voxels in a chunk. With the 'BatchElasticNet' solver,
+            all the voxels of a chunk are solved together. Default: 1000
+
         Returns
         -------
         SparseFascicleFit object
@@ -417,13 +434,33 @@ class SparseFascicleModel(ReconstModel, Cache):
                                 self.design_matrix.shape[-1]))
 
         isopredict = isotropic.predict()
-        for vox, vox_data in enumerate(flat_S):
-            # In voxels in which S0 is 0, we just want to keep the
-            # parameters at all-zeros, and avoid nasty sklearn errors:
-            if not (np.any(~np.isfinite(vox_data)) or np.all(vox_data == 0)):
-                fit_it = vox_data - isopredict[vox]
-                flat_params[vox] = self.solver.fit(self.design_matrix,
-                                                   fit_it).coef_
+        # In voxels in which S0 is 0, we just want to keep the
+        # parameters at all-zeros, and avoid nasty sklearn errors:
+        to_fit = ~(np.any(~np.isfinite(flat_S), -1) |
+                   np.all(flat_S == 0, -1))
+        fit_it = flat_S[to_fit] - isopredict[to_fit]
+        chunks = [fit_it[i:i + chunk_size]
+                  for i in range(0, fit_it.shape[0], chunk_size)]
+        if n_jobs == 1 or len(chunks) < 2:
+            chunk_params = [_fit_chunk(self.solver, self.design_matrix,
+                                       chunk) for chunk in chunks]
+        else:
+            # Every thread gets its own copy of the solver, which holds the
+            # state of the last fit. The design matrix is factorized once,
+            # the copies share its factors:
+            if isinstance(self.solver, opt.NonNegativeElasticNet):
+                self.solver._factorize(self.design_matrix)
+            pool = ThreadPool(n_jobs or cpu_count())
+            try:
+                chunk_params = pool.map(
+                    lambda chunk: _fit_chunk(copy.deepcopy(self.solver),
+                                             self.design_matrix, chunk),
+                    chunks)
+            finally:
+                pool.close()
+                pool.join()
+        if len(chunks):
+            flat_params[to_fit] = np.concatenate(chunk_params)
 
         if mask is None:
             out_shape = data.shape[:-1] + (-1, )
@@ -439,6 +476,19 @@ class SparseFascicleModel(ReconstModel, Cache):
         return SparseFascicleFit(self, beta, S0, isotropic)
 
 
+def _fit_chunk(solver, design_matrix, chunk):
+    """Fit the solver to the signals of a chunk of voxels, shape (n_voxels,
+    n_dwi), one voxel at a time unless the solver handles many signals"""
+    if isinstance(solver, opt.NonNegativeElasticNet):
+        return solver.fit(design_matrix, chunk.T).coef_
+    # Solvers with a warm start may update their coefficients in place at
+    # the next fit, so those of each voxel are copied in params:
+    params = np.zeros((chunk.shape[0], design_matrix.shape[-1]))
+    for vox, vox_data in enumerate(chunk):
+        params[vox] = solver.fit(design_matrix, vox_data).coef_
+    return params
+
+
 class SparseFascicleFit(ReconstFit):
     def __init__(self, model, beta, S0, iso):
         """
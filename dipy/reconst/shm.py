@@ -32,7 +32,7 @@ from numpy.random import randint
 from dipy.reconst.odf import OdfModel, OdfFit
 from dipy.core.geometry import cart2sphere
 from dipy.core.onetime import auto_attr
-from dipy.reconst.cache import Cache
+from dipy.reconst.cache import Cache, cached_basis
 
 from distutils.version import LooseVersion
 import scipy
@@ -239,6 +239,7 @@ def real_sph_harm(m, n, theta, phi):
     return real_sh
 
 
+@cached_basis
 def real_sym_sh_mrtrix(sh_order, theta, phi):
     """
     Compute real spherical harmonics as in mrtrix, where the real harmonic
@@ -282,6 +283,7 @@ def real_sym_sh_mrtrix(sh_order, theta, phi):
     return real_sh, m, n
 
 
+@cached_basis
 def real_sym_sh_basis(sh_order, theta, phi):
     """Samples a real symmetric spherical harmonic basis at point on the sphere
 
@@ -585,13 +587,23 @@ class SphHarmFit(OdfFit):
 
         return SphHarmFit(self.model, new_coef, new_mask)
 
-    def odf(self, sphere):
+    def odf(self, sphere, chunk_size=None, dtype=None, out=None):
         """Samples the odf function on the points of a sphere
 
         Parameters
         ----------
         sphere : Sphere
             The points on which to sample the odf.
+        chunk_size : int, optional
+            If given, the odfs are evaluated for chunks of `chunk_size`
+            voxels at a time (see `iter_odf`), so that the temporary arrays
+            stay small.
+        dtype : dtype, optional
+            Data type of the odfs, e.g. ``np.float32`` to halve their memory.
+            Default: the data type of the coefficients.
+        out : ndarray, optional
+            Array of shape ``self.shape + (len(sphere.vertices),)``, e.g. a
+            memory-mapped array, in which the odfs are written chunk by chunk.
 
         Returns
         -------
@@ -600,7 +612,57 @@ class SphHarmFit(OdfFit):
 
         """
         B = self.model.sampling_matrix(sphere)
-        return dot(self._shm_coef, B.T)
+        if chunk_size is None and out is None:
+            if dtype is None:
+                return dot(self._shm_coef, B.T)
+            return dot(self._shm_coef.astype(dtype), B.T.astype(dtype))
+        if out is None:
+            out = np.empty(self.shape + (B.shape[0],),
+                           dtype=dtype or self._shm_coef.dtype)
+        for index, odf in self.iter_odf(sphere, chunk_size or 10000,
+                                        dtype=dtype or out.dtype):
+            out[index] = odf
+        return out
+
+    def iter_odf(self, sphere, chunk_size=10000, dtype=np.float32):
+        """Samples the odf function on a sphere for chunks of voxels
+
+        Only the odfs of `chunk_size` voxels are held at a time, so that the
+        odfs of a whole volume never need to be fully materialized. For
+        example, the gfa of the odfs can be computed with::
+
+            gfa_map = np.zeros(fit.shape)
+            for index, odf in fit.iter_odf(sphere):
+                gfa_map[index] = gfa(odf)
+
+        Parameters
+        ----------
+        sphere : Sphere
+            The points on which to sample the odf.
+        chunk_size : int, optional
+            Number of voxels of each chunk. Default: 10000
+        dtype : dtype, optional
+            Data type of the odfs. Default: ``np.float32``.
+
+        Yields
+        ------
+        index : tuple of arrays
+            The indices of the voxels of the chunk in the fit, or
+            ``Ellipsis`` for the fit of a single voxel.
+        values : ndarray (chunk_size, len(sphere.vertices))
+            The value of the odf of these voxels on each point of `sphere`.
+        """
+        B = self.model.sampling_matrix(sphere).T.astype(dtype)
+        shape = self.shape
+        if shape == ():
+            yield Ellipsis, dot(self._shm_coef.astype(dtype), B)
+            return
+        n = int(np.prod(shape))
+        coef = self._shm_coef.reshape((n, -1))
+        for start in range(0, n, chunk_size):
+            end = min(start + chunk_size, n)
+            index = np.unravel_index(np.arange(start, end), shape)
+            yield index, dot(coef[start:end].astype(dtype), B)
 
     @auto_attr
     def gfa(self):
@@ -7,8 +7,8 @@ import numpy as np
 
 from scipy.special import genlaguerre, gamma, hyp2f1
 
-from .cache import Cache
-from .multi_voxel import multi_voxel_fit
+from .cache import Cache, cached_basis
+from .multi_voxel import multi_voxel_fit, MultiVoxelArrayFit
 from .shm import real_sph_harm
 from ..core.geometry import cart2sphere
 
@@ -18,6 +18,9 @@ cvxopt, have_cvxopt, _ = optional_package("cvxopt")
 if have_cvxopt:
     import cvxopt.solvers
 
+# Number of voxels whose coefficients are computed by a single matrix product
+_VOXEL_BLOCK = 10000
+
 class ShoreModel(Cache):
 
     r"""Simple Harmonic Oscillator based Reconstruction and Estimation
@@ -192,39 +195,119 @@ class ShoreModel(Cache):
         self.pos_grid = pos_grid
         self.pos_radius = pos_radius
 
-    @multi_voxel_fit
-    def fit(self, data):
+    def fit(self, data, mask=None, **kwargs):
+        """ Fit the model to the signal of one voxel or of many voxels.
 
-        Lshore = l_shore(self.radial_order)
-        Nshore = n_shore(self.radial_order)
+        Without the positivity constraint the coefficients are linear in the
+        signal (affine with the E(0) constraint), and the coefficients of the
+        voxels are computed by blocks with a single matrix product per
+        block. With the positivity constraint every voxel is solved by
+        CVXOPT.
+
+        Parameters
+        ----------
+        data : array
+            The measured signal, with the measurements along the last
+            dimension.
+        mask : array (optional)
+            A boolean array with the shape data.shape[:-1] selecting the
+            voxels to fit.
+        kwargs : dict
+            With the positivity constraint, passed to the multi voxel
+            decorator, e.g. to select a parallel ``engine``.
+
+        Returns
+        -------
+        ShoreFit or MultiVoxelArrayFit
+        """
+        if self.positive_constraint:
+            return self._fit_voxel(data, mask, **kwargs)
+
+        if mask is None:
+            mask = np.ones(data.shape[:-1], dtype=bool)
+        elif mask.shape != data.shape[:-1]:
+            raise ValueError("mask and data shape do not match")
+        else:
+            mask = np.asarray(mask, dtype=bool)
+
+        signal = np.reshape(data[mask], (-1, data.shape[-1]))
+        coef = np.empty((signal.shape[0], self._shore_matrix().shape[1]))
+        for start in range(0, signal.shape[0], _VOXEL_BLOCK):
+            block = slice(start, start + _VOXEL_BLOCK)
+            coef[block] = self._linear_fit(signal[block])
+
+        if data.ndim == 1:
+            return ShoreFit(self, coef[0])
+        return MultiVoxelArrayFit(self, ShoreFit(self, coef), mask)
+
+    def _shore_matrix(self):
         # Generate the SHORE basis
         M = self.cache_get('shore_matrix', key=self.gtab)
         if M is None:
             M = shore_matrix(
                 self.radial_order,  self.zeta, self.gtab, self.tau)
             self.cache_set('shore_matrix', self.gtab, M)
+        return M
 
-        MpseudoInv = self.cache_get('shore_matrix_reg_pinv', key=self.gtab)
-        if MpseudoInv is None:
-            MpseudoInv = np.dot(
-                np.linalg.inv(np.dot(M.T, M) + self.lambdaN * Nshore + self.lambdaL * Lshore), M.T)
-            self.cache_set('shore_matrix_reg_pinv', self.gtab, MpseudoInv)
+    def _regularization(self):
+        return (self.lambdaN * n_shore(self.radial_order) +
+                self.lambdaL * l_shore(self.radial_order))
 
-        # Compute the signal coefficients in SHORE basis
+    def _linear_fit(self, data):
+        """Coefficients of the signals ``data`` (n_voxels, N) without the
+        positivity constraint."""
+        M = self._shore_matrix()
         if not self.constrain_e0:
-            coef = np.dot(MpseudoInv, data)
+            MpseudoInv = self.cache_get('shore_matrix_reg_pinv',
+                                        key=self.gtab)
+            if MpseudoInv is None:
+                MpseudoInv = np.dot(np.linalg.inv(np.dot(M.T, M) +
+                                                  self._regularization()),
+                                    M.T)
+                self.cache_set('shore_matrix_reg_pinv', self.gtab,
+                               MpseudoInv)
+            coef = np.dot(data, MpseudoInv.T)
+
+            n = np.arange(int(self.radial_order / 2) + 1)
+            e0_weights = np.array(
+                [genlaguerre(i, 0.5)(0) for i in n]) * np.sqrt(
+                    np.array([factorial(i) for i in n], dtype=float) /
+                    (2 * np.pi * (self.zeta ** 1.5) * gamma(n + 1.5)))
+            signal_0 = np.dot(coef[:, :len(n)], e0_weights)
+            return coef / signal_0[:, None]
+
+        # The quadratic program of ``_fit_voxel`` with the only equality
+        # constraint E(0) = 1 is solved in closed form from its KKT system:
+        # coef = u - w (A u - 1) / (A w), with u = Q^-1 M'^T d and
+        # w = Q^-1 A^T
+        kkt = self.cache_get('shore_matrix_e0_kkt', key=self.gtab)
+        if kkt is None:
+            M0_mean = M[self.gtab.b0s_mask, :].mean(0)
+            Mprime = np.r_[M0_mean[None, :], M[~self.gtab.b0s_mask, :]]
+            Q = np.dot(Mprime.T, Mprime) + self._regularization()
+            Qinv = np.linalg.solve(Q, np.c_[Mprime.T, M0_mean])
+            kkt = (Qinv[:, :-1], Qinv[:, -1], M0_mean)
+            self.cache_set('shore_matrix_e0_kkt', self.gtab, kkt)
+        Qinv_Mprime, w, M0_mean = kkt
+
+        data_b0 = data[:, self.gtab.b0s_mask].mean(-1)
+        data_single_b0 = np.c_[np.ones(len(data)),
+                               data[:, ~self.gtab.b0s_mask] /
+                               data_b0[:, None]]
+        u = np.dot(data_single_b0, Qinv_Mprime.T)
+        nu = (np.dot(u, M0_mean) - 1) / np.dot(M0_mean, w)
+        return u - nu[:, None] * w
 
-            signal_0 = 0
+    @multi_voxel_fit
+    def _fit_voxel(self, data):
 
-            for n in range(int(self.radial_order / 2) + 1):
-                signal_0 += (
-                    coef[n] * (genlaguerre(n, 0.5)(0) * (
-                        (factorial(n)) /
-                        (2 * np.pi * (self.zeta ** 1.5) * gamma(n + 1.5))
-                    ) ** 0.5)
-                )
+        Lshore = l_shore(self.radial_order)
+        Nshore = n_shore(self.radial_order)
+        M = self._shore_matrix()
 
-            coef = coef / signal_0
+        # Compute the signal coefficients in SHORE basis
+        if not self.constrain_e0:
+            return ShoreFit(self, self._linear_fit(data[None])[0])
         else:
             data = data / data[self.gtab.b0s_mask].mean()
 
@@ -285,15 +368,19 @@ class ShoreModel(Cache):
 
 class ShoreFit():
 
+    # Parameters gathered in arrays by ``multi_voxel_fit``
+    _fit_params = ('_shore_coef',)
+
     def __init__(self, model, shore_coef):
-        """ Calculates diffusion properties for a single voxel
+        """ Calculates diffusion properties for a single voxel, or for many
+        voxels at once
 
         Parameters
         ----------
         model : object,
             AnalyticalModel
-        shore_coef : 1d ndarray,
-            shore coefficients
+        shore_coef : ndarray, shape (..., N)
+            shore coefficients, the leading dimensions run over voxels
         """
 
         self.model = model
@@ -336,9 +423,9 @@ class ShoreFit():
             self.model.cache_set(
                 'shore_matrix_pdf', (gridsize, radius_max), psi)
 
-        propagator = np.dot(psi, self._shore_coef)
-        eap = np.empty((gridsize, gridsize, gridsize), dtype=float)
-        eap[tuple(rgrid.astype(int).T)] = propagator
+        propagator = np.dot(self._shore_coef, psi.T)
+        eap = np.empty(propagator.shape[:-1] + (gridsize,) * 3, dtype=float)
+        eap[(Ellipsis,) + tuple(rgrid.astype(int).T)] = propagator
         eap *= (2 * radius_max / (gridsize - 1)) ** 3
 
         return eap
@@ -359,7 +446,7 @@ class ShoreFit():
                 self.model.cache_set(
                     'shore_matrix_pdf', hash(r_points.data), psi)
 
-        eap = np.dot(psi, self._shore_coef)
+        eap = np.dot(self._shore_coef, psi.T)
 
         return np.clip(eap, 0, eap.max())
 
@@ -370,7 +457,7 @@ class ShoreFit():
         J = (self.radial_order + 1) * (self.radial_order + 2) // 2
 
         # Compute the Spherical Harmonics Coefficients
-        c_sh = np.zeros(J)
+        c_sh = np.zeros(self._shore_coef.shape[:-1] + (J,))
         counter = 0
 
         for l in range(0, self.radial_order + 1, 2):
@@ -385,7 +472,8 @@ class ShoreFit():
                         l + 3.0 / 2.0) * factorial(n - l)) * (1.0 / 2.0) ** (-l / 2 - 3.0 / 2.0)
                     Fnl = hyp2f1(-n + l, l / 2 + 3.0 / 2.0, l + 3.0 / 2.0, 2.0)
 
-                    c_sh[j] += self._shore_coef[counter] * Cnl * Gnl * Fnl
+                    c_sh[..., j] += (self._shore_coef[..., counter] *
+                                     Cnl * Gnl * Fnl)
                     counter += 1
 
         return c_sh
@@ -399,7 +487,7 @@ class ShoreFit():
                 self.radial_order,  self.zeta, sphere.vertices)
             self.model.cache_set('shore_matrix_odf', sphere, upsilon)
 
-        odf = np.dot(upsilon, self._shore_coef)
+        odf = np.dot(self._shore_coef, upsilon.T)
         return odf
 
     def rtop_signal(self):
@@ -416,7 +504,7 @@ class ShoreFit():
         c = self._shore_coef
 
         for n in range(int(self.radial_order / 2) + 1):
-            rtop +=  c[n] * (-1) ** n * \
+            rtop += c[..., n] * (-1) ** n * \
                 ((16 * np.pi * self.zeta ** 1.5 * gamma(n + 1.5)) / (
                  factorial(n))) ** 0.5
 
@@ -435,7 +523,7 @@ class ShoreFit():
         rtop = 0
         c = self._shore_coef
         for n in range(int(self.radial_order / 2) + 1):
-            rtop += c[n] * (-1) ** n * \
+            rtop += c[..., n] * (-1) ** n * \
                 ((4 * np.pi ** 2 * self.zeta ** 1.5 * factorial(n)) / (gamma(n + 1.5))) ** 0.5 * \
                 genlaguerre(n, 0.5)(0)
 
@@ -461,7 +549,7 @@ class ShoreFit():
         c = self._shore_coef
 
         for n in range(int(self.radial_order / 2) + 1):
-            msd += c[n]  * (-1) ** n *\
+            msd += c[..., n] * (-1) ** n *\
                 (9 * (gamma(n + 1.5)) / (8 * np.pi ** 6  *  self.zeta ** 3.5 * factorial(n))) ** 0.5 *\
                 hyp2f1(-n, 2.5, 1.5, 2)
 
@@ -471,7 +559,7 @@ class ShoreFit():
         """ The fitted signal.
         """
         phi = self.model.cache_get('shore_matrix', key=self.model.gtab)
-        return np.dot(phi, self._shore_coef)
+        return np.dot(self._shore_coef, phi.T)
 
     @property
     def shore_coeff(self):
@@ -480,6 +568,7 @@ class ShoreFit():
         return self._shore_coef
 
 
+@cached_basis
 def shore_matrix(radial_order, zeta, gtab, tau=1 / (4 * np.pi ** 2)):
     r"""Compute the SHORE matrix for modified Merlet's 3D-SHORE [1]_
 
@@ -595,6 +684,7 @@ def _kappa_pdf(zeta, n, l):
     return np.sqrt((16 * np.pi ** 3 * zeta ** 1.5 * factorial(n - l)) / gamma(n + 1.5))
 
 
+@cached_basis
 def shore_matrix_odf(radial_order, zeta, sphere_vertices):
     r"""Compute the SHORE ODF matrix [1]_"
 
@@ -0,0 +1,347 @@
+# cython: wraparound=False, cdivision=True, boundscheck=False
+"""Closed-form eigen-decomposition of stacks of symmetric 3x3 matrices
+
+The tensors are given by their six unique elements in lower triangular order
+(Dxx, Dxy, Dyy, Dxz, Dyz, Dzz), as returned by
+``dipy.reconst.dti.lower_triangular``. All the tensors are processed in
+parallel, without the GIL.
+"""
+
+cimport cython
+
+import numpy as np
+cimport numpy as cnp
+
+from cython.parallel import parallel, prange
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
+from libc.math cimport sqrt, cos, acos, fabs, fmax, M_PI, NAN
+
+cnp.import_array()
+
+
+cdef inline void _eigvals(double a00, double a01, double a11, double a02,
+                          double a12, double a22, double *w) nogil:
+    """Eigenvalues of a symmetric 3x3 matrix, in descending order
+
+    Uses the trigonometric solution of the characteristic polynomial of the
+    deviatoric matrix (Smith, Communications of the ACM 1961).
+    """
+    cdef:
+        double m, b00, b11, b22, p2, p, q, r, phi
+    m = (a00 + a11 + a22) / 3.
+    b00 = a00 - m
+    b11 = a11 - m
+    b22 = a22 - m
+    p2 = (b00 * b00 + b11 * b11 + b22 * b22 +
+          2. * (a01 * a01 + a02 * a02 + a12 * a12)) / 6.
+    if p2 == 0:
+        w[0] = m
+        w[1] = m
+        w[2] = m
+        return
+    p = sqrt(p2)
+    # Half the determinant of the deviatoric matrix
+    q = 0.5 * (b00 * (b11 * b22 - a12 * a12) -
+               a01 * (a01 * b22 - a12 * a02) +
+               a02 * (a01 * a12 - b11 * a02))
+    r = q / (p2 * p)
+    if r <= -1:
+        phi = M_PI / 3.
+    elif r >= 1:
+        phi = 0
+    else:
+        phi = acos(r) / 3.
+    w[0] = m + 2. * p * cos(phi)
+    w[2] = m + 2. * p * cos(phi + 2. * M_PI / 3.)
+    w[1] = 3. * m - w[0] - w[2]
+
+
+cdef inline void _null_vector(double a00, double a01, double a11, double a02,
+                              double a12, double a22, double lam,
+                              double *v) nogil:
+    """Unit vector of the null space of the rank 2 matrix A - lam I
+
+    It is the largest of the cross products of the pairs of rows of the
+    matrix, which is the most accurate.
+    """
+    cdef:
+        double r0[3]
+        double r1[3]
+        double r2[3]
+        double c[3]
+        double n, nmax
+        int i
+    r0[0] = a00 - lam
+    r0[1] = a01
+    r0[2] = a02
+    r1[0] = a01
+    r1[1] = a11 - lam
+    r1[2] = a12
+    r2[0] = a02
+    r2[1] = a12
+    r2[2] = a22 - lam
+    v[0] = 1
+    v[1] = 0
+    v[2] = 0
+    nmax = 0
+    _cross(r0, r1, c)
+    n = c[0] * c[0] + c[1] * c[1] + c[2] * c[2]
+    if n > nmax:
+        nmax = n
+        v[0] = c[0]
+        v[1] = c[1]
+        v[2] = c[2]
+    _cross(r0, r2, c)
+    n = c[0] * c[0] + c[1] * c[1] + c[2] * c[2]
+    if n > nmax:
+        nmax = n
+        v[0] = c[0]
+        v[1] = c[1]
+        v[2] = c[2]
+    _cross(r1, r2, c)
+    n = c[0] * c[0] + c[1] * c[1] + c[2] * c[2]
+    if n > nmax:
+        nmax = n
+        v[0] = c[0]
+        v[1] = c[1]
+        v[2] = c[2]
+    if nmax > 0:
+        n = sqrt(nmax)
+        for i in range(3):
+            v[i] = v[i] / n
+
+
+cdef inline void _cross(double *a, double *b, double *c) nogil:
+    c[0] = a[1] * b[2] - a[2] * b[1]
+    c[1] = a[2] * b[0] - a[0] * b[2]
+    c[2] = a[0] * b[1] - a[1] * b[0]
+
+
+cdef inline double _quad(double a00, double a01, double a11, double a02,
+                         double a12, double a22, double *x,
+                         double *y) nogil:
+    """The bilinear form x^T A y"""
+    return (x[0] * (a00 * y[0] + a01 * y[1] + a02 * y[2]) +
+            x[1] * (a01 * y[0] + a11 * y[1] + a12 * y[2]) +
+            x[2] * (a02 * y[0] + a12 * y[1] + a22 * y[2]))
+
+
+cdef void _eigh3(double *t, double *w, double *vecs) nogil:
+    """Eigenvalues (descending) and eigenvectors of a symmetric 3x3 matrix
+
+    ``t`` holds the lower triangular elements of the matrix. The eigenvectors
+    are the columns of the row-major 3x3 array ``vecs``.
+
+    The eigenvector of the eigenvalue best separated from the others is the
+    null vector of A - lam I. The two others are found by a Jacobi rotation
+    of the restriction of the matrix to the plane orthogonal to it, which
+    stays accurate for degenerate eigenvalues.
+    """
+    cdef:
+        double a00, a01, a11, a02, a12, a22, scale
+        double lam[3]
+        double v[3]
+        double u[3]
+        double x[3]
+        double y[3]
+        double wk, muu, muw, mww, theta, tt, c, s, e1, e2, n
+        double evals[3]
+        double evecs[3][3]
+        int i, j, k, imax
+    scale = 0
+    for i in range(6):
+        if t[i] != t[i]:
+            # NaN elements
+            for j in range(3):
+                w[j] = NAN
+            for j in range(9):
+                vecs[j] = NAN
+            return
+        scale = fmax(scale, fabs(t[i]))
+    if scale == 0:
+        for j in range(3):
+            w[j] = 0
+        for j in range(9):
+            vecs[j] = 0
+        vecs[0] = vecs[4] = vecs[8] = 1
+        return
+    a00 = t[0] / scale
+    a01 = t[1] / scale
+    a11 = t[2] / scale
+    a02 = t[3] / scale
+    a12 = t[4] / scale
+    a22 = t[5] / scale
+
+    _eigvals(a00, a01, a11, a02, a12, a22, lam)
+    if lam[0] - lam[1] >= lam[1] - lam[2]:
+        wk = lam[0]
+    else:
+        wk = lam[2]
+    _null_vector(a00, a01, a11, a02, a12, a22, wk, v)
+
+    # Orthonormal basis (u, x) of the plane orthogonal to v
+    imax = 0
+    if fabs(v[1]) < fabs(v[imax]):
+        imax = 1
+    if fabs(v[2]) < fabs(v[imax]):
+        imax = 2
+    y[0] = 0
+    y[1] = 0
+    y[2] = 0
+    y[imax] = 1
+    _cross(v, y, u)
+    n = sqrt(u[0] * u[0] + u[1] * u[1] + u[2] * u[2])
+    for i in range(3):
+        u[i] = u[i] / n
+    _cross(v, u, x)
+
+    # Jacobi rotation diagonalizing the 2x2 restriction of the matrix
+    muu = _quad(a00, a01, a11, a02, a12, a22, u, u)
+    muw = _quad(a00, a01, a11, a02, a12, a22, u, x)
+    mww = _quad(a00, a01, a11, a02, a12, a22, x, x)
+    if muw == 0:
+        tt = 0
+    else:
+        theta = (mww - muu) / (2. * muw)
+        tt = 1. / (fabs(theta) + sqrt(theta * theta + 1.))
+        if theta < 0:
+            tt = -tt
+    c = 1. / sqrt(tt * tt + 1.)
+    s = tt * c
+    e1 = muu - tt * muw
+    e2 = mww + tt * muw
+
+    evals[0] = _quad(a00, a01, a11, a02, a12, a22, v, v)
+    evals[1] = e1
+    evals[2] = e2
+    for i in range(3):
+        evecs[0][i] = v[i]
+        evecs[1][i] = c * u[i] - s * x[i]
+        evecs[2][i] = s * u[i] + c * x[i]
+
+    # Sort in descending order
+    for i in range(3):
+        imax = i
+        for j in range(i + 1, 3):
+            if evals[j] > evals[imax]:
+                imax = j
+        w[i] = evals[imax] * scale
+        for k in range(3):
+            vecs[3 * k + i] = evecs[imax][k]
+        evals[imax] = evals[i]
+        for k in range(3):
+            evecs[imax][k] = evecs[i][k]
+
+
+def eigh_3x3(double[:, ::1] tensor_elements, num_threads=None):
+    """Eigen-decomposition of symmetric 3x3 matrices
+
+    Parameters
+    ----------
+    tensor_elements : array (N, 6), dtype=double
+        The elements of the matrices in lower triangular order (Dxx, Dxy,
+        Dyy, Dxz, Dyz, Dzz).
+    num_threads : int, optional
+        Number of threads. If None (default), the value of the
+        OMP_NUM_THREADS environment variable, or else all cores, are used.
+
+    Returns
+    -------
+    evals : array (N, 3)
+        The eigenvalues, in descending order.
+    evecs : array (N, 3, 3)
+        The eigenvectors, evecs[i, :, j] is associated with evals[i, j].
+    """
+    cdef:
+        cnp.npy_intp i, n = tensor_elements.shape[0]
+        double[:, ::1] evals
+        double[:, :, ::1] evecs
+
+    if tensor_elements.shape[1] != 6:
+        raise ValueError("tensor_elements must have shape (N, 6)")
+    evals_arr = np.empty((n, 3))
+    evecs_arr = np.empty((n, 3, 3))
+    evals = evals_arr
+    evecs = evecs_arr
+
+    set_num_threads(num_threads)
+    with nogil, parallel():
+        for i in prange(n, schedule='static'):
+            _eigh3(&tensor_elements[i, 0], &evals[i, 0], &evecs[i, 0, 0])
+    if num_threads is not None:
+        restore_default_num_threads()
+    return evals_arr, evecs_arr
+
+
+cdef void _metrics(double *t, double min_diffusivity, double *out) nogil:
+    """FA, MD, AD, RD and mode of the tensor of lower triangular elements t"""
+    cdef:
+        double w[3]
+        double vecs[9]
+        double m, d0, d1, d2, norm2
+        int j
+    _eigh3(t, w, vecs)
+    if w[0] != w[0]:
+        for j in range(5):
+            out[j] = NAN
+        return
+    for j in range(3):
+        w[j] = fmax(w[j], min_diffusivity)
+    m = (w[0] + w[1] + w[2]) / 3.
+    d0 = w[0] - m
+    d1 = w[1] - m
+    d2 = w[2] - m
+    norm2 = d0 * d0 + d1 * d1 + d2 * d2
+    if w[0] == 0 and w[1] == 0 and w[2] == 0:
+        out[0] = 0
+    else:
+        out[0] = sqrt(1.5 * norm2 / (w[0] * w[0] + w[1] * w[1] + w[2] * w[2]))
+    out[1] = m
+    out[2] = w[0]
+    out[3] = 0.5 * (w[1] + w[2])
+    # 3 sqrt(6) det(A_dev / |A_dev|), NaN for isotropic tensors
+    out[4] = 3. * sqrt(6.) * d0 * d1 * d2 / (norm2 * sqrt(norm2))
+
+
+def tensor_metrics_3x3(double[:, ::1] tensor_elements,
+                       double min_diffusivity=0, num_threads=None):
+    """FA, MD, AD, RD and mode of diffusion tensors, in one pass
+
+    The eigenvalues of each tensor are computed, and all the metrics are
+    derived from them at once, without intermediate arrays.
+
+    Parameters
+    ----------
+    tensor_elements : array (N, 6), dtype=double
+        The elements of the tensors in lower triangular order (Dxx, Dxy,
+        Dyy, Dxz, Dyz, Dzz).
+    min_diffusivity : float, optional
+        Eigenvalues smaller than `min_diffusivity` are replaced with
+        `min_diffusivity`, as in ``dipy.reconst.dti.decompose_tensor``.
+    num_threads : int, optional
+        Number of threads. If None (default), the value of the
+        OMP_NUM_THREADS environment variable, or else all cores, are used.
+
+    Returns
+    -------
+    metrics : array (N, 5)
+        The fractional anisotropy, mean diffusivity, axial diffusivity,
+        radial diffusivity and mode of each tensor.
+    """
+    cdef:
+        cnp.npy_intp i, n = tensor_elements.shape[0]
+        double[:, ::1] out
+
+    if tensor_elements.shape[1] != 6:
+        raise ValueError("tensor_elements must have shape (N, 6)")
+    out_arr = np.empty((n, 5))
+    out = out_arr
+
+    set_num_threads(num_threads)
+    with nogil, parallel():
+        for i in prange(n, schedule='static'):
+            _metrics(&tensor_elements[i, 0], min_diffusivity, &out[i, 0])
+    if num_threads is not None:
+        restore_default_num_threads()
+    return out_arr
@@ -1,7 +1,17 @@
-from dipy.reconst.cache import Cache
+import copy
+
+import numpy as np
+from nibabel.tmpdirs import InTemporaryDirectory
+
+from dipy.reconst.cache import (Cache, BasisCache, basis_cache, cached_basis,
+                                content_key)
 from dipy.core.sphere import Sphere
+from dipy.core.gradients import gradient_table
+from dipy.data import get_sphere
+from dipy.reconst.shm import real_sym_sh_basis
 
-from numpy.testing import assert_, assert_equal, run_module_suite
+from numpy.testing import (assert_, assert_equal, assert_raises,
+                           run_module_suite)
 
 
 class TestModel(Cache):
@@ -24,5 +34,80 @@ def test_basic_cache():
     assert_(t.cache_get("design_matrix", s) is None)
 
 
+def test_content_key():
+    sphere = get_sphere('repulsion100')
+    bvals = np.array([0., 1000., 1000.])
+    bvecs = np.array([[0., 0., 0.], [1., 0., 0.], [0., 1., 0.]])
+    # Objects with the same content give the same key
+    assert_equal(content_key(gradient_table(bvals, bvecs), 8),
+                 content_key(gradient_table(bvals.copy(), bvecs.copy()), 8))
+    assert_equal(content_key(sphere, 0.5),
+                 content_key(copy.deepcopy(sphere),
+                             np.float64(0.5)))
+    assert_(content_key(sphere, 0.5) != content_key(sphere, 0.25))
+    assert_(content_key(np.zeros(2)) != content_key(np.zeros(2, 'f4')))
+    assert_(content_key(np.zeros((2, 1))) != content_key(np.zeros((1, 2))))
+    assert_raises(TypeError, content_key, object())
+
+
+def test_basis_cache():
+    c = BasisCache(max_bytes=2 * 80)
+    a, b, d = np.ones(10), np.zeros(10), np.arange(10.)
+    assert_(c.get('a') is None)
+    c.set('a', a)
+    c.set('b', b)
+    assert_(c.get('a') is a)
+    assert_(not a.flags.writeable)
+    # b is the least recently used value
+    c.set('d', d)
+    assert_(c.get('b') is None)
+    assert_(c.get('a') is a)
+    assert_(c.get('d') is d)
+    # Values larger than the budget are not kept
+    c.set('big', np.ones(100))
+    assert_(c.get('big') is None)
+    assert_equal(c.stats(), dict(hits=3, disk_hits=0, misses=3,
+                                 evictions=1, entries=2, nbytes=160))
+    c.clear()
+    assert_equal(c.stats()['entries'], 0)
+
+    with InTemporaryDirectory() as tmpdir:
+        c = BasisCache(cache_dir=tmpdir)
+        c.set('a', a)
+        # Another cache using the same directory, like in a worker process
+        c2 = BasisCache(cache_dir=tmpdir)
+        np.testing.assert_array_equal(c2.get('a'), a)
+        assert_equal(c2.stats()['disk_hits'], 1)
+        assert_(c2.get('b') is None)
+
+
+def test_cached_basis():
+    calls = []
+
+    @cached_basis
+    def basis(order, sphere):
+        calls.append(order)
+        return np.ones((len(sphere.vertices), order))
+
+    sphere = get_sphere('repulsion100')
+    B1 = basis(3, sphere)
+    B2 = basis(3, copy.deepcopy(sphere))
+    np.testing.assert_array_equal(B1, B2)
+    basis(4, sphere)
+    assert_equal(calls, [3, 4])
+    # Callers get copies, modifying them does not change the cache
+    B1 *= 2
+    np.testing.assert_array_equal(basis(3, sphere), B2)
+
+    # The spherical harmonics bases of equal points are shared
+    hits = basis_cache.stats()['hits']
+    theta, phi = sphere.theta, sphere.phi
+    B, m, n = real_sym_sh_basis(8, theta, phi)
+    B2 = real_sym_sh_basis(8, theta.copy(), phi.copy())[0]
+    np.testing.assert_array_equal(B2, B)
+    assert_equal(basis_cache.stats()['hits'], hits + 1)
+    B2[:, 0] *= 2
+
+
 if __name__ == "__main__":
     run_module_suite()
@@ -70,6 +70,34 @@ def test_dti_xval():
     npt.assert_array_almost_equal(np.round(cod2d[0, 0]), cod)
 
 
+def test_parallel_xval():
+    """
+    Test k-fold cross-validation of folds fitted in parallel
+    """
+    data = nib.load(fdata).get_data()[1:3, 1:3, 1:3].astype(float)
+    gtab = gt.gradient_table(fbval, fbvec)
+    dm = dti.TensorModel(gtab, 'LS')
+    mask = np.ones(data.shape[:-1], dtype=bool)
+    mask[0, 0, 0] = False
+
+    np.random.seed(2015)
+    serial = xval.kfold_xval(dm, data, 4, mask=mask)
+    np.random.seed(2015)
+    parallel = xval.kfold_xval(dm, data, 4, mask=mask, parallel=True,
+                               nbr_processes=2)
+    npt.assert_array_almost_equal(parallel, serial)
+
+    # The predictions can be written in a given array:
+    out = np.empty(data.shape)
+    np.random.seed(2015)
+    prediction = xval.kfold_xval(dm, data, 4, mask=mask, parallel=True,
+                                 nbr_processes=2, out=out)
+    npt.assert_(prediction is out)
+    npt.assert_array_almost_equal(out, serial)
+    npt.assert_raises(ValueError, xval.kfold_xval, dm, data, 4,
+                      out=np.empty(data.shape[1:]))
+
+
 def test_csd_xval():
     # First, let's see that it works with some data:
     data = nib.load(fdata).get_data()[1:3, 1:3, 1:3]  # Make it *small*
@@ -18,7 +18,9 @@ from dipy.reconst.csdeconv import (ConstrainedSphericalDeconvModel,
                                    odf_sh_to_sharp,
                                    auto_response,
                                    recursive_response,
-                                   response_from_mask)
+                                   response_from_mask,
+                                   csdeconv,
+                                   csdeconv_batch)
 from dipy.direction.peaks import peak_directions
 from dipy.core.sphere_stats import angular_similarity
 from dipy.reconst.dti import TensorModel, fractional_anisotropy
@@ -106,6 +108,16 @@ def test_recursive_response_calibration():
     FA_gt = fractional_anisotropy(evals)
     assert_almost_equal(FA, FA_gt, 1)
 
+    # The deconvolution threads give the same response
+    response_par = recursive_response(gtab, data, mask=None, sh_order=8,
+                                      peak_thr=0.01, init_fa=0.05,
+                                      init_trace=0.0021, iter=8,
+                                      convergence=0.001, parallel=True,
+                                      nbr_processes=2)
+    assert_array_almost_equal(response_par.dwi_response,
+                              response.dwi_response)
+    assert_almost_equal(response_par.S0, response.S0)
+
 
 def test_response_from_mask():
     fdata, fbvals, fbvecs = get_data('small_64D')
@@ -535,5 +547,50 @@ def test_csd_superres():
     assert_(all(cos_sim > .99))
 
 
+def test_csd_batch():
+    """ Check that the batch fit method matches the voxelwise fit. """
+    _, fbvals, fbvecs = get_data('small_64D')
+    bvals = np.load(fbvals)
+    bvecs = np.load(fbvecs)
+    gtab = gradient_table(bvals, bvecs)
+
+    mevals = np.array(([0.0015, 0.0003, 0.0003],
+                       [0.0015, 0.0003, 0.0003]))
+    response = (mevals[0], 100.)
+    data = np.zeros((3, 4, len(bvals)))
+    np.random.seed(1)
+    for i, angle in enumerate(np.linspace(0, 90, 12)):
+        S, _ = multi_tensor(gtab, mevals, 100., angles=[(0, 0), (angle, 0)],
+                            fractions=[50, 50], snr=30)
+        data[np.unravel_index(i, data.shape[:-1])] = S
+    mask = np.ones(data.shape[:-1], dtype=bool)
+    mask[1, 2] = False
+
+    model = ConstrainedSphericalDeconvModel(gtab, response)
+    model_batch = ConstrainedSphericalDeconvModel(gtab, response,
+                                                  fit_method='batch',
+                                                  block_size=5)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        fit = model.fit(data, mask)
+        fit_batch = model_batch.fit(data, mask)
+        fit_threads = model_batch.fit(data, mask, n_jobs=2)
+        fit_single = model_batch.fit(data[0, 0])
+    assert_array_almost_equal(fit_batch.shm_coeff, fit.shm_coeff)
+    assert_array_equal(fit_batch.shm_coeff[1, 2], 0)
+    assert_array_almost_equal(fit_threads.shm_coeff, fit_batch.shm_coeff)
+    assert_array_almost_equal(fit_single.shm_coeff, fit.shm_coeff[0, 0])
+
+    dwi = data[..., ~gtab.b0s_mask].reshape(-1, np.sum(~gtab.b0s_mask))
+    fodf_sh, num_it = csdeconv_batch(dwi, model._X, model.B_reg, model.tau)
+    for i in range(dwi.shape[0]):
+        expected = csdeconv(dwi[i], model._X, model.B_reg, model.tau)
+        assert_array_almost_equal(fodf_sh[i], expected[0])
+        assert_equal(num_it[i], expected[1])
+
+    npt.assert_raises(ValueError, ConstrainedSphericalDeconvModel, gtab,
+                      response, fit_method='unknown')
+
+
 if __name__ == '__main__':
     run_module_suite()
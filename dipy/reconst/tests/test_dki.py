@@ -14,6 +14,7 @@ from dipy.io.gradients import read_bvals_bvecs
 from dipy.core.gradients import gradient_table
 from dipy.data import get_data
 from dipy.reconst.dti import (from_lower_triangular, decompose_tensor)
+from dipy.reconst.vec_val_sum import vec_val_vect
 from dipy.reconst.dki import (mean_kurtosis, carlson_rf,  carlson_rd,
                               axial_kurtosis, radial_kurtosis, _positive_evals,
                               lower_triangular)
@@ -732,3 +733,20 @@ def test_multi_voxel_kurtosis_maximum():
     RK[1, 1, 1] = 0
     k_max = dki.kurtosis_maximum(dkiF.model_params, mask=mask)
     assert_almost_equal(k_max, RK, decimal=5)
+
+    # TEST - the voxels processed together give the same maxima as the
+    # voxels processed one by one, also when spread over worker processes
+    evals, evecs, kt = dki.split_dki_param(dkiF.model_params[mask])
+    dt = lower_triangular(vec_val_vect(evecs, evals))
+    md = dki.mean_diffusivity(evals)
+    for gtol in [1e-5, None]:
+        k_max_vox = [dki._voxel_kurtosis_maximum(dt[i], md[i], kt[i], sphere,
+                                                 gtol=gtol)[0]
+                     for i in range(len(kt))]
+        k_max, max_dir = dki._batch_kurtosis_maximum(dt, md, kt, sphere,
+                                                     gtol=gtol)
+        assert_array_almost_equal(k_max, np.squeeze(k_max_vox))
+    k_max = dkiF.kmax(sphere, mask=mask, n_jobs=1)
+    k_max_pool = dkiF.kmax(sphere, mask=mask, n_jobs=2, chunk_size=3)
+    assert_array_almost_equal(k_max_pool, k_max)
+    assert_almost_equal(k_max_pool, RK, decimal=5)
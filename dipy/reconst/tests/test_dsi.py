@@ -3,9 +3,11 @@ from numpy.testing import (assert_equal,
                            assert_almost_equal,
                            run_module_suite,
                            assert_array_equal,
+                           assert_array_almost_equal,
                            assert_raises)
 from dipy.data import get_data, dsi_voxels
-from dipy.reconst.dsi import DiffusionSpectrumModel
+from dipy.reconst.dsi import (DiffusionSpectrumModel, pdf_interp_coords,
+                              pdf_odf, pdf_odf_matrix)
 from dipy.reconst.odf import gfa
 from dipy.direction.peaks import peak_directions
 from dipy.sims.voxel import SticksAndBall
@@ -73,6 +75,35 @@ def test_multivox_dsi():
     assert_equal(np.alltrue(np.isreal(PDF)), True)
 
 
+def test_multivox_dsi_odf():
+    data, gtab = dsi_voxels()
+    data = data[:2, :2, 0]
+    mask = np.ones(data.shape[:-1], dtype=bool)
+    mask[0, 0] = False
+    DS = DiffusionSpectrumModel(gtab)
+    sphere = get_sphere('repulsion100')
+
+    DSfit = DS.fit(data, mask)
+    odf = DSfit.odf(sphere)
+    pdf = DSfit.pdf()
+    assert_equal(odf.shape, data.shape[:-1] + (len(sphere.vertices),))
+    assert_array_almost_equal(odf[~mask], 0)
+    for ijk in zip(*np.nonzero(mask)):
+        voxfit = DS.fit(data[ijk])
+        assert_array_almost_equal(odf[ijk], voxfit.odf(sphere))
+        assert_array_almost_equal(pdf[ijk], voxfit.pdf())
+        assert_array_almost_equal(DSfit.rtop_pdf()[ijk], voxfit.rtop_pdf())
+        assert_array_almost_equal(DSfit.msd_discrete()[ijk],
+                                  voxfit.msd_discrete())
+    assert_array_almost_equal(DSfit.odf(sphere, n_jobs=2), odf)
+
+    # The sparse odf matrix is the interpolation of pdf_odf
+    interp_coords = pdf_interp_coords(sphere, DS.qradius, DS.origin)
+    odf_matrix = pdf_odf_matrix(DS.qradius, interp_coords, pdf.shape[-3:])
+    assert_array_almost_equal(odf_matrix.dot(pdf[0, 1].ravel()),
+                              pdf_odf(pdf[0, 1], DS.qradius, interp_coords))
+
+
 def test_multib0_dsi():
     data, gtab = dsi_voxels()
     # Create a new data-set with a b0 measurement:
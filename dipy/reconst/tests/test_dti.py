@@ -10,6 +10,7 @@ import numpy.testing as npt
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
                            assert_)
 import nibabel as nib
+from nibabel.tmpdirs import InTemporaryDirectory
 
 import scipy.optimize as opt
 
@@ -23,6 +24,7 @@ from dipy.reconst.dti import (axial_diffusivity, color_fa,
                               _decompose_tensor_nan)
 
 from dipy.io.bvectxt import read_bvec_file
+from dipy.io.image import memmap_nifti
 from dipy.data import get_data, dsi_voxels, get_sphere
 
 from dipy.core.subdivide_octahedron import create_unit_sphere
@@ -520,37 +522,53 @@ def test_mask():
     assert_almost_equal(dtifit_w_mask.S0_hat[0, 0, 0], dtifit.S0_hat[0, 0, 0])
 
 
-def test_nnls_jacobian_fucn():
-    b0 = 1000.
-    bvecs, bval = read_bvec_file(get_data('55dir_grad.bvec'))
-    gtab = grad.gradient_table(bval, bvecs)
-    B = bval[1]
+def _gmm_err_func(tensor, design_matrix, data):
+    """Geman-McClure weighted residuals of a voxel, which the NLLS fit with
+    the 'gmm' weighting minimized with scipy.optimize.leastsq"""
+    residuals = data - np.exp(np.dot(design_matrix, tensor))
+    C = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+    w = 1 / (residuals ** 2 + C ** 2)
+    w = w / np.mean(w)
+    return np.sqrt(w) * residuals
 
-    # Scale the eigenvalues and tensor by the B value so the units match
-    D = np.array([1., 1., 1., 0., 0., 1., -np.log(b0) * B]) / B
 
-    # Design Matrix
+def test_nlls_gmm_weighting():
+    bvecs, bval = read_bvec_file(get_data('55dir_grad.bvec'))
+    gtab = grad.gradient_table(bval, bvecs)
     X = dti.design_matrix(gtab)
-
-    # Signals
-    Y = np.exp(np.dot(X, D))
-
-    # Test Jacobian at D
-    args = [X, Y]
-    analytical = dti._nlls_jacobian_func(D, *args)
-    for i in range(len(X)):
-        args = [X[i], Y[i]]
-        approx = opt.approx_fprime(D, dti._nlls_err_func, 1e-8, *args)
-        assert_true(np.allclose(approx, analytical[i]))
-
-    # Test Jacobian at zero
-    D = np.zeros_like(D)
-    args = [X, Y]
-    analytical = dti._nlls_jacobian_func(D, *args)
-    for i in range(len(X)):
-        args = [X[i], Y[i]]
-        approx = opt.approx_fprime(D, dti._nlls_err_func, 1e-8, *args)
-        assert_true(np.allclose(approx, analytical[i]))
+    rng = np.random.RandomState(2017)
+    n = 10
+    Y = np.empty((n, len(bval)))
+    for i in range(n):
+        evals = np.array([1.7e-3, 0.4e-3, 0.3e-3]) * rng.uniform(.7, 1.3, 3)
+        evecs = np.linalg.qr(rng.randn(3, 3))[0]
+        Y[i] = single_tensor(gtab, 1000., evals, evecs)
+    Y = np.abs(Y + rng.randn(*Y.shape) * 20)
+    outliers = rng.rand(*Y.shape) < .08
+    Y[outliers] += rng.uniform(200, 600, outliers.sum())
+
+    # The voxel by voxel minimization of the weighted residuals
+    ols_params = np.dot(np.linalg.pinv(X), np.log(Y).T).T
+    expected = np.array([opt.leastsq(_gmm_err_func, ols_params[i],
+                                     args=(X, Y[i]))[0] for i in range(n)])
+    exp_evals = dti.decompose_tensor(
+        dti.from_lower_triangular(expected[:, :6]))[0]
+
+    params, S0 = dti.nlls_fit_tensor(X, Y, weighting='gmm',
+                                     return_S0_hat=True)
+    npt.assert_allclose(dti.fractional_anisotropy(params[:, :3]),
+                        dti.fractional_anisotropy(exp_evals), atol=0.05)
+    npt.assert_allclose(params[:, :3].mean(-1), exp_evals.mean(-1),
+                        rtol=0.05)
+    # The weighted residuals are as small
+    tensors = dti.lower_triangular(
+        dti.vec_val_vect(params[:, 3:].reshape(-1, 3, 3), params[:, :3]))
+    fitted = np.concatenate([tensors, -np.log(S0)], -1)
+    cost = [np.sum(_gmm_err_func(fitted[i], X, Y[i]) ** 2)
+            for i in range(n)]
+    expected_cost = [np.sum(_gmm_err_func(expected[i], X, Y[i]) ** 2)
+                     for i in range(n)]
+    assert_true(np.mean(cost) <= 1.05 * np.mean(expected_cost))
 
 
 def test_nlls_fit_tensor():
@@ -664,6 +682,42 @@ def test_restore():
     assert_almost_equal(tmf[0].S0_hat, b0)
 
 
+def test_restore_batch():
+    """
+    The voxels fit together by RESTORE each get their own outlier rejection
+    """
+    b0 = 1000.
+    bvecs, bval = read_bvec_file(get_data('55dir_grad.bvec'))
+    gtab = grad.gradient_table(bval, bvecs)
+    B = bval[1]
+    D = np.array([1., 1., 1., 0., 0., 1., -np.log(b0) * B]) / B
+    evals = np.array([2., 1., 0.]) / B
+    X = dti.design_matrix(gtab)
+    Y = np.exp(np.dot(X, D))
+    # Each voxel gets a different outlier, and some of them none
+    Y = np.tile(Y, (10, 1))
+    for i in range(5):
+        Y[i, 3 * i + 2] = 1.0
+
+    tensor_model = dti.TensorModel(gtab, fit_method='restore', sigma=67.0)
+    tensor_est = tensor_model.fit(Y)
+    assert_array_almost_equal(tensor_est.evals,
+                              np.tile(evals, (10, 1)), decimal=3)
+    for i in range(10):
+        assert_array_almost_equal(tensor_est.evals[i],
+                                  tensor_model.fit(Y[i]).evals)
+
+    # The non-linear fits of all voxels are the same as the fits of each
+    # voxel on its own
+    np.random.seed(2016)
+    noisy = np.abs(Y + np.random.randn(*Y.shape) * 10)
+    for weighting in [None, 'gmm']:
+        nlls = dti.nlls_fit_tensor(X, noisy, weighting=weighting)
+        for i in range(10):
+            assert_array_almost_equal(
+                nlls[i], dti.nlls_fit_tensor(X, noisy[i], weighting=weighting))
+
+
 def test_adc():
     """
     Test the implementation of the calculation of apparent diffusion
@@ -770,6 +824,63 @@ def test_eig_from_lo_tri():
     lo_tri = lower_triangular(dmfit.quadratic_form)
     assert_array_almost_equal(dti.eig_from_lo_tri(lo_tri), dmfit.model_params)
 
+
+def test_closed_form_eig():
+    # Random tensors, with some degenerate eigenvalues
+    rng = np.random.RandomState(2016)
+    n = 1000
+    rot = np.linalg.qr(rng.randn(n, 3, 3))[0]
+    evals = rng.rand(n, 3) * 0.003
+    evals[:100, 1] = evals[:100, 2]
+    evals[100:200, 0] = evals[100:200, 1]
+    evals[200:300] = evals[200:300, :1]
+    tensor = np.einsum('nij,nj,nkj->nik', rot, evals, rot)
+    tensor[300] = 0
+
+    w, v = decompose_tensor(tensor, backend='closed_form')
+    w_ref, v_ref = decompose_tensor(tensor)
+    assert_array_almost_equal(w, w_ref, 15)
+    assert_array_almost_equal(np.einsum('nij,nj,nkj->nik', v, w, v), tensor,
+                              15)
+    assert_array_almost_equal(np.einsum('nji,njk->nik', v, v),
+                              np.tile(np.eye(3), (n, 1, 1)))
+    # Eigenvectors of distinct eigenvalues match up to their sign
+    distinct = slice(301, None)
+    assert_array_almost_equal(np.abs((v * v_ref).sum(-2))[distinct], 1)
+    npt.assert_raises(ValueError, decompose_tensor, tensor, backend='lapack')
+
+    lo_tri = lower_triangular(tensor.reshape(10, 10, 10, 3, 3))
+    params = dti.eig_from_lo_tri(lo_tri, min_diffusivity=0.001,
+                                 backend='closed_form')
+    assert_array_almost_equal(params[..., :3], w.clip(0.001).reshape(10, 10,
+                                                                     10, 3))
+
+    # All the metrics in one pass
+    fa, md, ad, rd, mode = dti.tensor_metrics(lo_tri, min_diffusivity=0.001)
+    w_clip = w_ref.clip(0.001).reshape(10, 10, 10, 3)
+    assert_array_almost_equal(fa, fractional_anisotropy(w_clip))
+    assert_array_almost_equal(md, mean_diffusivity(w_clip))
+    assert_array_almost_equal(ad, axial_diffusivity(w_clip))
+    assert_array_almost_equal(rd, radial_diffusivity(w_clip))
+    anisotropic = w_clip[..., 0] - w_clip[..., 2] > 1e-4
+    assert_array_almost_equal(mode[anisotropic],
+                              dti.mode(from_lower_triangular(
+                                  lower_triangular(dti.vec_val_vect(
+                                      v_ref.reshape(10, 10, 10, 3, 3),
+                                      w_clip))))[anisotropic])
+
+    # As the eigen-decomposition backend of tensor fits
+    fdata, fbvals, fbvecs = get_data()
+    data = nib.load(fdata).get_data()
+    gtab = grad.gradient_table(fbvals, fbvecs)
+    for fit_method in ['WLS', 'OLS']:
+        fit_ref = TensorModel(gtab, fit_method).fit(data)
+        model = TensorModel(gtab, fit_method, eig_backend='closed_form')
+        fit = model.fit(data)
+        assert_array_almost_equal(fit.evals, fit_ref.evals)
+        assert_array_almost_equal(fit.quadratic_form, fit_ref.quadratic_form)
+
+
 def test_min_signal_alone():
     fdata, fbvals, fbvecs = get_data()
     data = nib.load(fdata).get_data()
@@ -797,3 +908,44 @@ def test_decompose_tensor_nan():
                                            from_lower_triangular(D_alter))
     assert_array_almost_equal(lalter, np.array([1.6e-3, 0.4e-3, 0.3e-3]))
     assert_array_almost_equal(valter, vref)
+
+
+def test_fit_blocks():
+    fdata, fbval, fbvec = get_data('small_25')
+    gtab = grad.gradient_table(fbval, fbvec)
+    img = nib.load(fdata)
+    data = img.get_data()
+    mask = data[..., 0] > 100
+    # The first slice is outside of the mask
+    mask[0] = False
+    model = TensorModel(gtab, return_S0_hat=True)
+    fit = model.fit(data, mask)
+
+    with InTemporaryDirectory():
+        nib.save(img, 'data.nii')
+        proxy = nib.load('data.nii').dataobj
+        out = memmap_nifti('params.nii', data.shape[:-1] + (12,),
+                           img.affine, dtype=np.float64)
+        fa = np.lib.format.open_memmap('fa.npy', mode='w+',
+                                       shape=data.shape[:-1])
+        # Blocks of one slice:
+        block_fit = model.fit(proxy, mask, out=out, scalars={'fa': fa},
+                              block_size=np.prod(data.shape[1:-1]))
+        assert_(block_fit.model_params is out)
+        assert_array_almost_equal(block_fit.model_params, fit.model_params)
+        assert_array_almost_equal(block_fit.S0_hat, fit.S0_hat)
+        assert_array_almost_equal(fa, fit.fa)
+        out.flush()
+        assert_array_almost_equal(nib.load('params.nii').get_data(),
+                                  fit.model_params)
+        del out, fa, block_fit
+
+        # Memory-mapped input, parameters kept in memory:
+        np.save('data.npy', data)
+        block_fit = model.fit(np.load('data.npy', mmap_mode='r'), mask,
+                              block_size=1)
+        assert_array_almost_equal(block_fit.model_params, fit.model_params)
+        assert_raises(ValueError, model.fit, data, out=np.zeros(3))
+        assert_raises(ValueError, model.fit, data,
+                      scalars={'not_a_map': np.zeros(data.shape[:-1])})
+        del block_fit
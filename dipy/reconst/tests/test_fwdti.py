@@ -237,6 +237,12 @@ def test_cholesky_functions():
     tensor = cholesky_to_lower_triangular(R)
     assert_array_almost_equal(dt, tensor)
 
+    # Many tensors at once
+    dts = np.array([dt, 2 * dt, dt / 3.])
+    R = lower_triangular_to_cholesky(dts)
+    assert_array_almost_equal(R[1], lower_triangular_to_cholesky(2 * dt))
+    assert_array_almost_equal(cholesky_to_lower_triangular(R), dts)
+
 
 def test_fwdti_jac_multi_voxel():
     fwdm = fwdti.FreeWaterTensorModel(gtab_2s, 'WLS')
@@ -271,6 +277,50 @@ def test_standalone_functions():
     assert_array_almost_equal(fa, FAref)
 
 
+def test_fwdti_batch():
+    # Noisy voxels with different fractions and orientations
+    np.random.seed(2016)
+    data = np.zeros((3, 4, len(gtab_2s.bvals)))
+    for i in range(3):
+        for j in range(4):
+            gtf = 0.2 * j + 0.05
+            angles = [(30 * i, 45 * j)] * 2
+            data[i, j] = multi_tensor(gtab_2s, mevals, S0=100, angles=angles,
+                                      fractions=[(1-gtf) * 100, gtf*100],
+                                      snr=50)[0]
+    mask = np.ones(data.shape[:-1], dtype=bool)
+    mask[0, 0] = False
+
+    # The voxels fitted together give the fits of each voxel alone
+    def wls_voxel(*args, **kwargs):
+        return fwdti.wls_iter(*args, **kwargs)
+
+    for fit_method, kwargs in [('WLS', {}),
+                               ('NLS', {}),
+                               ('NLS', {'cholesky': True}),
+                               ('NLS', {'f_transform': False}),
+                               ('NLS', {'weighting': 'sigma', 'sigma': 2})]:
+        fwdm = fwdti.FreeWaterTensorModel(gtab_2s, fit_method, **kwargs)
+        fit = fwdm.fit(data, mask=mask)
+        assert_array_almost_equal(fit.model_params[0, 0], 0)
+        for ijk in [(0, 1), (1, 2), (2, 3)]:
+            S0_v = np.mean(data[ijk][gtab_2s.b0s_mask])
+            params = fwdm.fit_method(fwdm.design_matrix, data[ijk], S0_v,
+                                     **kwargs)
+            assert_array_almost_equal(fit.f[ijk], params[12], 4)
+            assert_array_almost_equal(fit.evals[ijk], params[:3], 6)
+            tensor = dti.vec_val_vect(params[3:12].reshape(3, 3),
+                                      params[:3])
+            assert_array_almost_equal(fit.quadratic_form[ijk], tensor, 7)
+
+    # Other fit methods are applied to each voxel
+    fit = fwdti.FreeWaterTensorModel(gtab_2s, wls_voxel).fit(data, mask=mask)
+    fit_batch = fwdti.FreeWaterTensorModel(gtab_2s, 'WLS').fit(data,
+                                                               mask=mask)
+    assert_array_almost_equal(fit.f, fit_batch.f)
+    assert_array_almost_equal(fit.fa, fit_batch.fa)
+
+
 def test_md_regularization():
     # single voxel
     gtf = 0.97  # for this ground truth value, md is larger than 2.7e-3
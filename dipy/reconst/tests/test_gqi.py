@@ -7,6 +7,8 @@ from dipy.reconst.gqi import GeneralizedQSamplingModel
 from dipy.data import get_sphere
 from numpy.testing import (assert_equal,
                            assert_almost_equal,
+                           assert_array_almost_equal,
+                           assert_raises,
                            run_module_suite)
 from dipy.reconst.tests.test_dsi import sticks_and_ball_dummies
 from dipy.core.subdivide_octahedron import create_unit_sphere
@@ -72,6 +74,23 @@ def test_mvoxel_gqi():
     directions, values, indices = peak_directions(odf, sphere, .35, 25)
     assert_equal(directions.shape[0], 2)
 
+    # Masked voxels have zero ODFs, the others are those of single voxel fits
+    mask = np.zeros(data.shape[:-1], dtype=bool)
+    mask[0, 0, :2] = True
+    mask[-1, -1, -1] = True
+    odfs = gq.fit(data, mask).odf(sphere)
+    assert_equal(odfs.shape, all_odfs.shape)
+    assert_equal(odfs[~mask], 0)
+    for ijk in zip(*np.nonzero(mask)):
+        assert_array_almost_equal(odfs[ijk], gq.fit(data[ijk]).odf(sphere))
+    assert_array_almost_equal(gq.fit(data, mask)[0, 0, 1].odf(sphere),
+                              all_odfs[0, 0, 1])
+    assert_raises(ValueError, gq.fit, data, mask[0])
+
+    # The voxels can be fit in a pool of workers
+    threaded = gq.fit(data, mask, engine='thread', n_jobs=2, chunk_size=1)
+    assert_array_almost_equal(threaded.odf(sphere), odfs)
+
 
 if __name__ == "__main__":
     run_module_suite()
@@ -422,5 +422,35 @@ def test_leastsq_error():
     assert_array_almost_equal(fit, [-1, -1, -1, -1])
 
 
+def test_batch_fit():
+    """
+    Test that fitting all the voxels of a block at once gives the same
+    parameters as the voxelwise fit.
+    """
+    ivim_model_batch = IvimModel(gtab, fit_method='batch', block_size=3)
+    fit_batch = ivim_model_batch.fit(data_multi)
+    assert_array_almost_equal(fit_batch.model_params, ivim_params)
+    assert_array_almost_equal(fit_batch.model_params,
+                              ivim_fit_multi.model_params)
+
+    fit_voxel = ivim_model.fit(noisy_multi)
+    fit_batch = ivim_model_batch.fit(noisy_multi)
+    assert_array_almost_equal(fit_batch.S0_predicted,
+                              fit_voxel.S0_predicted, decimal=3)
+    assert_array_almost_equal(fit_batch.perfusion_fraction,
+                              fit_voxel.perfusion_fraction)
+    assert_array_almost_equal(fit_batch.D_star, fit_voxel.D_star)
+    assert_array_almost_equal(fit_batch.D, fit_voxel.D)
+
+    mask = np.array([[True, False], [False, True]])[..., None]
+    fit_batch = ivim_model_batch.fit(data_multi, mask)
+    assert_array_equal(fit_batch.model_params[~mask], 0)
+    assert_array_almost_equal(fit_batch.model_params[mask],
+                              ivim_params[mask])
+    assert_raises(ValueError, ivim_model_batch.fit, data_multi,
+                  np.ones((2, 2), dtype=bool))
+    assert_raises(ValueError, IvimModel, gtab, fit_method='unknown')
+
+
 if __name__ == '__main__':
     run_module_suite()
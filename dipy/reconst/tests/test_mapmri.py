@@ -827,5 +827,95 @@ def test_mapmri_odf(radial_order=6):
     assert_almost_equal(odf, odf_from_sh, 10)
 
 
+def test_mapmri_multi_voxel_array_fit(radial_order=6):
+    gtab = get_gtab_taiwan_dsi()
+    l1, l2, l3 = [0.0015, 0.0003, 0.0003]
+    S, _ = generate_signal_crossing(gtab, l1, l2, l3)
+    data = np.array([S * scale for scale in [0.5, 1., 2., 4.]])
+    data = data.reshape((2, 2, -1))
+    mask = np.array([[True, True], [False, True]])
+    sphere = get_sphere('repulsion100')
+    r_points = np.random.RandomState(0).rand(10, 3) * 0.01
+
+    for anisotropic_scaling in [True, False]:
+        mapm = MapmriModel(gtab, radial_order=radial_order,
+                           laplacian_weighting=0.02,
+                           anisotropic_scaling=anisotropic_scaling)
+        mapfit = mapm.fit(data, mask)
+        assert_equal(mapfit.mapmri_coeff.shape[:2], (2, 2))
+        assert_array_almost_equal(mapfit.rtop()[~mask], 0)
+        for ijk in zip(*np.nonzero(mask)):
+            voxfit = mapm.fit(data[ijk])
+            assert_almost_equal(mapfit.rtop()[ijk] / voxfit.rtop(), 1, 6)
+            assert_almost_equal(mapfit.rtap()[ijk] / voxfit.rtap(), 1, 6)
+            assert_almost_equal(mapfit.msd()[ijk] / voxfit.msd(), 1, 6)
+            assert_almost_equal(mapfit.norm_of_laplacian_signal()[ijk] /
+                                voxfit.norm_of_laplacian_signal(), 1, 6)
+            assert_array_almost_equal(mapfit.odf(sphere)[ijk],
+                                      voxfit.odf(sphere))
+            assert_array_almost_equal(mapfit.predict(gtab, S0=1.)[ijk],
+                                      voxfit.predict(gtab, S0=1.))
+            assert_array_almost_equal(mapfit.pdf(r_points)[ijk] /
+                                      voxfit.pdf(r_points), 1, 6)
+            assert_array_almost_equal(mapfit[ijk].mapmri_coeff,
+                                      voxfit.mapmri_coeff)
+
+
+def test_mapmri_batch_fit(radial_order=6):
+    gtab = get_gtab_taiwan_dsi()
+    l1, l2, l3 = [0.0015, 0.0003, 0.0003]
+    S, _ = generate_signal_crossing(gtab, l1, l2, l3)
+    data = np.array([add_noise(S * scale, snr=20, S0=100. * scale)
+                     for scale in [0.5, 1., 2., 4.]])
+    data = data.reshape((2, 2, -1))
+    mask = np.array([[True, True], [False, True]])
+    weight_array = np.linspace(0, .3, 31)
+
+    for anisotropic_scaling in [True, False]:
+        for weighting in [0.02, weight_array]:
+            kwargs = dict(radial_order=radial_order,
+                          laplacian_weighting=weighting,
+                          anisotropic_scaling=anisotropic_scaling)
+            mapm = MapmriModel(gtab, **kwargs)
+            mapm_batch = MapmriModel(gtab, fit_method='batch', **kwargs)
+            mapfit = mapm.fit(data, mask)
+            mapfit_batch = mapm_batch.fit(data, mask)
+            assert_array_almost_equal(mapfit_batch.lopt, mapfit.lopt)
+            assert_array_almost_equal(mapfit_batch.mu, mapfit.mu)
+            assert_array_almost_equal(mapfit_batch.mapmri_coeff,
+                                      mapfit.mapmri_coeff)
+            assert_array_almost_equal(mapfit_batch.rtop() / 1e5,
+                                      mapfit.rtop() / 1e5)
+            voxfit = mapm_batch.fit(data[0, 1])
+            assert_array_almost_equal(voxfit.mapmri_coeff,
+                                      mapfit[0, 1].mapmri_coeff)
+
+        # GCV over a grid of weights finds the optimum of the continuous
+        # optimization
+        mapm = MapmriModel(gtab, radial_order=radial_order,
+                           laplacian_weighting='GCV',
+                           anisotropic_scaling=anisotropic_scaling)
+        mapm_batch = MapmriModel(gtab, radial_order=radial_order,
+                                 laplacian_weighting='GCV',
+                                 anisotropic_scaling=anisotropic_scaling,
+                                 fit_method='batch')
+        lopt = mapm.fit(data, mask).lopt[mask]
+        lopt_batch = mapm_batch.fit(data, mask).lopt[mask]
+        assert_array_almost_equal(lopt_batch / np.ravel(lopt), 1, 1)
+
+    # Rounded isotropic scale factors
+    mapm_batch = MapmriModel(gtab, radial_order=radial_order,
+                             laplacian_weighting=0.02,
+                             anisotropic_scaling=False,
+                             fit_method='batch', mu_resolution=0.01)
+    mapfit_batch = mapm_batch.fit(data, mask)
+    u0 = mapm.fit(data, mask).mu[mask][:, 0]
+    u0_batch = mapfit_batch.mu[mask][:, 0]
+    assert_equal(np.all(np.abs(np.log(u0_batch / u0)) <=
+                        0.5 * np.log(1.01)), True)
+
+    assert_raises(ValueError, MapmriModel, gtab, fit_method='voxel')
+
+
 if __name__ == '__main__':
     run_module_suite()
@@ -5,7 +5,8 @@ from functools import reduce
 import numpy as np
 import numpy.testing as npt
 
-from dipy.reconst.multi_voxel import _squash, multi_voxel_fit, CallableArray
+from dipy.reconst.multi_voxel import (_squash, multi_voxel_fit, CallableArray,
+                                     MultiVoxelArrayFit)
 from dipy.core.sphere import unit_icosahedron
 
 
@@ -178,3 +179,113 @@ def test_multi_voxel_fit():
     # Test indexing into a fit
     npt.assert_equal(type(fit[0, 0, 0]), SillyFit)
     npt.assert_equal(fit[:2, :2, :2].shape, (2, 2, 2))
+
+
+class _MeanModel(object):
+    """Module level model so that it can be sent to worker processes"""
+
+    @multi_voxel_fit
+    def fit(self, data):
+        return _MeanFit(self, data)
+
+
+class _MeanFit(object):
+
+    def __init__(self, model, data):
+        self.model = model
+        self.mean = data.mean()
+
+
+def test_multi_voxel_fit_engines():
+    data = np.random.random((4, 5, 6, 10))
+    mask = np.random.random((4, 5, 6)) > 0.3
+    model = _MeanModel()
+    expected = np.zeros((4, 5, 6))
+    expected[mask] = data[mask].mean(-1)
+
+    serial_fit = model.fit(data, mask)
+    npt.assert_array_almost_equal(serial_fit.mean, expected)
+
+    for engine in ['thread', 'process']:
+        for n_jobs, chunk_size in [(1, None), (2, 7), (3, 1000)]:
+            fit = model.fit(data, mask, engine=engine, n_jobs=n_jobs,
+                            chunk_size=chunk_size)
+            npt.assert_array_almost_equal(fit.mean, expected)
+            npt.assert_(fit[mask][0].model is model)
+        fit = model.fit(data, engine=engine, n_jobs=2)
+        npt.assert_array_almost_equal(fit.mean, data.mean(-1))
+        # An empty mask gives an empty fit
+        fit = model.fit(data, np.zeros((4, 5, 6), bool), engine=engine)
+        npt.assert_(np.all(fit.fit_array == None))  # noqa
+
+    npt.assert_raises(ValueError, model.fit, data, mask, engine='gpu')
+    npt.assert_raises(ValueError, model.fit, data, mask, engine='process',
+                      n_jobs=0)
+    npt.assert_raises(ValueError, model.fit, data, mask, engine='thread',
+                      chunk_size=0)
+
+
+class _LineModel(object):
+
+    @multi_voxel_fit
+    def fit(self, data):
+        return _LineFit(self, np.polyfit(np.arange(len(data)), data, 1),
+                        len(data))
+
+
+class _LineFit(object):
+    """Fit whose parameters are gathered in arrays by multi_voxel_fit"""
+
+    _fit_params = ('coef', 'n_points')
+
+    def __init__(self, model, coef, n_points):
+        self.model = model
+        self.coef = coef
+        self.n_points = n_points
+
+    @property
+    def slope(self):
+        return self.coef[..., 0]
+
+    def predict(self, x, S0=1.):
+        return S0 * (self.coef[..., 0, None] * x + self.coef[..., 1, None])
+
+
+def test_multi_voxel_array_fit():
+    x = np.arange(5)
+    slope = np.arange(24.).reshape(2, 3, 4)
+    data = slope[..., None] * x + 1
+    mask = np.ones((2, 3, 4), bool)
+    mask[0, 1] = False
+    model = _LineModel()
+
+    for engine in ['serial', 'thread', 'process']:
+        fit = model.fit(data, mask, engine=engine, n_jobs=2)
+        npt.assert_(isinstance(fit, MultiVoxelArrayFit))
+        npt.assert_equal(fit.shape, mask.shape)
+        npt.assert_equal(fit.voxel_fit.coef.shape, (mask.sum(), 2))
+        npt.assert_array_almost_equal(fit.slope, slope * mask)
+        npt.assert_array_equal(fit.n_points, 5 * mask)
+        npt.assert_array_almost_equal(fit.predict(x),
+                                      data * mask[..., None])
+
+    # S0 given for every voxel
+    S0 = np.random.random(mask.shape)
+    npt.assert_array_almost_equal(fit.predict(x, S0=S0),
+                                  (S0 * mask)[..., None] * data)
+
+    # Indexing gives single voxel fits or smaller multi voxel fits
+    npt.assert_equal(type(fit[1, 2, 3]), _LineFit)
+    npt.assert_almost_equal(fit[1, 2, 3].slope, slope[1, 2, 3])
+    npt.assert_(fit[0, 1, 0] is None)
+    sub_fit = fit[0]
+    npt.assert_equal(sub_fit.shape, (3, 4))
+    npt.assert_array_almost_equal(sub_fit.slope, slope[0] * mask[0])
+
+    # The single voxel fits are also available in an object array
+    fit_array = fit.fit_array
+    npt.assert_equal(fit_array.shape, mask.shape)
+    npt.assert_(fit_array[0, 1, 2] is None)
+    npt.assert_equal(type(fit_array[1, 2, 3]), _LineFit)
+    npt.assert_almost_equal(fit_array[1, 2, 3].slope, slope[1, 2, 3])
+    npt.assert_(fit.fit_array is fit_array)
@@ -3,7 +3,8 @@ from __future__ import division, print_function, absolute_import
 import numpy as np
 import numpy.testing as npt
 from dipy.reconst.recspeed import (local_maxima, remove_similar_vertices,
-                                   search_descending)
+                                   search_descending, batch_peak_directions)
+from dipy.direction.peaks import peak_directions
 from dipy.data import get_sphere, get_data
 from dipy.core.sphere import unique_edges, HemiSphere
 from dipy.sims.voxel import all_tensor_evecs
@@ -138,6 +139,39 @@ def test_search_descending():
     npt.assert_equal(search_descending(a[:0], 1.), 0)
 
 
+def test_batch_peak_directions():
+    sphere = get_sphere('symmetric362')
+    vertices = sphere.vertices
+    rng = np.random.RandomState(1234)
+    # ODFs with up to three lobes, noise, and a few degenerate cases
+    lobes = rng.randn(50, 3, 3)
+    lobes /= np.sqrt((lobes ** 2).sum(-1))[..., None]
+    odfs = (rng.rand(50, 3, 1) *
+            np.abs(np.einsum('nkj,vj->nkv', lobes, vertices)) ** 20).sum(1)
+    odfs += 0.01 * rng.randn(*odfs.shape) - 0.02
+    odfs[0] = 1.
+    odfs[1] = -1.
+
+    for threshold, angle, npeaks in [(.5, 25, 5), (0., 10, 10), (.25, 45, 2)]:
+        directions, values, indices = batch_peak_directions(
+            odfs, sphere.edges, vertices, threshold, angle, npeaks)
+        npt.assert_equal(directions.shape, (50, npeaks, 3))
+        for i, odf in enumerate(odfs):
+            d, v, ind = peak_directions(odf, sphere, threshold, angle)
+            n = min(npeaks, len(v))
+            npt.assert_array_equal(indices[i, :n], ind[:n])
+            npt.assert_array_equal(indices[i, n:], -1)
+            npt.assert_array_equal(values[i, :n], v[:n])
+            npt.assert_array_equal(values[i, n:], 0)
+            npt.assert_array_equal(directions[i, :n], d[:n])
+
+    odfs[2, 5] = np.nan
+    npt.assert_raises(ValueError, batch_peak_directions, odfs, sphere.edges,
+                      vertices, .5, 25, 5)
+    npt.assert_raises(ValueError, batch_peak_directions, odfs[:, :-1],
+                      sphere.edges, vertices, .5, 25, 5)
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule()
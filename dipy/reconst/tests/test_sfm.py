@@ -1,3 +1,4 @@
+import copy
 import numpy as np
 import numpy.testing as npt
 import nibabel as nib
@@ -47,6 +48,62 @@ def test_sfm():
             np.zeros(sfmodel.design_matrix[0].shape[-1]))
 
 
+def test_sfm_batch():
+    fdata, fbvals, fbvecs = dpd.get_data()
+    data = nib.load(fdata).get_data()[:2, :2, :2]
+    gtab = grad.gradient_table(fbvals, fbvecs)
+    sfmodel = sfm.SparseFascicleModel(gtab, solver='BatchElasticNet')
+    npt.assert_(isinstance(sfmodel.solver, opt.NonNegativeElasticNet))
+    sffit1 = sfmodel.fit(data)
+    # Splitting the voxels in chunks fit by several threads does not change
+    # the result:
+    sffit2 = sfmodel.fit(data, n_jobs=2, chunk_size=3)
+    npt.assert_almost_equal(sffit2.beta, sffit1.beta)
+    # The copies of the solver in the threads share the factors of the
+    # design matrix, which is factorized once:
+    npt.assert_(sfmodel.solver._X is sfmodel.design_matrix)
+    npt.assert_(copy.deepcopy(sfmodel.solver)._svd is sfmodel.solver._svd)
+    sffit3 = sfmodel.fit(data[0, 0, 0])
+    npt.assert_almost_equal(sffit3.beta, sffit1.beta[0, 0, 0], decimal=4)
+    npt.assert_almost_equal(sffit1.predict(gtab), data, decimal=-2)
+
+
+@npt.dec.skipif(not sfm.has_sklearn)
+def test_sfm_batch_sklearn():
+    fdata, fbvals, fbvecs = dpd.get_data()
+    data = nib.load(fdata).get_data()[:2, :2, :2]
+    gtab = grad.gradient_table(fbvals, fbvecs)
+    batch_fit = sfm.SparseFascicleModel(gtab,
+                                        solver='BatchElasticNet').fit(data)
+    sk_model = sfm.SparseFascicleModel(gtab)
+    sk_fit = sk_model.fit(data)
+    npt.assert_(isinstance(sk_model.solver, sfm.lm.ElasticNet))
+
+    # The betas are not unique enough to be compared, but the objective of
+    # `sklearn.linear_model.ElasticNet(positive=True)` is the same. The
+    # intercept is the mean of the residuals:
+    X = sk_model.design_matrix
+    X = X - np.mean(X, 0)
+    S = (data[..., ~gtab.b0s_mask] /
+         np.mean(data[..., gtab.b0s_mask], -1)[..., None])
+    y = S.reshape(-1, X.shape[0]) - batch_fit.iso.predict()
+    y = y - np.mean(y, -1)[:, None]
+    alpha = sk_model.solver.alpha
+    l1_ratio = sk_model.solver.l1_ratio
+
+    def objective(beta):
+        beta = beta.reshape(-1, X.shape[1])
+        return (np.sum((y - np.dot(beta, X.T)) ** 2, -1) / (2 * X.shape[0]) +
+                alpha * l1_ratio * np.sum(np.abs(beta), -1) +
+                alpha * (1 - l1_ratio) / 2 * np.sum(beta ** 2, -1))
+
+    npt.assert_array_less(0, batch_fit.beta.sum(-1))
+    npt.assert_allclose(objective(batch_fit.beta), objective(sk_fit.beta),
+                        rtol=1e-3)
+    npt.assert_allclose(batch_fit.predict(gtab), sk_fit.predict(gtab),
+                        rtol=5e-3)
+
+
 @npt.dec.skipif(not sfm.has_sklearn)
 def test_predict():
     SNR = 1000
@@ -284,6 +284,43 @@ def test_SphHarmFit():
     assert_equal(slice.shape, (3, 4))
 
 
+def test_SphHarmFit_chunked_odf():
+    sphere = hemi_icosahedron.subdivide(2)
+    bvecs = np.concatenate(([[0, 0, 0]], sphere.vertices))
+    bvals = np.zeros(len(bvecs)) + 2000
+    bvals[0] = 0
+    gtab = gradient_table(bvals, bvecs)
+    signal = single_tensor(gtab, 1., [.0015, .0003, .0003], np.eye(3))
+    data = np.random.random((3, 4, 5, 1)) * signal
+    model = CsaOdfModel(gtab, 4)
+    fit = model.fit(data)
+    odf = fit.odf(sphere)
+
+    chunked = fit.odf(sphere, chunk_size=7)
+    assert_array_almost_equal(chunked, odf)
+    low = fit.odf(sphere, chunk_size=7, dtype=np.float32)
+    assert_equal(low.dtype, np.float32)
+    npt.assert_allclose(low, odf, rtol=1e-4, atol=1e-5)
+    out = np.zeros(odf.shape)
+    result = fit.odf(sphere, chunk_size=11, out=out)
+    assert_true(result is out)
+    assert_array_almost_equal(out, odf)
+
+    seen = np.zeros(fit.shape, dtype=int)
+    for index, odf_chunk in fit.iter_odf(sphere, chunk_size=8):
+        assert_true(len(odf_chunk) <= 8)
+        assert_equal(odf_chunk.dtype, np.float32)
+        npt.assert_allclose(odf_chunk, odf[index], rtol=1e-4, atol=1e-5)
+        seen[index] += 1
+    assert_array_equal(seen, 1)
+
+    # The fit of a single voxel
+    fit = model.fit(data[0, 0, 0])
+    assert_array_almost_equal(fit.odf(sphere, chunk_size=10), odf[0, 0, 0])
+    (index, odf_chunk), = fit.iter_odf(sphere)
+    npt.assert_allclose(odf_chunk[index], odf[0, 0, 0], rtol=1e-4, atol=1e-5)
+
+
 class TestOpdtModel(TestQballModel):
     model = OpdtModel
 
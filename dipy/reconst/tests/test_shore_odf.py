@@ -7,6 +7,7 @@ from numpy.testing import (assert_equal,
                            assert_almost_equal,
                            run_module_suite,
                            assert_array_equal,
+                           assert_array_almost_equal,
                            assert_raises)
 from dipy.sims.voxel import SticksAndBall
 from dipy.core.subdivide_octahedron import create_unit_sphere
@@ -71,6 +72,18 @@ def test_multivox_shore():
     assert_equal(c_shore.shape[0:3], data.shape[0:3])
     assert_equal(np.alltrue(np.isreal(c_shore)), True)
 
+    # The voxels of the mask are fit all at once as they are one by one
+    mask = np.random.random(data.shape[:-1]) > 0.5
+    for constrain_e0 in [False, True]:
+        asm = ShoreModel(gtab, radial_order=radial_order,
+                         zeta=zeta, lambdaN=1e-8, lambdaL=1e-8,
+                         constrain_e0=constrain_e0)
+        c_shore = asm.fit(data, mask).shore_coeff
+        assert_array_equal(c_shore[~mask], 0)
+        for ijk in list(zip(*np.nonzero(mask)))[:5]:
+            assert_array_almost_equal(c_shore[ijk],
+                                      asm.fit(data[ijk]).shore_coeff)
+
 
 if __name__ == '__main__':
     run_module_suite()
@@ -3,6 +3,8 @@ import numpy as np
 
 from abc import ABCMeta, abstractmethod
 
+from dipy.tracking import Streamlines
+from dipy.tracking._utils import _as_float32
 from dipy.segment.metric import Metric
 from dipy.segment.metric import ResampleFeature
 from dipy.segment.metric import AveragePointwiseEuclideanMetric
@@ -490,7 +492,7 @@ class QuickBundles(Clustering):
 
         Parameters
         ----------
-        streamlines : list of 2D arrays
+        streamlines : list of 2D arrays or Streamlines
             Each 2D array represents a sequence of 3D points (points, 3).
         ordering : iterable of indices
             Specifies the order in which data points will be clustered.
@@ -501,7 +503,11 @@ class QuickBundles(Clustering):
             Result of the clustering.
         """
         from dipy.segment.clustering_algorithms import quickbundles
-        cluster_map = quickbundles(streamlines, self.metric,
+        data = streamlines
+        if isinstance(streamlines, Streamlines):
+            # One float32 array of points instead of a copy of each streamline
+            data = _as_float32(streamlines)
+        cluster_map = quickbundles(data, self.metric,
                                    threshold=self.threshold,
                                    max_nb_clusters=self.max_nb_clusters,
                                    ordering=ordering)
@@ -7,6 +7,9 @@ cimport numpy as cnp
 from cythonutils cimport tuple2shape, shape2tuple, shape_from_memview
 from dipy.tracking.streamlinespeed cimport c_set_number_of_points, c_length
 
+from dipy.tracking import Streamlines
+from dipy.tracking._utils import _as_float32
+
 
 cdef class Feature(object):
     """ Extracts features from a sequential datum.
@@ -340,7 +343,7 @@ cpdef infer_shape(Feature feature, data):
     ----------
     feature : `Feature` object
         Tells how to infer shape of the features.
-    data : list of 2D arrays
+    data : list of 2D arrays or Streamlines
         List of sequences of N-dimensional points.
 
     Returns
@@ -356,6 +359,9 @@ cpdef infer_shape(Feature feature, data):
     if len(data) == 0:
         return []
 
+    if isinstance(data, Streamlines):
+        data = _as_float32(data)
+
     shapes = []
     cdef int i
     for i in range(0, len(data)):
@@ -375,7 +381,7 @@ cpdef extract(Feature feature, data):
     ----------
     feature : `Feature` object
         Tells how to extract features from the data.
-    datum : list of 2D arrays
+    datum : list of 2D arrays or Streamlines
         List of sequence of N-dimensional points.
 
     Returns
@@ -391,6 +397,10 @@ cpdef extract(Feature feature, data):
     if len(data) == 0:
         return []
 
+    # The points of Streamlines are converted to float32 all at once
+    if isinstance(data, Streamlines):
+        data = _as_float32(data)
+
     shapes = infer_shape(feature, data)
     features = [np.empty(shape, dtype=np.float32) for shape in shapes]
 
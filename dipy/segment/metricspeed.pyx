@@ -8,6 +8,9 @@ from libc.math cimport sqrt, acos
 from cythonutils cimport tuple2shape, shape2tuple, same_shape
 from featurespeed cimport IdentityFeature, ResampleFeature
 
+from dipy.tracking import Streamlines
+from dipy.tracking._utils import _as_float32
+
 DEF biggest_double = 1.7976931348623157e+308  #  np.finfo('f8').max
 
 import math
@@ -378,9 +381,9 @@ cpdef distance_matrix(Metric metric, data1, data2=None):
     ----------
     metric : `Metric` object
         Tells how to compute the distance between two sequential data.
-    data1 : list of 2D arrays
+    data1 : list of 2D arrays or Streamlines
         List of sequences of N-dimensional points.
-    data2 : list of 2D arrays
+    data2 : list of 2D arrays or Streamlines
         Llist of sequences of N-dimensional points.
 
     Returns
@@ -392,6 +395,12 @@ cpdef distance_matrix(Metric metric, data1, data2=None):
     if data2 is None:
         data2 = data1
 
+    # The points of Streamlines are converted to float32 all at once
+    if isinstance(data1, Streamlines):
+        data1 = _as_float32(data1)
+    if isinstance(data2, Streamlines):
+        data2 = _as_float32(data2)
+
     shape = metric.feature.infer_shape(data1[0].astype(np.float32))
     distance_matrix = np.zeros((len(data1), len(data2)), dtype=np.float64)
     cdef:
@@ -399,10 +408,10 @@ cpdef distance_matrix(Metric metric, data1, data2=None):
         Data2D features2 = np.empty(shape, np.float32)
 
     for i in range(len(data1)):
-        datum1 = data1[i] if data1[i].flags.writeable and data1[i].dtype is np.float32 else data1[i].astype(np.float32)
+        datum1 = data1[i] if data1[i].flags.writeable and data1[i].dtype == np.float32 else data1[i].astype(np.float32)
         metric.feature.c_extract(datum1, features1)
         for j in range(len(data2)):
-            datum2 = data2[j] if data2[j].flags.writeable and data2[j].dtype is np.float32 else data2[j].astype(np.float32)
+            datum2 = data2[j] if data2[j].flags.writeable and data2[j].dtype == np.float32 else data2[j].astype(np.float32)
             metric.feature.c_extract(datum2, features2)
             distance_matrix[i, j] = metric.c_dist(features1, features2)
 
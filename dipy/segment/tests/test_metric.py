@@ -1,6 +1,7 @@
 import numpy as np
 import dipy.segment.metric as dipymetric
 import itertools
+from dipy.tracking import Streamlines
 
 from nose.tools import (assert_true, assert_false, assert_equal)
 from numpy.testing import (assert_array_equal, assert_raises, run_module_suite,
@@ -253,6 +254,12 @@ def test_distance_matrix():
                 assert_equal(D[i, j], dipymetric.dist(metric, data[i],
                                                       data2[j]))
 
+        # Streamlines are converted to float32 at once.
+        D = dipymetric.distance_matrix(metric, Streamlines(data),
+                                       Streamlines(data2))
+        assert_array_equal(D, dipymetric.distance_matrix(
+            metric, data.astype(np.float32), data2.astype(np.float32)))
+
 
 if __name__ == '__main__':
     run_module_suite()
@@ -4,6 +4,8 @@ from __future__ import division, print_function, absolute_import
 from warnings import warn
 import numpy as np
 
+from dipy.tracking import Streamlines
+
 
 def _voxel_size_deprecated():
     m = DeprecationWarning('the voxel_size argument to this function is '
@@ -64,3 +66,62 @@ def _to_voxel_coordinates(streamline, lin_T, offset):
         raise IndexError('streamline has points that map to negative voxel'
                          ' indices')
     return inds.astype(int)
+
+
+def _streamlines_from_arrays(data, offsets, lengths):
+    """The ``Streamlines`` whose i-th streamline is
+    ``data[offsets[i]:offsets[i] + lengths[i]]``, without copying ``data``"""
+    streamlines = Streamlines()
+    streamlines._data = data
+    streamlines._offsets = np.asarray(offsets, dtype=np.intp)
+    streamlines._lengths = np.asarray(lengths, dtype=np.intp)
+    return streamlines
+
+
+def _compact_points(streamlines):
+    """The points of the ``Streamlines`` ``streamlines``, one streamline after
+    the other, and their offsets in this array
+
+    The points are not copied when the streamlines already are contiguous
+    and in order, as when they were not sliced.
+    """
+    offsets = np.asarray(streamlines._offsets, dtype=np.intp)
+    lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+    new_offsets = np.zeros(len(lengths), dtype=np.intp)
+    np.cumsum(lengths[:-1], out=new_offsets[1:])
+    total = lengths.sum()
+    data = streamlines._data
+    if len(data) == total and np.array_equal(offsets, new_offsets):
+        return data, new_offsets
+    # Index of each point in the buffer, streamline by streamline
+    index = np.repeat(offsets - new_offsets, lengths) + np.arange(total)
+    return data[index], new_offsets
+
+
+def _transform_array_sequence(streamlines, affine):
+    """Applies ``affine`` to all the points of the ``Streamlines``
+    ``streamlines`` at once
+
+    Floating point streamlines keep their dtype, the others are moved to
+    float64. Returns new, contiguous ``Streamlines``.
+    """
+    if len(streamlines) == 0:
+        return Streamlines()
+    points, offsets = _compact_points(streamlines)
+    dtype = points.dtype if points.dtype.kind == 'f' else np.float64
+    affine = np.asarray(affine)
+    moved = np.dot(points, affine[:3, :3].T.astype(dtype))
+    moved += affine[:3, 3].astype(dtype)
+    return _streamlines_from_arrays(moved, offsets,
+                                    np.array(streamlines._lengths))
+
+
+def _as_float32(streamlines):
+    """``Streamlines`` with the points of ``streamlines`` in one writeable
+    float32 array, ``streamlines`` itself if they already are"""
+    data = streamlines._data
+    if data.dtype == np.float32 and data.flags.writeable:
+        return streamlines
+    points, offsets = _compact_points(streamlines)
+    return _streamlines_from_arrays(points.astype(np.float32), offsets,
+                                    np.array(streamlines._lengths))
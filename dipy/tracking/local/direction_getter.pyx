@@ -14,6 +14,19 @@ cdef class DirectionGetter:
                             double[::1] point,
                             double[::1] direction) except -1:
         pass
+
+    cdef int get_direction_c(self, double *point,
+                             double *direction) nogil except -1:
+        """Updates ``direction`` like ``get_direction``, without the GIL
+
+        Subclasses implemented in Cython override it so that tracking does
+        not need the GIL. By default the GIL is acquired to call
+        ``get_direction``.
+        """
+        with gil:
+            return self.get_direction(<double[:3]> point,
+                                      <double[:3]> direction)
+
     cpdef np.ndarray[np.float_t, ndim=2] initial_direction(self,
                                                            double[::1] point):
         pass
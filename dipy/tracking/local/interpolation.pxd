@@ -2,6 +2,8 @@ cimport numpy as np
 
 cdef int _trilinear_interpolate_c_4d(double[:, :, :, :] data, double[:] point,
                                      double[::1] result) nogil
+cdef int _trilinear_interpolate_c_3d(double[:, :, :] data, double *point,
+                                     double *result) nogil
 cpdef trilinear_interpolate4d(double[:, :, :, :] data, double[:] point,
                               np.ndarray out=*)
 
@@ -4,6 +4,11 @@ from .direction_getter cimport DirectionGetter
 from .tissue_classifier cimport (TissueClassifier, TissueClass, TRACKPOINT,
                                  ENDPOINT, OUTSIDEIMAGE, INVALIDPOINT)
 
+import numpy as np
+
+from cython.parallel import prange
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
 
 cdef extern from "dpy_math.h" nogil:
     int dpy_signbit(double x)
@@ -150,8 +155,39 @@ def local_tracker(DirectionGetter dg, TissueClassifier tc,
     cdef:
         int i
         TissueClass tissue_class
-        double point[3], dir[3], vs[3], voxdir[3]
-        double[::1] pview = point, dview = dir
+        double point[3]
+        double dir[3]
+        double vs[3]
+
+    for i in range(3):
+        point[i] = seed[i]
+        dir[i] = first_step[i]
+        vs[i] = voxel_size[i]
+
+    i = _local_tracker_c(dg, tc, point, dir, vs, &streamline[0, 0],
+                         streamline.shape[0], stepsize, fixedstep,
+                         &tissue_class)
+    return i, tissue_class
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _local_tracker_c(DirectionGetter dg, TissueClassifier tc,
+                          double *seed, double *first_step,
+                          double *voxel_size, double *streamline, int length,
+                          double stepsize, int fixedstep,
+                          TissueClass *tissue_class) nogil except -1:
+    """Tracks one direction from a seed into ``streamline``, without the GIL
+
+    ``streamline`` points to a C-contiguous (length, 3) buffer. Returns the
+    number of points tracked and sets ``tissue_class``, see ``local_tracker``.
+    """
+    cdef:
+        int i, j
+        double point[3]
+        double dir[3]
+        double voxdir[3]
         void (*step)(double*, double*, double) nogil
 
     if fixedstep:
@@ -160,28 +196,225 @@ def local_tracker(DirectionGetter dg, TissueClassifier tc,
         step = step_to_boundary
 
     for i in range(3):
-        streamline[0, i] = point[i] = seed[i]
+        streamline[i] = point[i] = seed[i]
         dir[i] = first_step[i]
-        vs[i] = voxel_size[i]
 
-    tissue_class = TRACKPOINT
-    for i in range(1, streamline.shape[0]):
-        if dg.get_direction(pview, dview):
+    tissue_class[0] = TRACKPOINT
+    for i in range(1, length):
+        if dg.get_direction_c(point, dir):
             break
         for j in range(3):
-            voxdir[j] = dir[j] / vs[j]
+            voxdir[j] = dir[j] / voxel_size[j]
         step(point, voxdir, stepsize)
-        copypoint(point, &streamline[i, 0])
-        tissue_class = tc.check_point(pview)
-        if tissue_class == TRACKPOINT:
+        copypoint(point, &streamline[3 * i])
+        tissue_class[0] = tc.check_point_c(point)
+        if tissue_class[0] == TRACKPOINT:
             continue
-        elif (tissue_class == ENDPOINT or
-              tissue_class == INVALIDPOINT):
+        elif (tissue_class[0] == ENDPOINT or
+              tissue_class[0] == INVALIDPOINT):
             i += 1
             break
-        elif tissue_class == OUTSIDEIMAGE:
+        elif tissue_class[0] == OUTSIDEIMAGE:
             break
     else:
         # maximum length of streamline has been reached, return everything
-        i = streamline.shape[0]
-    return i, tissue_class
+        i = length
+    return i
+
+
+cdef inline int _keep(TissueClass tissue_class, int return_all) nogil:
+    return (return_all or tissue_class == ENDPOINT or
+            tissue_class == OUTSIDEIMAGE)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def local_tracker_batch(DirectionGetter dg, TissueClassifier tc, seeds,
+                        voxel_size, double stepsize, int fixedstep,
+                        int maxlen=500, max_cross=None, bint return_all=True,
+                        chunk_size=1024, num_threads=None):
+    """Tracks all the seeds in both directions, in parallel
+
+    The initial directions of all seeds are found first, then the
+    streamlines are tracked without the GIL, ``chunk_size`` streamlines at a
+    time, by the ``direction_getter.get_direction_c`` and
+    ``tissue_classifier.check_point_c`` methods. Direction getters and tissue
+    classifiers implemented in Python acquire the GIL at each step.
+
+    Parameters
+    ----------
+    dg : DirectionGetter
+        Used to choosing tracking directions.
+    tc : TissueClassifier
+        Used to check tissue type along path.
+    seeds : array (N, 3)
+        The seeds, in voxel coordinates.
+    voxel_size : array, float, 1d, (3,)
+        Size of voxels in the data set.
+    stepsize : float
+        Size of tracking steps in mm if ``fixed_step``.
+    fixedstep : bool
+        If true, a fixed stepsize is used, otherwise a variable step size is
+        used.
+    maxlen : int, optional
+        Maximum number of steps to track from seed in each direction.
+    max_cross : int or None, optional
+        The maximum number of direction to track from each seed in crossing
+        voxels. By default all initial directions are tracked.
+    return_all : bool, optional
+        If true, return all generated streamlines, otherwise only
+        streamlines reaching end points or exiting the image.
+    chunk_size : int, optional
+        Number of streamlines tracked at a time, the scratch memory is
+        ``48 * chunk_size * (maxlen + 1)`` bytes.
+    num_threads : int, optional
+        Number of threads. If None (default), the value of the
+        OMP_NUM_THREADS environment variable, or else all cores, are used.
+        Random directions are only reproducible with one thread, unless the
+        direction getter draws them from a stream of its own per streamline.
+
+    Returns
+    -------
+    points : array (P, 3)
+        The points of all streamlines, in voxel coordinates.
+    offsets : array (K + 1,)
+        Streamline ``k`` is ``points[offsets[k]:offsets[k + 1]]``. The
+        streamlines are in the order of the seeds, and in the order of the
+        initial directions for each seed.
+    """
+    cdef:
+        np.npy_intp n_seeds, n_items, start, end, i, k, m, n
+        double[:, ::1] seeds_v, item_dirs_v, out_v
+        double[::1] vs
+        np.npy_intp[::1] item_seeds_v, lengths_v, out_offsets_v
+        double[:, :, ::1] F, B
+        int[::1] nF, nB
+        TissueClass tissue_class
+
+    seeds = np.ascontiguousarray(seeds, dtype=float).reshape((-1, 3))
+    vs = np.ascontiguousarray(voxel_size, dtype=float)
+    if vs.shape[0] != 3:
+        raise ValueError("voxel_size should have shape (3,)")
+    if chunk_size < 1:
+        raise ValueError("chunk_size should be a positive integer, got %r"
+                         % (chunk_size,))
+    seeds_v = seeds
+    n_seeds = seeds.shape[0]
+
+    # The streamlines to track, a seed without initial direction is a
+    # streamline of one point
+    item_seeds = []
+    item_dirs = []
+    for i in range(n_seeds):
+        directions = dg.initial_direction(seeds[i])
+        if len(directions) == 0 and return_all:
+            item_seeds.append(i)
+            item_dirs.append(np.full((1, 3), np.nan))
+        directions = directions[:max_cross]
+        item_seeds.extend([i] * len(directions))
+        item_dirs.append(np.asarray(directions, dtype=float).reshape((-1, 3)))
+    n_items = len(item_seeds)
+    item_seeds_v = np.array(item_seeds, dtype=np.intp)
+    if n_items:
+        item_dirs_v = np.ascontiguousarray(np.concatenate(item_dirs))
+    else:
+        item_dirs_v = np.empty((0, 3))
+
+    chunk_size = min(chunk_size, max(n_items, 1))
+    F = np.empty((chunk_size, maxlen + 1, 3))
+    B = np.empty((chunk_size, maxlen + 1, 3))
+    nF = np.empty(chunk_size, dtype=np.intc)
+    nB = np.empty(chunk_size, dtype=np.intc)
+    lengths_v = np.empty(chunk_size, dtype=np.intp)
+    out_offsets_v = np.empty(chunk_size, dtype=np.intp)
+    chunks = []
+    chunk_lengths = []
+
+    set_num_threads(num_threads)
+    try:
+        for start in range(0, n_items, chunk_size):
+            end = min(start + chunk_size, n_items)
+            n = end - start
+            for k in prange(n, nogil=True, schedule='dynamic'):
+                lengths_v[k] = _track_item(
+                    dg, tc, &seeds_v[item_seeds_v[start + k], 0],
+                    &item_dirs_v[start + k, 0], &vs[0], &F[k, 0, 0],
+                    &B[k, 0, 0], maxlen + 1, stepsize, fixedstep,
+                    return_all, &nF[k], &nB[k])
+
+            # Join the backward and forward parts of the kept streamlines
+            m = 0
+            for k in range(n):
+                out_offsets_v[k] = m
+                m += lengths_v[k]
+            out = np.empty((m, 3))
+            out_v = out
+            for k in prange(n, nogil=True, schedule='static'):
+                _join(&F[k, 0, 0], nF[k], &B[k, 0, 0], nB[k], lengths_v[k],
+                      &out_v[out_offsets_v[k], 0])
+            chunks.append(out)
+            chunk_lengths.append(np.asarray(lengths_v[:n]).copy())
+    finally:
+        if num_threads is not None:
+            restore_default_num_threads()
+
+    if chunks:
+        points = np.concatenate(chunks)
+        lengths = np.concatenate(chunk_lengths)
+        lengths = lengths[lengths > 0]
+    else:
+        points = np.empty((0, 3))
+        lengths = np.empty(0, dtype=np.intp)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.intp)
+    np.cumsum(lengths, out=offsets[1:])
+    return points, offsets
+
+
+cdef np.npy_intp _track_item(DirectionGetter dg, TissueClassifier tc,
+                             double *seed, double *direction,
+                             double *voxel_size, double *F, double *B,
+                             int length, double stepsize, int fixedstep,
+                             int return_all, int *nF,
+                             int *nB) nogil except -1:
+    """Tracks a seed forward and backward, returns the streamline length
+
+    The length is 0 if the streamline is not kept. A NaN direction marks a
+    seed without initial direction, which is a streamline of one point.
+    """
+    cdef:
+        int i
+        double back[3]
+        TissueClass tissue_class
+
+    if direction[0] != direction[0]:
+        for i in range(3):
+            F[i] = seed[i]
+        nF[0] = 1
+        nB[0] = 1
+        return 1
+    nF[0] = _local_tracker_c(dg, tc, seed, direction, voxel_size, F, length,
+                             stepsize, fixedstep, &tissue_class)
+    if not _keep(tissue_class, return_all):
+        return 0
+    for i in range(3):
+        back[i] = -direction[i]
+    nB[0] = _local_tracker_c(dg, tc, seed, back, voxel_size, B, length,
+                             stepsize, fixedstep, &tissue_class)
+    if not _keep(tissue_class, return_all):
+        return 0
+    return nB[0] - 1 + nF[0]
+
+
+cdef void _join(double *F, int nF, double *B, int nB, np.npy_intp length,
+                double *out) nogil:
+    """Writes the backward part of a streamline reversed, then the forward
+    part"""
+    cdef:
+        int i, j
+    if length == 0:
+        return
+    for i in range(nB - 1):
+        for j in range(3):
+            out[3 * i + j] = B[3 * (nB - 1 - i) + j]
+    for i in range(3 * nF):
+        out[3 * (nB - 1) + i] = F[i]
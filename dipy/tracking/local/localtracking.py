@@ -1,6 +1,10 @@
+import copy
+from itertools import islice
+from multiprocessing import cpu_count, Pool
+
 import numpy as np
 
-from .localtrack import local_tracker
+from .localtrack import local_tracker_batch
 from dipy.align import Bunch
 from dipy.tracking import utils
 
@@ -34,7 +38,8 @@ class LocalTracking(object):
 
     def __init__(self, direction_getter, tissue_classifier, seeds, affine,
                  step_size, max_cross=None, maxlen=500, fixedstep=True,
-                 return_all=True):
+                 return_all=True, random_seed=None, n_jobs=1,
+                 batch_size=1000):
         """Creates streamlines by using local fiber-tracking.
 
         Parameters
@@ -67,6 +72,17 @@ class LocalTracking(object):
         return_all : bool
             If true, return all generated streamlines, otherwise only
             streamlines reaching end points or exiting the image.
+        random_seed : int, optional
+            If given, numpy's random generator is seeded from ``random_seed``
+            and the index of the batch at the start of each batch of seeds,
+            so that probabilistic tracking is reproducible and does not
+            depend on ``n_jobs``.
+        n_jobs : int, optional
+            Number of worker processes tracking the batches of seeds. 1
+            (default) tracks in this process, None uses all the cpus. The
+            streamlines are returned in the order of the seeds.
+        batch_size : int, optional
+            Number of seeds tracked by a worker at a time.
         """
         self.direction_getter = direction_getter
         self.tissue_classifier = tissue_classifier
@@ -80,54 +96,99 @@ class LocalTracking(object):
         self.max_cross = max_cross
         self.maxlen = maxlen
         self.return_all = return_all
+        if n_jobs is None:
+            n_jobs = cpu_count()
+        elif n_jobs < 1:
+            raise ValueError("n_jobs should be a positive integer, got %r"
+                             % (n_jobs,))
+        if batch_size < 1:
+            raise ValueError("batch_size should be a positive integer, got %r"
+                             % (batch_size,))
+        self.random_seed = random_seed
+        self.n_jobs = n_jobs
+        self.batch_size = batch_size
 
     def __iter__(self):
         # Make tracks, move them to point space and return
         track = self._generate_streamlines()
         return utils.move_streamlines(track, self.affine)
 
+    def _batches(self):
+        """The seeds split in consecutive batches of ``batch_size`` seeds"""
+        seeds = iter(self.seeds)
+        index = 0
+        while True:
+            batch = list(islice(seeds, self.batch_size))
+            if not batch:
+                return
+            yield index, batch
+            index += 1
+
     def _generate_streamlines(self):
-        """A streamline generator"""
-        N = self.maxlen
-        dg = self.direction_getter
-        tc = self.tissue_classifier
-        ss = self.step_size
-        fixed = self.fixed
-        max_cross = self.max_cross
-        vs = self._voxel_size
+        """A streamline generator
+
+        The seeds are tracked batch by batch, in this process or by a pool of
+        ``n_jobs`` worker processes. In both cases numpy's random generator
+        is seeded at the start of each batch when ``random_seed`` is set, and
+        the streamlines are yielded in the order of the seeds.
+        """
+        if self.n_jobs == 1:
+            for index, batch in self._batches():
+                self._seed_batch(self.random_seed, index)
+                for streamline in self._track_seeds(batch):
+                    yield streamline
+            return
+
+        random_seed = self.random_seed
+        if random_seed is None:
+            # Forked workers share the state of the random generator, give
+            # each batch its own stream
+            random_seed = np.random.randint(2 ** 31)
+        # The seeds are sent batch by batch, not with the tracker
+        tracker = copy.copy(self)
+        tracker.seeds = None
+        pool = Pool(self.n_jobs, initializer=_init_tracking_worker,
+                    initargs=(tracker, random_seed))
+        try:
+            for streamlines in pool.imap(_track_batch, self._batches()):
+                for streamline in streamlines:
+                    yield streamline
+        finally:
+            pool.close()
+            pool.join()
+
+    @staticmethod
+    def _seed_batch(random_seed, index):
+        if random_seed is not None:
+            np.random.seed((random_seed, index))
 
+    def _track_seeds(self, seeds):
+        """Tracks from ``seeds``, in point space, to voxel coordinates"""
+        seeds = np.asarray(seeds, dtype=float).reshape((-1, 3))
         # Get inverse transform (lin/offset) for seeds
         inv_A = np.linalg.inv(self.affine)
-        lin = inv_A[:3, :3]
-        offset = inv_A[:3, 3]
-
-        F = np.empty((N + 1, 3), dtype=float)
-        B = F.copy()
-        for s in self.seeds:
-            s = np.dot(lin, s) + offset
-            directions = dg.initial_direction(s)
-            if directions.size == 0 and self.return_all:
-                # only the seed position
-                yield [s]
-            directions = directions[:max_cross]
-            for first_step in directions:
-                stepsF, tissue_class = local_tracker(dg, tc, s, first_step,
-                                                     vs, F, ss, fixed)
-                if not (self.return_all or
-                        tissue_class == TissueTypes.ENDPOINT or
-                        tissue_class == TissueTypes.OUTSIDEIMAGE):
-                    continue
-                first_step = -first_step
-                stepsB, tissue_class = local_tracker(dg, tc, s, first_step,
-                                                     vs, B, ss, fixed)
-                if not (self.return_all or
-                        tissue_class == TissueTypes.ENDPOINT or
-                        tissue_class == TissueTypes.OUTSIDEIMAGE):
-                    continue
-
-                if stepsB == 1:
-                    streamline = F[:stepsF].copy()
-                else:
-                    parts = (B[stepsB-1:0:-1], F[:stepsF])
-                    streamline = np.concatenate(parts, axis=0)
-                yield streamline
+        seeds = np.dot(seeds, inv_A[:3, :3].T) + inv_A[:3, 3]
+
+        points, offsets = local_tracker_batch(
+            self.direction_getter, self.tissue_classifier, seeds,
+            self._voxel_size, self.step_size, self.fixed, self.maxlen,
+            self.max_cross, self.return_all, num_threads=1)
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield points[start:end]
+
+
+# State of the worker processes of ``LocalTracking``, set once per worker by
+# ``_init_tracking_worker`` so that the tracker is not sent with every batch.
+_worker_state = {}
+
+
+def _init_tracking_worker(tracker, random_seed):
+    _worker_state['tracker'] = tracker
+    _worker_state['random_seed'] = random_seed
+
+
+def _track_batch(batch):
+    index, seeds = batch
+    tracker = _worker_state['tracker']
+    tracker._seed_batch(_worker_state['random_seed'], index)
+    return list(tracker._track_seeds(seeds))
@@ -9,9 +9,10 @@ from dipy.data import get_data
 from dipy.tracking.local import (LocalTracking, ThresholdTissueClassifier,
                                  DirectionGetter, TissueClassifier,
                                  BinaryTissueClassifier)
-from dipy.direction import (ProbabilisticDirectionGetter,
+from dipy.direction import (PeaksAndMetrics, ProbabilisticDirectionGetter,
                             DeterministicMaximumDirectionGetter)
 from dipy.tracking.local.interpolation import trilinear_interpolate4d
+from dipy.tracking.local.localtrack import local_tracker, local_tracker_batch
 from dipy.tracking.local.localtracking import TissueTypes
 
 
@@ -452,5 +453,118 @@ def test_affine_transformations():
         npt.assert_(np.allclose(streamlines_inv[1], expected[1], atol=0.3))
 
 
+def test_local_tracker_batch():
+    """The batch tracker returns the streamlines of local_tracker, in the
+    order of the seeds, for any number of threads.
+    """
+    sphere = HemiSphere.from_sphere(unit_octahedron)
+    rng = np.random.RandomState(0)
+    shape = (8, 8, 8)
+    pam = PeaksAndMetrics()
+    pam.sphere = sphere
+    pam.peak_indices = rng.randint(0, 3, shape + (2,))
+    pam.peak_values = rng.uniform(.2, 1, shape + (2,))
+    # Voxels without peaks
+    pam.peak_indices[0, 0] = -1
+    pam.peak_values[0, 0] = 0
+    pam.peak_indices[..., 1] = np.where(rng.rand(*shape) > .5, -1,
+                                        pam.peak_indices[..., 1])
+    mask = np.ones(shape)
+    mask[0] = 0
+    mask[-1] = .3
+    tc = ThresholdTissueClassifier(mask, .5)
+    seeds = rng.uniform(0, 7, (40, 3))
+    seeds[:3, :2] = 0
+    vs = np.array([1., 1., 2.])
+
+    def allclose(x, y):
+        return x.shape == y.shape and np.allclose(x, y)
+
+    for return_all in [True, False]:
+        expected = []
+        F = np.empty((51, 3))
+        B = np.empty((51, 3))
+        for s in seeds:
+            directions = pam.initial_direction(s)
+            if len(directions) == 0 and return_all:
+                expected.append(s[None])
+            for d in directions[:1]:
+                nF, tissue_class = local_tracker(pam, tc, s, d, vs, F, .5, 1)
+                keep = (tissue_class == TissueTypes.ENDPOINT or
+                        tissue_class == TissueTypes.OUTSIDEIMAGE)
+                if not (return_all or keep):
+                    continue
+                nB, tissue_class = local_tracker(pam, tc, s, -d, vs, B, .5, 1)
+                keep = (tissue_class == TissueTypes.ENDPOINT or
+                        tissue_class == TissueTypes.OUTSIDEIMAGE)
+                if not (return_all or keep):
+                    continue
+                expected.append(np.concatenate((B[nB - 1:0:-1], F[:nF])))
+
+        for num_threads in [1, 2]:
+            points, offsets = local_tracker_batch(
+                pam, tc, seeds, vs, .5, True, maxlen=50, max_cross=1,
+                return_all=return_all, chunk_size=7, num_threads=num_threads)
+            npt.assert_equal(offsets[-1], len(points))
+            npt.assert_equal(len(offsets), len(expected) + 1)
+            for i, sl in enumerate(expected):
+                npt.assert_(allclose(points[offsets[i]:offsets[i + 1]], sl))
+
+    # Direction getters implemented in Python are called with the GIL
+    dg = DeterministicMaximumDirectionGetter.from_pmf(rng.rand(*shape + (3,)),
+                                                      90, sphere)
+    points1, offsets1 = local_tracker_batch(dg, tc, seeds, vs, .5, True,
+                                            num_threads=1)
+    points2, offsets2 = local_tracker_batch(dg, tc, seeds, vs, .5, True,
+                                            num_threads=2)
+    npt.assert_array_equal(offsets1, offsets2)
+    npt.assert_array_equal(points1, points2)
+
+    points, offsets = local_tracker_batch(dg, tc, np.empty((0, 3)), vs, .5,
+                                          True)
+    npt.assert_equal(points.shape, (0, 3))
+    npt.assert_array_equal(offsets, [0])
+
+
+def test_parallel_tracking():
+    """Streamlines tracked in batches by worker processes are those tracked
+    in this process, in the same order, when the random seed is set.
+    """
+    sphere = HemiSphere.from_sphere(unit_octahedron)
+    rng = np.random.RandomState(0)
+    pmf = rng.random_sample((8, 8, 8, 3))
+    mask = np.ones((8, 8, 8))
+    mask[0] = mask[-1] = 0
+    tc = ThresholdTissueClassifier(mask, .5)
+    dg = ProbabilisticDirectionGetter.from_pmf(pmf, 90, sphere,
+                                               pmf_threshold=0.1)
+    seeds = rng.uniform(1, 6, (50, 3))
+    affine = np.diag([2., 2., 2., 1.])
+
+    def track(**kwargs):
+        return list(LocalTracking(dg, tc, seeds, affine, 1., batch_size=7,
+                                  **kwargs))
+
+    serial = track(random_seed=42)
+    npt.assert_(len(serial) > 0)
+    for n_jobs in [1, 2]:
+        streamlines = track(random_seed=42, n_jobs=n_jobs)
+        npt.assert_equal(len(streamlines), len(serial))
+        for sl, expected in zip(streamlines, serial):
+            npt.assert_array_equal(sl, expected)
+
+    # Without random seed the batches still get different random streams
+    streamlines = track(n_jobs=2)
+    npt.assert_equal(len(streamlines), len(serial))
+    other = track(random_seed=43)
+    npt.assert_(any(len(a) != len(b) or not np.array_equal(a, b)
+                    for a, b in zip(other, serial)))
+
+    npt.assert_raises(ValueError, LocalTracking, dg, tc, seeds, affine, 1.,
+                      n_jobs=0)
+    npt.assert_raises(ValueError, LocalTracking, dg, tc, seeds, affine, 1.,
+                      batch_size=0)
+
+
 if __name__ == "__main__":
     npt.run_module_suite()
@@ -1,4 +1,6 @@
 
+import pickle
+
 import numpy as np
 import numpy.testing as npt
 import scipy.ndimage
@@ -150,5 +152,20 @@ def test_act_tissue_classifier():
         state = act_tc.check_point(pts)
         npt.assert_equal(state, TissueTypes.OUTSIDEIMAGE)
 
+
+def test_pickle_tissue_classifiers():
+    """Tissue classifiers are rebuilt from their maps when unpickled."""
+    mask = np.random.random((4, 4, 4))
+    classifiers = [BinaryTissueClassifier(mask > 0.4),
+                   ThresholdTissueClassifier(mask, 0.4),
+                   ActTissueClassifier(mask > 0.6, mask < 0.2)]
+    points = np.random.uniform(-1, 4, (50, 3))
+    for tc in classifiers:
+        tc2 = pickle.loads(pickle.dumps(tc))
+        npt.assert_equal(type(tc2), type(tc))
+        for pts in points:
+            npt.assert_equal(tc2.check_point(pts), tc.check_point(pts))
+
+
 if __name__ == '__main__':
     run_module_suite()
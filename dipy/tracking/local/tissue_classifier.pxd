@@ -13,6 +13,7 @@ cdef class TissueClassifier:
         double interp_out_double[1]
         double[::1] interp_out_view
     cpdef TissueClass check_point(self, double[::1] point) except PYERROR
+    cdef TissueClass check_point_c(self, double *point) nogil except PYERROR
 
 cdef class BinaryTissueClassifier(TissueClassifier):
     cdef:  
@@ -5,7 +5,7 @@ cdef extern from "dpy_math.h" nogil:
     int dpy_rint(double)
 
 from .interpolation cimport(trilinear_interpolate4d,
-                            _trilinear_interpolate_c_4d)
+                            _trilinear_interpolate_c_3d)
 
 import numpy as np
 
@@ -13,6 +13,16 @@ cdef class TissueClassifier:
     cpdef TissueClass check_point(self, double[::1] point) except PYERROR:
         pass
 
+    cdef TissueClass check_point_c(self, double *point) nogil except PYERROR:
+        """Tissue type at ``point``, callable without the GIL
+
+        Subclasses implemented in Cython override it so that tracking does
+        not need the GIL. By default the GIL is acquired to call
+        ``check_point``.
+        """
+        with gil:
+            return self.check_point(<double[:3]> point)
+
 
 cdef class BinaryTissueClassifier(TissueClassifier):
     """
@@ -24,18 +34,22 @@ cdef class BinaryTissueClassifier(TissueClassifier):
         self.interp_out_view = self.interp_out_double
         self.mask = (mask > 0).astype('uint8')
 
+    def __reduce__(self):
+        return type(self), (np.asarray(self.mask),)
+
+    cpdef TissueClass check_point(self, double[::1] point) except PYERROR:
+        if point.shape[0] != 3:
+            raise ValueError("Point has wrong shape")
+        return self.check_point_c(&point[0])
+
     @cython.boundscheck(False)
     @cython.wraparound(False)
     @cython.initializedcheck(False)
-    cpdef TissueClass check_point(self, double[::1] point) except PYERROR:
+    cdef TissueClass check_point_c(self, double *point) nogil except PYERROR:
         cdef:
             unsigned char result
-            int err
             int voxel[3]
 
-        if point.shape[0] != 3:
-            raise ValueError("Point has wrong shape")
-
         voxel[0] = int(dpy_rint(point[0]))
         voxel[1] = int(dpy_rint(point[1]))
         voxel[2] = int(dpy_rint(point[2]))
@@ -67,26 +81,21 @@ cdef class ThresholdTissueClassifier(TissueClassifier):
         self.metric_map = np.asarray(metric_map, 'float64')
         self.threshold = threshold
 
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
-    @cython.initializedcheck(False)
+    def __reduce__(self):
+        return type(self), (np.asarray(self.metric_map), self.threshold)
+
     cpdef TissueClass check_point(self, double[::1] point) except PYERROR:
+        if point.shape[0] != 3:
+            raise ValueError("Point has wrong shape")
+        return self.check_point_c(&point[0])
+
+    @cython.initializedcheck(False)
+    cdef TissueClass check_point_c(self, double *point) nogil except PYERROR:
         cdef:
             double result
-            int err
 
-        err = _trilinear_interpolate_c_4d(self.metric_map[..., None], point,
-                                          self.interp_out_view)
-        if err == -1:
+        if _trilinear_interpolate_c_3d(self.metric_map, point, &result):
             return OUTSIDEIMAGE
-        elif err == -2:
-            raise ValueError("Point has wrong shape")
-        elif err != 0:
-            # This should never happen
-            raise RuntimeError(
-                "Unexpected interpolation error (code:%i)" % err)
-
-        result = self.interp_out_view[0]
 
         if result > self.threshold:
             return TRACKPOINT
@@ -120,34 +129,25 @@ cdef class ActTissueClassifier(TissueClassifier):
         self.include_map = np.asarray(include_map, 'float64')
         self.exclude_map = np.asarray(exclude_map, 'float64')
 
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
-    @cython.initializedcheck(False)
+    def __reduce__(self):
+        return type(self), (np.asarray(self.include_map),
+                            np.asarray(self.exclude_map))
+
     cpdef TissueClass check_point(self, double[::1] point) except PYERROR:
+        if point.shape[0] != 3:
+            raise ValueError("Point has wrong shape")
+        return self.check_point_c(&point[0])
+
+    @cython.initializedcheck(False)
+    cdef TissueClass check_point_c(self, double *point) nogil except PYERROR:
         cdef:
             double include_result, exclude_result
-            int include_err, exclude_err
-
-        include_err = _trilinear_interpolate_c_4d(self.include_map[..., None],
-                                                  point, self.interp_out_view)
-        include_result = self.interp_out_view[0]
 
-        exclude_err = _trilinear_interpolate_c_4d(self.exclude_map[..., None],
-                                                  point, self.interp_out_view)
-        exclude_result = self.interp_out_view[0]
-
-        if include_err == -1 or exclude_err == -1:
+        if (_trilinear_interpolate_c_3d(self.include_map, point,
+                                        &include_result) or
+                _trilinear_interpolate_c_3d(self.exclude_map, point,
+                                            &exclude_result)):
             return OUTSIDEIMAGE
-        elif include_err == -2 or exclude_err == -2:
-            raise ValueError("Point has wrong shape")
-        elif include_err != 0:
-            # This should never happen
-            raise RuntimeError("Unexpected interpolation error " +
-                               "(include_map - code:%i)" % include_err)
-        elif exclude_err != 0:
-            # This should never happen
-            raise RuntimeError("Unexpected interpolation error " +
-                               "(exclude_map - code:%i)" % exclude_err)
 
         if include_result > 0.5:
             return ENDPOINT
@@ -1,6 +1,8 @@
 from copy import deepcopy
 from warnings import warn
+import struct
 import types
+import zipfile
 
 from scipy.spatial.distance import cdist
 import numpy as np
@@ -9,6 +11,9 @@ from nibabel.affines import apply_affine
 from dipy.tracking.streamlinespeed import set_number_of_points
 from dipy.tracking.streamlinespeed import length
 from dipy.tracking.streamlinespeed import compress_streamlines
+from dipy.tracking import Streamlines
+from dipy.tracking._utils import (_streamlines_from_arrays,
+                                  _transform_array_sequence)
 import dipy.tracking.utils as ut
 from dipy.tracking.utils import streamline_near_roi
 from dipy.core.geometry import dist_to_corner
@@ -93,19 +98,71 @@ def transform_streamlines(streamlines, mat):
 
     Parameters
     ----------
-    streamlines : list
+    streamlines : list or Streamlines
         List of 2D ndarrays of shape[-1]==3
     mat : array, (4, 4)
         transformation matrix
 
     Returns
     -------
-    new_streamlines : list
-        List of the transformed 2D ndarrays of shape[-1]==3
+    new_streamlines : list or Streamlines
+        List of the transformed 2D ndarrays of shape[-1]==3. If
+        ``streamlines`` is a ``Streamlines`` object, all its points are
+        transformed at once into a new ``Streamlines`` object, floating point
+        points keep their dtype.
     """
+    if isinstance(streamlines, Streamlines):
+        return _transform_array_sequence(streamlines, mat)
     return [apply_affine(mat, s) for s in streamlines]
 
 
+def memmap_streamlines(filename, mode='r'):
+    """ Streamlines whose points are memory-mapped from a file
+
+    Only the offsets and lengths of the streamlines are read in memory, so
+    that tractograms larger than memory can be processed.
+
+    Parameters
+    ----------
+    filename : str
+        A file written by ``Streamlines.save``, or by ``np.savez`` with the
+        arrays ``data``, ``offsets`` and ``lengths``. The arrays should not
+        be compressed.
+    mode : {'r', 'r+', 'c'}, optional
+        How the points are opened, see ``np.memmap``. With 'r+', changes to
+        the points are written to the file.
+
+    Returns
+    -------
+    streamlines : Streamlines
+        The streamlines, backed by the file.
+    """
+    with zipfile.ZipFile(filename) as archive:
+        info = archive.getinfo('data.npy')
+        if info.compress_type != zipfile.ZIP_STORED:
+            msg = "The points in %s are compressed, they can't be mapped"
+            raise ValueError(msg % filename)
+        offsets = np.load(archive.open('offsets.npy'))
+        lengths = np.load(archive.open('lengths.npy'))
+
+    with open(filename, 'rb') as f:
+        # The array starts after the local header of its zip entry
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', f.read(4))
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        shape, fortran_order, dtype = header
+        start = f.tell()
+
+    data = np.memmap(filename, dtype=dtype, mode=mode, offset=start,
+                     shape=shape, order='F' if fortran_order else 'C')
+    return _streamlines_from_arrays(data, offsets, lengths)
+
+
 def select_random_set_of_streamlines(streamlines, select):
     """ Select a random set of streamlines
 
@@ -9,12 +9,45 @@ from libc.stdlib cimport malloc, free
 cimport numpy as np
 
 from dipy.tracking import Streamlines
+from dipy.tracking._utils import _streamlines_from_arrays
 
 
 cdef extern from "dpy_math.h" nogil:
     bint dpy_isnan(double x)
 
 
+def _flat_arrays(streamlines):
+    """ The points, offsets and lengths of a :class:`Streamlines` object
+
+    The points are converted to float32 or float64 like the streamlines of
+    a list. They are not copied if they already are C-contiguous floats, even
+    if they are read-only, as when they are memory-mapped.
+    """
+    data = streamlines._data
+    dtype = data.dtype
+    if dtype != np.float32 and dtype != np.float64:
+        is_integer = dtype == np.int64 or dtype == np.uint64
+        dtype = np.float64 if is_integer else np.float32
+    data = np.ascontiguousarray(data, dtype=dtype)
+    offsets = np.array(streamlines._offsets, dtype=np.intp)
+    lengths = np.array(streamlines._lengths, dtype=np.intp)
+    return data, offsets, lengths
+
+
+cdef float2d _float2d(np.ndarray data):
+    """ Memoryview of a C-contiguous float32 (N, D) array, also read-only """
+    if data.shape[0] == 0:
+        return np.empty((0, data.shape[1]), dtype=np.float32)
+    return <float[:data.shape[0], :data.shape[1]]> <float*> np.PyArray_DATA(data)
+
+
+cdef double2d _double2d(np.ndarray data):
+    """ Memoryview of a C-contiguous float64 (N, D) array, also read-only """
+    if data.shape[0] == 0:
+        return np.empty((0, data.shape[1]), dtype=np.float64)
+    return <double[:data.shape[0], :data.shape[1]]> <double*> np.PyArray_DATA(data)
+
+
 cdef double c_length(Streamline streamline) nogil:
     cdef:
         np.npy_intp i
@@ -100,16 +133,15 @@ def length(streamlines):
             return 0.0
 
         arclengths = np.zeros(len(streamlines), dtype=np.float64)
+        data, offsets, lengths = _flat_arrays(streamlines)
 
-        if streamlines.data.dtype == np.float32:
-            c_arclengths_from_arraysequence[float2d](streamlines.data,
-                                                     streamlines._offsets,
-                                                     streamlines._lengths,
+        if data.dtype == np.float32:
+            c_arclengths_from_arraysequence[float2d](_float2d(data),
+                                                     offsets, lengths,
                                                      arclengths)
         else:
-            c_arclengths_from_arraysequence[double2d](streamlines.data,
-                                                      streamlines._offsets,
-                                                      streamlines._lengths,
+            c_arclengths_from_arraysequence[double2d](_double2d(data),
+                                                      offsets, lengths,
                                                       arclengths)
 
         return arclengths
@@ -240,6 +272,20 @@ cdef void c_set_number_of_points(Streamline streamline, Streamline out) nogil:
     free(arclengths)
 
 
+cdef void c_set_number_of_points_from_arraysequence(Streamline points,
+                                                    np.npy_intp[:] offsets,
+                                                    np.npy_intp[:] lengths,
+                                                    Streamline out) nogil:
+    """ Resamples each streamline of ``points`` into a block of ``out`` """
+    cdef:
+        np.npy_intp i
+        np.npy_intp nb_points = out.shape[0] // offsets.shape[0]
+
+    for i in range(offsets.shape[0]):
+        c_set_number_of_points(points[offsets[i]:offsets[i] + lengths[i]],
+                               out[i * nb_points:(i + 1) * nb_points])
+
+
 def set_number_of_points(streamlines, nb_points=3):
     ''' Change the number of points of streamlines
         (either by downsampling or upsampling)
@@ -250,7 +296,7 @@ def set_number_of_points(streamlines, nb_points=3):
 
     Parameters
     ----------
-    streamlines : one or a list of array-like shape (N,3)
+    streamlines : one or a list of array-like shape (N,3) or :class:`dipy.tracking.Streamlines`
        array representing x,y,z of N points in a streamline
     nb_points : int
        integer representing number of points wanted along the curve.
@@ -259,6 +305,8 @@ def set_number_of_points(streamlines, nb_points=3):
     -------
     modified_streamlines : one or a list of array-like shape (`nb_points`,3)
        array representing x,y,z of `nb_points` points that were interpolated.
+       A :class:`dipy.tracking.Streamlines` object, whose points are stored
+       in one array, if `streamlines` is one.
 
     Examples
     --------
@@ -282,6 +330,9 @@ def set_number_of_points(streamlines, nb_points=3):
     [10, 10]
 
     '''
+    if isinstance(streamlines, Streamlines):
+        return _set_number_of_points_arraysequence(streamlines, nb_points)
+
     only_one_streamlines = False
     if type(streamlines) is np.ndarray:
         only_one_streamlines = True
@@ -363,6 +414,34 @@ def set_number_of_points(streamlines, nb_points=3):
         return modified_streamlines
 
 
+def _set_number_of_points_arraysequence(streamlines, nb_points):
+    """ `set_number_of_points` of a :class:`Streamlines` object, the
+    streamlines are resampled from and into one array of points """
+    if len(streamlines) == 0:
+        return Streamlines()
+
+    if nb_points < 2:
+        raise ValueError("nb_points must be at least 2")
+
+    data, offsets, lengths = _flat_arrays(streamlines)
+    if lengths.min() < 2:
+        raise ValueError("All streamlines must have at least 2 points.")
+
+    cdef np.npy_intp nb_streamlines = len(offsets)
+    out = np.empty((nb_streamlines * nb_points, data.shape[1]),
+                   dtype=data.dtype)
+    if data.dtype == np.float32:
+        c_set_number_of_points_from_arraysequence[float2d](
+            _float2d(data), offsets, lengths, out)
+    else:
+        c_set_number_of_points_from_arraysequence[double2d](
+            _double2d(data), offsets, lengths, out)
+
+    new_offsets = np.arange(nb_streamlines, dtype=np.intp) * nb_points
+    new_lengths = np.full(nb_streamlines, nb_points, dtype=np.intp)
+    return _streamlines_from_arrays(out, new_offsets, new_lengths)
+
+
 cdef double c_norm_of_cross_product(double bx, double by, double bz,
                                     double cx, double cy, double cz) nogil:
     """ Computes the norm of the cross-product in 3D. """
@@ -466,6 +545,38 @@ cdef np.npy_intp c_compress_streamline(Streamline streamline, Streamline out,
     return nb_points
 
 
+cdef np.npy_intp c_compress_from_arraysequence(Streamline points,
+                                               np.npy_intp[:] offsets,
+                                               np.npy_intp[:] lengths,
+                                               Streamline out,
+                                               np.npy_intp[:] out_lengths,
+                                               double tol_error,
+                                               double max_segment_length) nogil:
+    """ Compresses each streamline of ``points``, one after the other in
+    ``out``, and returns the total number of points kept. ``out`` has as many
+    rows as the streamlines have points. """
+    cdef:
+        np.npy_intp i, j, d
+        np.npy_intp start, n
+        np.npy_intp nb_points = 0
+
+    for i in range(offsets.shape[0]):
+        start = offsets[i]
+        n = lengths[i]
+        if n <= 2:
+            for j in range(n):
+                for d in range(points.shape[1]):
+                    out[nb_points + j, d] = points[start + j, d]
+            out_lengths[i] = n
+        else:
+            out_lengths[i] = c_compress_streamline(
+                points[start:start + n], out[nb_points:nb_points + n],
+                tol_error, max_segment_length)
+        nb_points += out_lengths[i]
+
+    return nb_points
+
+
 def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10):
     """ Compress streamlines by linearization as in [Presseau15]_.
 
@@ -486,7 +597,7 @@ def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10):
 
     Parameters
     ----------
-    streamlines : one or a list of array-like of shape (N,3)
+    streamlines : one or a list of array-like of shape (N,3) or :class:`dipy.tracking.Streamlines`
         Array representing x,y,z of N points in a streamline.
     tol_error : float (optional)
         Tolerance error in mm (default: 0.01). A rule of thumb is to set it
@@ -499,7 +610,9 @@ def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10):
     Returns
     -------
     compressed_streamlines : one or a list of array-like
-        Results of the linearization process.
+        Results of the linearization process. A
+        :class:`dipy.tracking.Streamlines` object, whose points are stored in
+        one array, if `streamlines` is one.
 
     Examples
     --------
@@ -537,6 +650,10 @@ def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10):
     .. [Houde15] Houde J.-C. et al. How to Avoid Biased Streamlines-Based
                  Metrics for Streamlines with Variable Step Sizes, ISMRM, 2015.
     """
+    if isinstance(streamlines, Streamlines):
+        return _compress_arraysequence(streamlines, tol_error,
+                                       max_segment_length)
+
     only_one_streamlines = False
     if type(streamlines) is np.ndarray:
         only_one_streamlines = True
@@ -578,3 +695,28 @@ def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10):
         return compressed_streamlines[0]
     else:
         return compressed_streamlines
+
+
+def _compress_arraysequence(streamlines, tol_error, max_segment_length):
+    """ `compress_streamlines` of a :class:`Streamlines` object, the
+    streamlines are compressed from and into one array of points """
+    if len(streamlines) == 0:
+        return Streamlines()
+
+    data, offsets, lengths = _flat_arrays(streamlines)
+    out = np.empty((lengths.sum(), data.shape[1]), dtype=data.dtype)
+    out_lengths = np.empty(len(lengths), dtype=np.intp)
+    cdef np.npy_intp nb_points
+    if data.dtype == np.float32:
+        nb_points = c_compress_from_arraysequence[float2d](
+            _float2d(data), offsets, lengths, out, out_lengths, tol_error,
+            max_segment_length)
+    else:
+        nb_points = c_compress_from_arraysequence[double2d](
+            _double2d(data), offsets, lengths, out, out_lengths, tol_error,
+            max_segment_length)
+
+    out_offsets = np.zeros(len(lengths), dtype=np.intp)
+    np.cumsum(out_lengths[:len(lengths) - 1], out=out_offsets[1:])
+    return _streamlines_from_arrays(out[:nb_points].copy(), out_offsets,
+                                    out_lengths)
@@ -7,6 +7,7 @@ from numpy.linalg import norm
 import numpy.testing as npt
 from dipy.testing.memory import get_type_refcount
 from dipy.testing import assert_arrays_equal
+from nibabel.tmpdirs import InTemporaryDirectory
 
 from nose.tools import assert_true, assert_equal, assert_almost_equal
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
@@ -24,7 +25,8 @@ from dipy.tracking.streamline import (set_number_of_points,
                                       compress_streamlines,
                                       select_by_rois,
                                       orient_by_rois,
-                                      values_from_volume)
+                                      values_from_volume,
+                                      memmap_streamlines)
 
 
 streamline = np.array([[82.20181274,  91.36505890,  43.15737152],
@@ -516,6 +518,70 @@ def test_center_and_transform():
     assert_array_equal(streamlines3[0], B)
 
 
+def test_streamlines_functions():
+    # The functions give the same streamlines for lists and Streamlines,
+    # which are processed from and into one array of points
+    rng = np.random.RandomState(0)
+    streamlines = [np.cumsum(rng.randn(rng.randint(2, 30), 3), axis=0)
+                   for i in range(20)]
+    affine = np.array([[0, 2., 0, 1], [1, 0, 0, 2], [0, 0, 3, 3],
+                       [0, 0, 0, 1]])
+    for dtype in [np.float32, np.float64]:
+        data = [s.astype(dtype) for s in streamlines]
+        for idx in [slice(None), slice(None, None, -3), [7, 2, 2, 11]]:
+            arrseq = Streamlines(data)[idx]
+            expected = [data[i] for i in np.arange(20)[idx]]
+
+            new = set_number_of_points(arrseq, 7)
+            assert_true(isinstance(new, Streamlines))
+            assert_arrays_equal(new, set_number_of_points(expected, 7))
+            assert_equal(new._data.shape, (7 * len(expected), 3))
+
+            new = compress_streamlines(arrseq, tol_error=0.5)
+            assert_true(isinstance(new, Streamlines))
+            assert_arrays_equal(new, compress_streamlines(expected, 0.5))
+
+            new = transform_streamlines(arrseq, affine)
+            assert_true(isinstance(new, Streamlines))
+            assert_equal(new._data.dtype, dtype)
+            for s, e in zip(new, transform_streamlines(expected, affine)):
+                assert_array_almost_equal(s, e, decimal=4)
+
+    empty = Streamlines()
+    assert_equal(len(set_number_of_points(empty, 3)), 0)
+    assert_equal(len(compress_streamlines(empty)), 0)
+    assert_equal(len(transform_streamlines(empty, affine)), 0)
+    assert_raises(ValueError, set_number_of_points, Streamlines(data), 1)
+    assert_raises(ValueError, set_number_of_points,
+                  Streamlines(data + [data[0][:1]]), 3)
+
+
+def test_memmap_streamlines():
+    streamlines = [np.arange(3 * n, dtype=np.float32).reshape((n, 3))
+                   for n in [5, 1, 8, 3]]
+    with InTemporaryDirectory():
+        Streamlines(streamlines).save('streamlines.npz')
+        mapped = memmap_streamlines('streamlines.npz')
+        assert_true(isinstance(mapped._data, np.memmap))
+        assert_arrays_equal(mapped, streamlines)
+        # Read-only points are not copied by the functions
+        assert_array_almost_equal(length(mapped[::2]),
+                                  length(streamlines[::2]))
+        assert_arrays_equal(set_number_of_points(mapped[[0, 2]], 4),
+                            set_number_of_points(streamlines[::2], 4))
+        assert_arrays_equal(compress_streamlines(mapped),
+                            compress_streamlines(streamlines))
+
+        mapped = memmap_streamlines('streamlines.npz', mode='r+')
+        mapped[2][0] = -1
+        del mapped
+        assert_array_equal(memmap_streamlines('streamlines.npz')[2][0], -1)
+
+        np.savez_compressed('compressed.npz', data=streamlines[0],
+                            offsets=[0], lengths=[5])
+        assert_raises(ValueError, memmap_streamlines, 'compressed.npz')
+
+
 def test_select_random_streamlines():
     streamlines = [np.random.rand(10, 3),
                    np.random.rand(20, 3),
@@ -15,6 +15,7 @@ from dipy.tracking.utils import (affine_for_trackvis, connectivity_matrix,
                                  reduce_rois, path_length, flexi_tvis_affine,
                                  get_flexi_tvis_affine, _min_at)
 
+from dipy.tracking import Streamlines
 from dipy.tracking._utils import _to_voxel_coordinates
 
 import dipy.tracking.metrics as metrix
@@ -218,6 +219,15 @@ def test_move_streamlines():
     for (a, b) in zip(streamlinesA, streamlinesB):
         assert_array_equal(a, b)
 
+    # Streamlines are moved at once, in their dtype
+    for dtype in [np.float32, np.float64]:
+        arrseq = Streamlines([s.astype(dtype) for s in streamlines])[::-1]
+        moved = list(move_streamlines(arrseq, affine))
+        expected = move_streamlines(streamlines[::-1], affine)
+        for (a, b) in zip(moved, expected):
+            assert_equal(a.dtype, dtype)
+            assert_array_almost_equal(a, b, decimal=5)
+
 
 def test_target():
     streamlines = [np.array([[0., 0., 0.],
@@ -62,11 +62,12 @@ from ..utils.six.moves import xrange, map
 import numpy as np
 from numpy import (asarray, ceil, dot, empty, eye, sqrt)
 from dipy.io.bvectxt import ornt_mapping
-from dipy.tracking import metrics
+from dipy.tracking import metrics, Streamlines
 from .vox2track import _streamlines_in_mask
 
 # Import helper functions shared with vox2track
-from ._utils import (_mapping_to_voxel, _to_voxel_coordinates)
+from ._utils import (_mapping_to_voxel, _to_voxel_coordinates,
+                     _transform_array_sequence)
 from dipy.io.bvectxt import orientation_from_string
 import nibabel as nib
 
@@ -940,7 +941,7 @@ def move_streamlines(streamlines, output_space, input_space=None):
 
     Parameters
     ----------
-    streamlines : sequence
+    streamlines : sequence or Streamlines
         A set of streamlines to be transformed.
     output_space : array (4, 4)
         An affine matrix describing the target space to which the streamlines
@@ -954,7 +955,9 @@ def move_streamlines(streamlines, output_space, input_space=None):
     Returns
     -------
     streamlines : generator
-        A sequence of transformed streamlines.
+        A sequence of transformed streamlines. The points of a
+        ``Streamlines`` object are all transformed at once, and keep their
+        dtype if they are floats.
 
     """
     if input_space is None:
@@ -963,6 +966,15 @@ def move_streamlines(streamlines, output_space, input_space=None):
         inv = np.linalg.inv(input_space)
         affine = np.dot(output_space, inv)
 
+    if isinstance(streamlines, Streamlines):
+        moved = _transform_array_sequence(streamlines, affine)
+        yield
+        # End of initialization
+
+        for sl in moved:
+            yield sl
+        return
+
     lin_T = affine[:3, :3].T.copy()
     offset = affine[:3, 3].copy()
     yield